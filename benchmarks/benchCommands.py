@@ -0,0 +1,233 @@
+### * Description
+
+# Offline benchmark of the pyensembl commands (refresh, search, genomes,
+# download, fetch) against the local REST and FTP stand-ins of mockServers.py.
+#
+# Each command runs in its own process, with HOME pointing to a scratch
+# directory, and is measured for wall time, peak RSS, requests per second and
+# MB/s served by the mock servers.
+#
+# Usage:
+#   python benchmarks/benchCommands.py --species 100 1000 10000
+#   python benchmarks/benchCommands.py --latency 0.05 --failures 0.02
+#   python benchmarks/benchCommands.py --save baseline.json
+#   python benchmarks/benchCommands.py --compare baseline.json
+#
+# Needs the pyftpdlib package for the FTP server.
+
+### * Setup
+
+### ** Import
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.join(BENCH_DIR, ".."))
+import pyensembl
+import mockServers
+
+### ** Parameters
+
+REPO_DIR = os.path.join(BENCH_DIR, "..")
+# Ratio above which a measure is reported as a regression by --compare
+REGRESSION_RATIO = 1.2
+
+### * Functions
+
+### ** writeTable(rows, fields, path)
+
+def writeTable(rows, fields, path) :
+    """Write a list of dicts as a tab-separated table with a header"""
+    with open(path, "w") as fo :
+        fo.write("\t".join(fields) + "\n")
+        for row in rows :
+            fo.write("\t".join(str(row.get(x)) for x in fields) + "\n")
+
+### ** runCommand(args, env, cwd, servers, stdout)
+
+def runCommand(args, env, cwd, servers, stdout = None) :
+    """Run one pyensembl command in a child process and measure it
+
+    Args:
+        args (list of str): Command line arguments (e.g. ["search", "coli"])
+        env (dict): Environment of the child process
+        cwd (str): Working directory of the child process
+        servers (list): Mock servers whose statistics are reported
+        stdout (str): File receiving the output of the command (discarded if
+          None)
+
+    Returns:
+        dict: Measures (wall time, peak RSS, requests, failures, bytes, exit
+          status)
+
+    """
+    for server in servers :
+        server.stats.reset()
+    cmd = [sys.executable, "-c", "import pyensemblScripts; pyensemblScripts.main()"] + args
+    with open(stdout or os.devnull, "w") as fo, open(os.devnull, "w") as fe :
+        start = time.perf_counter()
+        process = subprocess.Popen(cmd, env = env, stdout = fo, stderr = fe,
+                                   cwd = cwd)
+        (pid, status, rusage) = os.wait4(process.pid, 0)
+        wall = time.perf_counter() - start
+    requests = sum(x.stats.requests for x in servers)
+    nBytes = sum(x.stats.bytes for x in servers)
+    return {"command" : " ".join(args),
+            "status" : os.waitstatus_to_exitcode(status),
+            "wall" : wall,
+            "rss" : rusage.ru_maxrss / 1024.0, # ru_maxrss is in kB on Linux
+            "requests" : requests,
+            "failures" : sum(x.stats.failures for x in servers),
+            "requestsPerSec" : requests / wall,
+            "MBPerSec" : nBytes / 1e6 / wall}
+
+### ** benchCatalogue(n, args, scratch)
+
+def benchCatalogue(n, args, scratch) :
+    """Run all the benchmarked commands against a catalogue of `n` species
+
+    Returns:
+        list of dict: Measures of each command (see runCommand())
+
+    """
+    catalogue = mockServers.syntheticCatalogue(n)
+    home = os.path.join(scratch, "home-%i" % n)
+    os.makedirs(home)
+    ftpRoot = os.path.join(scratch, "ftp")
+    nDownload = min(n, args.download)
+    mockServers.buildFtpTree(ftpRoot, [x[1] for x in catalogue[:nDownload]],
+                             fileSize = args.file_size * 1024,
+                             formats = ["genbank", "dna", "pep", "gff3"])
+    rest = mockServers.startRestServer(catalogue, latency = args.latency,
+                                       failures = args.failures)
+    ftp = mockServers.startFtpServer(ftpRoot, latency = args.latency,
+                                     failures = args.failures)
+    env = dict(os.environ)
+    env.update({"HOME" : home,
+                "PYTHONPATH" : REPO_DIR,
+                "PYENSEMBL_REST_SERVER" : rest.url,
+                "PYENSEMBL_REST_RATE" : str(args.rest_rate),
+                "PYENSEMBL_FTP_SERVER" : ftp.host})
+    # Input tables
+    speciesTable = os.path.join(home, "species.tsv")
+    writeTable([x[0] for x in catalogue[:args.genomes]], pyensembl.SPECIES_FIELDS,
+               speciesTable)
+    writeTable([x[0] for x in catalogue[:nDownload]], pyensembl.SPECIES_FIELDS,
+               os.path.join(home, "fetch.tsv"))
+    genomesTable = os.path.join(home, "genomes.tsv")
+    writeTable([x[1] for x in catalogue[:nDownload]], pyensembl.GENOME_FIELDS,
+               genomesTable)
+    mockServers.writeTaxdump(os.path.join(home, "taxdump"), catalogue)
+    queries = os.path.join(home, "queries.txt")
+    with open(queries, "w") as fo :
+        for (species, genome) in catalogue[:args.queries] :
+            fo.write(" ".join(species["display_name"].split()[:3]) + "\n")
+    os.makedirs(os.path.join(home, "download"))
+    os.makedirs(os.path.join(home, "fetch"))
+    os.makedirs(os.path.join(home, "formats"))
+    # Paths are relative to `home` so that commands can be matched to a baseline
+    download = ["download", "-g", "genomes.tsv", "-d", "download", "-j", str(args.jobs)]
+    commands = [["refresh"],
+                ["search", "escherichia"],
+                ["search", "-q", "queries.txt"],
+                ["genomes", "-f", "species.tsv", "-j", str(args.jobs)],
+                ["genomes", "-t", "escherichia"],
+                ["taxonomy", "--build", "taxdump"],
+                ["genomes", "-t", "escherichia", "--local", "-j", str(args.jobs)],
+                download,
+                download,
+                ["download", "-g", "genomes.tsv", "-d", "formats", "-j", str(args.jobs),
+                 "-f", "genbank", "dna", "pep", "gff3"],
+                ["fetch", "-f", "fetch.tsv", "-d", "fetch", "-j", str(args.jobs)]]
+    results = []
+    try :
+        for command in commands :
+            result = runCommand(command, env, home, [rest, ftp])
+            result["species"] = n
+            results.append(result)
+    finally :
+        rest.shutdown()
+        rest.server_close()
+        ftp.close_all()
+    # Name the second download run
+    results[-3]["command"] += " (up to date)"
+    return results
+
+### ** printResults(results, baseline)
+
+def printResults(results, baseline = None) :
+    """Print a table of measures, with the ratio to a baseline if given"""
+    fmt = "%-8s %-56s %6s %9s %9s %9s %9s %8s"
+    print(fmt % ("species", "command", "status", "wall (s)", "RSS (MB)", "requests",
+                 "req/s", "MB/s"))
+    reference = dict()
+    for row in baseline or [] :
+        reference[(row["species"], row["command"])] = row
+    for row in results :
+        print(fmt % (row["species"], row["command"][:56], row["status"],
+                     "%.2f" % row["wall"], "%.1f" % row["rss"], row["requests"],
+                     "%.1f" % row["requestsPerSec"], "%.2f" % row["MBPerSec"]))
+        ref = reference.get((row["species"], row["command"]))
+        if ref is not None :
+            for key in ["wall", "rss"] :
+                ratio = row[key] / max(ref[key], 1e-9)
+                if ratio > REGRESSION_RATIO :
+                    print("    regression: %s is %.2fx the baseline (%.2f vs %.2f)" %
+                          (key, ratio, row[key], ref[key]))
+
+### * Main
+
+def main() :
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--species", metavar = "N", type = int, nargs = "+",
+                        default = [100, 1000, 10000],
+                        help = "Sizes of the synthetic catalogues (default: 100 1000 "
+                        "10000, up to 100000)")
+    parser.add_argument("--genomes", metavar = "N", type = int, default = 200,
+                        help = "Number of species given to \"genomes -f\" (default: 200)")
+    parser.add_argument("--queries", metavar = "N", type = int, default = 500,
+                        help = "Number of queries given to \"search -q\" (default: 500)")
+    parser.add_argument("--download", metavar = "N", type = int, default = 50,
+                        help = "Number of genomes downloaded (default: 50)")
+    parser.add_argument("--file-size", metavar = "KB", type = int, default = 256,
+                        help = "Size of each genome file (default: 256)")
+    parser.add_argument("-j", "--jobs", metavar = "N", type = int, default = 4,
+                        help = "Value of the -j option of the commands (default: 4)")
+    parser.add_argument("--rest-rate", metavar = "N", type = float, default = 1000,
+                        help = "Request rate allowed to the REST client (default: "
+                        "1000, Ensembl allows 15)")
+    parser.add_argument("--latency", metavar = "SECONDS", type = float, default = 0.0,
+                        help = "Delay added by the servers to each request")
+    parser.add_argument("--failures", metavar = "FRACTION", type = float, default = 0.0,
+                        help = "Fraction of requests failed by the servers")
+    parser.add_argument("--save", metavar = "FILE", type = str,
+                        help = "Save the measures as a JSON baseline")
+    parser.add_argument("--compare", metavar = "FILE", type = str,
+                        help = "Compare the measures to a saved baseline")
+    args = parser.parse_args()
+    scratch = tempfile.mkdtemp(prefix = "pyensembl-bench-")
+    try :
+        results = []
+        for n in args.species :
+            results += benchCatalogue(n, args, scratch)
+    finally :
+        shutil.rmtree(scratch)
+    baseline = None
+    if args.compare is not None :
+        with open(args.compare, "r") as fi :
+            baseline = json.load(fi)["results"]
+    printResults(results, baseline)
+    if args.save is not None :
+        with open(args.save, "w") as fo :
+            json.dump({"settings" : vars(args), "results" : results}, fo, indent = 2)
+
+if __name__ == "__main__" :
+    main()
@@ -0,0 +1,173 @@
+### * Description
+
+# Benchmark of the indexed FASTA files ("pyensembl download --bgzf" and
+# "pyensembl extract"): a synthetic genome is written as a plain gzip FASTA
+# file, as served by the FTP server, then
+#
+#   - copies of it are recompressed to BGZF and indexed with one process and
+#     with several ones
+#   - random regions are read from the original file by decompressing it up to
+#     the record of the region (what reading a region of a downloaded file
+#     required before) and from the indexed file by seeking to the region
+#
+# The regions read both ways are compared, the benchmark exits with an error
+# if they differ.
+#
+# Usage:
+#   python benchmarks/benchExtract.py
+#   python benchmarks/benchExtract.py --bases 200 --records 50 --files 8 --jobs 1 4 8
+
+### * Setup
+
+### ** Import
+
+import os
+import sys
+import gzip
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import statistics
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, ".."))
+import pyensemblBgzf
+
+### * Functions
+
+### ** writeGenome(path, bases, records, seed)
+
+def writeGenome(path, bases, records, seed = 1) :
+    """Write a gzip FASTA file with random sequences of random lengths
+
+    Returns:
+        dict: Mapping (record name, length)
+
+    """
+    rng = random.Random(seed)
+    weights = [rng.random() + 0.1 for i in range(records)]
+    lengths = [max(1, int(bases * w / sum(weights))) for w in weights]
+    table = bytes(b"ACGT"[i % 4] for i in range(256))
+    o = dict()
+    with gzip.open(path, "wb", compresslevel = 6) as fo :
+        for (i, length) in enumerate(lengths) :
+            name = "record_%i" % (i + 1)
+            o[name] = length
+            fo.write((">%s synthetic sequence\n" % name).encode("ascii"))
+            seq = rng.randbytes(length).translate(table)
+            fo.write(b"\n".join(seq[j:j + 60] for j in range(0, length, 60)) + b"\n")
+    return o
+
+### ** fullDecompression(path, name, start, end)
+
+def fullDecompression(path, name, start, end) :
+    """Region of a record read by decompressing the file up to the end of the
+    record"""
+    seq = []
+    inRecord = False
+    with gzip.open(path, "rt") as fi :
+        for line in fi :
+            if line.startswith(">") :
+                if inRecord :
+                    break
+                inRecord = line[1:].split()[0] == name
+            elif inRecord :
+                seq.append(line.rstrip("\n"))
+    return "".join(seq)[start - 1:end]
+
+### ** benchRecompression(path, files, jobs, scratch)
+
+def benchRecompression(path, files, jobs, scratch) :
+    """Recompress and index copies of the genome file
+
+    Returns:
+        float: Seconds
+
+    """
+    folder = os.path.join(scratch, "recompress-%i" % jobs)
+    os.makedirs(folder)
+    paths = []
+    for i in range(files) :
+        paths.append(os.path.join(folder, "genome_%i.fa.gz" % i))
+        shutil.copy(path, paths[-1])
+    with open(os.devnull, "w") as devnull :
+        start = time.perf_counter()
+        failures = pyensemblBgzf.indexFiles(paths, jobs = jobs, stderr = devnull)
+        elapsed = time.perf_counter() - start
+    if len(failures) > 0 :
+        raise failures[0][1]
+    shutil.rmtree(folder)
+    return elapsed
+
+### * Main
+
+def main() :
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bases", metavar = "MB", type = float, default = 20,
+                        help = "Size of the genome, in millions of bases (default: 20)")
+    parser.add_argument("--records", metavar = "N", type = int, default = 20,
+                        help = "Number of records of the genome (default: 20)")
+    parser.add_argument("--regions", metavar = "N", type = int, default = 1000,
+                        help = "Number of regions read from the indexed file "
+                        "(default: 1000)")
+    parser.add_argument("--full-regions", metavar = "N", type = int, default = 10,
+                        help = "Number of regions read by full decompression "
+                        "(default: 10)")
+    parser.add_argument("--region-length", metavar = "N", type = int, default = 1000,
+                        help = "Length of the regions (default: 1000)")
+    parser.add_argument("--files", metavar = "N", type = int, default = 4,
+                        help = "Number of genome files recompressed (default: 4)")
+    parser.add_argument("--jobs", metavar = "N", type = int, nargs = "+", default = [1, 4],
+                        help = "Numbers of recompression processes compared "
+                        "(default: 1 4)")
+    args = parser.parse_args()
+    scratch = tempfile.mkdtemp(prefix = "pyensembl-bench-")
+    ok = True
+    try :
+        path = os.path.join(scratch, "genome.fa.gz")
+        lengths = writeGenome(path, int(args.bases * 1e6), args.records)
+        print("Genome: %g Mbases in %i records, %.1f MB compressed" %
+              (args.bases, args.records, os.path.getsize(path) / 2**20))
+        # Recompression
+        print("%-30s %10s" % ("recompression of %i files" % args.files, "time (s)"))
+        for jobs in args.jobs :
+            print("%-30s %10.2f" % ("%i processes" % jobs,
+                                    benchRecompression(path, args.files, jobs, scratch)))
+        # Extraction
+        indexed = os.path.join(scratch, "indexed.fa.gz")
+        shutil.copy(path, indexed)
+        pyensemblBgzf.indexFile(indexed)
+        rng = random.Random(2)
+        names = sorted(lengths)
+        regions = []
+        for i in range(max(args.regions, args.full_regions)) :
+            name = rng.choice(names)
+            start = rng.randint(1, max(1, lengths[name] - args.region_length + 1))
+            regions.append((name, start, min(lengths[name], start + args.region_length - 1)))
+        fasta = pyensemblBgzf.IndexedFasta(indexed)
+        latencies = {"full decompression" : [], "indexed" : []}
+        for (i, region) in enumerate(regions) :
+            start = time.perf_counter()
+            seq = fasta.fetch(*region)
+            latencies["indexed"].append(time.perf_counter() - start)
+            if i < args.full_regions :
+                start = time.perf_counter()
+                expected = fullDecompression(path, *region)
+                latencies["full decompression"].append(time.perf_counter() - start)
+                ok = ok and seq == expected
+        fasta.close()
+        print("%-30s %10s %10s %8s" % ("extraction (%i bases)" % args.region_length,
+                                       "median (ms)", "max (ms)", "regions"))
+        for (method, values) in latencies.items() :
+            print("%-30s %10.3f %10.3f %8i" % (method, 1000 * statistics.median(values),
+                                               1000 * max(values), len(values)))
+        print("Identical regions: %s" % ok)
+    finally :
+        shutil.rmtree(scratch)
+    if not ok :
+        sys.exit(1)
+
+if __name__ == "__main__" :
+    main()
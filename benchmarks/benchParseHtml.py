@@ -0,0 +1,146 @@
+### * Description
+
+# Benchmark of the parsing of the Ensembl Bacteria FTP index page: streaming
+# parser (pyensembl.parseHtmlToAccNum) against the previous BeautifulSoup
+# implementation, on a saved page or on a synthetic one.
+#
+# Usage:
+#   python benchmarks/benchParseHtml.py index.html
+#   python benchmarks/benchParseHtml.py --synthetic 50000
+#
+# The BeautifulSoup implementation needs the bs4 package.
+
+### * Setup
+
+### ** Import
+
+import os
+import sys
+import io
+import time
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import pyensembl
+
+### * Functions
+
+### ** parseHtmlToAccNumBs4(htmlContent, previousData = None, stderr = None)
+
+def parseHtmlToAccNumBs4(htmlContent, previousData = None, stderr = None) :
+    """Previous implementation of pyensembl.parseHtmlToAccNum(), kept as the
+    reference for this benchmark
+    """
+    from bs4 import BeautifulSoup
+    if stderr is None :
+        stderr = sys.stderr
+    if previousData is None :
+        previousData = dict()
+    content = BeautifulSoup(htmlContent, "html.parser")
+    speciesRows = [x for x in content.find_all("tr") if len(list(x.children)) > 5]
+    spAccMapping = dict()
+    spAccMapping.update(previousData)
+    for r in speciesRows :
+        cells = r.find_all("td")
+        if len(cells) > 0 :
+            assert len(cells) == 9;
+            species = cells[0].get_text()
+            if "EMBL" in cells[4].get_text() :
+                href = cells[4].find("a").get("href")
+                accNum = href.split("/view/")[1].split("&display")[0]
+                assert not spAccMapping.get(species, False)
+                spAccMapping[species] = accNum
+            else :
+                if species == "" :
+                    species = "???"
+                try :
+                    msg = ("No EMBL entry for species " + species + " (DNA "
+                           "link: " + cells[1].find("a").get("href") + ")\n" )
+                except :
+                    msg = ("No EMBL entry for species " + species + " (row " +
+                           str(r) + ")\n" )
+                stderr.write(msg)
+    return spAccMapping
+
+### ** syntheticPage(n)
+
+def syntheticPage(n) :
+    """Build an index page with `n` species rows, laid out like the Ensembl
+    Bacteria FTP index page
+
+    Args:
+        n (int): Number of species
+
+    Returns:
+        str: Html content
+
+    """
+    out = ["<html><body><table>\n<tr>\n<th>Species</th> <th>DNA</th> <th>cDNA</th>"
+           " <th>Protein</th> <th>EMBL</th> <th>GenBank</th> <th>GFF3</th>"
+           " <th>GTF</th> <th>MySQL</th>\n</tr>\n"]
+    for i in range(n) :
+        species = "<i>Bacterium sp. %i</i> str. &amp; %i" % (i, i)
+        if i % 70 == 0 :
+            dna = "-<br>"
+        else :
+            dna = '<a href="ftp://ftp.ensemblgenomes.org/pub/bacteria/dna/sp%i">FASTA</a>' % i
+        if i % 50 == 0 :
+            embl = "-"
+        else :
+            embl = ('<a href="http://www.ebi.ac.uk/ena/data/view/ACC%06i&amp;display=html">'
+                    'EMBL</a>' % i)
+        cells = [species, dna, "FASTA", "FASTA", embl, "GenBank", "GFF3", "GTF", "MySQL"]
+        out.append("<tr>\n" + "\n".join("<td>%s</td>" % x for x in cells) + "\n</tr>\n")
+    out.append("</table></body></html>\n")
+    return "".join(out)
+
+### ** bench(function, content)
+
+def bench(function, content) :
+    """Run a parsing function and measure its time and peak memory
+
+    Returns:
+        tuple: (mapping, warnings, seconds, peak memory in MB)
+
+    """
+    stderr = io.StringIO()
+    start = time.perf_counter()
+    mapping = function(content, stderr = stderr)
+    elapsed = time.perf_counter() - start
+    # Memory is measured in a second run, tracemalloc slowing down the parsing
+    tracemalloc.start()
+    function(content, stderr = io.StringIO())
+    peak = tracemalloc.get_traced_memory()[1] / 1e6
+    tracemalloc.stop()
+    return (mapping, stderr.getvalue(), elapsed, peak)
+
+### * Main
+
+def main() :
+    parser = argparse.ArgumentParser()
+    parser.add_argument("page", metavar = "HTML", nargs = "?",
+                        help = "Saved index page")
+    parser.add_argument("--synthetic", metavar = "N", type = int, default = 20000,
+                        help = "Number of species of the synthetic page used when no "
+                        "page is given (default: 20000)")
+    args = parser.parse_args()
+    if args.page is not None :
+        with open(args.page, "r") as fi :
+            content = fi.read()
+    else :
+        content = syntheticPage(args.synthetic)
+    print("Page size: %.1f MB" % (len(content) / 1e6))
+    (new, newMsg, newTime, newMem) = bench(pyensembl.parseHtmlToAccNum, content)
+    print("streaming parser:     %.3f s, peak %.1f MB, %i species" %
+          (newTime, newMem, len(new)))
+    (old, oldMsg, oldTime, oldMem) = bench(parseHtmlToAccNumBs4, content)
+    print("BeautifulSoup parser: %.3f s, peak %.1f MB, %i species" %
+          (oldTime, oldMem, len(old)))
+    print("Identical mapping: %s" % (new == old))
+    print("Identical warnings: %s" % (newMsg == oldMsg))
+    if new != old :
+        sys.exit(1)
+
+if __name__ == "__main__" :
+    main()
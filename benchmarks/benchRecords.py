@@ -0,0 +1,127 @@
+### * Description
+
+# Benchmark of the loading of species and genomes tables: typed records read
+# by pyensemblRecords.readTable() against the previous dict-per-row loader,
+# on a saved table or on synthetic ones.
+#
+# Usage:
+#   python benchmarks/benchRecords.py --synthetic 50000
+#   python benchmarks/benchRecords.py --genomes serratia.genomes.results
+
+### * Setup
+
+### ** Import
+
+import os
+import sys
+import io
+import time
+import argparse
+import tracemalloc
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.join(BENCH_DIR, ".."))
+import pyensembl
+import pyensemblRecords
+import mockServers
+
+### * Functions
+
+### ** loadDicts(fi)
+
+def loadDicts(fi) :
+    """Previous loader of the species and genomes tables (one dict of strings
+    per row), kept as the reference for this benchmark
+    """
+    info = []
+    header = next(fi).strip().split("\t")
+    for line in fi :
+        if line.strip() != "" :
+            info.append(dict(zip(header, line.strip().split("\t"))))
+    return info
+
+### ** loadRecords(recordClass)
+
+def loadRecords(recordClass) :
+    def load(fi) :
+        return list(pyensemblRecords.readTable(fi, recordClass))
+    return load
+
+### ** bench(function, content)
+
+def bench(function, content) :
+    """Load a table and measure the time and the memory held by the rows
+
+    Returns:
+        tuple: (rows, seconds, memory held in MB, peak memory in MB)
+
+    """
+    start = time.perf_counter()
+    rows = function(io.StringIO(content))
+    elapsed = time.perf_counter() - start
+    del rows
+    # Memory is measured in a second run, tracemalloc slowing down the loading
+    fi = io.StringIO(content)
+    tracemalloc.start()
+    rows = function(fi)
+    (held, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return (rows, elapsed, held / 1e6, peak / 1e6)
+
+### ** compare(name, content, recordClass)
+
+def compare(name, content, recordClass) :
+    """Load a table with both loaders and check that they read the same values
+
+    Returns:
+        bool: True if the tables written back from the records are identical
+          to the input
+
+    """
+    print("%s table: %.1f MB" % (name, len(content) / 1e6))
+    (dicts, dictTime, dictMem, dictPeak) = bench(loadDicts, content)
+    print("  dict per row:  %.3f s, %.1f MB held, peak %.1f MB, %i rows" %
+          (dictTime, dictMem, dictPeak, len(dicts)))
+    (records, recTime, recMem, recPeak) = bench(loadRecords(recordClass), content)
+    print("  typed records: %.3f s, %.1f MB held, peak %.1f MB, %i rows" %
+          (recTime, recMem, recPeak, len(records)))
+    fo = io.StringIO()
+    pyensemblRecords.writeTable(records, fo, recordClass)
+    identical = (fo.getvalue() == content)
+    print("  Identical table written back: %s" % identical)
+    return identical
+
+### * Main
+
+def main() :
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--species", metavar = "TABLE",
+                        help = "Saved species table (e.g. from pyensembl search)")
+    parser.add_argument("--genomes", metavar = "TABLE",
+                        help = "Saved genomes table (e.g. from pyensembl genomes)")
+    parser.add_argument("--synthetic", metavar = "N", type = int, default = 50000,
+                        help = "Number of rows of the synthetic tables used when no "
+                        "table is given (default: 50000)")
+    args = parser.parse_args()
+    tables = []
+    if args.species is None and args.genomes is None :
+        catalogue = mockServers.syntheticCatalogue(args.synthetic)
+        tables.append(("species", pyensembl.dumpEnsemblInfoSpecies([x[0] for x in catalogue]),
+                       pyensemblRecords.SpeciesRecord))
+        tables.append(("genomes", pyensembl.dumpEnsemblInfoGenomes([x[1] for x in catalogue]),
+                       pyensemblRecords.GenomeRecord))
+        del catalogue
+    for (name, path, recordClass) in [("species", args.species, pyensemblRecords.SpeciesRecord),
+                                      ("genomes", args.genomes, pyensemblRecords.GenomeRecord)] :
+        if path is not None :
+            with open(path, "r") as fi :
+                tables.append((name, fi.read(), recordClass))
+    ok = True
+    for (name, content, recordClass) in tables :
+        ok = compare(name, content, recordClass) and ok
+    if not ok :
+        sys.exit(1)
+
+if __name__ == "__main__" :
+    main()
@@ -0,0 +1,136 @@
+### * Description
+
+# Benchmark of the segmented transfers of large files: one large genome file
+# downloaded from the mock FTP server (REST offsets) and from the mock HTTP
+# file server (Range requests), over one connection and split into byte
+# ranges. Each connection of the servers is limited to a given bandwidth, as
+# a single stream from a distant server would be.
+#
+# The downloaded files are compared to the served ones (the CHECKSUMS
+# verification, slower than the transfers here, is disabled), the benchmark
+# exits with an error if they differ.
+#
+# Usage:
+#   python benchmarks/benchSegments.py
+#   python benchmarks/benchSegments.py --size 256 --bandwidth 16 --segments 1 2 4 8
+
+### * Setup
+
+### ** Import
+
+import os
+import sys
+import time
+import shutil
+import filecmp
+import argparse
+import tempfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.join(BENCH_DIR, ".."))
+import pyensembl
+import pyensemblFtp
+import mockServers
+
+### * Functions
+
+### ** benchFtp(ftpRoot, genome, segments, args, scratch)
+
+def benchFtp(ftpRoot, genome, segments, args, scratch) :
+    """Download the files of one genome with "pyensembl download"
+
+    Returns:
+        tuple: (seconds, True if the files are identical to the served ones)
+
+    """
+    ftp = mockServers.startFtpServer(ftpRoot, bandwidth = args.bandwidth * 2**20,
+                                     failures = args.failures)
+    outDir = os.path.join(scratch, "ftp-%i" % segments)
+    os.makedirs(outDir)
+    try :
+        with open(os.devnull, "w") as devnull :
+            start = time.perf_counter()
+            failures = pyensemblFtp.downloadGenomes([genome], outDir, jobs = 1,
+                                                    maxConnections = max(segments, 1),
+                                                    host = ftp.host, root = pyensemblFtp.FTP_ROOT,
+                                                    verify = False, segments = segments,
+                                                    segmentThreshold = 0, stderr = devnull)
+            elapsed = time.perf_counter() - start
+    finally :
+        ftp.close_all()
+    ftpDir = os.path.join(ftpRoot, pyensemblFtp.genomeFtpDir(genome))
+    names = sorted(x for x in os.listdir(ftpDir) if pyensemblFtp.keepGenomeFile(x))
+    identical = (len(failures) == 0 and sorted(os.listdir(outDir)) == names and
+                 all(filecmp.cmp(os.path.join(ftpDir, x), os.path.join(outDir, x),
+                                 shallow = False) for x in names))
+    return (elapsed, identical)
+
+### ** benchHttp(path, segments, args, scratch)
+
+def benchHttp(path, segments, args, scratch) :
+    """Download one file with pyensembl.HttpDownloader
+
+    Returns:
+        tuple: (seconds, True if the file is identical to the served one)
+
+    """
+    server = mockServers.startFileServer(os.path.dirname(path),
+                                         bandwidth = args.bandwidth * 2**20)
+    outFile = os.path.join(scratch, "http-%i" % segments)
+    try :
+        downloader = pyensembl.HttpDownloader(maxJobs = 1, segments = segments,
+                                              segmentThreshold = 0)
+        start = time.perf_counter()
+        status = downloader.download(server.url + "/" + os.path.basename(path), outFile)
+        elapsed = time.perf_counter() - start
+    finally :
+        server.shutdown()
+        server.server_close()
+    return (elapsed, status == 200 and filecmp.cmp(path, outFile, shallow = False))
+
+### * Main
+
+def main() :
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", metavar = "MB", type = int, default = 64,
+                        help = "Size of the large file (default: 64)")
+    parser.add_argument("--bandwidth", metavar = "MB", type = float, default = 16,
+                        help = "Bandwidth of each connection to the servers, in MB/s "
+                        "(default: 16)")
+    parser.add_argument("--segments", metavar = "N", type = int, nargs = "+",
+                        default = [1, 2, 4, 8],
+                        help = "Numbers of byte ranges compared (default: 1 2 4 8)")
+    parser.add_argument("--failures", metavar = "FRACTION", type = float, default = 0.0,
+                        help = "Fraction of FTP transfers failed by the server, "
+                        "resumed by the retries (default: 0)")
+    args = parser.parse_args()
+    scratch = tempfile.mkdtemp(prefix = "pyensembl-bench-")
+    ok = True
+    try :
+        genome = mockServers.syntheticCatalogue(1)[0][1]
+        ftpRoot = os.path.join(scratch, "ftp")
+        mockServers.buildFtpTree(ftpRoot, [genome], fileSize = args.size * 2**20,
+                                 filesPerGenome = 1)
+        ftpDir = os.path.join(ftpRoot, pyensemblFtp.genomeFtpDir(genome))
+        path = os.path.join(ftpDir, sorted(x for x in os.listdir(ftpDir)
+                                           if pyensemblFtp.keepGenomeFile(x))[0])
+        print("File: %i MB, bandwidth per connection: %g MB/s" % (args.size, args.bandwidth))
+        print("%-10s %8s %10s %10s  %s" % ("protocol", "segments", "time (s)", "MB/s",
+                                           "identical"))
+        for segments in args.segments :
+            for (protocol, bench) in [("ftp", lambda : benchFtp(ftpRoot, genome, segments,
+                                                                 args, scratch)),
+                                      ("http", lambda : benchHttp(path, segments, args,
+                                                                  scratch))] :
+                (elapsed, identical) = bench()
+                print("%-10s %8i %10.2f %10.1f  %s" % (protocol, segments, elapsed,
+                                                     args.size / elapsed, identical))
+                ok = ok and identical
+    finally :
+        shutil.rmtree(scratch)
+    if not ok :
+        sys.exit(1)
+
+if __name__ == "__main__" :
+    main()
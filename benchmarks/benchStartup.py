@@ -0,0 +1,168 @@
+### * Description
+
+# Cold-start benchmark of the offline pyensembl commands (refresh -c, search,
+# help): wall time of each command, and modules imported with their import
+# time, measured with "python -X importtime".
+#
+# The offline commands must not import the modules only needed to access the
+# network (requests, ftplib, asyncio, multiprocessing, ...), and their import
+# time must stay under a budget. The benchmark exits with an error otherwise,
+# so that it can be used as a check.
+#
+# Usage:
+#   python benchmarks/benchStartup.py
+#   python benchmarks/benchStartup.py --budget 50 --repeat 20 --verbose
+
+### * Setup
+
+### ** Import
+
+import os
+import sys
+import gzip
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.join(BENCH_DIR, ".."))
+import pyensembl
+import pyensemblDb
+import mockServers
+
+### ** Parameters
+
+REPO_DIR = os.path.join(BENCH_DIR, "..")
+# Commands which do not access the network
+OFFLINE_COMMANDS = [["refresh", "-c"],
+                    ["search", "escherichia"],
+                    ["search", "-p", "Escherichia", "-r", "32"],
+                    ["search", "-h"],
+                    ["download", "-h"],
+                    ["extract", "-h"]]
+# Modules which offline commands must not import
+FORBIDDEN_MODULES = ["requests", "urllib3", "ftplib", "ssl", "asyncio",
+                     "multiprocessing", "concurrent.futures", "cProfile", "hashlib"]
+# Budget (in ms) for the time spent importing modules after the interpreter
+# start-up
+IMPORT_BUDGET = 80
+
+### * Functions
+
+### ** parseImportTime(lines)
+
+def parseImportTime(lines) :
+    """Parse the output of "python -X importtime"
+
+    Args:
+        lines (iterable of str): Lines of stderr
+
+    Returns:
+        tuple: (list of (module, cumulative time in ms) for the top-level
+          imports done after the interpreter start-up (site), set of all the
+          imported modules)
+
+    """
+    topLevel = []
+    modules = set()
+    started = False
+    for line in lines :
+        if not line.startswith("import time:") :
+            continue
+        fields = line[len("import time:"):].split("|")
+        if len(fields) != 3 or not fields[1].strip().isdigit() :
+            continue
+        name = fields[2].rstrip()
+        module = name.strip()
+        modules.add(module)
+        if name == " site" :
+            started = True
+        elif started and not name.startswith("  ") :
+            topLevel.append((module, int(fields[1]) / 1000.0))
+    return (topLevel, modules)
+
+### ** runCommand(args, env, cwd, importTime)
+
+def runCommand(args, env, cwd, importTime = False) :
+    """Run one pyensembl command in a child process
+
+    Returns:
+        tuple: (wall time in s, exit status, stderr lines)
+
+    """
+    cmd = [sys.executable]
+    if importTime :
+        cmd += ["-X", "importtime"]
+    cmd += ["-c", "import pyensemblScripts; pyensemblScripts.main()"] + args
+    with open(os.devnull, "w") as fo :
+        start = time.perf_counter()
+        process = subprocess.run(cmd, env = env, cwd = cwd, stdout = fo,
+                                 stderr = subprocess.PIPE, universal_newlines = True)
+        wall = time.perf_counter() - start
+    return (wall, process.returncode, process.stderr.splitlines())
+
+### ** makeHome(home, n)
+
+def makeHome(home, n) :
+    """Write a snapshot of a synthetic catalogue of `n` species and its index
+    in `home`, as "pyensembl refresh" would"""
+    catalogue = mockServers.syntheticCatalogue(n)
+    dbName = pyensemblDb.SNAPSHOT_PREFIX + pyensembl.fileTimestamp() + ".gz"
+    index = pyensemblDb.SpeciesIndex(os.path.join(home, pyensemblDb.INDEX_FILE))
+    with gzip.open(os.path.join(home, dbName), "wt") as fo :
+        index.build(pyensemblDb.writeSnapshot([x[0] for x in catalogue], fo), dbName)
+    index.close()
+
+### * Main
+
+def main() :
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--species", metavar = "N", type = int, default = 1000,
+                        help = "Size of the synthetic catalogue (default: 1000)")
+    parser.add_argument("--repeat", metavar = "N", type = int, default = 10,
+                        help = "Number of runs of each command (default: 10)")
+    parser.add_argument("--budget", metavar = "MS", type = float, default = IMPORT_BUDGET,
+                        help = "Maximum import time of the offline commands, in "
+                        "ms (default: %i)" % IMPORT_BUDGET)
+    parser.add_argument("--verbose", action = "store_true",
+                        help = "List the slowest imports of each command")
+    args = parser.parse_args()
+    scratch = tempfile.mkdtemp(prefix = "pyensembl-bench-")
+    ok = True
+    try :
+        home = os.path.join(scratch, "home")
+        os.makedirs(home)
+        makeHome(home, args.species)
+        env = dict(os.environ)
+        env.update({"HOME" : home, "PYTHONPATH" : REPO_DIR})
+        print("%-40s %8s %8s %9s  %s" % ("command", "wall", "median", "imports",
+                                         "forbidden modules"))
+        for command in OFFLINE_COMMANDS :
+            walls = sorted(runCommand(command, env, home)[0] for i in range(args.repeat))
+            (wall, status, lines) = runCommand(command, env, home, importTime = True)
+            (topLevel, modules) = parseImportTime(lines)
+            importMs = sum(x[1] for x in topLevel)
+            forbidden = [x for x in FORBIDDEN_MODULES if x in modules]
+            print("%-40s %6.1fms %6.1fms %7.1fms  %s" %
+                  (" ".join(command), walls[0] * 1000, walls[len(walls) // 2] * 1000,
+                   importMs, ", ".join(forbidden) or "-"))
+            if args.verbose :
+                for (module, ms) in sorted(topLevel, key = lambda x : -x[1])[:5] :
+                    print("    %-36s %7.1fms" % (module, ms))
+            if status != 0 :
+                print("  Exit status %i" % status)
+                ok = False
+            if forbidden or importMs > args.budget :
+                ok = False
+    finally :
+        shutil.rmtree(scratch)
+    if not ok :
+        print("Start-up budget exceeded (%.0f ms, or forbidden modules imported)" %
+              args.budget)
+        sys.exit(1)
+
+if __name__ == "__main__" :
+    main()
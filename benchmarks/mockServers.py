@@ -0,0 +1,510 @@
+### * Description
+
+# Local stand-ins for the Ensembl REST and FTP servers, serving synthetic
+# catalogues, used by benchCommands.py. They can also be run on their own:
+#
+#   python benchmarks/mockServers.py --species 10000 --rest-port 8000 \
+#       --ftp-port 2121 --latency 0.05 --failures 0.01
+#
+# then point pyensembl at them with:
+#
+#   export PYENSEMBL_REST_SERVER=http://127.0.0.1:8000
+#   export PYENSEMBL_FTP_SERVER=127.0.0.1:2121
+#
+# The FTP server needs the pyftpdlib package.
+
+### * Setup
+
+### ** Import
+
+import os
+import re
+import sys
+import time
+import json
+import random
+import logging
+import argparse
+import threading
+import http.server
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import pyensemblFtp
+
+### ** Parameters
+
+GENERA = ["Escherichia", "Serratia", "Salmonella", "Bacillus", "Streptomyces",
+          "Pseudomonas", "Chryseobacterium", "Klebsiella", "Mycobacterium",
+          "Staphylococcus"]
+# Number of genomes per bacteria_N_collection directory
+COLLECTION_SIZE = 100
+
+### * Functions
+
+### ** syntheticCatalogue(n, seed)
+
+def syntheticCatalogue(n, seed = 1) :
+    """Build a synthetic catalogue of bacteria species
+
+    Args:
+        n (int): Number of species
+        seed (int): Random seed
+
+    Returns:
+        list of tuple: (species dict, as in /info/species, genome dict, as in
+          /info/genomes/<name>)
+
+    """
+    rng = random.Random(seed)
+    o = []
+    for i in range(n) :
+        genus = GENERA[rng.randrange(len(GENERA))]
+        display = "%s sp. %i str. X_%i" % (genus, i, rng.randrange(10000))
+        name = display.lower().replace(" ", "_").replace(".", "")
+        release = 32
+        dbname = "bacteria_%i_collection_core_%i_85_1" % (i // COLLECTION_SIZE, release)
+        species = {"accession" : "GCA_%09i.1" % i,
+                   "aliases" : [display.lower(), "%s %i" % (genus.lower(), i)],
+                   "assembly" : "ASM%iv1" % i,
+                   "common_name" : None,
+                   "display_name" : display,
+                   "division" : "EnsemblBacteria",
+                   "groups" : ["core"],
+                   "name" : name,
+                   "release" : release,
+                   "taxon_id" : str(1000 + i)}
+        genome = {"species_id" : 1 + i % COLLECTION_SIZE,
+                  "division" : "EnsemblBacteria",
+                  "is_reference" : "0",
+                  "has_pan_compara" : "0",
+                  "strain" : "X_%i" % i,
+                  "base_count" : str(rng.randrange(1000000, 8000000)),
+                  "assembly_name" : species["assembly"],
+                  "assembly_id" : species["accession"],
+                  "assembly_level" : "chromosome",
+                  "serotype" : None,
+                  "genebuild" : "2016-01-ENA",
+                  "taxonomy_id" : species["taxon_id"],
+                  "has_variations" : "0",
+                  "has_other_alignments" : "0",
+                  "species" : name,
+                  "has_peptide_compara" : "0",
+                  "species_taxonomy_id" : str(1000 + i),
+                  "has_genome_alignments" : "0",
+                  "dbname" : dbname,
+                  "name" : display}
+        o.append((species, genome))
+    return o
+
+### ** mockFileNames(genome, fmt, filesPerGenome)
+
+def mockFileNames(genome, fmt, filesPerGenome = 2) :
+    """Names of the files of a genome directory of a given format, mimicking
+    those of the Ensembl FTP server (including files which no format selects,
+    e.g. the ab initio predictions)"""
+    prefix = genome["species"] + "." + genome["assembly_name"]
+    if fmt.tree in ("genbank", "embl") :
+        return (["%s.chr%i.dat.gz" % (genome["species"], j) for j in range(filesPerGenome)] +
+                ["%s.plasmid.dat.gz" % genome["species"]])
+    if fmt.tree == "gff3" :
+        return [prefix + ".32.gff3.gz", prefix + ".32.abinitio.gff3.gz"]
+    if fmt.subdir == "dna" :
+        return [prefix + ".dna%s.toplevel.fa.gz" % x for x in ["", "_rm", "_sm"]] + \
+            [prefix + ".dna.chromosome.Chromosome.fa.gz"]
+    if fmt.subdir == "pep" :
+        return [prefix + ".pep.all.fa.gz", prefix + ".pep.abinitio.fa.gz"]
+    if fmt.subdir == "cds" :
+        return [prefix + ".cds.all.fa.gz"]
+    return [prefix + ".ncrna.fa.gz"]
+
+### ** buildFtpTree(root, genomes, fileSize, filesPerGenome, seed, formats)
+
+def buildFtpTree(root, genomes, fileSize = 64 * 1024, filesPerGenome = 2, seed = 1,
+                 formats = ("genbank", )) :
+    """Write the directories of genomes in some formats, with their CHECKSUMS
+    files, under `root`
+
+    Each GenBank (or EMBL) directory gets `filesPerGenome` data files, a
+    plasmid file and a README, all ignored by "pyensembl download" except the
+    data files. The directories of the other formats get the files of
+    mockFileNames().
+
+    Args:
+        root (str): Root directory of the FTP server
+        genomes (list of dict): Genome dicts (from syntheticCatalogue())
+        fileSize (int): Size in bytes of each data file
+        filesPerGenome (int): Number of GenBank or EMBL data files per genome
+        seed (int): Random seed for the file contents
+        formats (list of str): Names of the formats (keys of
+          pyensemblFtp.FTP_FORMATS)
+
+    Returns:
+        int: Total size in bytes of the files retrieved by "pyensembl download"
+
+    """
+    rng = random.Random(seed)
+    total = 0
+    for genome in genomes :
+        for name in formats :
+            fmt = pyensemblFtp.FTP_FORMATS[name]
+            d = os.path.join(root, pyensemblFtp.genomeFtpDir(genome, fmt = fmt))
+            names = mockFileNames(genome, fmt, filesPerGenome)
+            if not os.path.isfile(os.path.join(d, "CHECKSUMS")) :
+                os.makedirs(d, exist_ok = True)
+                sums = []
+                for x in names :
+                    path = os.path.join(d, x)
+                    with open(path, "wb") as fo :
+                        fo.write(bytes(rng.getrandbits(8) for i in range(256)) *
+                                 (fileSize // 256))
+                    sums.append("%05i %5i %s\n" % (pyensemblFtp.bsdSum(path) + (x,)))
+                with open(os.path.join(d, "README"), "w") as fo :
+                    fo.write("Synthetic genome\n")
+                with open(os.path.join(d, "CHECKSUMS"), "w") as fo :
+                    fo.write("".join(sums))
+            total += sum(os.path.getsize(os.path.join(d, x)) for x in names
+                         if pyensemblFtp.keepGenomeFile(x, fmt))
+    return total
+
+### ** writeTaxdump(folder, catalogue)
+
+def writeTaxdump(folder, catalogue) :
+    """Write the nodes.dmp and names.dmp files of a taxonomy matching a
+    synthetic catalogue: the root, Bacteria, one node per genus of GENERA and
+    the taxon of each species beneath its genus
+
+    Returns:
+        int: Number of nodes
+
+    """
+    os.makedirs(folder, exist_ok = True)
+    nodes = [(1, 1, "no rank", "root"), (2, 1, "superkingdom", "Bacteria")]
+    for (i, genus) in enumerate(GENERA) :
+        nodes.append((100 + i, 2, "genus", genus))
+    for (species, genome) in catalogue :
+        genus = species["display_name"].split()[0]
+        nodes.append((int(species["taxon_id"]), 100 + GENERA.index(genus), "species",
+                      species["display_name"]))
+    with open(os.path.join(folder, "nodes.dmp"), "w") as fo :
+        for (taxid, parent, rank, name) in nodes :
+            fo.write("%i\t|\t%i\t|\t%s\t|\t\t|\n" % (taxid, parent, rank))
+    with open(os.path.join(folder, "names.dmp"), "w") as fo :
+        for (taxid, parent, rank, name) in nodes :
+            fo.write("%i\t|\t%s\t|\t\t|\tscientific name\t|\n" % (taxid, name))
+        fo.write("2\t|\teubacteria\t|\t\t|\tgenbank common name\t|\n")
+    return len(nodes)
+
+### ** startRestServer(catalogue, port, latency, failures)
+
+def startRestServer(catalogue, port = 0, latency = 0.0, failures = 0.0) :
+    """Start a mock REST server in a background thread
+
+    Args:
+        catalogue (list): Output of syntheticCatalogue()
+        port (int): Port to listen to (0 to pick a free one)
+        latency (float): Delay in seconds added to each response
+        failures (float): Fraction of requests answered with a 503 error
+
+    Returns:
+        MockRestServer: The running server (its `url` attribute gives the base
+          URL and its `stats` attribute the request counters)
+
+    """
+    server = MockRestServer(("127.0.0.1", port), catalogue, latency, failures)
+    thread = threading.Thread(target = server.serve_forever, daemon = True)
+    thread.start()
+    return server
+
+### ** startFtpServer(root, port, latency, failures)
+
+def startFtpServer(root, port = 0, latency = 0.0, failures = 0.0, bandwidth = None) :
+    """Start a mock anonymous FTP server in a background thread
+
+    Args:
+        root (str): Directory served
+        port (int): Port to listen to (0 to pick a free one)
+        latency (float): Delay in seconds added to each command
+        failures (float): Fraction of RETR commands answered with an error
+        bandwidth (int): If not None, maximum rate of each data connection, in
+          bytes per second
+
+    Returns:
+        pyftpdlib server: The running server (its `host` attribute gives
+          "127.0.0.1:port" and its `stats` attribute the request counters)
+
+    """
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler, ThrottledDTPHandler
+    from pyftpdlib.servers import ThreadedFTPServer
+    from pyftpdlib.ioloop import IOLoop
+    stats = Stats()
+    class Handler(FTPHandler) :
+        def pre_process_command(self, line, cmd, arg) :
+            stats.request()
+            if latency > 0 :
+                time.sleep(latency)
+            if cmd == "RETR" and failures > 0 and random.random() < failures :
+                stats.failure()
+                self.respond("451 Injected failure.")
+                return
+            FTPHandler.pre_process_command(self, line, cmd, arg)
+        def on_file_sent(self, path) :
+            stats.sent(os.path.getsize(path))
+    authorizer = DummyAuthorizer()
+    authorizer.add_anonymous(root)
+    Handler.authorizer = authorizer
+    if bandwidth is not None :
+        class DTPHandler(ThrottledDTPHandler) :
+            write_limit = bandwidth
+            def _throttle_bandwidth(self, n, limit) :
+                # Pace each data connection from its first byte (the parent
+                # class lets one second of data through before pacing)
+                now = time.time()
+                if self._timenext == 0 :
+                    self._timenext = now
+                self._datacount += n
+                delay = self._timenext + self._datacount / limit - now
+                if delay > 0 :
+                    def wake() :
+                        self.add_channel(events = self.ioloop.WRITE)
+                    self.del_channel()
+                    self._cancel_throttler()
+                    self._throttler = self.ioloop.call_later(delay, wake,
+                                                             _errback = self.handle_error)
+        Handler.dtp_handler = DTPHandler
+    # Each server gets its own IO loop, so that several can be started and
+    # closed in the same process
+    server = ThreadedFTPServer(("127.0.0.1", port), Handler, ioloop = IOLoop())
+    server.host = "127.0.0.1:%i" % server.address[1]
+    server.stats = stats
+    # Keep pyftpdlib from logging every command to stderr
+    logger = logging.getLogger("pyftpdlib")
+    if not logger.handlers :
+        logger.addHandler(logging.NullHandler())
+        logger.propagate = False
+    thread = threading.Thread(target = server.serve_forever,
+                              kwargs = {"handle_exit" : False}, daemon = True)
+    thread.start()
+    return server
+
+### ** startFileServer(root, port, bandwidth)
+
+def startFileServer(root, port = 0, bandwidth = None) :
+    """Start a mock HTTP server of the files of a directory, answering range
+    requests, in a background thread
+
+    Args:
+        root (str): Directory served
+        port (int): Port to listen to (0 to pick a free one)
+        bandwidth (int): If not None, maximum rate of each response, in bytes
+          per second
+
+    Returns:
+        MockFileServer: The running server (its `url` attribute gives its
+          base URL)
+
+    """
+    server = MockFileServer(("127.0.0.1", port), root, bandwidth)
+    thread = threading.Thread(target = server.serve_forever, daemon = True)
+    thread.start()
+    return server
+
+### * Classes
+
+### ** Stats
+
+class Stats(object) :
+    """Thread-safe counters of the requests served by a mock server"""
+
+    def __init__(self) :
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) :
+        with self._lock :
+            self.requests = 0
+            self.failures = 0
+            self.bytes = 0
+
+    def request(self) :
+        with self._lock :
+            self.requests += 1
+
+    def failure(self) :
+        with self._lock :
+            self.failures += 1
+
+    def sent(self, n) :
+        with self._lock :
+            self.bytes += n
+
+### ** MockRestServer
+
+class MockRestServer(http.server.ThreadingHTTPServer) :
+    """Threaded HTTP server answering the REST endpoints used by pyensembl
+    from a synthetic catalogue"""
+
+    daemon_threads = True
+
+    def __init__(self, address, catalogue, latency = 0.0, failures = 0.0) :
+        http.server.ThreadingHTTPServer.__init__(self, address, MockRestHandler)
+        self.latency = latency
+        self.failures = failures
+        self.stats = Stats()
+        self.url = "http://127.0.0.1:%i" % self.server_address[1]
+        self.species = json.dumps({"species" : [x[0] for x in catalogue]}).encode("utf-8")
+        self.genomes = dict((x[1]["species"], x[1]) for x in catalogue)
+        self.genera = dict()
+        for (species, genome) in catalogue :
+            genus = species["display_name"].split()[0].lower()
+            self.genera.setdefault(genus, []).append(genome)
+
+    def answer(self, path) :
+        """Body of the response to a request path, or None if not found"""
+        path = path.split("?")[0]
+        if path == "/info/species" :
+            return self.species
+        if path.startswith("/info/genomes/taxonomy/") :
+            taxon = path[len("/info/genomes/taxonomy/"):].lower()
+            return json.dumps(self.genera.get(taxon, [])).encode("utf-8")
+        if path.startswith("/info/genomes/") :
+            genome = self.genomes.get(path[len("/info/genomes/"):])
+            if genome is None :
+                return None
+            return json.dumps(genome).encode("utf-8")
+        return None
+
+### ** MockRestHandler
+
+class MockRestHandler(http.server.BaseHTTPRequestHandler) :
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args) :
+        pass
+
+    def do_GET(self) :
+        server = self.server
+        server.stats.request()
+        if server.latency > 0 :
+            time.sleep(server.latency)
+        if server.failures > 0 and random.random() < server.failures :
+            server.stats.failure()
+            self.send_response(503)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = server.answer(self.path)
+        if body is None :
+            body = b'{"error":"not found"}'
+            self.send_response(400)
+        else :
+            self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        server.stats.sent(len(body))
+
+### ** MockFileServer
+
+class MockFileServer(http.server.ThreadingHTTPServer) :
+    """Threaded HTTP server of the files of a directory, answering range
+    requests ("Range: bytes=start-end") with 206 responses"""
+
+    daemon_threads = True
+
+    def __init__(self, address, root, bandwidth = None) :
+        http.server.ThreadingHTTPServer.__init__(self, address, MockFileHandler)
+        self.root = root
+        self.bandwidth = bandwidth
+        self.stats = Stats()
+        self.url = "http://127.0.0.1:%i" % self.server_address[1]
+
+### ** MockFileHandler
+
+class MockFileHandler(http.server.BaseHTTPRequestHandler) :
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args) :
+        pass
+
+    def do_GET(self) :
+        server = self.server
+        server.stats.request()
+        path = os.path.join(server.root, self.path.split("?")[0].lstrip("/"))
+        if not os.path.isfile(path) :
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        size = os.path.getsize(path)
+        (start, end) = (0, size)
+        match = re.match(r"bytes=(\d+)-(\d*)$", self.headers.get("Range", ""))
+        if match :
+            start = int(match.group(1))
+            if match.group(2) :
+                end = min(size, int(match.group(2)) + 1)
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %i-%i/%i" % (start, end - 1, size))
+        else :
+            self.send_response(200)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(end - start))
+        self.end_headers()
+        block = 1 << 16
+        with open(path, "rb") as fi :
+            fi.seek(start)
+            position = start
+            try :
+                while position < end :
+                    chunk = fi.read(min(block, end - position))
+                    self.wfile.write(chunk)
+                    position += len(chunk)
+                    server.stats.sent(len(chunk))
+                    if server.bandwidth is not None :
+                        time.sleep(len(chunk) / server.bandwidth)
+            except (BrokenPipeError, ConnectionResetError) :
+                self.close_connection = True
+
+### * Main
+
+def main() :
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--species", metavar = "N", type = int, default = 1000,
+                        help = "Number of species in the catalogue (default: 1000)")
+    parser.add_argument("--ftp-genomes", metavar = "N", type = int, default = 50,
+                        help = "Number of genome directories on the FTP server "
+                        "(default: 50)")
+    parser.add_argument("--file-size", metavar = "KB", type = int, default = 64,
+                        help = "Size of each genome file (default: 64)")
+    parser.add_argument("--formats", metavar = "FORMAT", type = str, nargs = "+",
+                        default = list(pyensemblFtp.FTP_FORMATS.keys()),
+                        choices = list(pyensemblFtp.FTP_FORMATS.keys()),
+                        help = "Formats published on the FTP server (default: all)")
+    parser.add_argument("--ftp-root", metavar = "DIR", type = str,
+                        default = "pyensembl-mock-ftp",
+                        help = "Directory for the FTP tree (default: pyensembl-mock-ftp)")
+    parser.add_argument("--rest-port", metavar = "PORT", type = int, default = 8000)
+    parser.add_argument("--ftp-port", metavar = "PORT", type = int, default = 2121)
+    parser.add_argument("--latency", metavar = "SECONDS", type = float, default = 0.0,
+                        help = "Delay added to each request (default: 0)")
+    parser.add_argument("--failures", metavar = "FRACTION", type = float, default = 0.0,
+                        help = "Fraction of failed requests (default: 0)")
+    args = parser.parse_args()
+    catalogue = syntheticCatalogue(args.species)
+    buildFtpTree(args.ftp_root, [x[1] for x in catalogue[:args.ftp_genomes]],
+                 fileSize = args.file_size * 1024, formats = args.formats)
+    rest = startRestServer(catalogue, args.rest_port, args.latency, args.failures)
+    ftp = startFtpServer(args.ftp_root, args.ftp_port, args.latency, args.failures)
+    print("export PYENSEMBL_REST_SERVER=%s" % rest.url)
+    print("export PYENSEMBL_FTP_SERVER=%s" % ftp.host)
+    try :
+        while True :
+            time.sleep(3600)
+    except KeyboardInterrupt :
+        pass
+
+if __name__ == "__main__" :
+    main()
@@ -8,18 +8,123 @@
 
 import sys
 import os
-import subprocess
 import time
-from bs4 import BeautifulSoup
+import io
+import html.parser
+import importlib
 
 import datetime
-import requests, sys
 import json
+import threading
+import sqlite3
+import zlib
+import re
+import codecs
+import collections
+
+import pyensemblMetrics
+
+### *** Lazy imports
+
+# Modules which are slow to import and only needed by the commands accessing
+# the network are imported the first time one of their attributes is used, so
+# that offline commands such as "pyensembl search" start quickly
+
+class LazyModule(object) :
+    """Stand-in for a module, importing it when one of its attributes is first
+    used
+
+    The import goes through importlib.import_module(), so that threads using
+    the module at the same time wait for it to be completely loaded.
+    """
+
+    def __init__(self, name) :
+        """
+        Args:
+            name (str): Module name (e.g. "requests" or "concurrent.futures")
+
+        """
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr) :
+        if self._module is None :
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+    def __repr__(self) :
+        return "<lazy module %r>" % self._name
+
+requests = LazyModule("requests")
+futures = LazyModule("concurrent.futures")
 
 ### ** Parameters
 
 ENSEMBL_INDEX_URL = "http://bacteria.ensembl.org/info/website/ftp/index.html"
-ENSEMBL_REST_SERVER = "http://rest.ensemblgenomes.org"
+# The REST server and the request rate can be set from the environment (e.g.
+# to run against a local server, see benchmarks/)
+ENSEMBL_REST_SERVER = os.environ.get("PYENSEMBL_REST_SERVER",
+                                     "http://rest.ensemblgenomes.org")
+# Ensembl allows 15 requests per second and per client
+REST_RATE = float(os.environ.get("PYENSEMBL_REST_RATE", 15))
+REST_MAX_CONNECTIONS = 8
+REST_RETRIES = 5
+REST_TIMEOUT = 120
+REST_JOBS = 4
+REST_CACHE_FILE = os.path.join(os.path.expanduser("~"), ".pyensembl-rest-cache.sqlite")
+REST_CACHE_MAX_SIZE = 500 * 2**20
+# Time to live (in seconds) of cached responses, by endpoint prefix. The
+# species catalogue is always revalidated so that "pyensembl refresh" gets the
+# current list.
+REST_CACHE_TTL = [("/info/species", 0),
+                  ("/info/genomes/taxonomy/", 24 * 3600),
+                  ("/info/genomes/", 7 * 24 * 3600)]
+REST_CACHE_DEFAULT_TTL = 24 * 3600
+# Streamed responses larger than this are not stored in the cache
+REST_CACHE_STREAM_LIMIT = 32 * 2**20
+# Void html elements (no end tag), and attributes holding space-separated
+# lists, as serialized by BeautifulSoup (see AccNumHtmlParser)
+HTML_VOID_TAGS = frozenset(["area", "base", "br", "col", "embed", "hr", "img", "input",
+                            "keygen", "link", "menuitem", "meta", "param", "source",
+                            "track", "wbr", "basefont", "bgsound", "command", "frame",
+                            "image", "isindex", "nextid", "spacer"])
+HTML_LIST_ATTRIBUTES = frozenset(["class", "accesskey", "dropzone", "rel", "rev",
+                                  "headers"])
+# In-process download of EMBL records
+EMBL_DOWNLOAD_URL = "http://www.ebi.ac.uk/ena/data/view/%s&display=text&download=gzip"
+DOWNLOAD_MAX_JOBS = 8
+DOWNLOAD_RETRIES = 5
+DOWNLOAD_TIMEOUT = 300
+# Requests answered faster than this (in seconds) let the downloader open one
+# more concurrent request
+DOWNLOAD_FAST_LATENCY = 2.0
+# Files of at least this size (in bytes) are downloaded as several byte ranges
+# over parallel connections, when the server accepts range requests
+DOWNLOAD_SEGMENT_THRESHOLD = 64 * 2**20
+DOWNLOAD_SEGMENTS = 4
+# Columns of the species and genomes tables
+SPECIES_FIELDS = ["accession", "assembly", "common_name", "display_name",
+                  "division", "name", "release", "taxon_id"]
+GENOME_FIELDS = [u'species_id',
+                 u'division',
+                 u'is_reference',
+                 u'has_pan_compara',
+                 u'strain',
+                 u'base_count',
+                 u'assembly_name',
+                 u'assembly_id',
+                 u'assembly_level',
+                 u'serotype',
+                 u'genebuild',
+                 u'taxonomy_id',
+                 u'has_variations',
+                 u'has_other_alignments',
+                 u'species',
+                 u'has_peptide_compara',
+                 u'species_taxonomy_id',
+                 u'has_genome_alignments',
+                 u'dbname',
+                 u'name']
 
 ### *** Colors
 
@@ -51,25 +156,127 @@ def fileTimestamp() :
 
 ### ** downloadBacteriaSpecies()
 
-def downloadBacteriaSpecies():
+def downloadBacteriaSpecies(client = None):
     """Request the list of species from Ensembl Bacteria using the REST API.
     Code modified from http://rest.ensemblgenomes.org/documentation/info/species
 
+    Args:
+        client (RestClient): REST client to use (if None, use the shared client
+          from getRestClient())
+
     Returns:
         json object: The species information
     """
-    server = ENSEMBL_REST_SERVER
+    if client is None:
+        client = getRestClient()
     ext = "/info/species?division=EnsemblBacteria"
     print(PC.B + timestamp() + "Downloading information about species in EnsemblBacteria" + PC.E)
-    print(PC.Y + "Server: %s" % server + PC.E)
+    print(PC.Y + "Server: %s" % client.server + PC.E)
     print(PC.Y + "Request: %s" % ext + PC.E)
-    r = requests.get(server + ext,
-                     headers = {"Content-Type" : "application/json"})
-    if not r.ok:
-        r.raise_for_status()
-        sys.exit()
+    data = client.get(ext)
     print(PC.G + timestamp() + "Request successful" + PC.E)
-    return r.json()
+    return data
+
+### ** iterBacteriaSpecies()
+
+def iterBacteriaSpecies(client = None):
+    """Stream the list of species from Ensembl Bacteria using the REST API
+
+    Same request as downloadBacteriaSpecies(), but the response is parsed as
+    it arrives and the species are yielded one by one, so that memory use
+    does not depend on the size of the catalogue.
+
+    Args:
+        client (RestClient): REST client to use (if None, use the shared client
+          from getRestClient())
+
+    Returns:
+        generator: The species JSON objects (elements of the "species" list)
+    """
+    if client is None:
+        client = getRestClient()
+    ext = "/info/species?division=EnsemblBacteria"
+    print(PC.B + timestamp() + "Downloading information about species in EnsemblBacteria" + PC.E)
+    print(PC.Y + "Server: %s" % client.server + PC.E)
+    print(PC.Y + "Request: %s" % ext + PC.E)
+    n = 0
+    for species in client.iterJson(ext, key = "species"):
+        n += 1
+        yield species
+    print(PC.G + timestamp() + "Request successful (%i species)" % n + PC.E)
+
+### ** iterJsonArray(chunks, key = None)
+
+def iterJsonArray(chunks, key = None):
+    """Parse a JSON array incrementally and yield its elements
+
+    The array is either the whole document (if `key` is None) or the value of
+    `key` in the top-level object. Only one element at a time is held in
+    memory, in addition to the current chunk. When `key` is given, it is
+    located by its first occurrence followed by a colon and an opening
+    bracket, so it must not appear in this form earlier in the document.
+
+    Args:
+        chunks (iterable of bytes): The document, in UTF-8 encoded pieces
+        key (str): Key of the array in the top-level object
+
+    Returns:
+        generator: The elements of the array
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    chunks = iter(chunks)
+    if key is None:
+        start = re.compile(r"\[")
+    else:
+        start = re.compile(r'"' + re.escape(key) + r'"\s*:\s*\[')
+    buf = ""
+    pos = None
+    exhausted = False
+    def more():
+        for chunk in chunks:
+            return utf8.decode(chunk)
+        return None
+    # Find the start of the array
+    while pos is None:
+        m = start.search(buf)
+        if m is not None:
+            pos = m.end()
+            break
+        chunk = more()
+        if chunk is None:
+            raise ValueError("No JSON array found")
+        # Keep enough of the tail for a match spanning two chunks
+        buf = buf[-(len(key or "") + 64):] + chunk
+    # Decode the elements one by one
+    while True:
+        while pos < len(buf) and buf[pos] in " \t\r\n,":
+            pos += 1
+        if pos < len(buf) and buf[pos] == "]":
+            return
+        try:
+            if pos >= len(buf):
+                raise ValueError("Need more data")
+            (item, end) = decoder.raw_decode(buf, pos)
+            follow = end
+            while follow < len(buf) and buf[follow] in " \t\r\n":
+                follow += 1
+            if (follow == len(buf) or buf[follow] not in ",]") and not exhausted:
+                # A scalar element might be cut at the end of the chunk, and
+                # be decoded in part (e.g. 2 from "2." for 2.5)
+                raise ValueError("Need more data")
+        except ValueError:
+            chunk = None if exhausted else more()
+            if chunk is None:
+                if exhausted:
+                    raise ValueError("Truncated JSON array")
+                exhausted = True
+                continue
+            buf = buf[pos:] + chunk
+            pos = 0
+            continue
+        yield item
+        pos = end
 
 ### ** saveJson(jsonData, outFile)
 
@@ -107,54 +314,129 @@ def loadJson(inFile):
 
 ### ** retrieveGenomeInfo(speciesName)
 
-def retrieveGenomeInfo(speciesName, stderr = sys.stderr):
+def retrieveGenomeInfo(speciesName, stderr = sys.stderr, client = None):
     """Use the REST API to get the genome information for a species
     http://rest.ensemblgenomes.org/documentation/info/info_genome
 
     Args:
         speciesName (str): Name of the species, "name" field of the species JSON
           object
+        client (RestClient): REST client to use (if None, use the shared client
+          from getRestClient())
 
     Returns:
         A JSON object holding the genome information
     """
-    server = ENSEMBL_REST_SERVER
+    if client is None:
+        client = getRestClient()
     ext = "/info/genomes/" + speciesName + "?"
     stderr.write(PC.B + timestamp() + "Downloading information about genome in EnsemblBacteria" + PC.E + "\n")
-    stderr.write(PC.Y + "Server: %s" % server + PC.E + "\n")
+    stderr.write(PC.Y + "Server: %s" % client.server + PC.E + "\n")
     stderr.write(PC.Y + "Request: %s" % ext + PC.E + "\n")
-    r = requests.get(server + ext,
-                     headers = {"Content-Type" : "application/json"})
-    if not r.ok:
-        r.raise_for_status()
-        sys.exit()
+    data = client.get(ext)
     stderr.write(PC.G + timestamp() + "Request successful" + PC.E + "\n")
-    return r.json()
+    return data
+
+### ** retrieveGenomesInfo(speciesNames)
+
+def retrieveGenomesInfo(speciesNames, jobs = REST_JOBS, stderr = sys.stderr, client = None):
+    """Get the genome information for several species with concurrent requests
+
+    Args:
+        speciesNames (iterable of str): Names of the species, "name" field of
+          the species JSON objects
+        jobs (int): Maximum number of requests in flight
+        client (RestClient): REST client to use (if None, use the shared client
+          from getRestClient())
+
+    Returns:
+        generator: JSON objects holding the genome information, in the same
+          order as `speciesNames`
+    """
+    if client is None:
+        client = getRestClient()
+    return client.map(lambda x: retrieveGenomeInfo(x, stderr = stderr, client = client),
+                      speciesNames, jobs = jobs)
 
 ### ** retrieveGenomesTaxonName(taxonName)
 
-def retrieveGenomesTaxonName(taxonName, stderr = sys.stderr):
+def retrieveGenomesTaxonName(taxonName, stderr = sys.stderr, client = None):
     """Use the REST API to get the genomes information for a taxon
     http://rest.ensemblgenomes.org/documentation/info/info_genomes_taxonomy
 
     Args:
         taxonName (str): Name of the taxon
+        client (RestClient): REST client to use (if None, use the shared client
+          from getRestClient())
 
     Returns:
         A JSON object holding the genomes information
     """
-    server = ENSEMBL_REST_SERVER
+    if client is None:
+        client = getRestClient()
+    ext = "/info/genomes/taxonomy/" + taxonName + "?"
+    stderr.write(PC.B + timestamp() + "Downloading information about genomes in EnsemblBacteria" + PC.E + "\n")
+    stderr.write(PC.Y + "Server: %s" % client.server + PC.E + "\n")
+    stderr.write(PC.Y + "Request: %s" % ext + PC.E + "\n")
+    data = client.get(ext)
+    stderr.write(PC.G + timestamp() + "Request successful" + PC.E + "\n")
+    return data
+
+### ** iterGenomesTaxonName(taxonName)
+
+def iterGenomesTaxonName(taxonName, stderr = sys.stderr, client = None):
+    """Stream the genomes information for a taxon
+
+    Same request as retrieveGenomesTaxonName(), but the genomes are yielded
+    as soon as they are parsed from the response.
+
+    Args:
+        taxonName (str): Name of the taxon
+        client (RestClient): REST client to use (if None, use the shared client
+          from getRestClient())
+
+    Returns:
+        generator: JSON objects holding the information of each genome
+    """
+    if client is None:
+        client = getRestClient()
     ext = "/info/genomes/taxonomy/" + taxonName + "?"
     stderr.write(PC.B + timestamp() + "Downloading information about genomes in EnsemblBacteria" + PC.E + "\n")
-    stderr.write(PC.Y + "Server: %s" % server + PC.E + "\n")
+    stderr.write(PC.Y + "Server: %s" % client.server + PC.E + "\n")
     stderr.write(PC.Y + "Request: %s" % ext + PC.E + "\n")
-    r = requests.get(server + ext,
-                     headers = {"Content-Type" : "application/json"})
-    if not r.ok:
-        r.raise_for_status()
-        sys.exit()
+    for genome in client.iterJson(ext):
+        yield genome
     stderr.write(PC.G + timestamp() + "Request successful" + PC.E + "\n")
-    return r.json()
+
+### ** getRestClient()
+
+_restClient = None
+_restClientLock = threading.Lock()
+
+def getRestClient():
+    """Return the REST client shared by the module functions, creating it on
+    first use
+
+    Returns:
+        RestClient
+    """
+    global _restClient
+    with _restClientLock:
+        if _restClient is None:
+            _restClient = RestClient(cache = RestCache())
+        return _restClient
+
+### ** setRestClient(client)
+
+def setRestClient(client):
+    """Replace the REST client shared by the module functions
+
+    Args:
+        client (RestClient): The new shared client
+    """
+    global _restClient
+    with _restClientLock:
+        _restClient = client
 
 ### ** downloadUrl(url, outFile = None)
 
@@ -170,6 +452,7 @@ def downloadUrl(url, outFile = None) :
         int: Return code from wget
 
     """
+    import subprocess
     command = ["wget"]
     command += [url]
     if outFile is not None :
@@ -179,6 +462,8 @@ def downloadUrl(url, outFile = None) :
 
 ### ** parseHtmlToAccNum(htmlContent, previousData = None, stderr = None)
 
+@pyensemblMetrics.profiled
+@pyensemblMetrics.timed("parse_seconds", {"format" : "html"})
 def parseHtmlToAccNum(htmlContent, previousData = None, stderr = None) :
     """Parse the content of the html index page from Ensembl into a mapping
     between species and accession numbers
@@ -202,30 +487,115 @@ def parseHtmlToAccNum(htmlContent, previousData = None, stderr = None) :
         stderr = sys.stderr
     if previousData is None :
         previousData = dict()
-    content = BeautifulSoup(htmlContent, "html.parser")
-    speciesRows = [x for x in content.find_all("tr") if len(list(x.children)) > 5]
     spAccMapping = dict()
     spAccMapping.update(previousData)
-    for r in speciesRows :
-        cells = r.find_all("td")
-        if len(cells) > 0 :
-            assert len(cells) == 9;
-            species = cells[0].get_text()
-            if "EMBL" in cells[4].get_text() :
-                href = cells[4].find("a").get("href")
-                accNum = href.split("/view/")[1].split("&display")[0]
-                assert not spAccMapping.get(species, False)
-                spAccMapping[species] = accNum
-            else :
-                if species == "" :
-                    species = "???"
-                try :
-                    msg = ("No EMBL entry for species " + species + " (DNA "
-                           "link: " + cells[1].find("a").get("href") + ")\n" )
-                except :
-                    msg = ("No EMBL entry for species " + species + " (row " +
-                           str(r) + ")\n" )
-                stderr.write(msg)
+    for (species, accNum) in iterHtmlAccNum([htmlContent], stderr = stderr) :
+        assert not spAccMapping.get(species, False)
+        spAccMapping[species] = accNum
+    return spAccMapping
+
+### ** iterHtmlAccNum(chunks, stderr = None)
+
+def iterHtmlAccNum(chunks, stderr = None) :
+    """Parse an html index page from Ensembl incrementally and yield the
+    (species, accession number) pairs as the table rows are read
+
+    Args:
+        chunks (iterable of str): Pieces of the html content (e.g. lines of
+          an open file)
+        stderr (file): Stderr stream to write warning messages (if None, use
+          sys.stderr)
+
+    Returns:
+        generator: (species, accession number) tuples
+
+    """
+    if stderr is None :
+        stderr = sys.stderr
+    parser = AccNumHtmlParser()
+    for chunk in chunks :
+        parser.feed(chunk)
+        for (cells, markup) in parser.popRows() :
+            pair = parseAccNumRow(cells, stderr, markup)
+            if pair is not None :
+                yield pair
+    parser.close()
+    for (cells, markup) in parser.popRows() :
+        pair = parseAccNumRow(cells, stderr, markup)
+        if pair is not None :
+            yield pair
+
+### ** parseAccNumRow(cells, stderr, markup = None)
+
+def parseAccNumRow(cells, stderr, markup = None) :
+    """Get the species and accession number from a row of the index page
+
+    Args:
+        cells (list of (str, str)): Text and first link of each cell of the row
+        stderr (file): Stream to write a warning if the row has no EMBL link
+        markup (str): Html of the row, written in the warning if the row has
+          no DNA link either (if None, the texts of the cells are written)
+
+    Returns:
+        tuple: (species, accession number), or None if the row has no EMBL
+          link
+
+    """
+    assert len(cells) == 9;
+    species = cells[0][0]
+    if "EMBL" in cells[4][0] :
+        href = cells[4][1]
+        accNum = href.split("/view/")[1].split("&display")[0]
+        return (species, accNum)
+    if species == "" :
+        species = "???"
+    if cells[1][1] is not None :
+        msg = ("No EMBL entry for species " + species + " (DNA "
+               "link: " + cells[1][1] + ")\n" )
+    else :
+        if markup is None :
+            markup = str([x[0] for x in cells])
+        msg = ("No EMBL entry for species " + species + " (row " + markup + ")\n" )
+    stderr.write(msg)
+    return None
+
+### ** parseHtmlPages(pages, jobs = 1)
+
+def _parseHtmlPage(htmlContent) :
+    messages = io.StringIO()
+    mapping = parseHtmlToAccNum(htmlContent, stderr = messages)
+    return (mapping, messages.getvalue())
+
+@pyensemblMetrics.profiled
+def parseHtmlPages(pages, jobs = 1, previousData = None, stderr = None) :
+    """Parse several html index pages in parallel into one mapping
+
+    Args:
+        pages (list of str): Html contents of the index pages
+        jobs (int): Number of processes
+        previousData (dict): Mapping to update, as in parseHtmlToAccNum()
+        stderr (file): Stderr stream to write warning messages (if None, use
+          sys.stderr)
+
+    Returns:
+        dict: Dictionary mapping (species, accession number(s))
+
+    """
+    if stderr is None :
+        stderr = sys.stderr
+    spAccMapping = dict()
+    if previousData is not None :
+        spAccMapping.update(previousData)
+    if jobs > 1 and len(pages) > 1 :
+        with futures.ProcessPoolExecutor(jobs) as executor :
+            results = list(executor.map(_parseHtmlPage, pages))
+    else :
+        results = [_parseHtmlPage(x) for x in pages]
+    for (mapping, messages) in results :
+        stderr.write(messages)
+        for (species, accNum) in mapping.items() :
+            assert not spAccMapping.get(species, False)
+            spAccMapping[species] = accNum
     return spAccMapping
 
 ### ** filterAccNumBySpecies(spAccMapping, species)
@@ -251,10 +621,46 @@ def filterAccNumBySpecies(spAccMapping, species) :
     o = dict()
     species = species.lower()
     for (k, v) in spAccMapping.items() :
-        if species in k.lower().replace("_", " ") :
+        if species in normalizeSpeciesName(k) :
             o[k] = v
     return o
 
+### ** normalizeSpeciesName(name)
+
+def normalizeSpeciesName(name) :
+    """Normalize a species name for matching: lower case, with underscores
+    replaced by spaces
+
+    Args:
+        name (str): Species name
+
+    Returns:
+        str
+    """
+    return name.lower().replace("_", " ")
+
+### ** searchBatch(texts, queries)
+
+@pyensemblMetrics.profiled
+def searchBatch(texts, queries) :
+    """Find which texts contain each of several query strings, in a single
+    pass over the texts
+
+    Args:
+        texts (iterable of str): Texts to search
+        queries (list of str): Query strings
+
+    Returns:
+        list of list of int: For each query, the positions in `texts` of the
+          texts containing it (in increasing order)
+    """
+    automaton = AhoCorasick(queries)
+    o = [[] for q in queries]
+    for (i, text) in enumerate(texts) :
+        for q in automaton.findAll(text) :
+            o[q].append(i)
+    return o
+
 ### ** dumpEnsemblInfoSpecies(speciesList)
 
 def dumpEnsemblInfoSpecies(speciesList):
@@ -279,13 +685,38 @@ def dumpEnsemblInfoSpecies(speciesList):
     Returns:
         str
     """
-    FIELDS = ["accession", "assembly", "common_name", "display_name",
-              "division", "name", "release", "taxon_id"]
-    out = ""
-    out += "\t".join(FIELDS) + "\n"
+    return "".join(iterEnsemblInfoSpecies(speciesList))
+
+### ** iterEnsemblInfoSpecies(speciesList)
+
+def iterEnsemblInfoSpecies(speciesList):
+    """Convert bacteria species information to table lines, one at a time
+
+    Args:
+        speciesList (iterable): Species dict, as for dumpEnsemblInfoSpecies()
+
+    Returns:
+        generator: The header line, then one line per species
+    """
+    yield "\t".join(SPECIES_FIELDS) + "\n"
     for sp in speciesList:
-        out += "\t".join([str(sp[f]) for f in FIELDS]) + "\n"
-    return out
+        yield "\t".join([str(sp[f]) for f in SPECIES_FIELDS]) + "\n"
+
+### ** writeEnsemblInfoSpecies(speciesList, fo)
+
+def writeEnsemblInfoSpecies(speciesList, fo, flush = False):
+    """Write bacteria species information to a file as a table, line by line
+    as the species are produced
+
+    Args:
+        speciesList (iterable): Species dict, as for dumpEnsemblInfoSpecies()
+        fo (file): Output stream
+        flush (bool): Flush the stream after each line?
+
+    Returns:
+        int: Number of species written
+    """
+    return writeLines(iterEnsemblInfoSpecies(speciesList), fo, flush) - 1
 
 ### ** dumpEnsemblInfoGenomes(genomeList)
 
@@ -299,34 +730,1074 @@ def dumpEnsemblInfoGenomes(genomeList):
     Returns:
         str
     """
-    FIELDS = [u'species_id',
-               u'division',
-               u'is_reference',
-               u'has_pan_compara',
-               u'strain',
-               u'base_count',
-               u'assembly_name',
-               u'assembly_id',
-               u'assembly_level',
-               u'serotype',
-               u'genebuild',
-               u'taxonomy_id',
-               u'has_variations',
-               u'has_other_alignments',
-               u'species',
-               u'has_peptide_compara',
-               u'species_taxonomy_id',
-               u'has_genome_alignments',
-               u'dbname',
-               u'name']
-    out = ""
-    out += "\t".join(FIELDS) + "\n"
+    return "".join(iterEnsemblInfoGenomes(genomeList))
+
+### ** iterEnsemblInfoGenomes(genomeList)
+
+def iterEnsemblInfoGenomes(genomeList):
+    """Convert genomes information to table lines, one at a time
+
+    Args:
+        genomeList (iterable): Genome dict, as for dumpEnsemblInfoGenomes()
+
+    Returns:
+        generator: The header line, then one line per genome
+    """
+    yield "\t".join(GENOME_FIELDS) + "\n"
     for genome in genomeList:
-        out += "\t".join([str(genome[f]) for f in FIELDS]) + "\n"
-    return out
-    
+        yield "\t".join([str(genome[f]) for f in GENOME_FIELDS]) + "\n"
+
+### ** writeEnsemblInfoGenomes(genomeList, fo)
+
+def writeEnsemblInfoGenomes(genomeList, fo, flush = False):
+    """Write genomes information to a file as a table, line by line as the
+    genomes are produced
+
+    Args:
+        genomeList (iterable): Genome dict, as for dumpEnsemblInfoGenomes()
+        fo (file): Output stream
+        flush (bool): Flush the stream after each line?
+
+    Returns:
+        int: Number of genomes written
+    """
+    return writeLines(iterEnsemblInfoGenomes(genomeList), fo, flush) - 1
+
+### ** writeLines(lines, fo)
+
+def writeLines(lines, fo, flush = False):
+    """Write lines to a stream as they are produced
+
+    Args:
+        lines (iterable of str): Lines, with their line ends
+        fo (file): Output stream
+        flush (bool): Flush the stream after each line?
+
+    Returns:
+        int: Number of lines written
+    """
+    n = 0
+    for line in lines:
+        fo.write(line)
+        if flush:
+            fo.flush()
+        n += 1
+    return n
+
+### ** splitRanges(size, segments)
+
+def splitRanges(size, segments):
+    """Split a file into contiguous byte ranges of (nearly) equal sizes
+
+    Args:
+        size (int): Size of the file in bytes
+        segments (int): Number of ranges
+
+    Returns:
+        list of (start, end): Byte ranges, `end` excluded
+    """
+    segments = max(1, min(segments, size))
+    bounds = [size * i // segments for i in range(segments + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+### ** preallocate(path, size)
+
+def preallocate(path, size):
+    """Create a file (or resize an existing one) with its final size, so that
+    byte ranges can be written into it in any order with os.pwrite()
+
+    The existing content up to `size` is kept. The disk space is reserved
+    when the platform allows it.
+
+    Args:
+        path (str): Path to the file
+        size (int): Size in bytes
+    """
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT)
+    try:
+        os.ftruncate(fd, size)
+        if size > 0 and hasattr(os, "posix_fallocate"):
+            try:
+                os.posix_fallocate(fd, 0, size)
+            except OSError:
+                # Not supported by the file system
+                pass
+    finally:
+        os.close(fd)
+
 ### * Classes
 
+### ** AccNumHtmlParser
+
+class AccNumHtmlParser(html.parser.HTMLParser) :
+    """Event-driven parser collecting the table rows of an Ensembl index page
+
+    Only what parseAccNumRow() needs is kept: for each row, the text and the
+    first link of each <td> cell, and the html of the rows without EMBL and
+    DNA links serialized as BeautifulSoup does (written in the warnings; the
+    events of a row are only recorded until its DNA link is found). As with the tree-based parsing
+    used before, rows with five children or less (counting the whitespace
+    between cells) and rows without <td> cells (headers) are skipped.
+    Completed rows are retrieved with popRows().
+    """
+
+    def __init__(self) :
+        html.parser.HTMLParser.__init__(self, convert_charrefs = True)
+        self.rows = []
+        self._row = None
+        self._cell = None
+        self._cellDepth = 0
+        self._children = 0
+        self._lastData = False
+        self._markup = None
+        self._openTags = []
+
+    def handle_starttag(self, tag, attrs) :
+        if tag == "tr" :
+            self._endRow()
+            self._row = []
+            self._children = 0
+            self._markup = [(tag, attrs)]
+            self._openTags = []
+        elif self._row is None :
+            pass
+        else :
+            if self._markup is not None :
+                self._markup.append((tag, attrs))
+                if tag not in HTML_VOID_TAGS :
+                    self._openTags.append(tag)
+            if tag in ("td", "th") :
+                self._endCell()
+                self._children += 1
+                if tag == "td" :
+                    self._cell = [[], None]
+                self._cellDepth = 1
+            elif self._cellDepth > 0 :
+                if tag == "a" and self._cell is not None and self._cell[1] is None :
+                    self._cell[1] = dict(attrs).get("href")
+                if tag not in HTML_VOID_TAGS :
+                    self._cellDepth += 1
+            else :
+                self._children += 1
+        self._lastData = False
+
+    def handle_startendtag(self, tag, attrs) :
+        if self._markup is not None :
+            self._markup.append((tag, attrs))
+            if tag not in HTML_VOID_TAGS :
+                self._markup.append((None, "</%s>" % tag))
+        if tag == "a" and self._cell is not None and self._cell[1] is None :
+            self._cell[1] = dict(attrs).get("href")
+        elif self._row is not None and self._cellDepth == 0 :
+            self._children += 1
+        self._lastData = False
+
+    def handle_endtag(self, tag) :
+        if self._markup is not None and tag in self._openTags :
+            self._closeTags(tag)
+        if tag == "tr" :
+            self._endRow()
+        elif tag in ("table", "tbody", "thead", "tfoot") :
+            self._endRow()
+        elif self._cellDepth > 0 :
+            if tag in ("td", "th") :
+                self._endCell()
+            else :
+                self._cellDepth = max(1, self._cellDepth - 1)
+        self._lastData = False
+
+    def handle_data(self, data) :
+        if self._markup is not None :
+            self._markup.append(data)
+        if self._cell is not None :
+            self._cell[0].append(data)
+        elif self._row is not None and self._cellDepth == 0 and not self._lastData :
+            self._children += 1
+        self._lastData = True
+
+    def handle_comment(self, data) :
+        if self._markup is not None :
+            self._markup.append((None, "<!--%s-->" % data))
+        if self._row is not None and self._cellDepth == 0 :
+            self._children += 1
+        self._lastData = False
+
+    def _endCell(self) :
+        if self._cell is not None :
+            self._row.append(("".join(self._cell[0]), self._cell[1]))
+            if len(self._row) == 2 and self._cell[1] is not None :
+                # A row with a DNA link is never written in a warning
+                self._markup = None
+        self._cell = None
+        self._cellDepth = 0
+
+    def _startTag(self, tag, attrs) :
+        # Attributes as BeautifulSoup writes them: sorted, the last value of
+        # repeated attributes, minimal escaping, single quotes only if needed
+        values = dict()
+        for (name, value) in attrs :
+            if value is None :
+                value = ""
+            elif name in HTML_LIST_ATTRIBUTES :
+                value = " ".join(value.split())
+            values[name] = value
+        out = ["<", tag]
+        for (name, value) in sorted(values.items()) :
+            value = value.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+            if '"' not in value :
+                out.append(' %s="%s"' % (name, value))
+            elif "'" not in value :
+                out.append(" %s='%s'" % (name, value))
+            else :
+                out.append(' %s="%s"' % (name, value.replace('"', "&quot;")))
+        out.append("/>" if tag in HTML_VOID_TAGS else ">")
+        return "".join(out)
+
+    def _html(self, markup) :
+        # Serialize the start tags (tag, attributes), markup (None, html) and
+        # text recorded for a row
+        out = []
+        for x in markup :
+            if type(x) is str :
+                out.append(x.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;"))
+            elif x[0] is None :
+                out.append(x[1])
+            else :
+                out.append(self._startTag(x[0], x[1]))
+        return "".join(out)
+
+    def _closeTags(self, tag) :
+        # Close the elements left open in `tag`, then `tag`
+        while self._openTags :
+            last = self._openTags.pop()
+            self._markup.append((None, "</%s>" % last))
+            if last == tag :
+                break
+
+    def _endRow(self) :
+        if self._row is None :
+            return
+        self._endCell()
+        if self._children > 5 and len(self._row) > 0 :
+            markup = None
+            if (self._markup is not None and len(self._row) > 4 and
+                "EMBL" not in self._row[4][0]) :
+                # Written in the warning of parseAccNumRow()
+                self._closeTags(None)
+                self._markup.append((None, "</tr>"))
+                markup = self._html(self._markup)
+            self.rows.append((self._row, markup))
+        self._row = None
+        self._markup = None
+
+    def popRows(self) :
+        """Return the rows completed so far and forget them
+
+        Returns:
+            list of (list of (str, str), str): For each row, the text and
+              first link (None if there is none) of each cell, and the html
+              of the row if parseAccNumRow() writes it in a warning (None
+              otherwise)
+
+        """
+        rows, self.rows = self.rows, []
+        return rows
+
+    def close(self) :
+        html.parser.HTMLParser.close(self)
+        self._endRow()
+
+### ** TrigramIndex
+
+class TrigramIndex(object) :
+    """Substring index over a list of texts
+
+    Each trigram of the texts is mapped to the sorted list of the texts
+    containing it, so that a query only checks the texts containing all its
+    trigrams. Queries shorter than three characters scan all the texts.
+    """
+
+    def __init__(self, texts) :
+        """
+        Args:
+            texts (iterable of str): Texts to index (already normalized)
+
+        """
+        self.texts = list(texts)
+        self.postings = dict()
+        for (i, text) in enumerate(self.texts) :
+            for gram in set(text[j:j+3] for j in range(len(text) - 2)) :
+                self.postings.setdefault(gram, []).append(i)
+
+    def search(self, query) :
+        """Find the texts containing a query string
+
+        Args:
+            query (str): Query string (normalized as the texts)
+
+        Returns:
+            list of int: Positions of the matching texts, in increasing order
+
+        """
+        if len(query) < 3 :
+            return [i for (i, text) in enumerate(self.texts) if query in text]
+        grams = set(query[j:j+3] for j in range(len(query) - 2))
+        postings = []
+        for gram in grams :
+            if gram not in self.postings :
+                return []
+            postings.append(self.postings[gram])
+        postings.sort(key = len)
+        candidates = postings[0]
+        for p in postings[1:] :
+            p = set(p)
+            candidates = [i for i in candidates if i in p]
+        return [i for i in candidates if query in self.texts[i]]
+
+### ** AhoCorasick
+
+class AhoCorasick(object) :
+    """Aho-Corasick automaton finding all the occurrences of a set of query
+    strings in a text in one pass over the text
+    """
+
+    def __init__(self, queries) :
+        """
+        Args:
+            queries (list of str): Query strings
+
+        """
+        self.goto = [dict()]
+        self.fail = [0]
+        self.output = [[]]
+        for (q, query) in enumerate(queries) :
+            state = 0
+            for char in query :
+                if char not in self.goto[state] :
+                    self.goto.append(dict())
+                    self.fail.append(0)
+                    self.output.append([])
+                    self.goto[state][char] = len(self.goto) - 1
+                state = self.goto[state][char]
+            self.output[state].append(q)
+        # Breadth-first computation of the failure links
+        level = list(self.goto[0].values())
+        while len(level) > 0 :
+            nextLevel = []
+            for state in level :
+                for (char, child) in self.goto[state].items() :
+                    f = self.fail[state]
+                    while f != 0 and char not in self.goto[f] :
+                        f = self.fail[f]
+                    if state != 0 and char in self.goto[f] :
+                        f = self.goto[f][char]
+                    self.fail[child] = f
+                    self.output[child] = self.output[child] + self.output[f]
+                    nextLevel.append(child)
+            level = nextLevel
+        self._empty = [q for q in self.output[0]]
+
+    def findAll(self, text) :
+        """Find the queries occurring in a text
+
+        Args:
+            text (str): Text to search
+
+        Returns:
+            set of int: Positions (in the list given at construction) of the
+              queries found in `text`
+
+        """
+        found = set(self._empty)
+        goto = self.goto
+        fail = self.fail
+        output = self.output
+        state = 0
+        for char in text :
+            while state != 0 and char not in goto[state] :
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state] :
+                found.update(output[state])
+        return found
+
+### ** RestCacheMiss
+
+class RestCacheMiss(Exception) :
+    """Raised in cache-only mode when a response is not in the cache"""
+    pass
+
+### ** TokenBucket
+
+class TokenBucket(object) :
+    """Thread-safe token bucket used to pace requests to a server
+    """
+
+    def __init__(self, rate, capacity = None) :
+        """
+        Args:
+            rate (float): Number of tokens added per second
+            capacity (float): Maximum number of tokens stored (default: `rate`,
+              i.e. bursts of up to one second of requests). It is at least 1,
+              otherwise no token could ever be taken with rates below one
+              request per second.
+
+        """
+        self.rate = float(rate)
+        self.capacity = max(1.0, float(capacity if capacity is not None else rate))
+        self.tokens = self.capacity
+        self.updated = time.time()
+        self.pausedUntil = 0
+        self._lock = threading.Lock()
+
+    def _refill(self, now) :
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self) :
+        """Take one token, waiting until one is available"""
+        while True :
+            with self._lock :
+                now = time.time()
+                self._refill(now)
+                if now >= self.pausedUntil and self.tokens >= 1 :
+                    self.tokens -= 1
+                    return
+                wait = max(self.pausedUntil - now, (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    def pause(self, seconds) :
+        """Do not hand out any token for the next `seconds` seconds"""
+        with self._lock :
+            self.pausedUntil = max(self.pausedUntil, time.time() + seconds)
+            self.tokens = 0
+
+    def setRate(self, rate) :
+        """Change the refill rate"""
+        with self._lock :
+            self._refill(time.time())
+            self.rate = float(rate)
+            self.capacity = max(1.0, min(self.capacity, self.rate))
+
+### ** RestClient
+
+class RestClient(object) :
+    """Client for the Ensembl REST API
+
+    All requests go through one requests.Session with a pool of keep-alive
+    connections. They are paced by a token bucket which follows the
+    X-RateLimit-* and Retry-After headers sent by the server, and failed
+    requests (connection errors, 429 and 5xx responses) are retried with an
+    exponential backoff.
+    """
+
+    def __init__(self, server = ENSEMBL_REST_SERVER, rate = REST_RATE,
+                 maxConnections = REST_MAX_CONNECTIONS, retries = REST_RETRIES,
+                 timeout = REST_TIMEOUT, cache = None, cacheOnly = False) :
+        """
+        Args:
+            server (str): Base URL of the REST server
+            rate (float): Maximum number of requests per second
+            maxConnections (int): Size of the connection pool
+            retries (int): Number of retries for failed requests
+            timeout (float): Timeout of each request in seconds
+            cache (RestCache): If not None, responses are stored in and served
+              from this cache
+            cacheOnly (bool): Never contact the server, answer only from the
+              cache (stale entries included) and raise RestCacheMiss otherwise
+
+        """
+        self.server = server
+        self.cache = cache
+        self.cacheOnly = cacheOnly
+        self.rate = rate
+        self.retries = retries
+        self.timeout = timeout
+        self.bucket = TokenBucket(rate)
+        self.maxConnections = maxConnections
+        self._session = None
+        self._sessionLock = threading.Lock()
+
+    @property
+    def session(self) :
+        """HTTP session, created with the first request (so that commands
+        which do not contact the server do not load requests)"""
+        with self._sessionLock :
+            if self._session is None :
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections = 1,
+                                                        pool_maxsize = self.maxConnections)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                session.headers.update({"Content-Type" : "application/json"})
+                self._session = session
+            return self._session
+
+    def _updateLimits(self, headers) :
+        """Adjust the pacing to the rate limit announced by the server"""
+        try :
+            limit = float(headers["X-RateLimit-Limit"])
+            period = float(headers["X-RateLimit-Period"])
+            if limit > 0 and period > 0 :
+                self.bucket.setRate(min(self.rate, limit / period))
+        except (KeyError, ValueError) :
+            pass
+        try :
+            if int(headers["X-RateLimit-Remaining"]) <= 0 :
+                self.bucket.pause(float(headers.get("X-RateLimit-Reset", 1)))
+        except (KeyError, ValueError) :
+            pass
+
+    def request(self, ext, headers = None, stream = False) :
+        """Send a GET request, retrying on failure
+
+        Args:
+            ext (str): Endpoint and parameters (e.g. "/info/genomes/serratia?")
+            headers (dict): Additional request headers
+            stream (bool): If True, the body is not downloaded before returning
+
+        Returns:
+            requests.Response: The (successful) response
+
+        """
+        attempt = 0
+        while True :
+            self.bucket.acquire()
+            start = time.perf_counter()
+            try :
+                r = self.session.get(self.server + ext, headers = headers,
+                                     timeout = self.timeout, stream = stream)
+            except (requests.ConnectionError, requests.Timeout) :
+                pyensemblMetrics.increment("rest_requests_total", labels = {"status" : "error"})
+                if attempt >= self.retries :
+                    raise
+            else :
+                pyensemblMetrics.observe("rest_request_seconds", time.perf_counter() - start)
+                pyensemblMetrics.increment("rest_requests_total",
+                                           labels = {"status" : r.status_code})
+                if not stream :
+                    pyensemblMetrics.increment("rest_bytes_total", len(r.content))
+                self._updateLimits(r.headers)
+                if r.status_code != 429 and r.status_code < 500 :
+                    if not r.ok :
+                        r.raise_for_status()
+                    return r
+                if attempt >= self.retries :
+                    r.raise_for_status()
+                if "Retry-After" in r.headers :
+                    try :
+                        self.bucket.pause(float(r.headers["Retry-After"]))
+                    except ValueError :
+                        pass
+            pyensemblMetrics.increment("rest_retries_total")
+            time.sleep(min(2 ** attempt, 60))
+            attempt += 1
+
+    def _requestFull(self, ext, r, stream = False) :
+        """Send a request again without validators after a 304 response for
+        which no cached body is available (the server must then send the full
+        response)"""
+        r.close()
+        pyensemblMetrics.increment("rest_cache_total", labels = {"result" : "unexpected_304"})
+        r = self.request(ext, headers = {"Cache-Control" : "no-cache"}, stream = stream)
+        if r.status_code == 304 :
+            r.close()
+            raise requests.HTTPError("304 Not Modified without a cached response for %s" %
+                                     (self.server + ext), response = r)
+        return r
+
+    def get(self, ext) :
+        """Send a GET request and decode the JSON response
+
+        If the client has a cache, fresh cached responses are returned without
+        contacting the server and stale ones are revalidated with a
+        conditional request.
+
+        Args:
+            ext (str): Endpoint and parameters (e.g. "/info/genomes/serratia?")
+
+        Returns:
+            A JSON object
+
+        """
+        if self.cache is None :
+            if self.cacheOnly :
+                raise RestCacheMiss(self.server + ext)
+            return self.request(ext).json()
+        key = self.server + ext
+        entry = self.cache.lookup(key)
+        if entry is not None and (self.cacheOnly or entry["fresh"]) :
+            pyensemblMetrics.increment("rest_cache_total", labels = {"result" : "hit"})
+            return json.loads(entry["body"].decode("utf-8"))
+        pyensemblMetrics.increment("rest_cache_total", labels = {"result" : "miss"})
+        if self.cacheOnly :
+            raise RestCacheMiss(key)
+        headers = dict()
+        if entry is not None :
+            if entry["etag"] is not None :
+                headers["If-None-Match"] = entry["etag"]
+            if entry["lastModified"] is not None :
+                headers["If-Modified-Since"] = entry["lastModified"]
+        r = self.request(ext, headers = headers)
+        if r.status_code == 304 and entry is not None :
+            pyensemblMetrics.increment("rest_cache_total", labels = {"result" : "revalidated"})
+            self.cache.touch(key)
+            return json.loads(entry["body"].decode("utf-8"))
+        if r.status_code == 304 :
+            r = self._requestFull(ext, r)
+        self.cache.store(key, r.content, etag = r.headers.get("ETag"),
+                         lastModified = r.headers.get("Last-Modified"))
+        return r.json()
+
+    def iterJson(self, ext, key = None) :
+        """Send a GET request and parse the response as it arrives
+
+        The response must be a JSON array, or an object holding an array
+        under `key`. The cache is used as in get(), except that responses
+        larger than REST_CACHE_STREAM_LIMIT are not stored since they are
+        never held in memory.
+
+        Args:
+            ext (str): Endpoint and parameters
+            key (str): Key of the array in the top-level object (None if the
+              response itself is the array)
+
+        Returns:
+            generator: The elements of the array
+
+        """
+        url = self.server + ext
+        entry = None
+        headers = dict()
+        if self.cache is not None :
+            entry = self.cache.lookup(url)
+            if entry is not None and (self.cacheOnly or entry["fresh"]) :
+                pyensemblMetrics.increment("rest_cache_total", labels = {"result" : "hit"})
+                for item in iterJsonArray([entry["body"]], key = key) :
+                    yield item
+                return
+            pyensemblMetrics.increment("rest_cache_total", labels = {"result" : "miss"})
+            if entry is not None :
+                if entry["etag"] is not None :
+                    headers["If-None-Match"] = entry["etag"]
+                if entry["lastModified"] is not None :
+                    headers["If-Modified-Since"] = entry["lastModified"]
+        if self.cacheOnly :
+            raise RestCacheMiss(url)
+        r = self.request(ext, headers = headers, stream = True)
+        try :
+            if r.status_code == 304 and entry is not None :
+                pyensemblMetrics.increment("rest_cache_total", labels = {"result" : "revalidated"})
+                self.cache.touch(url)
+                for item in iterJsonArray([entry["body"]], key = key) :
+                    yield item
+                return
+            if r.status_code == 304 :
+                r = self._requestFull(ext, r, stream = True)
+            # Keep a copy of the body for the cache while it is small enough
+            body = [] if self.cache is not None else None
+            size = [0]
+            def chunks() :
+                for chunk in r.iter_content(1 << 16) :
+                    pyensemblMetrics.increment("rest_bytes_total", len(chunk))
+                    if body is not None :
+                        size[0] += len(chunk)
+                        if size[0] <= REST_CACHE_STREAM_LIMIT :
+                            body.append(chunk)
+                    yield chunk
+            for item in iterJsonArray(chunks(), key = key) :
+                yield item
+            if body is not None and size[0] <= REST_CACHE_STREAM_LIMIT :
+                self.cache.store(url, b"".join(body), etag = r.headers.get("ETag"),
+                                 lastModified = r.headers.get("Last-Modified"))
+        finally :
+            r.close()
+
+    def map(self, function, items, jobs = REST_JOBS) :
+        """Apply a function calling the REST API to several items concurrently
+
+        Args:
+            function (function): Function taking one item
+            items (iterable): Items to process
+            jobs (int): Maximum number of calls running at the same time
+
+        Returns:
+            generator: The results, in the order of `items`
+
+        """
+        # Items are submitted as results are consumed, at most 2 * `jobs`
+        # ahead, rather than all at once as with Executor.map()
+        jobs = max(1, jobs)
+        window = collections.deque()
+        with futures.ThreadPoolExecutor(jobs) as executor :
+            try :
+                for item in items :
+                    window.append(executor.submit(function, item))
+                    if len(window) >= 2 * jobs :
+                        yield window.popleft().result()
+                while window :
+                    yield window.popleft().result()
+            finally :
+                for future in window :
+                    future.cancel()
+
+### ** RestCache
+
+class RestCache(object) :
+    """Persistent cache of REST responses, stored in a SQLite file
+
+    Entries are keyed by URL (server, endpoint and parameters). Each entry
+    has a time to live depending on its endpoint (REST_CACHE_TTL) and stores
+    the ETag and Last-Modified headers of the response for revalidation. When
+    the compressed size of the entries exceeds `maxSize`, the least recently
+    used ones are evicted.
+    """
+
+    def __init__(self, path = REST_CACHE_FILE, maxSize = REST_CACHE_MAX_SIZE,
+                 ttl = REST_CACHE_TTL, defaultTtl = REST_CACHE_DEFAULT_TTL) :
+        """
+        Args:
+            path (str): Path to the cache file
+            maxSize (int): Maximum total size of the stored responses in bytes
+            ttl (list): List of (endpoint prefix, time to live in seconds)
+            defaultTtl (float): Time to live for the other endpoints
+
+        """
+        self.path = path
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.defaultTtl = defaultTtl
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread = False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS entries ("
+                         "key TEXT PRIMARY KEY, body BLOB, etag TEXT, "
+                         "lastModified TEXT, fetched REAL, accessed REAL, "
+                         "size INTEGER)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS entriesAccessed ON entries (accessed)")
+        self._db.commit()
+
+    def ttlFor(self, key) :
+        """Time to live of an entry, from the endpoint in its URL"""
+        path = key.split("://", 1)[-1]
+        path = path[path.find("/"):]
+        for (prefix, ttl) in self.ttl :
+            if path.startswith(prefix) :
+                return ttl
+        return self.defaultTtl
+
+    def lookup(self, key) :
+        """Get a cached response
+
+        Args:
+            key (str): URL of the request
+
+        Returns:
+            dict: With keys "body" (bytes), "etag", "lastModified" and "fresh"
+              (bool, False if the time to live has expired), or None if the
+              URL is not in the cache
+
+        """
+        now = time.time()
+        with self._lock :
+            row = self._db.execute("SELECT body, etag, lastModified, fetched FROM entries "
+                                   "WHERE key = ?", (key, )).fetchone()
+            if row is None :
+                return None
+            self._db.execute("UPDATE entries SET accessed = ? WHERE key = ?", (now, key))
+            self._db.commit()
+        return {"body" : zlib.decompress(row[0]), "etag" : row[1],
+                "lastModified" : row[2], "fresh" : now - row[3] < self.ttlFor(key)}
+
+    def touch(self, key) :
+        """Mark an entry as freshly validated by the server"""
+        now = time.time()
+        with self._lock :
+            self._db.execute("UPDATE entries SET fetched = ?, accessed = ? WHERE key = ?",
+                             (now, now, key))
+            self._db.commit()
+
+    def store(self, key, body, etag = None, lastModified = None) :
+        """Store a response and evict old entries if needed
+
+        Args:
+            key (str): URL of the request
+            body (bytes): Body of the response
+            etag (str): ETag header of the response
+            lastModified (str): Last-Modified header of the response
+
+        """
+        now = time.time()
+        body = zlib.compress(body)
+        if len(body) > self.maxSize :
+            return
+        with self._lock :
+            self._db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)",
+                             (key, sqlite3.Binary(body), etag, lastModified, now, now,
+                              len(body)))
+            self._evict()
+            self._db.commit()
+
+    def _evict(self) :
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.maxSize :
+            return
+        rows = self._db.execute("SELECT key, size FROM entries ORDER BY accessed").fetchall()
+        for (key, size) in rows :
+            if total <= self.maxSize :
+                break
+            self._db.execute("DELETE FROM entries WHERE key = ?", (key, ))
+            total -= size
+
+    def clear(self) :
+        """Remove all the entries"""
+        with self._lock :
+            self._db.execute("DELETE FROM entries")
+            self._db.commit()
+
+### ** AdaptiveLimiter
+
+class AdaptiveLimiter(object) :
+    """Concurrency limit adjusted to the server responses (additive increase,
+    multiplicative decrease)
+
+    The limit grows by one after a round of fast successful requests and is
+    halved when the server answers with 429 or 5xx, in which case new
+    requests are also held for the Retry-After delay if one was given.
+    """
+
+    def __init__(self, maxJobs = DOWNLOAD_MAX_JOBS, fastLatency = DOWNLOAD_FAST_LATENCY) :
+        """
+        Args:
+            maxJobs (int): Upper bound of the limit
+            fastLatency (float): Latency (seconds) under which a request is
+              considered fast
+
+        """
+        self.maxJobs = maxJobs
+        self.fastLatency = fastLatency
+        self.limit = 1
+        self.inFlight = 0
+        self.pausedUntil = 0
+        self._successes = 0
+        self._cond = threading.Condition()
+
+    def acquire(self) :
+        """Wait for a free slot under the current limit"""
+        with self._cond :
+            while True :
+                wait = self.pausedUntil - time.time()
+                if wait <= 0 and self.inFlight < self.limit :
+                    self.inFlight += 1
+                    return
+                self._cond.wait(wait if wait > 0 else None)
+
+    def release(self, latency = None, throttled = False, retryAfter = None) :
+        """Free a slot and adjust the limit
+
+        Args:
+            latency (float): Time to first byte of the request (None if it
+              failed)
+            throttled (bool): True if the server answered 429 or 5xx
+            retryAfter (float): Delay requested by the server, if any
+
+        """
+        with self._cond :
+            self.inFlight -= 1
+            if throttled :
+                self.limit = max(1, self.limit // 2)
+                self._successes = 0
+                if retryAfter is not None :
+                    self.pausedUntil = max(self.pausedUntil, time.time() + retryAfter)
+            elif latency is not None and latency < self.fastLatency :
+                self._successes += 1
+                if self._successes >= self.limit :
+                    self.limit = min(self.maxJobs, self.limit + 1)
+                    self._successes = 0
+            self._cond.notify_all()
+
+### ** HttpDownloader
+
+class HttpDownloader(object) :
+    """Download files over HTTP with pooled connections and a concurrency
+    adapted to how fast the server answers (see AdaptiveLimiter)
+
+    Response bodies are streamed to disk as sent by the server (gzip files
+    stay compressed), into a temporary file renamed once complete. Large
+    responses from servers accepting range requests are split into byte
+    ranges: the first request keeps receiving the first range while the other
+    ranges are requested in parallel (outside of the concurrency limit), and
+    each range is written in place into the preallocated temporary file.
+    """
+
+    def __init__(self, maxJobs = DOWNLOAD_MAX_JOBS, retries = DOWNLOAD_RETRIES,
+                 timeout = DOWNLOAD_TIMEOUT, fastLatency = DOWNLOAD_FAST_LATENCY,
+                 segments = DOWNLOAD_SEGMENTS, segmentThreshold = DOWNLOAD_SEGMENT_THRESHOLD) :
+        """
+        Args:
+            maxJobs (int): Maximum number of concurrent downloads
+            retries (int): Number of retries for failed downloads
+            timeout (float): Socket timeout in seconds
+            fastLatency (float): See AdaptiveLimiter
+            segments (int): Number of byte ranges of the large files (1 to
+              download every file over one connection)
+            segmentThreshold (int): Size in bytes from which a file is
+              split into byte ranges
+
+        """
+        self.maxJobs = maxJobs
+        self.retries = retries
+        self.timeout = timeout
+        self.segments = max(1, segments)
+        self.segmentThreshold = segmentThreshold
+        self.limiter = AdaptiveLimiter(maxJobs, fastLatency)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections = 4,
+                                                pool_maxsize = maxJobs * self.segments)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def _attempt(self, url, outFile) :
+        """One download attempt
+
+        Returns:
+            tuple: (HTTP status code (0 for connection errors), True if the
+              server asked to slow down, Retry-After delay or None)
+
+        """
+        self.limiter.acquire()
+        start = time.time()
+        latency = None
+        throttled = False
+        retryAfter = None
+        try :
+            try :
+                r = self.session.get(url, stream = True, timeout = self.timeout)
+            except (requests.ConnectionError, requests.Timeout) :
+                return (0, False, None)
+            latency = time.time() - start
+            try :
+                throttled = r.status_code == 429 or r.status_code >= 500
+                if throttled and "Retry-After" in r.headers :
+                    try :
+                        retryAfter = float(r.headers["Retry-After"])
+                    except ValueError :
+                        pass
+                if r.ok :
+                    partFile = outFile + ".part"
+                    size = int(r.headers.get("Content-Length", -1))
+                    if (self.segments > 1 and r.status_code == 200 and
+                        size >= self.segmentThreshold and
+                        r.headers.get("Accept-Ranges", "").lower() == "bytes") :
+                        self._segmented(url, r, partFile, size)
+                    else :
+                        size = 0
+                        with open(partFile, "wb") as fo :
+                            for chunk in r.raw.stream(1 << 16, decode_content = False) :
+                                fo.write(chunk)
+                                size += len(chunk)
+                    os.replace(partFile, outFile)
+                    elapsed = time.time() - start
+                    pyensemblMetrics.increment("http_download_bytes_total", size)
+                    pyensemblMetrics.observe("http_download_seconds", elapsed)
+                    pyensemblMetrics.observe("http_download_rate_bytes_per_second",
+                                             size / max(elapsed, 1e-6),
+                                             buckets = pyensemblMetrics.RATE_BUCKETS)
+            except (requests.RequestException, IOError) :
+                return (0, False, None)
+            finally :
+                r.close()
+            return (r.status_code, throttled, retryAfter)
+        finally :
+            self.limiter.release(latency = latency, throttled = throttled,
+                                 retryAfter = retryAfter)
+
+    def _segmented(self, url, response, partFile, size) :
+        """Receive a large response as byte ranges over parallel connections
+
+        Args:
+            url (str): URL address
+            response (requests.Response): Response to the plain GET request,
+              which is read for the first range
+            partFile (str): Temporary file, written in place
+            size (int): Size of the response body
+
+        Raises:
+            IOError: If a range is not served or is incomplete
+
+        """
+        ranges = splitRanges(size, self.segments)
+        preallocate(partFile, size)
+        fd = os.open(partFile, os.O_WRONLY)
+        def receive(r, start, end) :
+            position = start
+            for chunk in r.raw.stream(1 << 16, decode_content = False) :
+                chunk = chunk[:end - position]
+                os.pwrite(fd, chunk, position)
+                position += len(chunk)
+                if position >= end :
+                    break
+            if position < end :
+                raise IOError("Incomplete range %i-%i of %s" % (start, end - 1, url))
+        def fetch(item) :
+            (start, end) = item
+            r = self.session.get(url, stream = True, timeout = self.timeout,
+                                 headers = {"Range" : "bytes=%i-%i" % (start, end - 1)})
+            try :
+                if r.status_code != 206 :
+                    raise IOError("Range request answered with status %i" % r.status_code)
+                receive(r, start, end)
+            finally :
+                r.close()
+        try :
+            with futures.ThreadPoolExecutor(len(ranges) - 1) as executor :
+                others = [executor.submit(fetch, x) for x in ranges[1:]]
+                receive(response, *ranges[0])
+                for x in others :
+                    x.result()
+        finally :
+            os.close(fd)
+        pyensemblMetrics.increment("http_download_segments_total", len(ranges))
+
+    def download(self, url, outFile) :
+        """Download a URL to a file, retrying on connection errors, 429 and
+        5xx responses
+
+        Args:
+            url (str): URL address
+            outFile (str): Path to the output file
+
+        Returns:
+            int: HTTP status code of the last attempt (0 if the connection
+              failed)
+
+        """
+        attempt = 0
+        while True :
+            (status, throttled, retryAfter) = self._attempt(url, outFile)
+            pyensemblMetrics.increment("http_download_attempts_total",
+                                       labels = {"status" : status})
+            if (status != 0 and not throttled) or attempt >= self.retries :
+                return status
+            if retryAfter is None :
+                time.sleep(min(2 ** attempt, 60))
+            attempt += 1
+
+    def downloadAll(self, downloads) :
+        """Download several URLs concurrently
+
+        Args:
+            downloads (list of (key, url, outFile)): Downloads to perform
+
+        Returns:
+            dict: Mapping (key, HTTP status code of the download)
+
+        """
+        def run(item) :
+            (key, url, outFile) = item
+            return (key, self.download(url, outFile))
+        with futures.ThreadPoolExecutor(self.maxJobs) as executor :
+            return dict(executor.map(run, downloads))
+
 ### ** EMBLspeciesIndex
 
 class EMBLspeciesIndex(object) :
@@ -344,6 +1815,7 @@ class EMBLspeciesIndex(object) :
 
         """
         self.mapping = dict()
+        self._searchIndex = None
         assert not (html is not None and table is not None)
         if html is not None :
             self.parseHtml(html)
@@ -363,14 +1835,64 @@ class EMBLspeciesIndex(object) :
         """
         self.mapping = parseHtmlToAccNum(content, self.mapping)
 
+    def parseHtmlPages(self, contents, jobs = 1) :
+        """Parse several index pages in parallel and add them to the current
+        mapping
+
+        Args:
+            contents (list of str): Html contents of index files from Ensembl
+            jobs (int): Number of processes
+
+        """
+        self.mapping = parseHtmlPages(contents, jobs, self.mapping)
+
+    def searchIndex(self) :
+        """Return the substring index of the normalized species names,
+        building it again if the mapping changed since the last call
+
+        Returns:
+            tuple: (list of species names, TrigramIndex of their normalized
+              names)
+
+        """
+        signature = (id(self.mapping), len(self.mapping))
+        if self._searchIndex is None or self._searchIndex[0] != signature :
+            keys = list(self.mapping.keys())
+            index = TrigramIndex(normalizeSpeciesName(k) for k in keys)
+            self._searchIndex = (signature, keys, index)
+        return self._searchIndex[1:]
+
     def searchSpecies(self, species) :
         """Return a subset of the current mapping as a new instance after
-        filtering for a query species using filterAccNumBySpecies()
+        filtering for a query species (same matching as
+        filterAccNumBySpecies(), but using the precomputed index)
 
         """
         o = EMBLspeciesIndex()
-        mapping = filterAccNumBySpecies(self.mapping, species)
-        o.mapping.update(mapping)
+        (keys, index) = self.searchIndex()
+        for i in index.search(species.lower()) :
+            o.mapping[keys[i]] = self.mapping[keys[i]]
+        return o
+
+    def searchSpeciesBatch(self, queries) :
+        """Filter the current mapping for several query species in a single
+        pass over the species names
+
+        Args:
+            queries (list of str): Query strings
+
+        Returns:
+            dict: Mapping (query, EMBLspeciesIndex instance with the matching
+              subset of the current mapping)
+
+        """
+        (keys, index) = self.searchIndex()
+        matches = searchBatch(index.texts, [q.lower() for q in queries])
+        o = dict()
+        for (query, hits) in zip(queries, matches) :
+            o[query] = EMBLspeciesIndex()
+            for i in hits :
+                o[query].mapping[keys[i]] = self.mapping[keys[i]]
         return o
 
     def load(self, inFile) :
@@ -395,30 +1917,52 @@ class EMBLspeciesIndex(object) :
 
         """
         with open(outFile, "w") as fo :
-            fo.write(self.makeTable())
+            writeLines(self.iterTable(), fo)
 
     def makeTable(self) :
         """Produce a table for the current mapping
 
         """
-        o = ""
+        return "".join(self.iterTable())
+
+    def iterTable(self) :
+        """Produce the lines of the table for the current mapping, one at a
+        time
+
+        """
         for (k, v) in self.mapping.items() :
-            o += "\t".join([k, v]) + "\n"
-        return o
+            yield "\t".join([k, v]) + "\n"
                         
-    def downloadAll(self, outDir = ".", force = False) :
+    def downloadAll(self, outDir = ".", force = False, maxJobs = DOWNLOAD_MAX_JOBS,
+                    segments = DOWNLOAD_SEGMENTS, segmentThreshold = DOWNLOAD_SEGMENT_THRESHOLD) :
         """Download all the EMBL records present in the mapping.
 
+        Records are downloaded in-process by an HttpDownloader, which opens
+        more concurrent requests while the server answers quickly and backs
+        off when it answers with 429 or 5xx.
+
         Args:
             outDir (str): Path to the output directory (default: ".")
             force (bool): Download a file even if already present on disk?
+            maxJobs (int): Maximum number of concurrent downloads
+            segments (int): Number of byte ranges downloaded in parallel for
+              the records of at least `segmentThreshold` bytes (if the server
+              accepts range requests)
+            segmentThreshold (int): Size in bytes from which a record is
+              split into byte ranges
+
+        Returns:
+            dict: Mapping (accession number, HTTP status code of its download,
+              0 if the connection failed) for the records which were not
+              already on disk
 
         """
+        downloads = []
         for (k, v) in self.mapping.items() :
             outFile = os.path.join(outDir,
                                    ".".join([k, v]).replace(" ", "-").replace("/", "<SLASH>") +
                                    ".EMBL.gz")
-            if not os.path.isfile(outFile) :
-                url = "http://www.ebi.ac.uk/ena/data/view/" + v + "&display=text&download=gzip"
-                downloadUrl(url, outFile)
-                time.sleep(10)
+            if force or not os.path.isfile(outFile) :
+                downloads.append((v, EMBL_DOWNLOAD_URL % v, outFile))
+        return HttpDownloader(maxJobs = maxJobs, segments = segments,
+                              segmentThreshold = segmentThreshold).downloadAll(downloads)
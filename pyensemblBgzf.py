@@ -0,0 +1,511 @@
+### * Description
+
+# Indexed storage of the downloaded FASTA files, for random access to their
+# sequences
+#
+# The gzip files of the FTP server must be decompressed from their start to
+# reach any sequence. They are recompressed here to BGZF (blocked gzip, as
+# produced by "bgzip"): a series of gzip members holding at most 64 kB of
+# uncompressed data each, which is still a valid gzip file. Two indexes are
+# written next to each file, in the formats of samtools:
+#
+#   X.fa.gz.gzi  compressed and uncompressed offsets of the start of each
+#                block
+#   X.fa.gz.fai  name, length, offset of the first base, bases per line and
+#                bytes per line of each record
+#
+# and the size and modification time of the file before it was recompressed
+# are kept in X.fa.gz.source, so that the file is still recognised as a copy
+# of the file of the server.
+#
+# A region of a record is then read by computing its uncompressed offsets from
+# the .fai, finding the blocks holding them in the .gzi and decompressing only
+# these blocks. Uncompressed FASTA files (such as the ".fna" derivatives of
+# the GenBank files) only get a .fai.
+
+### * Setup
+
+### ** Import
+
+import os
+import re
+import sys
+import gzip
+import zlib
+import struct
+import bisect
+import collections
+
+import pyensembl
+import pyensemblMetrics
+
+futures = pyensembl.LazyModule("concurrent.futures")
+
+### ** Parameters
+
+FAI_SUFFIX = ".fai"
+GZI_SUFFIX = ".gzi"
+SOURCE_SUFFIX = ".source"
+# Uncompressed size of the blocks (the one used by bgzip, so that a block
+# which does not compress still fits in the 64 kB limit)
+BGZF_BLOCK_SIZE = 0xff00
+BGZF_LEVEL = 6
+BGZF_JOBS = 2
+# Empty block marking the end of a BGZF file
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+# Files indexed by indexFiles(): the FASTA files of the FTP server and the
+# FASTA derivatives of the GenBank files
+INDEXED_FILES = r"\.(fa\.gz|fna)$"
+READ_SIZE = 1 << 22
+
+PC = pyensembl.PC
+
+### ** FaiRecord
+
+# One line of a .fai index: name of the record, number of bases, offset of
+# its first base in the uncompressed file, bases per line and bytes per line
+# (end of line included)
+FaiRecord = collections.namedtuple("FaiRecord", ["name", "length", "offset", "linebases",
+                                                 "linewidth"])
+
+### * Functions
+
+### ** compressBlock(data, level)
+
+def compressBlock(data, level = BGZF_LEVEL) :
+    """Compress data into one BGZF block
+
+    Args:
+        data (bytes): At most BGZF_BLOCK_SIZE bytes
+        level (int): zlib compression level
+
+    Returns:
+        bytes: gzip member with the BC extra field giving its size
+
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    deflated = compressor.compress(data) + compressor.flush()
+    header = struct.pack("<BBBBIBBHBBHH", 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2,
+                         len(deflated) + 25)
+    return header + deflated + struct.pack("<II", zlib.crc32(data), len(data))
+
+### ** readBlock(fi)
+
+def readBlock(fi) :
+    """Read and decompress the BGZF block at the current position of a file
+
+    Returns:
+        bytes: Uncompressed data (empty at the end of the file)
+
+    """
+    header = fi.read(12)
+    if len(header) == 0 :
+        return b""
+    if len(header) < 12 or header[:4] != b"\x1f\x8b\x08\x04" :
+        raise BgzfError("Not a BGZF block at offset %i of %s" % (fi.tell() - len(header),
+                                                                 fi.name))
+    (xlen, ) = struct.unpack("<H", header[10:12])
+    extra = fi.read(xlen)
+    size = None
+    i = 0
+    while i + 4 <= len(extra) :
+        (length, ) = struct.unpack("<H", extra[i + 2:i + 4])
+        if extra[i:i + 2] == b"BC" and length == 2 :
+            (size, ) = struct.unpack("<H", extra[i + 4:i + 6])
+        i += 4 + length
+    if size is None :
+        raise BgzfError("BGZF block without size in %s" % fi.name)
+    data = fi.read(size + 1 - 12 - xlen)
+    return zlib.decompress(data[:-8], -15)
+
+### ** writeGzi(path, blocks)
+
+def writeGzi(path, blocks) :
+    """Write a .gzi index (little-endian 64-bit integers: number of entries,
+    then the compressed and uncompressed offsets of each block but the first)
+
+    Args:
+        path (str): Path to the index file
+        blocks (list of (int, int)): Compressed and uncompressed offsets of
+          the blocks, from the first one
+
+    """
+    entries = blocks[1:]
+    with open(path, "wb") as fo :
+        fo.write(struct.pack("<Q", len(entries)))
+        for entry in entries :
+            fo.write(struct.pack("<QQ", *entry))
+
+### ** readGzi(path)
+
+def readGzi(path) :
+    """Read a .gzi index
+
+    Returns:
+        tuple: (compressed offsets, uncompressed offsets) of the blocks,
+          including the first one
+
+    """
+    with open(path, "rb") as fi :
+        content = fi.read()
+    (n, ) = struct.unpack("<Q", content[:8])
+    values = struct.unpack("<%iQ" % (2 * n), content[8:8 + 16 * n])
+    return ([0] + list(values[0::2]), [0] + list(values[1::2]))
+
+### ** writeFai(path, records)
+
+def writeFai(path, records) :
+    with open(path, "w") as fo :
+        for record in records :
+            fo.write("\t".join(str(x) for x in record) + "\n")
+
+### ** readFai(path)
+
+def readFai(path) :
+    """Read a .fai index
+
+    Returns:
+        OrderedDict: Mapping (record name, FaiRecord)
+
+    """
+    o = collections.OrderedDict()
+    with open(path, "r") as fi :
+        for line in fi :
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) >= 5 :
+                o[fields[0]] = FaiRecord(fields[0], *[int(x) for x in fields[1:5]])
+    return o
+
+### ** isIndexed(path)
+
+def isIndexed(path) :
+    """Does a FASTA file have indexes at least as recent as its content?
+
+    The indexes are compared with the change time of the file, which is
+    updated when the file is replaced by a new download or linked from the
+    genome store.
+
+    """
+    if not os.path.isfile(path) :
+        return False
+    changed = os.stat(path).st_ctime
+    indexes = [path + FAI_SUFFIX]
+    if path.endswith(".gz") :
+        indexes.append(path + GZI_SUFFIX)
+    return all(os.path.isfile(x) and os.stat(x).st_mtime >= changed for x in indexes)
+
+### ** isRecompressed(path)
+
+def isRecompressed(path) :
+    """Is a file a BGZF copy made by indexFile() (its size differs from the
+    file of the server)?"""
+    return path.endswith(".gz") and isIndexed(path)
+
+### ** recompressedSource(path)
+
+def recompressedSource(path) :
+    """Size and modification time of the file a BGZF copy was made from
+
+    Args:
+        path (str): Path to a file recompressed by indexFile()
+
+    Returns:
+        tuple: (size, modification time), or None if the file was not
+          recompressed or was replaced since
+
+    """
+    source = path + SOURCE_SUFFIX
+    if not isRecompressed(path) or not os.path.isfile(source) :
+        return None
+    if os.stat(source).st_mtime < os.stat(path).st_ctime :
+        return None
+    with open(source, "r") as fi :
+        fields = fi.read().split()
+    try :
+        return (int(fields[0]), float(fields[1]))
+    except (IndexError, ValueError) :
+        return None
+
+### ** indexFile(path, level)
+
+def indexFile(path, level = BGZF_LEVEL) :
+    """Recompress a gzip FASTA file to BGZF and write its .fai and .gzi
+    indexes, or only write the .fai of an uncompressed FASTA file
+
+    The file keeps its modification time, and its size and modification
+    time before recompression are written to a SOURCE_SUFFIX file (see
+    pyensemblFtp.isCurrent()).
+
+    Args:
+        path (str): Path to the FASTA file
+        level (int): zlib compression level
+
+    Returns:
+        tuple: (path, number of records, size before, size after, exception
+          or None)
+
+    """
+    try :
+        stat = os.stat(path)
+        fai = FaiBuilder()
+        if not path.endswith(".gz") :
+            with open(path, "rb") as fi :
+                for chunk in iter(lambda : fi.read(READ_SIZE), b"") :
+                    fai.feed(chunk)
+            records = fai.close()
+        else :
+            tmpPath = path + ".bgzf.part"
+            blocks = []
+            compressed = 0
+            uncompressed = 0
+            with gzip.open(path, "rb") as fi, open(tmpPath, "wb") as fo :
+                for chunk in iter(lambda : fi.read(READ_SIZE), b"") :
+                    fai.feed(chunk)
+                    for i in range(0, len(chunk), BGZF_BLOCK_SIZE) :
+                        data = chunk[i:i + BGZF_BLOCK_SIZE]
+                        block = compressBlock(data, level)
+                        blocks.append((compressed, uncompressed))
+                        fo.write(block)
+                        compressed += len(block)
+                        uncompressed += len(data)
+                fo.write(BGZF_EOF)
+            records = fai.close()
+            os.utime(tmpPath, (stat.st_atime, stat.st_mtime))
+            os.replace(tmpPath, path)
+            writeGzi(path + GZI_SUFFIX, blocks)
+            with open(path + SOURCE_SUFFIX, "w") as fo :
+                fo.write("%i\t%r\n" % (stat.st_size, stat.st_mtime))
+        writeFai(path + FAI_SUFFIX, records)
+        return (path, len(records), stat.st_size, os.path.getsize(path), None)
+    except (OSError, EOFError, zlib.error, BgzfError) as e :
+        if os.path.isfile(path + ".bgzf.part") :
+            os.remove(path + ".bgzf.part")
+        return (path, 0, 0, 0, e)
+
+### ** findUnindexed(folder)
+
+def findUnindexed(folder) :
+    """FASTA files of a download directory (and of its format subdirectories)
+    without up-to-date indexes
+
+    Returns:
+        list of str: Paths to the files
+
+    """
+    o = []
+    for (dirpath, dirnames, filenames) in os.walk(folder) :
+        for name in sorted(filenames) :
+            path = os.path.join(dirpath, name)
+            if re.search(INDEXED_FILES, name) and not isIndexed(path) :
+                o.append(path)
+    return sorted(o)
+
+### ** indexFiles(paths, jobs, level, stderr)
+
+@pyensemblMetrics.profiled
+@pyensemblMetrics.timed("bgzf_seconds")
+def indexFiles(paths, jobs = BGZF_JOBS, level = BGZF_LEVEL, stderr = sys.stderr) :
+    """Recompress and index FASTA files with a pool of processes
+
+    Args:
+        paths (list of str): Paths to the files (see indexFile())
+        jobs (int): Number of files processed in parallel
+        level (int): zlib compression level
+        stderr (file): Stream for progress messages
+
+    Returns:
+        list of (str, Exception): The files which could not be indexed
+
+    """
+    stderr.write(PC.B + pyensembl.timestamp() + "Indexing %i FASTA files" % len(paths) +
+                 PC.E + "\n")
+    failures = []
+    before = 0
+    after = 0
+    with futures.ProcessPoolExecutor(jobs) as pool :
+        for (path, n, sizeBefore, sizeAfter, e) in pool.map(indexFile, paths,
+                                                             [level] * len(paths)) :
+            pyensemblMetrics.increment("bgzf_files_total", labels = {"ok" : e is None})
+            if e is not None :
+                failures.append((path, e))
+                continue
+            pyensemblMetrics.increment("bgzf_records_total", n)
+            if path.endswith(".gz") :
+                before += sizeBefore
+                after += sizeAfter
+    if before > 0 :
+        stderr.write(PC.G + "Recompressed to BGZF: %.1f MB (%.1f MB before)" %
+                     (after / 2**20, before / 2**20) + PC.E + "\n")
+    return failures
+
+### ** parseRegion(region)
+
+def parseRegion(region) :
+    """Parse a region given as "record", "record:start" or "record:start-end"
+    (1-based, inclusive coordinates, as in samtools)
+
+    Returns:
+        tuple: (record, start, end), start and end being None if not given
+
+    """
+    match = re.match(r"^(.+):([0-9,]+)(?:-([0-9,]+))?$", region)
+    if match is None :
+        return (region, None, None)
+    (name, start, end) = match.groups()
+    start = int(start.replace(",", ""))
+    end = int(end.replace(",", "")) if end is not None else None
+    return (name, start, end)
+
+### * Classes
+
+### ** BgzfError
+
+class BgzfError(Exception) :
+    """Raised for malformed FASTA or BGZF files and for regions which cannot
+    be read"""
+    pass
+
+### ** FaiBuilder
+
+class FaiBuilder(object) :
+    """Incremental computation of the .fai index of a FASTA file, from its
+    uncompressed content
+
+    As for "samtools faidx", the lines of a record must all hold the same
+    number of bases, except the last one.
+    """
+
+    def __init__(self) :
+        self.records = []
+        self._offset = 0
+        self._rest = b""
+        # name, length, offset, linebases, linewidth, short line seen
+        self._current = None
+
+    def feed(self, data) :
+        lines = (self._rest + data).split(b"\n")
+        self._rest = lines.pop()
+        for line in lines :
+            self._line(line, len(line) + 1)
+
+    def close(self) :
+        """Finish the index
+
+        Returns:
+            list of FaiRecord
+
+        """
+        if self._rest != b"" :
+            self._line(self._rest, len(self._rest))
+            self._rest = b""
+        self._endRecord()
+        return self.records
+
+    def _line(self, line, width) :
+        self._offset += width
+        if line.startswith(b">") :
+            self._endRecord()
+            fields = line[1:].split(None, 1)
+            if len(fields) == 0 :
+                raise BgzfError("Record without name before offset %i" % self._offset)
+            self._current = [fields[0].decode("latin-1"), 0, self._offset, 0, 0, False]
+            return
+        current = self._current
+        bases = len(line.rstrip(b"\r"))
+        if current is None :
+            if bases > 0 :
+                raise BgzfError("Sequence before the first record header")
+            return
+        if current[3] == 0 :
+            if bases == 0 :
+                # Blank lines before the sequence
+                current[2] = self._offset
+                return
+            (current[3], current[4]) = (bases, width)
+        elif current[5] or bases != current[3] or width != current[4] :
+            if bases > 0 and (current[5] or bases > current[3]) :
+                raise BgzfError("Lines of different lengths in record %s" % current[0])
+            current[5] = True
+        current[1] += bases
+
+    def _endRecord(self) :
+        if self._current is not None :
+            self.records.append(FaiRecord(*self._current[:5]))
+            self._current = None
+
+### ** IndexedFasta
+
+class IndexedFasta(object) :
+    """Random access to the records of an indexed FASTA file (BGZF or
+    uncompressed)"""
+
+    def __init__(self, path) :
+        """
+        Args:
+            path (str): Path to the FASTA file, indexed by indexFile()
+
+        """
+        if not isIndexed(path) :
+            raise BgzfError("%s has no up-to-date index, run \"pyensembl download "
+                            "--bgzf\" on its directory" % path)
+        self.path = path
+        self.records = readFai(path + FAI_SUFFIX)
+        self._blocks = None
+        if path.endswith(".gz") :
+            self._blocks = readGzi(path + GZI_SUFFIX)
+        self._fi = open(path, "rb")
+        # Last block read (compressed offset, data), for consecutive regions
+        self._cached = (None, b"")
+
+    def close(self) :
+        self._fi.close()
+
+    def read(self, start, end) :
+        """Uncompressed bytes between two offsets"""
+        if self._blocks is None :
+            self._fi.seek(start)
+            return self._fi.read(end - start)
+        (coffsets, uoffsets) = self._blocks
+        i = bisect.bisect_right(uoffsets, start) - 1
+        origin = uoffsets[i]
+        position = origin
+        chunks = []
+        while position < end and i < len(coffsets) :
+            if self._cached[0] == coffsets[i] :
+                data = self._cached[1]
+            else :
+                self._fi.seek(coffsets[i])
+                data = readBlock(self._fi)
+                self._cached = (coffsets[i], data)
+            chunks.append(data)
+            position += len(data)
+            i += 1
+        return b"".join(chunks)[start - origin:end - origin]
+
+    @pyensemblMetrics.timed("extract_seconds")
+    def fetch(self, name, start = None, end = None) :
+        """Sequence of a region of a record
+
+        Args:
+            name (str): Name of the record
+            start (int): First position (1-based, from the start if None)
+            end (int): Last position (inclusive, to the end if None)
+
+        Returns:
+            str: The sequence
+
+        """
+        if name not in self.records :
+            raise BgzfError("Record %s not found in %s" % (name, self.path))
+        record = self.records[name]
+        start = 1 if start is None else start
+        end = record.length if end is None else min(end, record.length)
+        if start < 1 or start > end :
+            raise BgzfError("Invalid region %s:%i-%i (record length: %i)" %
+                            (name, start, end, record.length))
+        def offset(i) :
+            # Offset of the base at 0-based position i
+            return (record.offset + (i // record.linebases) * record.linewidth +
+                    i % record.linebases)
+        data = self.read(offset(start - 1), offset(end - 1) + 1)
+        return data.replace(b"\n", b"").replace(b"\r", b"").decode("latin-1")
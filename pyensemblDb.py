@@ -0,0 +1,543 @@
+### * Description
+
+# Local database of EnsemblBacteria species: JSON snapshots of the species
+# catalogue and the SQLite index used to search them
+
+### * Setup
+
+### ** Import
+
+import os
+import json
+import gzip
+import sqlite3
+
+import pyensembl
+import pyensemblMetrics
+
+### ** Parameters
+
+SNAPSHOT_PREFIX = ".pyensembl-bacteria-species."
+CHANGES_PREFIX = ".pyensembl-bacteria-changes."
+# Number of snapshots kept by "pyensembl refresh"
+SNAPSHOT_KEEP = 5
+INDEX_FILE = ".pyensembl-species-index.sqlite"
+# Columns of the species table, in the order of the stored values
+SPECIES_COLUMNS = ["name", "display_name", "aliases", "accession", "assembly",
+                   "common_name", "division", "release", "taxon_id"]
+# Fields compared between snapshots to detect changed species (species are
+# matched by name)
+DIFF_FIELDS = ["accession", "assembly", "release"]
+# Fields which can be searched
+SEARCH_FIELDS = ["name", "display_name"]
+ALIAS_SEARCH_FIELDS = ["name", "display_name", "aliases", "accession", "taxon_id"]
+
+### * Functions
+
+### ** listSnapshots(folder)
+
+def listSnapshots(folder) :
+    """List the species catalogue snapshots present in a folder
+
+    Args:
+        folder (str): Path to the folder
+
+    Returns:
+        list of str: File names, oldest first
+
+    """
+    files = [x for x in os.listdir(folder) if x.startswith(SNAPSHOT_PREFIX) and
+             not x.endswith(".tmp")]
+    files.sort()
+    return files
+
+### ** latestSnapshot(folder)
+
+def latestSnapshot(folder) :
+    """Get the most recent species catalogue snapshot present in a folder
+
+    Args:
+        folder (str): Path to the folder
+
+    Returns:
+        str: File name, or None if there is no snapshot
+
+    """
+    files = listSnapshots(folder)
+    if len(files) == 0 :
+        return None
+    return files[-1]
+
+### ** iterSnapshot(path)
+
+def iterSnapshot(path) :
+    """Read the species from a snapshot file one by one
+
+    Args:
+        path (str): Path to the snapshot file
+
+    Returns:
+        generator: Species JSON objects
+
+    """
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rb") as fi :
+        chunks = iter(lambda : fi.read(1 << 16), b"")
+        for species in pyensembl.iterJsonArray(chunks, key = "species") :
+            yield species
+
+### ** writeSnapshot(species, fo)
+
+def writeSnapshot(species, fo) :
+    """Write species to a snapshot file as they are consumed
+
+    This is a pass-through generator: each species is written to `fo` and
+    then yielded, so that the snapshot can be saved while the same stream is
+    consumed by something else (e.g. SpeciesIndex.build()). The file content
+    is complete once the generator is exhausted.
+
+    Args:
+        species (iterable of dict): Species JSON objects
+        fo (file): Output file, opened in text mode
+
+    Returns:
+        generator: The species from `species`
+
+    """
+    fo.write('{"species": [')
+    first = True
+    for sp in species :
+        if not first :
+            fo.write(", ")
+        first = False
+        json.dump(sp, fo)
+        yield sp
+    fo.write("]}")
+
+### ** changesFile(snapshot)
+
+def changesFile(snapshot) :
+    """Name of the file holding the changes introduced by a snapshot
+
+    Args:
+        snapshot (str): Name of the snapshot file
+
+    Returns:
+        str: Name of the changes file
+
+    """
+    stamp = snapshot[len(SNAPSHOT_PREFIX):]
+    if stamp.endswith(".gz") :
+        stamp = stamp[:-3]
+    return CHANGES_PREFIX + stamp + ".tsv"
+
+### ** pruneSnapshots(folder, keep)
+
+def pruneSnapshots(folder, keep = SNAPSHOT_KEEP) :
+    """Remove the oldest snapshots (and their changes files) from a folder
+
+    Args:
+        folder (str): Path to the folder
+        keep (int): Number of snapshots to keep
+
+    Returns:
+        list of str: Names of the removed snapshots
+
+    """
+    files = listSnapshots(folder)
+    removed = files[:max(0, len(files) - keep)]
+    for f in removed :
+        os.remove(os.path.join(folder, f))
+        changes = os.path.join(folder, changesFile(f))
+        if os.path.isfile(changes) :
+            os.remove(changes)
+    return removed
+
+### ** speciesRow(species)
+
+def speciesRow(species) :
+    """Convert a species JSON object into a row of the species table
+
+    Args:
+        species (dict): Species information, from
+          downloadBacteriaSpecies()["species"]
+
+    Returns:
+        tuple: Values for SPECIES_COLUMNS
+
+    """
+    row = [species.get(c) for c in SPECIES_COLUMNS]
+    aliases = SPECIES_COLUMNS.index("aliases")
+    row[aliases] = "\t".join(row[aliases] or [])
+    return tuple(row)
+
+### ** rowSpecies(row)
+
+def rowSpecies(row) :
+    """Convert a row of the species table back into a species dict
+
+    Args:
+        row (tuple): Values for SPECIES_COLUMNS
+
+    Returns:
+        dict: Species information
+
+    """
+    species = dict(zip(SPECIES_COLUMNS, row))
+    species["aliases"] = [x for x in species["aliases"].split("\t") if x != ""]
+    return species
+
+### ** searchValues(species, fields)
+
+def searchValues(species, fields) :
+    """Values of a species searched by a query
+
+    Args:
+        species (dict): Species information
+        fields (list of str): Searched fields (aliases are searched one by
+          one)
+
+    Returns:
+        generator: The values, as str
+
+    """
+    for f in fields :
+        if f == "aliases" :
+            for a in species["aliases"] :
+                yield a
+        elif species[f] is not None :
+            yield str(species[f])
+
+### ** escapeLike(query)
+
+def escapeLike(query) :
+    """Escape the wildcards of a string used in a LIKE pattern (with ESCAPE
+    '\\')"""
+    return query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+### * Classes
+
+### ** SnapshotDiff
+
+class SnapshotDiff(object) :
+    """Changes between the previous snapshot and a stream of species, written
+    to a changes file as they are found
+
+    Species are matched by name. A species present in both is changed if one
+    of DIFF_FIELDS differs. The previous species are looked up by name in the
+    index of the previous snapshot, and the removed ones are found by joining
+    this index with the new one, so that no snapshot is held in memory.
+    """
+
+    def __init__(self, outFile, previous = None) :
+        """
+        Args:
+            outFile (str): Path to the changes file (written once close() is
+              called)
+            previous (SpeciesIndex): Index of the previous snapshot; if None,
+              all species are new
+
+        """
+        self.outFile = outFile
+        self.previous = previous
+        if previous is not None :
+            # Opened now, so that it still reads the previous index once the
+            # new one replaces it
+            previous.db()
+        self.counts = {"added" : 0, "changed" : 0, "removed" : 0}
+        self._fo = open(outFile + ".tmp", "w")
+        self._fo.write("\t".join(["change"] + pyensembl.SPECIES_FIELDS) + "\n")
+
+    def key(self, values) :
+        return tuple(None if x is None else str(x) for x in values)
+
+    def _write(self, change, sp) :
+        self.counts[change] += 1
+        self._fo.write("\t".join([change] + [str(sp.get(f)) for f in pyensembl.SPECIES_FIELDS]) +
+                       "\n")
+
+    def track(self, species) :
+        """Pass-through generator recording the changes of each species
+
+        Args:
+            species (iterable of dict): Species of the new snapshot
+
+        Returns:
+            generator: The species from `species`
+
+        """
+        sql = ("SELECT " + ", ".join(DIFF_FIELDS) + " FROM species WHERE name = ? "
+               "ORDER BY id LIMIT 1")
+        for sp in species :
+            row = None
+            if self.previous is not None :
+                row = self.previous.db().execute(sql, (sp["name"], )).fetchone()
+            if row is None :
+                self._write("added", sp)
+            elif self.key(row) != self.key(sp.get(f) for f in DIFF_FIELDS) :
+                self._write("changed", sp)
+            yield sp
+
+    def close(self, index) :
+        """Write the removed species and complete the changes file (once
+        track() is exhausted)
+
+        The file has the columns of the species tables produced by "pyensembl
+        search" plus a "change" column, so it can be given to "pyensembl
+        genomes -f".
+
+        Args:
+            index (SpeciesIndex): Index of the new snapshot
+
+        """
+        if self.previous is not None :
+            db = self.previous.db()
+            db.execute("ATTACH DATABASE ? AS new", (index.path, ))
+            try :
+                for row in db.execute("SELECT " + ", ".join(SPECIES_COLUMNS) + " FROM "
+                                      "species AS old WHERE NOT EXISTS (SELECT 1 FROM "
+                                      "new.species AS current WHERE current.name = "
+                                      "old.name) ORDER BY id") :
+                    self._write("removed", rowSpecies(row))
+            finally :
+                db.execute("DETACH DATABASE new")
+        self._fo.close()
+        os.replace(self.outFile + ".tmp", self.outFile)
+
+    def abort(self) :
+        self._fo.close()
+        os.remove(self.outFile + ".tmp")
+
+### ** SpeciesIndex
+
+class SpeciesIndex(object) :
+    """SQLite index of a species catalogue snapshot
+
+    The species are stored in a table with one column per field, with a
+    full-text table using the trigram tokenizer over the searchable fields so
+    that substring queries do not scan the whole catalogue. If the SQLite
+    library does not provide the trigram tokenizer, queries fall back to
+    LIKE scans of the table.
+    """
+
+    def __init__(self, path, memory = False) :
+        """
+        Args:
+            path (str): Path to the index file (created by build() if it does
+              not exist)
+            memory (bool): Copy the index file to memory when it is opened,
+              the copy being usable from any thread (see pyensemblServe)
+
+        """
+        self.path = path
+        self.memory = memory
+        self._db = None
+
+    def db(self) :
+        if self._db is None :
+            if self.memory :
+                db = sqlite3.connect(":memory:", check_same_thread = False)
+                source = sqlite3.connect(self.path)
+                try :
+                    source.backup(db)
+                finally :
+                    source.close()
+                self._db = db
+            else :
+                self._db = sqlite3.connect(self.path)
+        return self._db
+
+    def close(self) :
+        if self._db is not None :
+            self._db.close()
+            self._db = None
+
+    def exists(self) :
+        return os.path.isfile(self.path)
+
+    def meta(self, key) :
+        """Get a value from the meta table (None if absent)"""
+        try :
+            row = self.db().execute("SELECT value FROM meta WHERE key = ?", (key, )).fetchone()
+        except sqlite3.DatabaseError :
+            return None
+        if row is None :
+            return None
+        return row[0]
+
+    def snapshot(self) :
+        """Name of the snapshot file the index was built from"""
+        return self.meta("snapshot")
+
+    @pyensemblMetrics.profiled
+    @pyensemblMetrics.timed("index_build_seconds")
+    def build(self, species, snapshot) :
+        """Build the index from a list of species, replacing any previous one
+
+        The index is written to a temporary file which replaces `self.path`
+        once complete, so that concurrent searches always see a complete
+        index.
+
+        Args:
+            species (iterable of dict): Species information, from
+              downloadBacteriaSpecies()["species"]
+            snapshot (str): Name of the snapshot file the species come from
+
+        """
+        tmpPath = self.path + ".tmp"
+        if os.path.isfile(tmpPath) :
+            os.remove(tmpPath)
+        db = sqlite3.connect(tmpPath)
+        try :
+            db.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+            db.execute("CREATE TABLE species (id INTEGER PRIMARY KEY, " +
+                       ", ".join(["%s %s" % (c, "INTEGER" if c == "release" else
+                                             "TEXT COLLATE NOCASE")
+                                  for c in SPECIES_COLUMNS]) + ")")
+            db.executemany("INSERT INTO species (" + ", ".join(SPECIES_COLUMNS) +
+                           ") VALUES (" + ", ".join(["?"] * len(SPECIES_COLUMNS)) + ")",
+                           (speciesRow(x) for x in species))
+            for c in ["name", "display_name", "release", "assembly"] :
+                db.execute("CREATE INDEX species_%s ON species (%s)" % (c, c))
+            try :
+                db.execute("CREATE VIRTUAL TABLE speciesText USING fts5(" +
+                           ", ".join(ALIAS_SEARCH_FIELDS) + ", content = 'species', "
+                           "content_rowid = 'id', tokenize = 'trigram')")
+                db.execute("INSERT INTO speciesText (speciesText) VALUES ('rebuild')")
+                fts = "1"
+            except sqlite3.OperationalError :
+                fts = "0"
+            db.executemany("INSERT INTO meta VALUES (?, ?)", [("snapshot", snapshot),
+                                                               ("fts", fts)])
+            db.commit()
+            db.close()
+        except BaseException :
+            # E.g. the species could not all be retrieved
+            db.close()
+            os.remove(tmpPath)
+            raise
+        self.close()
+        os.replace(tmpPath, self.path)
+
+    @pyensemblMetrics.timed("index_search_seconds")
+    def search(self, query, aliases = False, prefix = False, release = None,
+               assembly = None) :
+        """Search the species matching a query string (case-insensitive)
+
+        Args:
+            query (str): Query string
+            aliases (bool): Also search in aliases, accession and taxon_id (by
+              default only name and display_name are searched)
+            prefix (bool): Match only at the start of the fields instead of
+              anywhere in them
+            release (int): If not None, keep only species from this release
+            assembly (str): If not None, keep only species with this assembly
+              name
+
+        Returns:
+            list of dict: Matching species, in catalogue order
+
+        """
+        fields = ALIAS_SEARCH_FIELDS if aliases else SEARCH_FIELDS
+        db = self.db()
+        where = []
+        params = []
+        if prefix or len(query) < 3 or self.meta("fts") != "1" :
+            # Trigrams need at least three characters and cannot anchor a
+            # match at the start of a field
+            pattern = escapeLike(query) + "%"
+            if not prefix :
+                pattern = "%" + pattern
+            where.append("(" + " OR ".join(["%s LIKE ? ESCAPE '\\'" % f for f in fields]) + ")")
+            params += [pattern] * len(fields)
+            sql = "SELECT " + ", ".join(SPECIES_COLUMNS) + " FROM species"
+        else :
+            where.append("speciesText MATCH ?")
+            params.append("{%s} : \"%s\"" % (" ".join(fields), query.replace('"', '""')))
+            sql = ("SELECT " + ", ".join(["species." + c for c in SPECIES_COLUMNS]) +
+                   " FROM speciesText JOIN species ON species.id = speciesText.rowid")
+        if release is not None :
+            where.append("release = ?")
+            params.append(int(release))
+        if assembly is not None :
+            where.append("assembly = ?")
+            params.append(assembly)
+        sql += " WHERE " + " AND ".join(where) + " ORDER BY species.id"
+        species = [rowSpecies(x) for x in db.execute(sql, params)]
+        # The index matches may be looser than Python's lower(), check them
+        query = query.lower()
+        def match(value) :
+            value = value.lower()
+            return value.startswith(query) if prefix else query in value
+        return [x for x in species if any(match(v) for v in searchValues(x, fields))]
+
+    def lookup(self, names) :
+        """Get species by name (case-insensitive)
+
+        Args:
+            names (list of str): Species names (e.g. "escherichia_coli_k_12")
+
+        Returns:
+            list of dict: Species information for each name (None for names
+              absent from the catalogue)
+
+        """
+        sql = ("SELECT " + ", ".join(SPECIES_COLUMNS) + " FROM species WHERE name = ? "
+               "ORDER BY id LIMIT 1")
+        db = self.db()
+        o = []
+        for name in names :
+            row = db.execute(sql, (name, )).fetchone()
+            o.append(rowSpecies(row) if row is not None else None)
+        return o
+
+    def count(self) :
+        """Number of species in the index"""
+        return self.db().execute("SELECT COUNT(*) FROM species").fetchone()[0]
+
+    @pyensemblMetrics.profiled
+    @pyensemblMetrics.timed("index_search_seconds", {"batch" : True})
+    def searchBatch(self, queries, aliases = False, prefix = False, release = None,
+                    assembly = None) :
+        """Search the species matching each of several query strings, in a
+        single pass over the catalogue
+
+        The matching is the same as in search(), the queries being looked up
+        together with an Aho-Corasick automaton.
+
+        Args:
+            queries (list of str): Query strings
+            aliases, prefix, release, assembly: See search()
+
+        Returns:
+            list of (str, dict): (query, matching species) pairs, ordered by
+              query and then by catalogue order
+
+        """
+        fields = ALIAS_SEARCH_FIELDS if aliases else SEARCH_FIELDS
+        lowered = [q.lower() for q in queries]
+        automaton = pyensembl.AhoCorasick(lowered)
+        where = []
+        params = []
+        if release is not None :
+            where.append("release = ?")
+            params.append(int(release))
+        if assembly is not None :
+            where.append("assembly = ?")
+            params.append(assembly)
+        sql = "SELECT " + ", ".join(SPECIES_COLUMNS) + " FROM species"
+        if len(where) > 0 :
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY id"
+        hits = [[] for q in queries]
+        for row in self.db().execute(sql, params) :
+            sp = rowSpecies(row)
+            found = set()
+            for value in searchValues(sp, fields) :
+                value = value.lower()
+                for q in automaton.findAll(value) :
+                    if not prefix or value.startswith(lowered[q]) :
+                        found.add(q)
+            for q in found :
+                hits[q].append(sp)
+        return [(query, sp) for (query, species) in zip(queries, hits) for sp in species]
@@ -0,0 +1,1683 @@
+### * Description
+
+# FTP download engine for the sequence data of EnsemblBacteria genomes
+
+### * Setup
+
+### ** Import
+
+import os
+import re
+import sys
+import time
+import json
+import threading
+import io
+import contextlib
+import collections
+import queue
+
+import pyensembl
+import pyensemblBgzf
+import pyensemblGenbank
+import pyensemblMetrics
+
+ftplib = pyensembl.LazyModule("ftplib")
+futures = pyensembl.LazyModule("concurrent.futures")
+
+### ** Parameters
+
+# Host of the FTP server, possibly with a port ("host:port"), can be set from
+# the environment
+FTP_SERVER = os.environ.get("PYENSEMBL_FTP_SERVER", "ftp.ensemblgenomes.org")
+# Root of the format trees on the FTP server
+FTP_ROOT = "pub/bacteria/current"
+FTP_MAX_CONNECTIONS = 4
+FTP_RETRIES = 3
+FTP_TIMEOUT = 60
+FTP_VERIFY_JOBS = 2
+# Program computing the BSD checksums of the CHECKSUMS files ("sum -r" from
+# coreutils), much faster than bsdSum() in Python. If it is not available,
+# the checksums are computed in Python.
+SUM_PROGRAM = "sum"
+PART_SUFFIX = ".part"
+# Files of at least this size (in bytes) are transferred as several byte
+# ranges over parallel connections. The ranges already received are recorded
+# next to the partial file, with this suffix.
+FTP_SEGMENT_THRESHOLD = 64 * 2**20
+FTP_SEGMENTS = 4
+SEGMENTS_SUFFIX = ".segments"
+FTP_BLOCK_SIZE = 1 << 16
+LISTING_CACHE_FILE = ".pyensembl-ftp-listings.json"
+# Colors
+PC = pyensembl.PC
+
+### ** FTPTask
+
+# One file to transfer: the genome it belongs to, its path on the server, its
+# destination path on disk, its (sum, blocks) entry in the CHECKSUMS file of
+# the genome directory, its size and its modification time on the server
+# (these three are None if unknown), the release and collection of the genome
+# and the name of the format of the file
+FTPTask = collections.namedtuple("FTPTask", ["species", "remotePath", "localPath",
+                                             "checksum", "size", "modify", "release",
+                                             "collection", "format"])
+
+### ** FTPFormat
+
+# One format of genome files: its name, the directory of its tree under the
+# FTP root, the subdirectory of the genome directories holding its files ("" if
+# none) and a regular expression matching the names of the files to retrieve
+FTPFormat = collections.namedtuple("FTPFormat", ["name", "tree", "subdir", "pattern"])
+
+# Formats which can be downloaded. The FASTA files come in several flavours,
+# only one of which is retrieved by each format (e.g. "dna" is the top level
+# sequence, not the repeat-masked one nor the chromosome by chromosome files).
+FTP_FORMATS = collections.OrderedDict((x[0], FTPFormat(*x)) for x in [
+    ("genbank", "genbank", "", r"\.dat\.gz$"),
+    ("embl", "embl", "", r"\.dat\.gz$"),
+    ("gff3", "gff3", "", r"\.\d+\.gff3\.gz$"),
+    ("dna", "fasta", "dna", r"\.dna\.toplevel\.fa\.gz$"),
+    ("dna_rm", "fasta", "dna", r"\.dna_rm\.toplevel\.fa\.gz$"),
+    ("dna_sm", "fasta", "dna", r"\.dna_sm\.toplevel\.fa\.gz$"),
+    ("cds", "fasta", "cds", r"\.cds\.all\.fa\.gz$"),
+    ("pep", "fasta", "pep", r"\.pep\.all\.fa\.gz$"),
+    ("ncrna", "fasta", "ncrna", r"\.ncrna\.fa\.gz$")])
+GENBANK = FTP_FORMATS["genbank"]
+
+### ** FTPEntry
+
+# One file of a directory listing: name, size in bytes and modification time
+# (seconds since the epoch, None if the server did not give it precisely)
+FTPEntry = collections.namedtuple("FTPEntry", ["name", "size", "modify"])
+
+### ** ChecksumError
+
+class ChecksumError(Exception) :
+    """Raised when a downloaded file does not match its CHECKSUMS entry"""
+    pass
+
+### * Functions
+
+### ** splitHost(host)
+
+def splitHost(host) :
+    """Split a "host[:port]" string
+
+    Args:
+        host (str): Host name, optionally followed by a port number
+
+    Returns:
+        tuple: (host, port), port being 21 if not given
+
+    """
+    if ":" in host :
+        (name, port) = host.rsplit(":", 1)
+        return (name, int(port))
+    return (host, 21)
+
+### ** genomeCollection(genome)
+
+def genomeCollection(genome) :
+    """Name of the collection holding a genome on the FTP server
+
+    Args:
+        genome (dict): Genome information, must contain the "dbname" field
+
+    Returns:
+        str: Collection name (e.g. "bacteria_0_collection")
+
+    """
+    return genome["dbname"].split("_collection")[0] + "_collection"
+
+### ** genomeRelease(genome)
+
+def genomeRelease(genome) :
+    """Ensembl Genomes release of a genome, from its database name
+
+    Args:
+        genome (dict): Genome information, must contain the "dbname" field
+          (e.g. "bacteria_0_collection_core_32_85_1")
+
+    Returns:
+        str: Release number (e.g. "32"), or "unknown"
+
+    """
+    m = re.search(r"_core_(\d+)_\d+_\d+$", genome["dbname"])
+    if m is None :
+        return "unknown"
+    return m.group(1)
+
+### ** genomeDirKey(genome, fmt)
+
+def genomeDirKey(genome, fmt = GENBANK) :
+    """Path of the directory holding the files of a genome in a given format,
+    relative to the FTP root (e.g. "fasta/bacteria_0_collection/species/pep")
+
+    Args:
+        genome (dict): Genome information (as produced by "pyensembl genomes"),
+          must contain the "dbname" and "species" fields
+        fmt (FTPFormat): Format of the files
+
+    Returns:
+        str: Relative path of the directory
+
+    """
+    path = fmt.tree + "/" + genomeCollection(genome) + "/" + genome["species"]
+    if fmt.subdir :
+        path += "/" + fmt.subdir
+    return path
+
+### ** genomeFtpDir(genome, root, fmt)
+
+def genomeFtpDir(genome, root = FTP_ROOT, fmt = GENBANK) :
+    """Build the path of the FTP directory holding the files of a genome
+
+    Args:
+        genome (dict): Genome information (as produced by "pyensembl genomes"),
+          must contain the "dbname" and "species" fields
+        root (str): Root of the format trees on the FTP server
+        fmt (FTPFormat): Format of the files
+
+    Returns:
+        str: Path to the genome directory on the FTP server
+
+    """
+    return root + "/" + genomeDirKey(genome, fmt)
+
+### ** keepGenomeFile(name, fmt, plasmids)
+
+def keepGenomeFile(name, fmt = GENBANK, plasmids = False) :
+    """Is a file of a genome directory to be downloaded?
+
+    The files are selected by the pattern of their format, and plasmid files
+    are excluded unless `plasmids` is True. CHECKSUMS and README files are
+    never selected.
+    """
+    if name in ["CHECKSUMS", "README"] :
+        return False
+    if not plasmids and "plasmid" in name :
+        return False
+    return re.search(fmt.pattern, name) is not None
+
+### ** formatDir(outDir, fmt, formats)
+
+def formatDir(outDir, fmt, formats) :
+    """Local directory of the files of a format: the destination directory
+    itself when a single format is downloaded, a subdirectory named after the
+    format otherwise (GenBank and EMBL files have the same names)"""
+    if len(formats) == 1 :
+        return outDir
+    return os.path.join(outDir, fmt.name)
+
+### ** parseListLine(line)
+
+def parseListLine(line) :
+    """Parse one line of a Unix-style LIST output
+
+    Args:
+        line (str): e.g. "-rw-r--r--    1 ftp      ftp      1234 Jan 01  2016 name"
+
+    Returns:
+        tuple: (name, is a directory, size), or None if the line is not a file
+          or directory entry
+
+    """
+    fields = line.split(None, 8)
+    if len(fields) < 9 or fields[0][0] not in "-dl" :
+        return None
+    name = fields[8]
+    if fields[0][0] == "l" :
+        name = name.split(" -> ")[0]
+    try :
+        size = int(fields[4])
+    except ValueError :
+        size = None
+    return (name, fields[0][0] == "d", size)
+
+### ** parseMlsdTime(value)
+
+def parseMlsdTime(value) :
+    """Convert a MLSD "modify" fact (YYYYMMDDHHMMSS[.sss], UTC) to seconds
+    since the epoch"""
+    import calendar
+    return calendar.timegm(time.strptime(value[:14], "%Y%m%d%H%M%S"))
+
+### ** listDirectory(ftp, path)
+
+def listDirectory(ftp, path) :
+    """List the files of a directory with their size and modification time
+
+    MLSD is used when the server supports it. Otherwise the LIST output is
+    parsed, which gives no precise modification time.
+
+    Args:
+        ftp (ftplib.FTP): Logged-in FTP connection
+        path (str): Path to the directory on the server
+
+    Returns:
+        list of FTPEntry: The files (not the subdirectories)
+
+    """
+    with pyensemblMetrics.timer("ftp_listing_seconds") :
+        return _listDirectory(ftp, path)
+
+### ** _listDirectory(ftp, path)
+
+def _listDirectory(ftp, path) :
+    try :
+        entries = []
+        for (name, facts) in ftp.mlsd(path, facts = ["type", "size", "modify"]) :
+            if facts.get("type", "file") != "file" :
+                continue
+            size = int(facts["size"]) if "size" in facts else None
+            modify = parseMlsdTime(facts["modify"]) if "modify" in facts else None
+            entries.append(FTPEntry(name, size, modify))
+        return entries
+    except ftplib.error_perm as e :
+        if not str(e).startswith("50") :
+            raise
+    # Probably not portable way, but should work for now
+    # http://stackoverflow.com/questions/111954/using-pythons-ftplib-to-get-a-directory-listing-portably
+    lines = []
+    ftp.dir(path, lines.append)
+    entries = []
+    for line in lines :
+        parsed = parseListLine(line)
+        if parsed is not None and not parsed[1] :
+            entries.append(FTPEntry(parsed[0], parsed[2], None))
+    return entries
+
+### ** fileModifyTime(ftp, path)
+
+def fileModifyTime(ftp, path) :
+    """Get the modification time of a file with MDTM
+
+    Args:
+        ftp (ftplib.FTP): Logged-in FTP connection
+        path (str): Path to the file on the server
+
+    Returns:
+        float: Seconds since the epoch, or None if the server does not give
+          it
+
+    """
+    try :
+        reply = ftp.sendcmd("MDTM %s" % path)
+    except ftplib.error_perm :
+        return None
+    try :
+        return parseMlsdTime(reply.split()[-1])
+    except ValueError :
+        return None
+
+### ** listGenomeFiles(ftp, ftpPath, fmt, plasmids)
+
+def listGenomeFiles(ftp, ftpPath, fmt = GENBANK, plasmids = False) :
+    """List the files of interest in a genome directory
+
+    Only the files selected by keepGenomeFile() are kept.
+
+    Args:
+        ftp (ftplib.FTP): Logged-in FTP connection
+        ftpPath (str): Path to the genome directory on the server
+        fmt (FTPFormat): Format of the files
+        plasmids (bool): Keep the plasmid files?
+
+    Returns:
+        list of FTPEntry: The files
+
+    """
+    return [x for x in listDirectory(ftp, ftpPath) if keepGenomeFile(x.name, fmt, plasmids)]
+
+### ** listCollection(ftp, path)
+
+def listCollection(ftp, path) :
+    """List all the genome directories of a collection in one request, with a
+    recursive LIST
+
+    The recursive listing gives no modification times (see
+    completeModifyTimes()).
+
+    Args:
+        ftp (ftplib.FTP): Logged-in FTP connection
+        path (str): Path to the collection directory on the server
+
+    Returns:
+        dict: Mapping (path of a directory relative to the collection (e.g.
+          "species" or "species/pep"), list of FTPEntry for all its files),
+          or None if the server does not support recursive listings
+
+    """
+    lines = []
+    try :
+        with pyensemblMetrics.timer("ftp_listing_seconds", {"recursive" : True}) :
+            ftp.retrlines("LIST -R %s" % path, lines.append)
+    except ftplib.error_perm :
+        return None
+    base = [x for x in path.split("/") if x not in ("", ".")]
+    o = dict()
+    current = None
+    recursive = False
+    for line in lines :
+        if line.endswith(":") and not line.startswith(("-", "d", "l", "total")) :
+            # Section header: "<dir>:" relative to the listed directory
+            recursive = True
+            parts = [x for x in line[:-1].split("/") if x not in ("", ".")]
+            if parts[:len(base)] == base :
+                parts = parts[len(base):]
+            current = "/".join(parts) if len(parts) > 0 else None
+            if current is not None :
+                o.setdefault(current, [])
+            continue
+        parsed = parseListLine(line)
+        if current is not None and parsed is not None and not parsed[1] :
+            o[current].append(FTPEntry(parsed[0], parsed[2], None))
+    if not recursive :
+        return None
+    return o
+
+### ** isCurrent(localPath, entry)
+
+def isCurrent(localPath, entry) :
+    """Is a local file an up-to-date copy of a remote file?
+
+    The sizes must be equal, as well as the modification times when the
+    listing gives them (downloaded files get the remote modification time).
+    Files recompressed to BGZF (see pyensemblBgzf) are compared with the size
+    and modification time they had before recompression.
+
+    Args:
+        localPath (str): Path to the local file
+        entry (FTPEntry): Remote file
+
+    Returns:
+        bool
+
+    """
+    if entry.size is None or not os.path.isfile(localPath) :
+        return False
+    stat = os.stat(localPath)
+    (size, modify) = (stat.st_size, stat.st_mtime)
+    if size != entry.size :
+        source = pyensemblBgzf.recompressedSource(localPath)
+        if source is not None :
+            (size, modify) = source
+        elif entry.modify is not None and pyensemblBgzf.isRecompressed(localPath) :
+            # Recompressed before the source sizes were recorded: only the
+            # modification time can be compared
+            size = entry.size
+        if size != entry.size :
+            return False
+    return entry.modify is None or int(modify) == int(entry.modify)
+
+### ** isTransientError(e)
+
+def isTransientError(e) :
+    """Is an FTP error worth trying again on a new connection?
+
+    Temporary errors (4xx replies), dropped connections and timeouts are;
+    permanent errors (5xx replies, e.g. a missing file) and local errors
+    (e.g. a full disk) are not.
+
+    """
+    import socket
+    return isinstance(e, (ftplib.error_temp, EOFError, ConnectionError, socket.timeout,
+                          socket.gaierror))
+
+### ** retrieveChecksums(ftp, ftpPath)
+
+def retrieveChecksums(ftp, ftpPath) :
+    """Download and parse the CHECKSUMS file of a genome directory
+
+    Args:
+        ftp (ftplib.FTP): Logged-in FTP connection
+        ftpPath (str): Path to the genome directory on the server
+
+    Returns:
+        dict: Mapping (file name, (sum, blocks)) as computed by the Unix `sum`
+          command. Empty if the directory has no CHECKSUMS file.
+
+    """
+    content = io.BytesIO()
+    try :
+        ftp.retrbinary("RETR %s/CHECKSUMS" % ftpPath, content.write)
+    except ftplib.error_perm :
+        return dict()
+    return parseChecksums(content.getvalue().decode("ascii", "replace"))
+
+### ** parseChecksums(content)
+
+def parseChecksums(content) :
+    """Parse the content of a CHECKSUMS file
+
+    Each line is the output of the Unix `sum` command: checksum, number of
+    1 kB blocks and file name.
+
+    Args:
+        content (str): Content of the CHECKSUMS file
+
+    Returns:
+        dict: Mapping (file name, (sum, blocks))
+
+    """
+    o = dict()
+    for line in content.splitlines() :
+        line = line.split()
+        if len(line) == 3 :
+            o[line[2]] = (int(line[0]), int(line[1]))
+    return o
+
+### ** bsdSum(path)
+
+def bsdSum(path) :
+    """Compute the checksum of a file with the BSD algorithm used by the Unix
+    `sum` command (the algorithm of the CHECKSUMS files on the Ensembl FTP)
+
+    Each byte rotates the running sum before being added to it, so the sum
+    cannot be computed a chunk at a time: this runs SUM_PROGRAM if it is
+    available (about 100 times faster) and falls back to pythonBsdSum().
+
+    Args:
+        path (str): Path to the file
+
+    Returns:
+        tuple: (sum, number of 1 kB blocks)
+
+    """
+    observed = programBsdSum(path)
+    if observed is None :
+        observed = pythonBsdSum(path)
+    return observed
+
+### ** programBsdSum(path)
+
+def programBsdSum(path) :
+    """Compute the BSD checksum of a file with SUM_PROGRAM
+
+    Args:
+        path (str): Path to the file
+
+    Returns:
+        tuple: (sum, number of 1 kB blocks), or None if the program is not
+          available or fails
+
+    """
+    if SUM_PROGRAM is None :
+        return None
+    import subprocess
+    # The file is given on the standard input so that the output holds no
+    # file name
+    with open(path, "rb") as fi :
+        try :
+            p = subprocess.run([SUM_PROGRAM, "-r"], stdin = fi, stdout = subprocess.PIPE,
+                               stderr = subprocess.DEVNULL)
+        except OSError :
+            return None
+    fields = p.stdout.split()
+    if p.returncode != 0 or len(fields) != 2 or not all(x.isdigit() for x in fields) :
+        return None
+    return (int(fields[0]), int(fields[1]))
+
+### ** pythonBsdSum(path)
+
+def pythonBsdSum(path) :
+    """Compute the BSD checksum of a file in Python (about 200 s per GB)
+
+    Args:
+        path (str): Path to the file
+
+    Returns:
+        tuple: (sum, number of 1 kB blocks)
+
+    """
+    checksum = 0
+    size = 0
+    with open(path, "rb") as fi :
+        while True :
+            chunk = fi.read(1 << 20)
+            if not chunk :
+                break
+            size += len(chunk)
+            for byte in chunk :
+                checksum = (((checksum >> 1) | ((checksum & 1) << 15)) + byte) & 0xffff
+    return (checksum, (size + 1023) // 1024)
+
+### ** verifyFile(path, checksum)
+
+def verifyFile(path, checksum) :
+    """Check a file against its CHECKSUMS entry
+
+    This runs in the worker processes of the verification pool, so it only
+    takes and returns picklable values.
+
+    Args:
+        path (str): Path to the file
+        checksum (tuple): Expected (sum, blocks)
+
+    Returns:
+        tuple: (path, observed (sum, blocks), True if it matches `checksum`)
+
+    """
+    observed = bsdSum(path)
+    return (path, observed, observed == tuple(checksum))
+
+### ** retrieveFile(ftp, task, progress, processor)
+
+@pyensemblMetrics.profiled
+def retrieveFile(ftp, task, progress = None, processor = None) :
+    """Download one file over an FTP connection
+
+    The data is written to `task.localPath` + PART_SUFFIX, which is renamed to
+    `task.localPath` once the transfer is complete. If a partial file is
+    already present (e.g. from an interrupted run), the transfer is resumed
+    from its end with a REST command.
+
+    Args:
+        ftp (ftplib.FTP): Logged-in FTP connection
+        task (FTPTask): File to download
+        progress (DownloadProgress): If not None, updated with the number of
+          bytes received
+        processor (pyensemblGenbank.GenbankProcessor): If not None, the files
+          it accepts are post-processed: the received bytes are streamed to it
+          during the transfer, or the file is handed to it once complete when
+          the transfer was resumed
+
+    """
+    partFile = task.localPath + PART_SUFFIX
+    offset = os.path.getsize(partFile) if os.path.isfile(partFile) else 0
+    if os.path.isfile(partFile + SEGMENTS_SUFFIX) :
+        # Partial file of a segmented transfer: it has its final size but
+        # holds gaps, so it cannot be resumed from its end
+        os.remove(partFile + SEGMENTS_SUFFIX)
+        offset = 0
+    start = time.perf_counter()
+    received = [0]
+    ftp.voidcmd("TYPE I")
+    try :
+        remoteSize = ftp.size(task.remotePath)
+    except ftplib.error_perm :
+        remoteSize = None
+    if remoteSize is not None and offset > remoteSize :
+        offset = 0
+    if processor is not None and not processor.accepts(task) :
+        processor = None
+    stream = None
+    if remoteSize is None or offset < remoteSize :
+        if processor is not None and offset == 0 :
+            stream = processor.open(task)
+        # http://stackoverflow.com/questions/11573817/how-to-download-a-file-via-ftp-with-python-ftplib
+        with open(partFile, "ab" if offset > 0 else "wb") as fo :
+            def write(block) :
+                fo.write(block)
+                if stream is not None :
+                    stream.write(block)
+                received[0] += len(block)
+                if progress is not None :
+                    progress.addBytes(len(block))
+            try :
+                try :
+                    ftp.retrbinary("RETR %s" % task.remotePath, write,
+                                   rest = offset if offset > 0 else None)
+                except (ftplib.error_reply, ftplib.error_perm) :
+                    # The server may not support REST: start from scratch
+                    if offset == 0 :
+                        raise
+                    fo.seek(0)
+                    fo.truncate()
+                    ftp.retrbinary("RETR %s" % task.remotePath, write)
+            except BaseException :
+                if stream is not None :
+                    stream.abort()
+                raise
+    os.replace(partFile, task.localPath)
+    if stream is not None :
+        stream.close()
+    elif processor is not None :
+        processor.processFile(task)
+    modify = task.modify
+    if modify is None :
+        # Listed without modification time: keep the one of the server so
+        # that completeModifyTimes() finds the file current
+        modify = fileModifyTime(ftp, task.remotePath)
+    if modify is not None :
+        os.utime(task.localPath, (time.time(), modify))
+    elapsed = time.perf_counter() - start
+    pyensemblMetrics.increment("ftp_bytes_total", received[0])
+    pyensemblMetrics.observe("ftp_file_seconds", elapsed)
+    pyensemblMetrics.observe("ftp_file_rate_bytes_per_second", received[0] / max(elapsed, 1e-6),
+                             buckets = pyensemblMetrics.RATE_BUCKETS)
+    pyensemblMetrics.event("ftp_file", path = task.remotePath, bytes = received[0],
+                           resumedFrom = offset, seconds = elapsed)
+
+### ** retrieveRange(ftp, remotePath, fd, start, end, received)
+
+def retrieveRange(ftp, remotePath, fd, start, end, received = None) :
+    """Download a byte range of a file over an FTP connection, starting the
+    transfer at its offset with a REST command
+
+    The bytes are written at the same offsets of an open file. The data
+    connection is closed once the range is received, before the end of the
+    file, and the reply of the server to the aborted transfer is consumed so
+    that the connection can be used again.
+
+    Args:
+        ftp (ftplib.FTP): Logged-in FTP connection
+        remotePath (str): Path to the file on the server
+        fd (int): File descriptor open for writing
+        start (int): Offset of the first byte of the range
+        end (int): Offset following the last byte of the range
+        received (function): If not None, called with the length of each
+          block once it is written
+
+    Raises:
+        EOFError: If the file ends before the end of the range
+
+    """
+    ftp.voidcmd("TYPE I")
+    position = start
+    conn = ftp.transfercmd("RETR %s" % remotePath, rest = start if start > 0 else None)
+    try :
+        while position < end :
+            block = conn.recv(min(FTP_BLOCK_SIZE, end - position))
+            if not block :
+                break
+            os.pwrite(fd, block, position)
+            position += len(block)
+            if received is not None :
+                received(len(block))
+    finally :
+        conn.close()
+    try :
+        # 226 if the data connection reached the end of the file, 426 or 451
+        # if it was closed before
+        ftp.voidresp()
+    except ftplib.error_temp :
+        if position < end :
+            raise
+    if position < end :
+        raise EOFError("%s ends at %i, before the end of range %i-%i" %
+                       (remotePath, position, start, end - 1))
+
+### ** retrieveSegmented(pool, task, segments, progress, processor)
+
+@pyensemblMetrics.profiled
+def retrieveSegmented(pool, task, segments = FTP_SEGMENTS, progress = None,
+                      processor = None) :
+    """Download one large file as byte ranges over parallel pooled connections
+
+    The ranges are written in place into `task.localPath` + PART_SUFFIX,
+    preallocated with the size of the file and renamed once all the ranges are
+    received. The offset reached in each range is recorded in a
+    SEGMENTS_SUFFIX file every second and when the transfer stops, so that an
+    interrupted transfer is resumed range by range; a range whose connection drops is
+    resumed from where it stopped by the retries of the pool.
+
+    Args:
+        pool (FTPConnectionPool): Pool of connections to the server
+        task (FTPTask): File to download (its size must be known)
+        segments (int): Number of byte ranges
+        progress (DownloadProgress): If not None, updated with the number of
+          bytes received
+        processor (pyensemblGenbank.GenbankProcessor): If not None, the file
+          is handed to it once complete if it accepts it
+
+    """
+    partFile = task.localPath + PART_SUFFIX
+    stateFile = partFile + SEGMENTS_SUFFIX
+    ranges = pyensembl.splitRanges(task.size, segments)
+    positions = None
+    if os.path.isfile(partFile) and os.path.isfile(stateFile) :
+        try :
+            with open(stateFile, "r") as fi :
+                state = json.load(fi)
+            if (state["size"] == task.size and state["modify"] == task.modify and
+                [tuple(x) for x in state["ranges"]] == ranges) :
+                positions = state["positions"]
+        except (ValueError, KeyError, TypeError) :
+            pass
+    if positions is None :
+        positions = [x[0] for x in ranges]
+    pyensembl.preallocate(partFile, task.size)
+    resumedFrom = sum(p - x[0] for (p, x) in zip(positions, ranges))
+    lock = threading.Lock()
+    saved = [time.time()]
+    def saveState() :
+        with lock :
+            saved[0] = time.time()
+            with open(stateFile + ".tmp", "w") as fo :
+                json.dump({"size" : task.size, "modify" : task.modify,
+                           "ranges" : ranges, "positions" : positions}, fo)
+            os.replace(stateFile + ".tmp", stateFile)
+    start = time.perf_counter()
+    fd = os.open(partFile, os.O_WRONLY)
+    try :
+        saveState()
+        def fetch(i) :
+            def received(n) :
+                positions[i] += n
+                if progress is not None :
+                    progress.addBytes(n)
+                if time.time() - saved[0] > 1.0 :
+                    saveState()
+            def run(ftp) :
+                if positions[i] < ranges[i][1] :
+                    retrieveRange(ftp, task.remotePath, fd, positions[i], ranges[i][1],
+                                  received)
+            pool.run(run)
+        results = runThreaded(range(len(ranges)), fetch, len(ranges))
+    finally :
+        os.close(fd)
+        saveState()
+    errors = [e for (i, result, e) in results if e is not None]
+    if len(errors) > 0 :
+        raise errors[0]
+    os.replace(partFile, task.localPath)
+    os.remove(stateFile)
+    if processor is not None and processor.accepts(task) :
+        processor.processFile(task)
+    modify = task.modify
+    if modify is None :
+        modify = pool.run(lambda ftp : fileModifyTime(ftp, task.remotePath))
+    if modify is not None :
+        os.utime(task.localPath, (time.time(), modify))
+    elapsed = time.perf_counter() - start
+    size = task.size - resumedFrom
+    pyensemblMetrics.increment("ftp_bytes_total", size)
+    pyensemblMetrics.increment("ftp_segments_total", len(ranges))
+    pyensemblMetrics.observe("ftp_file_seconds", elapsed)
+    pyensemblMetrics.observe("ftp_file_rate_bytes_per_second", size / max(elapsed, 1e-6),
+                             buckets = pyensemblMetrics.RATE_BUCKETS)
+    pyensemblMetrics.event("ftp_file", path = task.remotePath, bytes = size,
+                           resumedFrom = resumedFrom, seconds = elapsed,
+                           segments = len(ranges))
+
+### ** retrieveTask(pool, task, progress, processor, segments, segmentThreshold)
+
+def retrieveTask(pool, task, progress = None, processor = None, segments = FTP_SEGMENTS,
+                 segmentThreshold = FTP_SEGMENT_THRESHOLD) :
+    """Download one file with a pooled connection, or as byte ranges over
+    several connections if it is large (see retrieveFile() and
+    retrieveSegmented())
+
+    Args:
+        pool (FTPConnectionPool): Pool of connections to the server
+        task (FTPTask): File to download
+        progress (DownloadProgress): If not None, updated with the number of
+          bytes received
+        processor (pyensemblGenbank.GenbankProcessor): Post-processor of the
+          GenBank files, or None
+        segments (int): Number of byte ranges of the large files (1 to
+          transfer every file over one connection)
+        segmentThreshold (int): Size in bytes from which a file is split into
+          byte ranges
+
+    """
+    if segments > 1 and task.size is not None and task.size >= segmentThreshold :
+        retrieveSegmented(pool, task, segments, progress, processor)
+    else :
+        pool.run(lambda ftp : retrieveFile(ftp, task, progress, processor))
+
+### ** listGenomes(pool, genomes, root, listingCache, jobs, formats, plasmids)
+
+def listGenomes(pool, genomes, root, listingCache, jobs = 1, formats = (GENBANK, ),
+                plasmids = False) :
+    """List the files of interest of several genome directories, in one or
+    several formats
+
+    Collections are listed recursively in one request when possible (one
+    request covering all the FASTA flavours), and directory by directory
+    otherwise. The listings are read from and stored in `listingCache`.
+
+    Args:
+        pool (FTPConnectionPool): Connections to the FTP server
+        genomes (list of dict): Genome information
+        root (str): Root of the format trees on the FTP server
+        listingCache (FTPListingCache): Cache of the listings
+        jobs (int): Number of parallel workers
+        formats (list of FTPFormat): Formats to list
+        plasmids (bool): Keep the plasmid files?
+
+    Returns:
+        tuple: (list of (genome, FTPFormat, list of FTPEntry), list of
+          (genome, Exception) for the directories which could not be listed),
+          the first list following the order of `genomes`, then `formats`
+
+    """
+    dirs = [(genome, fmt) for genome in genomes for fmt in formats]
+    # Collections of each format tree with directories missing from the cache
+    collections_ = collections.OrderedDict()
+    for (genome, fmt) in dirs :
+        if listingCache.getFiles(genomeRelease(genome), genomeDirKey(genome, fmt)) is None :
+            key = (genomeRelease(genome), fmt.tree, genomeCollection(genome))
+            collections_.setdefault(key, set()).add(genome["species"])
+    def listWhole(key) :
+        (release, tree, collection) = key
+        if len(collections_[key]) < 2 :
+            return False
+        path = tree + "/" + collection
+        listing = pool.run(lambda ftp : listCollection(ftp, root + "/" + path))
+        if listing is None :
+            return False
+        for (subdir, files) in listing.items() :
+            listingCache.putFiles(release, path + "/" + subdir, files)
+        return True
+    runThreaded(list(collections_.keys()), listWhole, jobs)
+    # Genome directories still missing from the cache
+    def listOne(item) :
+        (genome, fmt) = item
+        return listGenome(pool, genome, root, listingCache, fmt, plasmids)
+    listings = []
+    failures = []
+    for ((genome, fmt), files, e) in runThreaded(dirs, listOne, jobs) :
+        if e is not None :
+            failures.append((genome, e))
+        else :
+            listings.append((genome, fmt, files))
+    return (listings, failures)
+
+### ** listGenome(pool, genome, root, listingCache, fmt, plasmids)
+
+def listGenome(pool, genome, root, listingCache, fmt = GENBANK, plasmids = False) :
+    """List the files of interest of one genome directory, from the cache if
+    possible
+
+    Args:
+        pool (FTPConnectionPool): Connections to the FTP server
+        genome (dict): Genome information
+        root (str): Root of the format trees on the FTP server
+        listingCache (FTPListingCache): Cache of the listings
+        fmt (FTPFormat): Format of the files
+        plasmids (bool): Keep the plasmid files?
+
+    Returns:
+        list of FTPEntry: The files selected by keepGenomeFile()
+
+    """
+    release = genomeRelease(genome)
+    key = genomeDirKey(genome, fmt)
+    files = listingCache.getFiles(release, key)
+    if files is None :
+        ftpPath = genomeFtpDir(genome, root, fmt)
+        files = pool.run(lambda ftp : listDirectory(ftp, ftpPath))
+        listingCache.putFiles(release, key, files)
+    return [x for x in files if keepGenomeFile(x.name, fmt, plasmids)]
+
+### ** completeModifyTimes(pool, genome, root, listingCache, fmt, files, outDir)
+
+def completeModifyTimes(pool, genome, root, listingCache, fmt, files, outDir) :
+    """Get the modification times missing from a listing (e.g. from a
+    recursive LIST, see listCollection()) for the files which are present in
+    `outDir` with the size of the server, which would be skipped otherwise
+    even if they changed
+
+    The genome directory is listed again with MLSD, which updates the cache,
+    and MDTM is sent for the files still without modification time.
+
+    Args:
+        pool (FTPConnectionPool): Connections to the FTP server
+        genome (dict): Genome information
+        root (str): Root of the format trees on the FTP server
+        listingCache (FTPListingCache): Cache of the listings
+        fmt (FTPFormat): Format of the files
+        files (list of FTPEntry): Files of the directory, from listGenome()
+        outDir (str): Destination directory of the files
+
+    Returns:
+        list of FTPEntry: `files`, with the modification times
+
+    """
+    def unknown(entries) :
+        return [x.name for x in entries if x.modify is None and
+                isCurrent(os.path.join(outDir, x.name), x)]
+    if len(unknown(files)) == 0 :
+        return files
+    ftpPath = genomeFtpDir(genome, root, fmt)
+    listed = pool.run(lambda ftp : listDirectory(ftp, ftpPath))
+    if any(x.modify is not None for x in listed) :
+        listingCache.putFiles(genomeRelease(genome), genomeDirKey(genome, fmt), listed)
+        listed = dict((x.name, x) for x in listed)
+        files = [listed.get(x.name, x) for x in files]
+    names = set(unknown(files))
+    if len(names) > 0 :
+        def modifyTimes(ftp) :
+            return dict((x, fileModifyTime(ftp, ftpPath + "/" + x)) for x in names)
+        times = pool.run(modifyTimes)
+        files = [x._replace(modify = times[x.name]) if x.name in names else x for x in files]
+    return files
+
+### ** genomeChecksums(pool, genome, root, listingCache, fmt)
+
+def genomeChecksums(pool, genome, root, listingCache, fmt = GENBANK) :
+    """Get the CHECKSUMS of a genome directory, from the cache if possible
+
+    Returns:
+        dict: Mapping (file name, (sum, blocks))
+
+    """
+    release = genomeRelease(genome)
+    key = genomeDirKey(genome, fmt)
+    sums = listingCache.getChecksums(release, key)
+    if sums is None :
+        ftpPath = genomeFtpDir(genome, root, fmt)
+        sums = pool.run(lambda ftp : retrieveChecksums(ftp, ftpPath))
+        listingCache.putChecksums(release, key, sums)
+    return sums
+
+### ** selectFiles(files, outDir, skipCurrent)
+
+def selectFiles(files, outDir, skipCurrent = True) :
+    """Keep the files which are missing or changed in `outDir`
+
+    Args:
+        files (list of FTPEntry): Remote files
+        outDir (str): Destination directory
+        skipCurrent (bool): If False, all the files are kept
+
+    Returns:
+        tuple: (list of FTPEntry to transfer, number of files skipped)
+
+    """
+    todo = []
+    for entry in files :
+        if not (skipCurrent and isCurrent(os.path.join(outDir, entry.name), entry)) :
+            todo.append(entry)
+    return (todo, len(files) - len(todo))
+
+### ** genomeTasks(genome, files, outDir, root, checksums, fmt)
+
+def genomeTasks(genome, files, outDir, root, checksums = None, fmt = GENBANK) :
+    """Build the transfer tasks for files of a genome directory
+
+    Args:
+        genome (dict): Genome information
+        files (list of FTPEntry): Files to transfer
+        outDir (str): Destination directory of the files
+        root (str): Root of the format trees on the FTP server
+        checksums (dict): CHECKSUMS of the directory (None if not verified)
+        fmt (FTPFormat): Format of the files
+
+    Returns:
+        list of FTPTask
+
+    """
+    ftpPath = genomeFtpDir(genome, root, fmt)
+    checksums = checksums or dict()
+    release = genomeRelease(genome)
+    collection = genomeCollection(genome)
+    return [FTPTask(genome["species"], ftpPath + "/" + x.name,
+                    os.path.join(outDir, x.name), checksums.get(x.name), x.size,
+                    x.modify, release, collection, fmt.name)
+            for x in files]
+
+### ** takeFromStore(store, tasks)
+
+def takeFromStore(store, tasks) :
+    """Write the files already present in a genome store instead of
+    transferring them
+
+    Args:
+        store (pyensemblStore.GenomeStore): The store
+        tasks (list of FTPTask): Transfers
+
+    Returns:
+        tuple: (list of FTPTask still to transfer, list of FTPTask written
+          from the store)
+
+    """
+    todo = []
+    reused = []
+    for task in tasks :
+        blob = store.find(task)
+        if blob is None :
+            todo.append(task)
+            continue
+        reused.append(task)
+        method = store.materialize(task, blob)
+        store.record(task, blob)
+        pyensemblMetrics.increment("store_files_total", labels = {"result" : method})
+        if task.size is not None :
+            pyensemblMetrics.increment("store_bytes_reused_total", task.size)
+    return (todo, reused)
+
+### ** addToStore(store, tasks)
+
+def addToStore(store, tasks) :
+    """Add downloaded files to a genome store
+
+    Args:
+        store (pyensemblStore.GenomeStore): The store
+        tasks (list of FTPTask): Completed (and verified) transfers
+
+    """
+    for task in tasks :
+        store.add(task)
+        pyensemblMetrics.increment("store_files_total", labels = {"result" : "added"})
+
+### ** scheduleTasks(tasks, genomes)
+
+def scheduleTasks(tasks, genomes) :
+    """Order transfers longest first, so that the last transfers of the
+    workers end close together instead of one large file stretching the end
+    of the run
+
+    The expected cost of a transfer is the size of its file in the listing,
+    or the base count of its genome if the listing did not give it.
+
+    Args:
+        tasks (list of FTPTask): Transfers
+        genomes (list of dict): Genome information (with "base_count")
+
+    Returns:
+        list of FTPTask: The transfers, largest first (in their original
+          order for equal sizes)
+
+    """
+    baseCounts = dict((g["species"], int(g.get("base_count") or 0)) for g in genomes)
+    def cost(task) :
+        if task.size is not None :
+            return task.size
+        return baseCounts.get(task.species, 0)
+    return sorted(tasks, key = lambda x : -cost(x))
+
+### ** resumeTasks(genomes, formats, planned, skipCurrent)
+
+def resumeTasks(genomes, formats, planned, skipCurrent = True) :
+    """Tasks of an interrupted download still to perform, from its journal
+
+    Args:
+        genomes (list of dict): Genome information
+        formats (list of FTPFormat): Formats to download
+        planned (dict): Directories planned by the interrupted download, from
+          pyensemblJournal.DownloadJournal.planned()
+        skipCurrent (bool): Consider the unfinished tasks whose file is up to
+          date as done?
+
+    Returns:
+        tuple: (list of (genome, format) pairs which were not planned, list
+          of FTPTask to perform, list of FTPTask done or up to date, list of
+          FTPTask received but not verified)
+
+    """
+    unplanned = []
+    todo = []
+    done = []
+    unverified = []
+    for genome in genomes :
+        for fmt in formats :
+            key = genomeDirKey(genome, fmt)
+            if key not in planned :
+                unplanned.append((genome, fmt))
+                continue
+            for (task, state) in planned[key] :
+                entry = FTPEntry(os.path.basename(task.localPath), task.size, task.modify)
+                current = isCurrent(task.localPath, entry)
+                if current and state == "received" :
+                    unverified.append(task)
+                elif current and (state == "done" or skipCurrent) :
+                    done.append(task)
+                else :
+                    todo.append(task)
+    return (unplanned, todo, done, unverified)
+
+### ** runThreaded(items, worker, jobs)
+
+def runThreaded(items, worker, jobs = 1) :
+    """Process items from a shared queue with a fixed number of threads
+
+    Args:
+        items (iterable): Items to process
+        worker (function): Called once per item, its return value is stored
+        jobs (int): Number of threads
+
+    Returns:
+        list of (item, result, exception) tuples, in the order of `items`.
+          `exception` is None for successful items.
+
+    """
+    items = list(items)
+    results = [None] * len(items)
+    tasks = queue.Queue()
+    for i, item in enumerate(items) :
+        tasks.put((i, item))
+    def loop() :
+        while True :
+            try :
+                (i, item) = tasks.get_nowait()
+            except queue.Empty :
+                return
+            try :
+                results[i] = (item, worker(item), None)
+            except Exception as e :
+                results[i] = (item, None, e)
+    threads = [threading.Thread(target = loop) for x in range(max(1, min(jobs, len(items))))]
+    for t in threads :
+        t.daemon = True
+        t.start()
+    for t in threads :
+        t.join()
+    return results
+
+### ** finishProcessing(processor, corrupted, stderr)
+
+def finishProcessing(processor, corrupted, stderr = sys.stderr) :
+    """Wait for the post-processing of the GenBank files to complete
+
+    Args:
+        processor (pyensemblGenbank.GenbankProcessor): The processor
+        corrupted (list of FTPTask): Files which failed verification: their
+          derivatives are deleted
+        stderr (file): Stream for progress messages
+
+    Returns:
+        list of (FTPTask, GenbankError): The files which could not be processed
+
+    """
+    stderr.write(PC.B + pyensembl.timestamp() + "Finishing GenBank post-processing" +
+                 PC.E + "\n")
+    corrupted = set(task.localPath for task in corrupted)
+    failures = []
+    for (task, summaries, e) in processor.finish() :
+        pyensemblMetrics.increment("genbank_files_total", labels = {"ok" : e is None})
+        if e is not None :
+            failures.append((task, e))
+        elif task.localPath in corrupted :
+            pyensemblGenbank.removeDerivatives(task.localPath, processor.outputs)
+        else :
+            pyensemblMetrics.increment("genbank_records_total", len(summaries))
+            pyensemblMetrics.increment("genbank_bases_total",
+                                       sum(x["length"] for x in summaries))
+    return failures
+
+### ** downloadGenomes(genomes, outDir, ...)
+
+@pyensemblMetrics.profiled
+def downloadGenomes(genomes, outDir, jobs = 1, maxConnections = FTP_MAX_CONNECTIONS,
+                    host = FTP_SERVER, root = FTP_ROOT, formats = (GENBANK, ),
+                    plasmids = False, verify = True, verifyJobs = FTP_VERIFY_JOBS,
+                    listingCache = None,
+                    skipCurrent = True, store = None, derive = None,
+                    deriveJobs = pyensemblGenbank.GENBANK_JOBS, segments = FTP_SEGMENTS,
+                    segmentThreshold = FTP_SEGMENT_THRESHOLD, journal = None,
+                    resume = False, stderr = sys.stderr) :
+    """Download the files of a list of genomes from the Ensembl FTP server
+
+    Directory listings and file transfers of all the requested formats are
+    distributed over `jobs` threads sharing a pool of at most `maxConnections`
+    logged-in FTP connections. When several formats are requested, the files
+    of each format go to a subdirectory of `outDir` named after it.
+    Each collection is listed with one recursive listing when the server
+    supports it, one listing per genome directory otherwise. Listings and
+    CHECKSUMS are kept in `listingCache` for the release of the genomes, and
+    local files with the same size and modification time as the remote ones
+    are not downloaded again.
+    Finished files are checked against the CHECKSUMS file of their directory
+    by a pool of `verifyJobs` processes while the other transfers go on; files
+    which do not match are deleted.
+    If a `store` is given, files whose content is already stored are written
+    from it instead of being transferred, and the downloaded files are added
+    to it.
+    If `derive` is given, the GenBank files (".dat.gz") are parsed by a pool of
+    `deriveJobs` processes as they are received and the requested derivatives
+    are written next to them (see pyensemblGenbank).
+    Files of at least `segmentThreshold` bytes are transferred as `segments`
+    byte ranges over parallel connections of the pool (see
+    retrieveSegmented()).
+    Transfers are ordered longest first (see scheduleTasks()). If a `journal`
+    is given, the planned files and the state of each transfer are recorded
+    in it; with `resume`, the genome directories planned by the previous
+    download recorded in the journal are not listed again and only its
+    unfinished transfers are performed.
+
+    Args:
+        genomes (list of dict): Genome information (as produced by
+          "pyensembl genomes")
+        outDir (str): Destination directory
+        jobs (int): Number of parallel workers
+        maxConnections (int): Maximum number of simultaneous connections to the
+          FTP server
+        host (str): FTP server ("host" or "host:port")
+        root (str): Root of the format trees on the FTP server
+        formats (list of FTPFormat): Formats to download
+        plasmids (bool): Also download the plasmid files?
+        verify (bool): Check the downloaded files against CHECKSUMS?
+        verifyJobs (int): Number of processes used for the verification
+        listingCache (FTPListingCache): If not None, cache of the directory
+          listings
+        skipCurrent (bool): Skip files already present and up to date in
+          `outDir`?
+        store (pyensemblStore.GenomeStore): If not None, store of the genome
+          files
+        derive (list of str): Derivatives of the GenBank files to produce,
+          among pyensemblGenbank.DERIVATIVES
+        deriveJobs (int): Number of processes parsing the GenBank files
+        segments (int): Number of byte ranges of the large files
+        segmentThreshold (int): Size in bytes from which a file is split into
+          byte ranges
+        journal (pyensemblJournal.DownloadJournal): If not None, journal of
+          the download
+        resume (bool): Resume the download recorded in `journal`? (it is
+          emptied otherwise)
+        stderr (file): Stream for progress messages
+
+    Returns:
+        list of (FTPTask or dict, Exception): The listings and transfers which
+          failed after all retries, the files which failed verification (with
+          a ChecksumError) and the GenBank files which could not be parsed
+          (with a GenbankError)
+
+    """
+    pool = FTPConnectionPool(host = host, maxConnections = maxConnections)
+    verifier = None
+    if verify :
+        verifier = futures.ProcessPoolExecutor(verifyJobs)
+    processor = None
+    if derive :
+        processor = pyensemblGenbank.GenbankProcessor(derive, deriveJobs)
+    verifications = []
+    try :
+        # Take the directories already planned from the journal
+        resumed = []
+        unverified = []
+        unplanned = set(genomeDirKey(g, fmt) for g in genomes for fmt in formats)
+        if journal is not None :
+            settings = dict(host = host, root = root, plasmids = plasmids,
+                            formats = [fmt.name for fmt in formats])
+            if resume and journal.settings() != settings :
+                stderr.write(PC.Y + "The journal of %s is not from a download with the "
+                             "same settings, starting over" % outDir + PC.E + "\n")
+                resume = False
+            if resume :
+                (unplanned, resumed, done, unverified) = resumeTasks(genomes, formats,
+                                                                     journal.planned(),
+                                                                     skipCurrent)
+                for task in done :
+                    journal.setState(task, "done")
+                stderr.write(PC.G + "Resuming: %i files done, %i to transfer, %i genome "
+                             "directories to list" % (len(done) + len(unverified),
+                                                      len(resumed), len(unplanned)) +
+                             PC.E + "\n")
+                unplanned = set(genomeDirKey(g, fmt) for (g, fmt) in unplanned)
+            else :
+                journal.reset(settings)
+        toList = [g for g in genomes if any(genomeDirKey(g, fmt) in unplanned
+                                            for fmt in formats)]
+        # List genome directories
+        stderr.write(PC.B + pyensembl.timestamp() + "Listing %i genome directories" %
+                     (len(toList) * len(formats)) + PC.E + "\n")
+        if listingCache is None :
+            listingCache = FTPListingCache(None)
+        (listings, failures) = listGenomes(pool, toList, root, listingCache, jobs,
+                                           formats, plasmids)
+        # Keep the files which are missing or changed
+        listings = [x for x in listings if genomeDirKey(x[0], x[1]) in unplanned]
+        if skipCurrent :
+            def complete(item) :
+                (genome, fmt, files) = item
+                return completeModifyTimes(pool, genome, root, listingCache, fmt, files,
+                                           formatDir(outDir, fmt, formats))
+            completed = []
+            for ((genome, fmt, files), result, e) in runThreaded(listings, complete, jobs) :
+                if e is not None :
+                    failures.append((genome, e))
+                else :
+                    completed.append((genome, fmt, result))
+            listings = completed
+        pending = []
+        skipped = 0
+        for (genome, fmt, files) in listings :
+            key = genomeDirKey(genome, fmt)
+            (todo, n) = selectFiles(files, formatDir(outDir, fmt, formats), skipCurrent)
+            skipped += n
+            if len(todo) > 0 :
+                pending.append((genome, fmt, todo))
+            elif journal is not None :
+                journal.plan(key, [])
+        pyensemblMetrics.increment("ftp_files_skipped_total", skipped)
+        if skipped > 0 :
+            stderr.write(PC.G + "%i files already up to date" % skipped + PC.E + "\n")
+        # Get the checksums of the directories with files to transfer
+        sums = dict()
+        if verify :
+            def checksums(item) :
+                (genome, fmt, todo) = item
+                return genomeChecksums(pool, genome, root, listingCache, fmt)
+            for ((genome, fmt, todo), result, e) in runThreaded(pending, checksums, jobs) :
+                if e is not None :
+                    failures.append((genome, e))
+                else :
+                    sums[genomeDirKey(genome, fmt)] = result
+        listingCache.save()
+        tasks = []
+        for (genome, fmt, todo) in pending :
+            key = genomeDirKey(genome, fmt)
+            if verify and key not in sums :
+                continue
+            fmtDir = formatDir(outDir, fmt, formats)
+            if not os.path.isdir(fmtDir) :
+                os.makedirs(fmtDir)
+            planned = genomeTasks(genome, todo, fmtDir, root, sums.get(key), fmt)
+            if journal is not None :
+                journal.plan(key, planned)
+            tasks += planned
+        tasks = scheduleTasks(tasks + resumed, genomes)
+        if store is not None :
+            (tasks, reused) = takeFromStore(store, tasks)
+            if journal is not None :
+                for task in reused :
+                    journal.setState(task, "done")
+            if len(reused) > 0 :
+                stderr.write(PC.G + "%i files taken from the store" % len(reused) +
+                             PC.E + "\n")
+            if processor is not None :
+                for task in reused :
+                    if processor.accepts(task) :
+                        processor.processFile(task)
+        # Transfer files
+        stderr.write(PC.B + pyensembl.timestamp() + "Retrieving %i files" % len(tasks) +
+                     PC.E + "\n")
+        progress = DownloadProgress(len(tasks), stderr = stderr)
+        for task in unverified :
+            if verifier is not None and task.checksum is not None :
+                verifications.append((task, verifier.submit(verifyFile, task.localPath,
+                                                            task.checksum)))
+            else :
+                journal.setState(task, "done")
+        def transfer(task) :
+            if journal is not None :
+                journal.setState(task, "running")
+            try :
+                retrieveTask(pool, task, progress, processor, segments, segmentThreshold)
+            except Exception as e :
+                progress.fileDone(failed = True)
+                if journal is not None :
+                    journal.setState(task, "failed", e)
+                raise
+            progress.fileDone()
+            if verifier is not None and task.checksum is not None :
+                if journal is not None :
+                    journal.setState(task, "received")
+                verifications.append((task, verifier.submit(verifyFile, task.localPath,
+                                                            task.checksum)))
+            elif journal is not None :
+                journal.setState(task, "done")
+        transfers = runThreaded(tasks, transfer, jobs)
+        progress.finish()
+        failures += [(task, e) for (task, result, e) in transfers if e is not None]
+        # Collect the verification results
+        if len(verifications) > 0 :
+            stderr.write(PC.B + pyensembl.timestamp() + "Verifying checksums" +
+                         PC.E + "\n")
+        corrupted = []
+        for (task, future) in verifications :
+            (path, observed, ok) = future.result()
+            pyensemblMetrics.increment("ftp_checksums_total", labels = {"ok" : ok})
+            if not ok :
+                os.remove(path)
+                corrupted.append(task)
+                e = ChecksumError("expected sum %i %i, got %i %i" % (task.checksum + observed))
+                failures.append((task, e))
+                if journal is not None :
+                    journal.setState(task, "failed", e)
+            elif journal is not None :
+                journal.setState(task, "done")
+        if store is not None :
+            failed = set(task.localPath for (task, e) in failures
+                         if isinstance(task, FTPTask))
+            addToStore(store, [task for task in tasks + unverified
+                               if task.localPath not in failed])
+        if processor is not None :
+            failures += finishProcessing(processor, corrupted, stderr)
+    finally :
+        pool.close()
+        if verifier is not None :
+            verifier.shutdown()
+        if processor is not None :
+            processor.close()
+    return failures
+
+### * Classes
+
+### ** FTPConnectionPool
+
+class FTPConnectionPool(object) :
+    """Pool of logged-in anonymous FTP connections to one server
+
+    Connections are opened on demand and never more than `maxConnections` of
+    them exist at the same time: callers block until one is free. A
+    connection on which an error occurred is closed instead of being put back
+    in the pool, so that the next caller gets a fresh login.
+    """
+
+    def __init__(self, host = FTP_SERVER, maxConnections = FTP_MAX_CONNECTIONS,
+                 timeout = FTP_TIMEOUT, retries = FTP_RETRIES) :
+        """
+        Args:
+            host (str): FTP server ("host" or "host:port")
+            maxConnections (int): Maximum number of simultaneous connections
+            timeout (float): Socket timeout in seconds
+            retries (int): Number of reconnections attempted by run()
+
+        """
+        self.host = host
+        self.maxConnections = maxConnections
+        self.timeout = timeout
+        self.retries = retries
+        self._slots = threading.BoundedSemaphore(maxConnections)
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _connect(self) :
+        ftp = ftplib.FTP(timeout = self.timeout)
+        ftp.connect(*splitHost(self.host))
+        ftp.login() # Anonymous login
+        return ftp
+
+    def acquire(self) :
+        """Get a connection, opening a new one if none is idle
+
+        Returns:
+            ftplib.FTP: A logged-in connection, to be given back with release()
+
+        """
+        self._slots.acquire()
+        with self._lock :
+            if len(self._idle) > 0 :
+                return self._idle.pop()
+        try :
+            return self._connect()
+        except :
+            self._slots.release()
+            raise
+
+    def release(self, ftp, broken = False) :
+        """Give a connection back to the pool
+
+        Args:
+            ftp (ftplib.FTP): Connection obtained from acquire()
+            broken (bool): If True, the connection is closed and discarded
+
+        """
+        if broken :
+            try :
+                ftp.close()
+            except Exception :
+                pass
+        else :
+            with self._lock :
+                self._idle.append(ftp)
+        self._slots.release()
+
+    @contextlib.contextmanager
+    def connection(self) :
+        """Context manager yielding a pooled connection"""
+        ftp = self.acquire()
+        try :
+            yield ftp
+        except :
+            self.release(ftp, broken = True)
+            raise
+        self.release(ftp)
+
+    def run(self, function) :
+        """Call function(ftp) on a pooled connection, reconnecting and trying
+        again if the connection drops or the server answers with a temporary
+        error (see isTransientError()); other errors are raised at once
+
+        Args:
+            function (function): Takes a logged-in ftplib.FTP as its only
+              argument
+
+        Returns:
+            The return value of function
+
+        """
+        attempt = 0
+        while True :
+            try :
+                with self.connection() as ftp :
+                    return function(ftp)
+            except ftplib.all_errors as e :
+                if attempt >= self.retries or not isTransientError(e) :
+                    raise
+                pyensemblMetrics.increment("ftp_retries_total")
+                time.sleep(2 ** attempt)
+                attempt += 1
+
+    def close(self) :
+        """Close all idle connections"""
+        with self._lock :
+            idle, self._idle = self._idle, []
+        for ftp in idle :
+            try :
+                ftp.quit()
+            except Exception :
+                ftp.close()
+
+### ** FTPListingCache
+
+class FTPListingCache(object) :
+    """Local cache of the FTP listings and CHECKSUMS of genome directories
+
+    Entries are stored by release and directory (relative to the FTP root, see
+    genomeDirKey()) in a JSON file. Files on the FTP server do not change
+    within a release, so entries never expire: a new release gives new keys.
+    """
+
+    def __init__(self, path) :
+        """
+        Args:
+            path (str): Path to the JSON file (if None, the cache is only kept
+              in memory)
+
+        """
+        self.path = path
+        self.data = dict()
+        self._lock = threading.Lock()
+        self._changed = False
+        if path is not None and os.path.isfile(path) :
+            try :
+                with open(path, "r") as fi :
+                    self.data = json.load(fi)
+            except ValueError :
+                self.data = dict()
+        # Drop the entries stored by collection and species by older versions
+        for release in self.data.values() :
+            for key in [x for x in release if "/" not in x] :
+                del release[key]
+
+    def _entry(self, release, key, create = False) :
+        if create :
+            return self.data.setdefault(release, dict()).setdefault(key, dict())
+        return self.data.get(release, dict()).get(key)
+
+    def getFiles(self, release, key) :
+        """Cached listing of a genome directory (list of FTPEntry), or None"""
+        with self._lock :
+            entry = self._entry(release, key)
+            if entry is None or "files" not in entry :
+                return None
+            return [FTPEntry(*x) for x in entry["files"]]
+
+    def putFiles(self, release, key, files) :
+        with self._lock :
+            self._entry(release, key, True)["files"] = [list(x) for x in files]
+            self._changed = True
+
+    def getChecksums(self, release, key) :
+        """Cached CHECKSUMS of a genome directory (dict), or None"""
+        with self._lock :
+            entry = self._entry(release, key)
+            if entry is None or "checksums" not in entry :
+                return None
+            return {k : tuple(v) for (k, v) in entry["checksums"].items()}
+
+    def putChecksums(self, release, key, checksums) :
+        with self._lock :
+            self._entry(release, key, True)["checksums"] = checksums
+            self._changed = True
+
+    def save(self) :
+        """Write the cache to its file if it changed"""
+        with self._lock :
+            if self.path is None or not self._changed :
+                return
+            with open(self.path + ".tmp", "w") as fo :
+                json.dump(self.data, fo)
+            os.replace(self.path + ".tmp", self.path)
+            self._changed = False
+
+### ** DownloadProgress
+
+class DownloadProgress(object) :
+    """Thread-safe progress report for a whole download run, written as a
+    single status line refreshed at most once per `interval` seconds
+    """
+
+    def __init__(self, nFiles, stderr = sys.stderr, interval = 1.0) :
+        self.nFiles = nFiles
+        self.stderr = stderr
+        self.interval = interval
+        self.done = 0
+        self.failed = 0
+        self.bytes = 0
+        self.start = time.time()
+        self._lastReport = 0
+        self._lock = threading.Lock()
+
+    def addFiles(self, n) :
+        """Add files to the total (when it is not known from the start)"""
+        with self._lock :
+            self.nFiles += n
+
+    def addBytes(self, n) :
+        with self._lock :
+            self.bytes += n
+        self.report()
+
+    def fileDone(self, failed = False) :
+        with self._lock :
+            if failed :
+                self.failed += 1
+            else :
+                self.done += 1
+        self.report()
+
+    def status(self) :
+        elapsed = max(time.time() - self.start, 1e-6)
+        return ("Retrieved %i/%i files (%i failed), %.1f MB at %.2f MB/s" %
+                (self.done, self.nFiles, self.failed, self.bytes / 1e6,
+                 self.bytes / 1e6 / elapsed))
+
+    def report(self, force = False) :
+        now = time.time()
+        with self._lock :
+            if not force and now - self._lastReport < self.interval :
+                return
+            self._lastReport = now
+            self.stderr.write("\r" + PC.G + pyensembl.timestamp() + self.status() + PC.E)
+            self.stderr.flush()
+
+    def finish(self) :
+        self.report(force = True)
+        self.stderr.write("\n")
@@ -0,0 +1,678 @@
+### * Description
+
+# Incremental GenBank parsing and derivative files (nucleotide FASTA,
+# proteins, feature table, summary statistics), computed while the GenBank
+# files are being downloaded.
+#
+# The parsing runs in worker processes (GenbankProcessor): the transfer
+# threads only hand them the compressed chunks as they arrive, so that the
+# network is never kept waiting by the parsing.
+
+### * Setup
+
+### ** Import
+
+import os
+import re
+import zlib
+import threading
+
+### ** Parameters
+
+# Derivatives which can be produced, with the suffix of their files
+DERIVATIVE_SUFFIXES = [("fasta", ".fna"),
+                       ("proteins", ".faa"),
+                       ("features", ".features.tsv"),
+                       ("summary", ".summary.tsv")]
+DERIVATIVES = [x[0] for x in DERIVATIVE_SUFFIXES]
+GENBANK_JOBS = 2
+# Size of the data messages sent to the workers, and number of messages
+# waiting for each worker before the transfers are held back
+GENBANK_CHUNK_SIZE = 1 << 18
+GENBANK_QUEUE_SIZE = 64
+FASTA_WIDTH = 60
+FEATURE_COLUMNS = ["record", "type", "start", "end", "strand", "locus_tag", "gene",
+                   "protein_id", "product"]
+SUMMARY_COLUMNS = ["record", "accession", "length", "gc", "features", "genes", "cds",
+                   "rrna", "trna", "definition"]
+# Bacterial genetic code (NCBI translation table 11)
+CODON_BASES = "TCAG"
+CODON_AMINO_ACIDS = "FFLLSSSSYY**CC*WLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG"
+START_CODONS = set(["TTG", "CTG", "ATT", "ATC", "ATA", "ATG", "GTG"])
+COMPLEMENT = str.maketrans("ACGTRYKMBVDHNacgtrykmbvdhn", "TGCAYRMKVBHDNtgcayrmkvbhdn")
+
+### * Functions
+
+### ** isGenbankFile(name)
+
+def isGenbankFile(name) :
+    """Is a file name that of a compressed GenBank flat file?"""
+    return name.endswith(".dat.gz")
+
+### ** derivativePaths(path, outputs)
+
+def derivativePaths(path, outputs) :
+    """Paths of the derivative files of a GenBank file
+
+    Args:
+        path (str): Path to the GenBank file (e.g. "X.dat.gz")
+        outputs (list of str): Derivatives, among DERIVATIVES
+
+    Returns:
+        dict: Mapping (derivative, path)
+
+    """
+    base = path
+    for suffix in [".gz", ".dat"] :
+        if base.endswith(suffix) :
+            base = base[:-len(suffix)]
+    return dict((kind, base + suffix) for (kind, suffix) in DERIVATIVE_SUFFIXES
+                if kind in outputs)
+
+### ** removeDerivatives(path, outputs)
+
+def removeDerivatives(path, outputs) :
+    """Remove the derivative files of a GenBank file, if present"""
+    for derivative in derivativePaths(path, outputs).values() :
+        for p in [derivative, derivative + ".part"] :
+            if os.path.isfile(p) :
+                os.remove(p)
+
+### ** parseLocation(text)
+
+def parseLocation(text) :
+    """Parse a GenBank feature location
+
+    Args:
+        text (str): Location (e.g. "complement(join(<1..200,300..>410))")
+
+    Returns:
+        list of (int, int, int): (start, end, strand) of each part, 1-based
+          and inclusive, in the order of transcription. Remote parts (on other
+          records) and between-base positions are skipped.
+
+    """
+    text = text.replace(" ", "")
+    (parts, i) = _parseLocation(text, 0, 1)
+    return parts
+
+def _parseLocation(text, i, strand) :
+    for operator in ["complement(", "join(", "order("] :
+        if text.startswith(operator, i) :
+            i += len(operator)
+            parts = []
+            while True :
+                (sub, i) = _parseLocation(text, i, strand * (-1 if operator == "complement(" else 1))
+                parts += sub
+                if i < len(text) and text[i] == "," :
+                    i += 1
+                    continue
+                break
+            if i < len(text) and text[i] == ")" :
+                i += 1
+            if operator == "complement(" :
+                parts.reverse()
+            return (parts, i)
+    m = re.compile(r"([^,()]*)").match(text, i)
+    token = m.group(1)
+    i = m.end()
+    if ":" in token or "^" in token :
+        return ([], i)
+    bounds = token.replace("<", "").replace(">", "").split("..")
+    try :
+        start = int(bounds[0])
+        end = int(bounds[-1])
+    except ValueError :
+        return ([], i)
+    return ([(start, end, strand)], i)
+
+### ** reverseComplement(seq)
+
+def reverseComplement(seq) :
+    return seq.translate(COMPLEMENT)[::-1]
+
+### ** translate(seq, start)
+
+def translate(seq, start = True) :
+    """Translate a coding sequence with the bacterial genetic code
+
+    Args:
+        seq (str): Nucleotide sequence
+        start (bool): Is the first codon a start codon (translated as M)?
+
+    Returns:
+        str: Protein sequence, without the final stop
+
+    """
+    seq = seq.upper()
+    protein = []
+    for i in range(0, len(seq) - 2, 3) :
+        codon = seq[i:i+3]
+        try :
+            index = (CODON_BASES.index(codon[0]) * 16 + CODON_BASES.index(codon[1]) * 4 +
+                     CODON_BASES.index(codon[2]))
+            protein.append(CODON_AMINO_ACIDS[index])
+        except ValueError :
+            protein.append("X")
+    if start and len(protein) > 0 and seq[:3] in START_CODONS :
+        protein[0] = "M"
+    if len(protein) > 0 and protein[-1] == "*" :
+        protein.pop()
+    return "".join(protein)
+
+### ** processFile(path, outputs)
+
+def processFile(path, outputs) :
+    """Compute the derivatives of a GenBank file already on disk
+
+    Returns:
+        list of dict: Summary of each record (see GenbankDerivatives.close())
+
+    """
+    derivatives = GenbankDerivatives(path, outputs)
+    try :
+        with open(path, "rb") as fi :
+            while True :
+                chunk = fi.read(GENBANK_CHUNK_SIZE)
+                if not chunk :
+                    break
+                derivatives.feed(chunk)
+    except Exception :
+        derivatives.abort()
+        raise
+    return derivatives.close()
+
+### ** _worker(inQueue, outQueue)
+
+def _worker(inQueue, outQueue) :
+    """Loop of a GenbankProcessor worker process
+
+    Messages are (kind, fileId, payload) tuples: ("open", id, (path,
+    outputs)), ("data", id, bytes), ("close", id, None), ("abort", id, None)
+    or ("file", id, (path, outputs)), and None to stop. Exactly one result,
+    (id, summary or None, error message or None), is sent back per file.
+    """
+    states = dict()
+    while True :
+        message = inQueue.get()
+        if message is None :
+            break
+        (kind, fileId, payload) = message
+        try :
+            if kind == "open" :
+                states[fileId] = GenbankDerivatives(*payload)
+            elif kind == "data" :
+                if fileId in states :
+                    states[fileId].feed(payload)
+            elif kind == "close" :
+                if fileId in states :
+                    outQueue.put((fileId, states.pop(fileId).close(), None))
+            elif kind == "abort" :
+                if fileId in states :
+                    states.pop(fileId).abort()
+                    outQueue.put((fileId, None, None))
+            elif kind == "file" :
+                outQueue.put((fileId, processFile(*payload), None))
+        except Exception as e :
+            if fileId in states :
+                states.pop(fileId).abort()
+            outQueue.put((fileId, None, "%s: %s" % (type(e).__name__, e)))
+
+### * Classes
+
+### ** GenbankError
+
+class GenbankError(Exception) :
+    """Raised when the derivatives of a GenBank file could not be computed"""
+    pass
+
+### ** GzipStream
+
+class GzipStream(object) :
+    """Incremental decompression of gzip data, possibly made of several
+    concatenated members"""
+
+    def __init__(self) :
+        self._d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def decompress(self, data) :
+        out = []
+        while data :
+            out.append(self._d.decompress(data))
+            if self._d.eof :
+                data = self._d.unused_data
+                self._d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            else :
+                data = b""
+        return b"".join(out)
+
+### ** GenbankParser
+
+class GenbankParser(object) :
+    """Line-based incremental parser of GenBank flat files
+
+    Lines are given with feed() as they are decoded. The parser calls the
+    methods of a handler object:
+    - startRecord(header): after the LOCUS to FEATURES header (dict with
+      "name", "length", "accession" and "definition")
+    - feature(feature): for each feature (dict with "type", "location" and
+      "qualifiers", a dict of lists of values)
+    - sequence(seq): for each line of the ORIGIN section
+    - endRecord(): at the "//" line closing the record
+    """
+
+    def __init__(self, handler) :
+        self.handler = handler
+        self._section = None
+        self._header = None
+        self._lastKey = None
+        self._feature = None
+        self._qualifier = None
+
+    def feed(self, line) :
+        line = line.rstrip("\r\n")
+        if line.startswith("//") :
+            self._endFeature()
+            if self._section == "features" :
+                self._startRecord()
+            self.handler.endRecord()
+            self._section = None
+            return
+        if self._section == "origin" :
+            self.handler.sequence("".join(line.split()[1:]))
+            return
+        if line[:1] not in (" ", "") :
+            # Start of a top-level section
+            key = line.split(None, 1)[0]
+            value = line[12:].strip()
+            if key == "LOCUS" :
+                fields = line.split()
+                self._header = {"name" : fields[1], "length" : None,
+                                "accession" : fields[1], "definition" : ""}
+                if len(fields) > 2 and fields[2].isdigit() :
+                    self._header["length"] = int(fields[2])
+                self._section = "header"
+            elif key == "FEATURES" :
+                self._section = "features"
+                self._startRecord()
+            elif key == "ORIGIN" :
+                self._endFeature()
+                # Start the record here if there was no FEATURES section
+                if self._header is not None :
+                    self._startRecord()
+                self._section = "origin"
+            else :
+                if self._section == "features" :
+                    self._endFeature()
+                self._section = "header" if self._header is not None else None
+                if key in ("DEFINITION", "ACCESSION", "VERSION") and self._header is not None :
+                    if key == "DEFINITION" :
+                        self._header["definition"] = value
+                    elif key == "ACCESSION" :
+                        self._header["accession"] = value.split()[0] if value else self._header["name"]
+            self._lastKey = key
+            return
+        if self._section == "header" and self._lastKey == "DEFINITION" and line.startswith(" " * 12) :
+            self._header["definition"] += " " + line.strip()
+            return
+        if self._section == "features" :
+            self._featureLine(line)
+
+    def _startRecord(self) :
+        if self._header is not None :
+            self.handler.startRecord(self._header)
+            self._header = None
+
+    def _featureLine(self, line) :
+        if len(line) > 5 and line[5] != " " :
+            # New feature: key at column 6, location at column 22
+            self._endFeature()
+            self._feature = {"type" : line[5:21].strip(), "location" : line[21:].strip(),
+                             "qualifiers" : dict()}
+            self._qualifier = None
+            return
+        if self._feature is None :
+            return
+        text = line[21:].strip()
+        if text.startswith("/") :
+            if "=" in text :
+                (key, value) = text[1:].split("=", 1)
+            else :
+                (key, value) = (text[1:], "")
+            self._qualifier = [key, value]
+            self._feature["qualifiers"].setdefault(key, []).append(None)
+            self._updateQualifier()
+        elif self._qualifier is not None :
+            # Continuation of a qualifier value (translations are not spaced)
+            sep = "" if self._qualifier[0] == "translation" else " "
+            self._qualifier[1] += sep + text
+            self._updateQualifier()
+        else :
+            # Continuation of the location
+            self._feature["location"] += text
+
+    def _updateQualifier(self) :
+        (key, value) = self._qualifier
+        if value.startswith('"') :
+            value = value[1:-1] if value.endswith('"') and len(value) > 1 else value[1:]
+        self._feature["qualifiers"][key][-1] = value
+
+    def _endFeature(self) :
+        if self._feature is not None :
+            self.handler.feature(self._feature)
+            self._feature = None
+            self._qualifier = None
+
+### ** GenbankDerivatives
+
+class GenbankDerivatives(object) :
+    """Compute the derivatives of one compressed GenBank file from its bytes,
+    fed as they arrive
+
+    The derivative files are written with a ".part" suffix and renamed by
+    close(); abort() removes them.
+    """
+
+    def __init__(self, path, outputs) :
+        """
+        Args:
+            path (str): Path of the GenBank file (used to name the derivatives)
+            outputs (list of str): Derivatives to produce, among DERIVATIVES
+
+        """
+        self.paths = derivativePaths(path, outputs)
+        self.files = dict((kind, open(p + ".part", "w")) for (kind, p) in self.paths.items())
+        self.gzip = GzipStream()
+        self.decoder = None
+        self._pending = ""
+        self.parser = GenbankParser(self)
+        self.summaries = []
+        self._record = None
+        if "features" in self.files :
+            self.files["features"].write("\t".join(FEATURE_COLUMNS) + "\n")
+        if "summary" in self.files :
+            self.files["summary"].write("\t".join(SUMMARY_COLUMNS) + "\n")
+
+    def feed(self, data) :
+        """Feed compressed bytes"""
+        text = self.gzip.decompress(data).decode("latin-1")
+        lines = (self._pending + text).split("\n")
+        self._pending = lines.pop()
+        for line in lines :
+            self.parser.feed(line)
+
+    def close(self) :
+        """Finish the files
+
+        Returns:
+            list of dict: Summary of each record (keys from SUMMARY_COLUMNS)
+
+        """
+        if self._pending :
+            self.parser.feed(self._pending)
+            self._pending = ""
+        if "summary" in self.files and len(self.summaries) > 1 :
+            total = {"record" : "total", "accession" : "", "definition" : ""}
+            for key in ["length", "features", "genes", "cds", "rrna", "trna"] :
+                total[key] = sum(x[key] for x in self.summaries)
+            gc = sum(x["gc"] * x["length"] for x in self.summaries)
+            total["gc"] = round(gc / max(total["length"], 1), 4)
+            self._writeSummary(total)
+        for fo in self.files.values() :
+            fo.close()
+        for p in self.paths.values() :
+            os.replace(p + ".part", p)
+        return self.summaries
+
+    def abort(self) :
+        for fo in self.files.values() :
+            fo.close()
+        for p in self.paths.values() :
+            if os.path.isfile(p + ".part") :
+                os.remove(p + ".part")
+
+    # Parser handler
+
+    def startRecord(self, header) :
+        self._record = {"header" : header, "length" : 0, "gc" : 0, "features" : 0,
+                        "genes" : 0, "cds" : 0, "rrna" : 0, "trna" : 0,
+                        "sequence" : [], "proteins" : [], "translate" : False}
+        if "fasta" in self.files :
+            title = header["accession"]
+            if header["definition"] :
+                title += " " + header["definition"]
+            self.files["fasta"].write(">" + title + "\n")
+            self._fastaLine = ""
+
+    def feature(self, feature) :
+        record = self._record
+        if record is None :
+            return
+        kind = feature["type"]
+        record["features"] += 1
+        key = {"gene" : "genes", "CDS" : "cds", "rRNA" : "rrna", "tRNA" : "trna"}.get(kind)
+        if key is not None :
+            record[key] += 1
+        qualifiers = feature["qualifiers"]
+        first = lambda k : (qualifiers.get(k) or [""])[0] or ""
+        if "features" in self.files and kind != "source" :
+            parts = parseLocation(feature["location"])
+            if len(parts) > 0 :
+                start = min(x[0] for x in parts)
+                end = max(x[1] for x in parts)
+                strand = "-" if parts[0][2] < 0 else "+"
+            else :
+                (start, end, strand) = ("", "", "")
+            self.files["features"].write("\t".join([record["header"]["accession"], kind,
+                                                    str(start), str(end), strand,
+                                                    first("locus_tag"), first("gene"),
+                                                    first("protein_id"),
+                                                    first("product")]) + "\n")
+        if "proteins" in self.files and kind == "CDS" and "pseudo" not in qualifiers :
+            # Written at the end of the record, once its sequence is known for
+            # the CDS without a /translation
+            record["proteins"].append(feature)
+            if not first("translation") :
+                record["translate"] = True
+
+    def sequence(self, seq) :
+        record = self._record
+        if record is None :
+            return
+        record["length"] += len(seq)
+        record["gc"] += sum(seq.count(x) for x in "gcGCsS")
+        if record["translate"] :
+            record["sequence"].append(seq)
+        if "fasta" in self.files :
+            line = self._fastaLine + seq.upper()
+            n = len(line) - len(line) % FASTA_WIDTH
+            out = self.files["fasta"]
+            for i in range(0, n, FASTA_WIDTH) :
+                out.write(line[i:i+FASTA_WIDTH] + "\n")
+            self._fastaLine = line[n:]
+
+    def endRecord(self) :
+        record = self._record
+        if record is None :
+            return
+        if "fasta" in self.files and self._fastaLine :
+            self.files["fasta"].write(self._fastaLine + "\n")
+            self._fastaLine = ""
+        seq = "".join(record["sequence"])
+        for feature in record["proteins"] :
+            protein = (feature["qualifiers"].get("translation") or [""])[0]
+            self._writeProtein(feature, protein or self._translate(feature, seq))
+        header = record["header"]
+        summary = {"record" : header["name"], "accession" : header["accession"],
+                   "length" : record["length"],
+                   "gc" : round(record["gc"] / max(record["length"], 1), 4),
+                   "features" : record["features"], "genes" : record["genes"],
+                   "cds" : record["cds"], "rrna" : record["rrna"], "trna" : record["trna"],
+                   "definition" : header["definition"]}
+        self.summaries.append(summary)
+        if "summary" in self.files :
+            self._writeSummary(summary)
+        self._record = None
+
+    def _writeSummary(self, summary) :
+        self.files["summary"].write("\t".join(str(summary[x]) for x in SUMMARY_COLUMNS) + "\n")
+
+    def _translate(self, feature, seq) :
+        parts = parseLocation(feature["location"])
+        coding = "".join(seq[start-1:end] if strand > 0 else
+                         reverseComplement(seq[start-1:end])
+                         for (start, end, strand) in parts)
+        codonStart = feature["qualifiers"].get("codon_start", ["1"])[0]
+        try :
+            coding = coding[int(codonStart) - 1:]
+        except ValueError :
+            pass
+        # A partial start is marked on the bound where the transcription
+        # starts: the upper one (">") on the reverse strand, the lower one
+        # ("<") otherwise
+        if len(parts) > 0 and parts[0][2] < 0 :
+            partial = ">" in feature["location"]
+        else :
+            partial = "<" in feature["location"]
+        return translate(coding, start = codonStart == "1" and not partial)
+
+    def _writeProtein(self, feature, protein) :
+        qualifiers = feature["qualifiers"]
+        first = lambda k : (qualifiers.get(k) or [""])[0] or ""
+        name = first("protein_id") or first("locus_tag") or first("gene") or "unknown"
+        title = name
+        if first("product") :
+            title += " " + first("product")
+        out = self.files["proteins"]
+        out.write(">" + title + "\n")
+        for i in range(0, len(protein), FASTA_WIDTH) :
+            out.write(protein[i:i+FASTA_WIDTH] + "\n")
+
+### ** GenbankProcessor
+
+class GenbankProcessor(object) :
+    """Pool of worker processes computing the derivatives of GenBank files
+
+    Files are either streamed (open() returns a GenbankStream receiving the
+    compressed bytes as they are downloaded) or processed from disk
+    (processFile(), e.g. for resumed transfers). All the chunks of a file go
+    to the same worker.
+    """
+
+    def __init__(self, outputs, jobs = GENBANK_JOBS) :
+        """
+        Args:
+            outputs (list of str): Derivatives to produce, among DERIVATIVES
+            jobs (int): Number of worker processes
+
+        """
+        import multiprocessing
+        self.outputs = list(outputs)
+        self.results = multiprocessing.Queue()
+        self.queues = [multiprocessing.Queue(GENBANK_QUEUE_SIZE) for i in range(max(1, jobs))]
+        self.workers = [multiprocessing.Process(target = _worker, args = (q, self.results),
+                                                daemon = True)
+                        for q in self.queues]
+        for worker in self.workers :
+            worker.start()
+        self._lock = threading.Lock()
+        self._files = dict()
+        self._aborted = set()
+        self._next = 0
+
+    def _register(self, task) :
+        with self._lock :
+            fileId = self._next
+            self._next += 1
+            self._files[fileId] = task
+        return (fileId, self.queues[fileId % len(self.queues)])
+
+    def accepts(self, task) :
+        """Does the processor handle the file of a transfer task?"""
+        return task.format == "genbank" and isGenbankFile(task.localPath)
+
+    def open(self, task) :
+        """Start streaming a file
+
+        Args:
+            task (pyensemblFtp.FTPTask): The transfer
+
+        Returns:
+            GenbankStream
+
+        """
+        (fileId, queue) = self._register(task)
+        queue.put(("open", fileId, (task.localPath, self.outputs)))
+        return GenbankStream(self, fileId, queue)
+
+    def processFile(self, task) :
+        """Compute the derivatives of a file already downloaded"""
+        (fileId, queue) = self._register(task)
+        queue.put(("file", fileId, (task.localPath, self.outputs)))
+
+    def finish(self) :
+        """Wait for all the files to be processed and stop the workers
+
+        Returns:
+            list of (task, list of dict, GenbankError): The task, the record
+              summaries and the error (None on success) of each processed file
+
+        """
+        for queue in self.queues :
+            queue.put(None)
+        results = dict()
+        while len(results) < len(self._files) :
+            (fileId, summaries, error) = self.results.get()
+            results[fileId] = (summaries, error)
+        for worker in self.workers :
+            worker.join()
+        o = []
+        for (fileId, task) in sorted(self._files.items()) :
+            if fileId in self._aborted :
+                continue
+            (summaries, error) = results[fileId]
+            o.append((task, summaries, GenbankError(error) if error is not None else None))
+        return o
+
+    def close(self) :
+        """Stop the workers without waiting for the results"""
+        for worker in self.workers :
+            if worker.is_alive() :
+                worker.terminate()
+
+### ** GenbankStream
+
+class GenbankStream(object) :
+    """Compressed bytes of one file, sent by chunks to a worker"""
+
+    def __init__(self, processor, fileId, queue) :
+        self.processor = processor
+        self.fileId = fileId
+        self.queue = queue
+        self._buffer = []
+        self._size = 0
+
+    def write(self, data) :
+        self._buffer.append(data)
+        self._size += len(data)
+        if self._size >= GENBANK_CHUNK_SIZE :
+            self._flush()
+
+    def _flush(self) :
+        if self._size > 0 :
+            self.queue.put(("data", self.fileId, b"".join(self._buffer)))
+            self._buffer = []
+            self._size = 0
+
+    def close(self) :
+        """The file is complete"""
+        self._flush()
+        self.queue.put(("close", self.fileId, None))
+
+    def abort(self) :
+        """The transfer failed: drop the partial derivatives"""
+        self._buffer = []
+        self._size = 0
+        with self.processor._lock :
+            self.processor._aborted.add(self.fileId)
+        self.queue.put(("abort", self.fileId, None))
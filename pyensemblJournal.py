@@ -0,0 +1,173 @@
+### * Description
+
+# Journal of the downloads of "pyensembl download", kept in the destination
+# directory, so that an interrupted download can be resumed without listing
+# the genome directories again
+#
+# The journal records the genome directories whose files were planned (listed
+# and compared with the local files) and, for each file to transfer, its
+# transfer task and its state:
+#
+#   planned   waiting to be transferred
+#   running   transfer started
+#   received  transferred, waiting for the checksum verification
+#   done      transferred and verified (or taken from the genome store)
+#   failed    transfer or verification failed after all retries
+#
+# Each change of state is committed at once, so the journal survives a crash
+# of the process.
+
+### * Setup
+
+### ** Import
+
+import os
+import json
+import time
+import sqlite3
+import threading
+
+import pyensemblFtp
+
+### ** Parameters
+
+JOURNAL_FILE = ".pyensembl-download-journal.sqlite"
+STATES = ["planned", "running", "received", "done", "failed"]
+# Columns of the tasks table holding the fields of pyensemblFtp.FTPTask
+TASK_COLUMNS = ["species", "remotePath", "localPath", "sum", "blocks", "size", "modify",
+                "release", "collection", "format"]
+
+### * Functions
+
+### ** taskRow(task)
+
+def taskRow(task) :
+    """Values of the TASK_COLUMNS for a transfer task"""
+    checksum = task.checksum or (None, None)
+    return (task.species, task.remotePath, task.localPath, checksum[0], checksum[1],
+            task.size, task.modify, task.release, task.collection, task.format)
+
+### ** rowTask(row)
+
+def rowTask(row) :
+    """Transfer task from the values of the TASK_COLUMNS"""
+    (species, remotePath, localPath, s, blocks, size, modify, release, collection,
+     fmt) = row
+    checksum = (s, blocks) if s is not None else None
+    return pyensemblFtp.FTPTask(species, remotePath, localPath, checksum, size, modify,
+                                release, collection, fmt)
+
+### * Classes
+
+### ** DownloadJournal
+
+class DownloadJournal(object) :
+    """SQLite journal of the transfers of a download directory
+
+    Tables:
+        meta: key, value (settings of the download, as JSON)
+        directories: genome directories whose files were planned (key from
+          pyensemblFtp.genomeDirKey())
+        tasks: one row per file to transfer (TASK_COLUMNS), with its
+          directory, state, number of attempts, last error and time of the
+          last change
+    """
+
+    def __init__(self, path) :
+        """
+        Args:
+            path (str): Path to the journal file (created if needed)
+
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread = False)
+        self._db.execute("PRAGMA journal_mode = WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS directories (key TEXT PRIMARY KEY)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS tasks (" +
+                         ", ".join(TASK_COLUMNS) + ", directory TEXT, state TEXT, "
+                         "attempts INTEGER, error TEXT, updated REAL, "
+                         "PRIMARY KEY (localPath))")
+        self._db.commit()
+
+    def settings(self) :
+        """Settings of the download recorded by reset() (None if the journal
+        is empty)"""
+        with self._lock :
+            row = self._db.execute("SELECT value FROM meta WHERE key = 'settings'").fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def reset(self, settings) :
+        """Empty the journal for a new download
+
+        Args:
+            settings (dict): Settings of the download (formats, server, ...),
+              compared by the caller before resuming
+
+        """
+        with self._lock :
+            self._db.execute("DELETE FROM directories")
+            self._db.execute("DELETE FROM tasks")
+            self._db.execute("INSERT OR REPLACE INTO meta VALUES ('settings', ?)",
+                             (json.dumps(settings, sort_keys = True), ))
+            self._db.commit()
+
+    def plan(self, key, tasks) :
+        """Record the files to transfer for a genome directory
+
+        Args:
+            key (str): Key of the directory (pyensemblFtp.genomeDirKey())
+            tasks (list of FTPTask): Files of the directory to transfer (empty
+              if all its files are up to date)
+
+        """
+        now = time.time()
+        with self._lock :
+            self._db.execute("INSERT OR REPLACE INTO directories VALUES (?)", (key, ))
+            self._db.executemany("INSERT OR REPLACE INTO tasks VALUES (" +
+                                 ", ".join(["?"] * (len(TASK_COLUMNS) + 5)) + ")",
+                                 [taskRow(x) + (key, "planned", 0, None, now)
+                                  for x in tasks])
+            self._db.commit()
+
+    def planned(self) :
+        """Genome directories already planned, with their tasks
+
+        Returns:
+            dict: Mapping (directory key, list of (FTPTask, state))
+
+        """
+        o = dict()
+        with self._lock :
+            for (key, ) in self._db.execute("SELECT key FROM directories") :
+                o[key] = []
+            for row in self._db.execute("SELECT " + ", ".join(TASK_COLUMNS) +
+                                        ", directory, state FROM tasks") :
+                o.setdefault(row[-2], []).append((rowTask(row[:-2]), row[-1]))
+        return o
+
+    def setState(self, task, state, error = None) :
+        """Record the new state of a task (and the error if it failed)"""
+        assert state in STATES
+        with self._lock :
+            self._db.execute("UPDATE tasks SET state = ?, error = ?, updated = ?, "
+                             "attempts = attempts + ? WHERE localPath = ?",
+                             (state, None if error is None else str(error), time.time(),
+                              1 if state == "running" else 0, task.localPath))
+            self._db.commit()
+
+    def counts(self) :
+        """Number of tasks in each state
+
+        Returns:
+            dict: Mapping (state, number of tasks)
+
+        """
+        with self._lock :
+            rows = self._db.execute("SELECT state, COUNT(*) FROM tasks GROUP BY state")
+            return dict(rows.fetchall())
+
+    def close(self) :
+        with self._lock :
+            self._db.close()
@@ -0,0 +1,344 @@
+### * Description
+
+# Instrumentation: counters, histograms and timers collected while pyensembl
+# runs, sent to pluggable sinks (JSON-lines event log, Prometheus textfile,
+# summary table), and optional cProfile hooks around the hot functions.
+#
+# Instrumented code only calls the module-level functions (increment(),
+# observe(), timer(), event(), profiled()), which update the default registry.
+# Without sinks and profiling, they only update in-memory aggregates.
+
+### * Setup
+
+### ** Import
+
+import os
+import sys
+import time
+import json
+import threading
+import functools
+import contextlib
+
+### ** Parameters
+
+# Upper bounds of the histogram buckets, suitable for durations in seconds
+TIME_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60,
+                300, 1800]
+# Buckets for transfer rates in bytes per second
+RATE_BUCKETS = [1e4, 1e5, 5e5, 1e6, 5e6, 1e7, 5e7, 1e8]
+
+### * Functions
+
+### ** labelKey(labels)
+
+def labelKey(labels) :
+    """Hashable, sorted version of a dict of labels"""
+    if not labels :
+        return ()
+    return tuple(sorted((str(k), str(v)) for (k, v) in labels.items()))
+
+### ** formatLabels(key)
+
+def formatLabels(key) :
+    """Prometheus representation of a label key (e.g. '{status="200"}')"""
+    if len(key) == 0 :
+        return ""
+    return "{" + ",".join('%s="%s"' % (k, v.replace("\\", "\\\\").replace('"', '\\"'))
+                          for (k, v) in key) + "}"
+
+### ** getMetrics()
+
+def getMetrics() :
+    """Get the default metrics registry"""
+    return _metrics
+
+### ** setMetrics(metrics)
+
+def setMetrics(metrics) :
+    """Replace the default metrics registry"""
+    global _metrics
+    _metrics = metrics
+
+### ** increment(name, value, labels)
+
+def increment(name, value = 1, labels = None) :
+    """Increment a counter of the default registry"""
+    _metrics.increment(name, value, labels)
+
+### ** observe(name, value, labels, buckets)
+
+def observe(name, value, labels = None, buckets = TIME_BUCKETS) :
+    """Add a value to a histogram of the default registry"""
+    _metrics.observe(name, value, labels, buckets)
+
+### ** event(name, **fields)
+
+def event(name, **fields) :
+    """Send an event to the sinks of the default registry"""
+    _metrics.event(name, **fields)
+
+### ** timer(name, labels)
+
+@contextlib.contextmanager
+def timer(name, labels = None) :
+    """Context manager adding the duration of its block, in seconds, to a
+    histogram of the default registry
+
+    Example:
+        with timer("ftp_listing_seconds") :
+            entries = listDirectory(ftp, path)
+
+    """
+    start = time.perf_counter()
+    try :
+        yield
+    finally :
+        _metrics.observe(name, time.perf_counter() - start, labels)
+
+### ** timed(name, labels)
+
+def timed(name, labels = None) :
+    """Decorator recording the duration of each call of a function in a
+    histogram of the default registry"""
+    def decorator(function) :
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs) :
+            with timer(name, labels) :
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+### ** profiled(function)
+
+def profiled(function) :
+    """Decorator running a function under cProfile when profiling is enabled
+    (see Metrics.enableProfiling())
+
+    Only the outermost profiled call of each thread is profiled, and calls
+    made while the profiler is busy in another thread run unprofiled.
+    """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs) :
+        metrics = _metrics
+        if metrics.profile is None or getattr(_local, "profiling", False) :
+            return function(*args, **kwargs)
+        import cProfile
+        profile = cProfile.Profile()
+        try :
+            profile.enable()
+        except ValueError :
+            # Another profiler is active (Python >= 3.12 allows only one)
+            return function(*args, **kwargs)
+        _local.profiling = True
+        try :
+            return function(*args, **kwargs)
+        finally :
+            profile.disable()
+            _local.profiling = False
+            metrics.addProfile(profile)
+    return wrapper
+
+### * Classes
+
+### ** Histogram
+
+class Histogram(object) :
+    """Distribution of observed values: count, sum, extremes and cumulative
+    bucket counts"""
+
+    def __init__(self, buckets = TIME_BUCKETS) :
+        self.buckets = list(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value) :
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min :
+            self.min = value
+        if self.max is None or value > self.max :
+            self.max = value
+        for (i, bound) in enumerate(self.buckets) :
+            if value <= bound :
+                self.counts[i] += 1
+                break
+
+    def cumulative(self) :
+        """List of (upper bound, number of values <= bound)"""
+        o = []
+        total = 0
+        for (bound, n) in zip(self.buckets, self.counts) :
+            total += n
+            o.append((bound, total))
+        return o
+
+    def quantile(self, q) :
+        """Approximate quantile (upper bound of the bucket holding it)"""
+        if self.count == 0 :
+            return None
+        target = q * self.count
+        for (bound, total) in self.cumulative() :
+            if total >= target :
+                return min(bound, self.max)
+        return self.max
+
+### ** Metrics
+
+class Metrics(object) :
+    """Thread-safe registry of counters and histograms, with sinks
+
+    Sinks are objects with an `event(record)` method, called for each event
+    and metric update, and a `close(metrics)` method, called once at the end
+    with the registry.
+    """
+
+    def __init__(self, sinks = None) :
+        self.sinks = list(sinks or [])
+        self.counters = dict()
+        self.histograms = dict()
+        self.profile = None
+        self.profileFile = None
+        self.start = time.time()
+        self._lock = threading.Lock()
+
+    def addSink(self, sink) :
+        self.sinks.append(sink)
+
+    def _emit(self, record) :
+        if self.sinks :
+            record["ts"] = round(time.time(), 6)
+            for sink in self.sinks :
+                sink.event(record)
+
+    def increment(self, name, value = 1, labels = None) :
+        key = (name, labelKey(labels))
+        with self._lock :
+            self.counters[key] = self.counters.get(key, 0) + value
+            self._emit({"type" : "counter", "name" : name, "value" : value,
+                        "labels" : labels or {}})
+
+    def observe(self, name, value, labels = None, buckets = TIME_BUCKETS) :
+        key = (name, labelKey(labels))
+        with self._lock :
+            if key not in self.histograms :
+                self.histograms[key] = Histogram(buckets)
+            self.histograms[key].add(value)
+            self._emit({"type" : "histogram", "name" : name, "value" : value,
+                        "labels" : labels or {}})
+
+    def event(self, name, **fields) :
+        with self._lock :
+            record = {"type" : "event", "name" : name}
+            record.update(fields)
+            self._emit(record)
+
+    def enableProfiling(self, outFile) :
+        """Profile the functions decorated with profiled() and write the
+        combined statistics (pstats format) to `outFile` at close()"""
+        self.profile = []
+        self.profileFile = outFile
+
+    def addProfile(self, profile) :
+        with self._lock :
+            self.profile.append(profile)
+
+    def close(self) :
+        """Hand the registry to the sinks and write the profile, if any"""
+        for sink in self.sinks :
+            sink.close(self)
+        if self.profile :
+            import pstats
+            stats = pstats.Stats(self.profile[0])
+            for profile in self.profile[1:] :
+                stats.add(profile)
+            stats.dump_stats(self.profileFile)
+
+### ** JsonLinesSink
+
+class JsonLinesSink(object) :
+    """Write each event and metric update as one JSON object per line"""
+
+    def __init__(self, path) :
+        self.fo = open(path, "a")
+
+    def event(self, record) :
+        self.fo.write(json.dumps(record, default = str) + "\n")
+
+    def close(self, metrics) :
+        self.fo.write(json.dumps({"type" : "end", "ts" : round(time.time(), 6),
+                                  "elapsed" : time.time() - metrics.start}) + "\n")
+        self.fo.close()
+
+### ** PrometheusSink
+
+class PrometheusSink(object) :
+    """Write the final value of the metrics in the Prometheus text format (for
+    the textfile collector of node_exporter)"""
+
+    def __init__(self, path, prefix = "pyensembl_") :
+        self.path = path
+        self.prefix = prefix
+
+    def event(self, record) :
+        pass
+
+    def close(self, metrics) :
+        lines = []
+        names = set()
+        for ((name, key), value) in sorted(metrics.counters.items()) :
+            if name not in names :
+                lines.append("# TYPE %s%s counter" % (self.prefix, name))
+                names.add(name)
+            lines.append("%s%s%s %s" % (self.prefix, name, formatLabels(key), value))
+        for ((name, key), h) in sorted(metrics.histograms.items(), key = lambda x : x[0]) :
+            if name not in names :
+                lines.append("# TYPE %s%s histogram" % (self.prefix, name))
+                names.add(name)
+            for (bound, total) in h.cumulative() :
+                bucketKey = key + (("le", repr(float(bound))),)
+                lines.append("%s%s_bucket%s %i" % (self.prefix, name,
+                                                   formatLabels(bucketKey), total))
+            lines.append("%s%s_bucket%s %i" % (self.prefix, name,
+                                               formatLabels(key + (("le", "+Inf"),)),
+                                               h.count))
+            lines.append("%s%s_sum%s %s" % (self.prefix, name, formatLabels(key), h.sum))
+            lines.append("%s%s_count%s %i" % (self.prefix, name, formatLabels(key),
+                                              h.count))
+        # The collector must never read a partial file
+        with open(self.path + ".tmp", "w") as fo :
+            fo.write("\n".join(lines) + "\n")
+        os.replace(self.path + ".tmp", self.path)
+
+### ** SummarySink
+
+class SummarySink(object) :
+    """Print a summary table of the metrics at the end of the run"""
+
+    def __init__(self, fo = None) :
+        self.fo = fo
+
+    def event(self, record) :
+        pass
+
+    def close(self, metrics) :
+        fo = self.fo if self.fo is not None else sys.stderr
+        fo.write("Metrics (%.1f s)\n" % (time.time() - metrics.start))
+        for ((name, key), value) in sorted(metrics.counters.items()) :
+            fo.write("  %-50s %14s\n" % (name + formatLabels(key), value))
+        if metrics.histograms :
+            fo.write("  %-50s %8s %10s %10s %10s %10s\n" %
+                     ("", "count", "mean", "p50", "p95", "max"))
+        for ((name, key), h) in sorted(metrics.histograms.items(), key = lambda x : x[0]) :
+            fo.write("  %-50s %8i %10.4g %10.4g %10.4g %10.4g\n" %
+                     (name + formatLabels(key), h.count, h.sum / h.count,
+                      h.quantile(0.5), h.quantile(0.95), h.max))
+        fo.flush()
+
+### * Default registry
+
+_metrics = Metrics()
+_local = threading.local()
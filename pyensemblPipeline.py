@@ -0,0 +1,361 @@
+### * Description
+
+# Genome retrieval pipeline: genome metadata lookups (REST), FTP directory
+# listings and file transfers run as overlapping asyncio stages connected by
+# bounded queues, so that the first files are downloaded while the metadata
+# of later genomes is still arriving ("pyensembl fetch").
+#
+# The REST client and the FTP connections are blocking: each stage runs them
+# in a thread pool, the event loop only moving work between the queues.
+
+### * Setup
+
+### ** Import
+
+import os
+import sys
+import time
+import threading
+
+import pyensembl
+import pyensemblFtp
+import pyensemblGenbank
+import pyensemblMetrics
+
+asyncio = pyensembl.LazyModule("asyncio")
+futures = pyensembl.LazyModule("concurrent.futures")
+
+### ** Parameters
+
+# Size of the queues between the stages: a stage blocks when the next one
+# has that many items waiting
+PIPELINE_QUEUE_SIZE = 16
+PIPELINE_LIST_JOBS = 2
+# Interval (in seconds) at which the metadata reader, while waiting for room
+# in the queue, checks whether the pipeline is stopping
+PIPELINE_STOP_CHECK = 0.2
+# Colors
+PC = pyensembl.PC
+
+### * Functions
+
+### ** fetchGenomes(genomes, outDir, ...)
+
+def fetchGenomes(genomes, outDir, jobs = 1, listJobs = PIPELINE_LIST_JOBS,
+                 maxConnections = pyensemblFtp.FTP_MAX_CONNECTIONS,
+                 host = pyensemblFtp.FTP_SERVER, root = pyensemblFtp.FTP_ROOT,
+                 formats = (pyensemblFtp.GENBANK, ), plasmids = False, verify = True,
+                 verifyJobs = pyensemblFtp.FTP_VERIFY_JOBS,
+                 listingCache = None, skipCurrent = True, store = None, derive = None,
+                 deriveJobs = pyensemblGenbank.GENBANK_JOBS,
+                 segments = pyensemblFtp.FTP_SEGMENTS,
+                 segmentThreshold = pyensemblFtp.FTP_SEGMENT_THRESHOLD, table = None,
+                 queueSize = PIPELINE_QUEUE_SIZE, stderr = sys.stderr) :
+    """Download the files of genomes as their information arrives
+
+    Three stages run concurrently: the genome information is read from
+    `genomes` (typically a generator sending REST requests), the genome
+    directories are listed on the FTP server and the files are transferred
+    and verified. Each stage passes its results to the next one through a
+    bounded queue.
+
+    Args:
+        genomes (iterable of dict): Genome information, e.g. from
+          pyensembl.iterGenomesTaxonName() or pyensembl.retrieveGenomesInfo()
+        outDir (str): Destination directory
+        jobs (int): Number of parallel file transfers
+        listJobs (int): Number of parallel directory listings
+        maxConnections (int): Maximum number of simultaneous connections to the
+          FTP server
+        host (str): FTP server ("host" or "host:port")
+        root (str): Root of the format trees on the FTP server
+        formats (list of pyensemblFtp.FTPFormat): Formats to download (in
+          subdirectories of `outDir` if there are several)
+        plasmids (bool): Also download the plasmid files?
+        verify (bool): Check the downloaded files against CHECKSUMS?
+        verifyJobs (int): Number of processes used for the verification
+        listingCache (pyensemblFtp.FTPListingCache): If not None, cache of the
+          directory listings
+        skipCurrent (bool): Skip files already present and up to date in
+          `outDir`?
+        store (pyensemblStore.GenomeStore): If not None, files already in the
+          store are written from it, and the downloaded files are added to it
+        derive (list of str): Derivatives of the GenBank files to produce while
+          they are received (see pyensemblFtp.downloadGenomes())
+        deriveJobs (int): Number of processes parsing the GenBank files
+        segments (int): Number of byte ranges of the large files
+        segmentThreshold (int): Size in bytes from which a file is split into
+          byte ranges (see pyensemblFtp.retrieveSegmented())
+        table (file): If not None, the genome information is written to it as
+          a table (as by "pyensembl genomes") as it arrives
+        queueSize (int): Size of the queues between the stages
+        stderr (file): Stream for progress messages
+
+    Returns:
+        list of (FTPTask or genome dict, Exception): The failures (listing,
+          transfer, checksum and post-processing failures)
+
+    """
+    if listingCache is None :
+        listingCache = pyensemblFtp.FTPListingCache(None)
+    pipeline = Pipeline(genomes, outDir, jobs = jobs, listJobs = listJobs,
+                        maxConnections = maxConnections, host = host, root = root,
+                        formats = formats, plasmids = plasmids,
+                        verify = verify, verifyJobs = verifyJobs,
+                        listingCache = listingCache, skipCurrent = skipCurrent,
+                        store = store, derive = derive, deriveJobs = deriveJobs,
+                        segments = segments, segmentThreshold = segmentThreshold,
+                        table = table, queueSize = queueSize, stderr = stderr)
+    return asyncio.run(pipeline.run())
+
+### * Classes
+
+### ** Pipeline
+
+class Pipeline(object) :
+    """State of one run of fetchGenomes()"""
+
+    def __init__(self, genomes, outDir, jobs, listJobs, maxConnections, host, root,
+                 formats, plasmids, verify, verifyJobs, listingCache, skipCurrent, store, derive,
+                 deriveJobs, segments, segmentThreshold, table, queueSize, stderr) :
+        self.genomes = genomes
+        self.outDir = outDir
+        self.jobs = max(1, jobs)
+        self.listJobs = max(1, listJobs)
+        self.maxConnections = maxConnections
+        self.host = host
+        self.root = root
+        self.formats = formats
+        self.plasmids = plasmids
+        self.verify = verify
+        self.verifyJobs = verifyJobs
+        self.listingCache = listingCache
+        self.skipCurrent = skipCurrent
+        self.store = store
+        self.derive = derive
+        self.deriveJobs = deriveJobs
+        self.segments = segments
+        self.segmentThreshold = segmentThreshold
+        self.table = table
+        self.queueSize = queueSize
+        self.stderr = stderr
+        self.failures = []
+        self.nGenomes = 0
+        self.nFiles = 0
+        self.skipped = 0
+        self.reused = 0
+        self.transferred = []
+        self.start = None
+        self.firstFile = None
+        self.metadataDone = None
+        # Set when the run ends (normally, on error or when cancelled) so that
+        # the reader thread stops waiting for the event loop
+        self.stopping = threading.Event()
+
+    async def run(self) :
+        """Run the three stages until all the genomes are processed
+
+        Returns:
+            list: The failures, see fetchGenomes()
+
+        """
+        loop = asyncio.get_running_loop()
+        self.start = time.perf_counter()
+        genomesQueue = asyncio.Queue(self.queueSize)
+        tasksQueue = asyncio.Queue(self.queueSize)
+        # One thread per blocking worker: the metadata reader, the listers and
+        # the transfers
+        threads = futures.ThreadPoolExecutor(1 + self.listJobs + self.jobs)
+        verifier = None
+        if self.verify :
+            verifier = futures.ProcessPoolExecutor(self.verifyJobs)
+        self.processor = None
+        if self.derive :
+            self.processor = pyensemblGenbank.GenbankProcessor(self.derive, self.deriveJobs)
+        self.pool = pyensemblFtp.FTPConnectionPool(host = self.host,
+                                                   maxConnections = self.maxConnections)
+        self.progress = pyensemblFtp.DownloadProgress(0, stderr = self.stderr)
+        self.verifications = []
+        self.stderr.write(PC.B + pyensembl.timestamp() + "Retrieving genomes information "
+                          "and files" + PC.E + "\n")
+        try :
+            listers = [asyncio.ensure_future(self.lister(loop, threads, genomesQueue,
+                                                         tasksQueue))
+                       for i in range(self.listJobs)]
+            transfers = [asyncio.ensure_future(self.transfer(loop, threads, verifier,
+                                                             tasksQueue))
+                         for i in range(self.jobs)]
+            await self.reader(loop, threads, genomesQueue)
+            for i in range(self.listJobs) :
+                await genomesQueue.put(None)
+            await asyncio.gather(*listers)
+            for i in range(self.jobs) :
+                await tasksQueue.put(None)
+            await asyncio.gather(*transfers)
+            self.progress.finish()
+            # Collect the verification results
+            corrupted = []
+            for (task, future) in self.verifications :
+                (path, observed, ok) = await future
+                pyensemblMetrics.increment("ftp_checksums_total", labels = {"ok" : ok})
+                if not ok :
+                    os.remove(path)
+                    corrupted.append(task)
+                    self.failures.append((task, pyensemblFtp.ChecksumError(
+                        "expected sum %i %i, got %i %i" % (task.checksum + observed))))
+            if self.store is not None :
+                failed = set(task.localPath for (task, e) in self.failures
+                             if isinstance(task, pyensemblFtp.FTPTask))
+                await loop.run_in_executor(threads, pyensemblFtp.addToStore, self.store,
+                                           [task for task in self.transferred
+                                            if task.localPath not in failed])
+            if self.processor is not None :
+                self.failures += await loop.run_in_executor(
+                    threads, pyensemblFtp.finishProcessing, self.processor, corrupted,
+                    self.stderr)
+        finally :
+            self.stopping.set()
+            self.listingCache.save()
+            self.pool.close()
+            # The threads are joined from another thread, since the reader may
+            # be waiting for the loop (until it sees self.stopping)
+            threads.shutdown(wait = False, cancel_futures = True)
+            if verifier is not None :
+                verifier.shutdown(wait = False, cancel_futures = True)
+            await loop.run_in_executor(None, threads.shutdown)
+            if verifier is not None :
+                await loop.run_in_executor(None, verifier.shutdown)
+            if self.processor is not None :
+                self.processor.close()
+        self.report()
+        return self.failures
+
+    async def reader(self, loop, threads, genomesQueue) :
+        """First stage: read the genome information in a thread and queue it"""
+        def tap() :
+            for genome in self.genomes :
+                # Blocks the thread (not the loop) while the queue is full,
+                # until the pipeline stops
+                put = asyncio.run_coroutine_threadsafe(genomesQueue.put(genome), loop)
+                while True :
+                    if self.stopping.is_set() :
+                        put.cancel()
+                        return
+                    try :
+                        put.result(timeout = PIPELINE_STOP_CHECK)
+                        break
+                    except futures.TimeoutError :
+                        pass
+                self.nGenomes += 1
+                yield genome
+        def read() :
+            if self.table is not None :
+                pyensembl.writeEnsemblInfoGenomes(tap(), self.table, flush = True)
+            else :
+                for genome in tap() :
+                    pass
+        try :
+            await loop.run_in_executor(threads, read)
+        except Exception as e :
+            self.failures.append(({"species" : "genome information"}, e))
+        self.metadataDone = time.perf_counter()
+        pyensemblMetrics.observe("pipeline_stage_seconds", self.metadataDone - self.start,
+                                 {"stage" : "metadata"})
+
+    async def lister(self, loop, threads, genomesQueue, tasksQueue) :
+        """Second stage: list the genome directories and queue the files to
+        transfer"""
+        while True :
+            genome = await genomesQueue.get()
+            if genome is None :
+                return
+            try :
+                (tasks, skipped) = await loop.run_in_executor(threads, self.plan, genome)
+            except Exception as e :
+                self.failures.append((genome, e))
+                continue
+            self.skipped += skipped
+            self.progress.addFiles(len(tasks))
+            for task in tasks :
+                await tasksQueue.put(task)
+
+    def plan(self, genome) :
+        """List the directories of a genome (one per format) and build the
+        transfer tasks of the files which are missing or changed, writing those
+        found in the store (runs in a thread)
+
+        Returns:
+            tuple: (list of FTPTask, number of files already up to date)
+
+        """
+        tasks = []
+        skipped = 0
+        for fmt in self.formats :
+            files = pyensemblFtp.listGenome(self.pool, genome, self.root, self.listingCache,
+                                            fmt, self.plasmids)
+            fmtDir = pyensemblFtp.formatDir(self.outDir, fmt, self.formats)
+            if self.skipCurrent :
+                files = pyensemblFtp.completeModifyTimes(self.pool, genome, self.root,
+                                                         self.listingCache, fmt, files,
+                                                         fmtDir)
+            (todo, n) = pyensemblFtp.selectFiles(files, fmtDir, self.skipCurrent)
+            skipped += n
+            if len(todo) == 0 :
+                continue
+            checksums = None
+            if self.verify :
+                checksums = pyensemblFtp.genomeChecksums(self.pool, genome, self.root,
+                                                         self.listingCache, fmt)
+            os.makedirs(fmtDir, exist_ok = True)
+            tasks += pyensemblFtp.genomeTasks(genome, todo, fmtDir, self.root, checksums,
+                                              fmt)
+        pyensemblMetrics.increment("ftp_files_skipped_total", skipped)
+        if self.store is not None :
+            (tasks, reused) = pyensemblFtp.takeFromStore(self.store, tasks)
+            self.reused += len(reused)
+            if self.processor is not None :
+                for task in reused :
+                    if self.processor.accepts(task) :
+                        self.processor.processFile(task)
+        return (tasks, skipped)
+
+    async def transfer(self, loop, threads, verifier, tasksQueue) :
+        """Third stage: transfer the files and submit them for verification"""
+        while True :
+            task = await tasksQueue.get()
+            if task is None :
+                return
+            def retrieve() :
+                pyensemblFtp.retrieveTask(self.pool, task, self.progress, self.processor,
+                                          self.segments, self.segmentThreshold)
+            try :
+                await loop.run_in_executor(threads, retrieve)
+            except Exception as e :
+                self.progress.fileDone(failed = True)
+                self.failures.append((task, e))
+                continue
+            self.progress.fileDone()
+            self.nFiles += 1
+            self.transferred.append(task)
+            if self.firstFile is None :
+                self.firstFile = time.perf_counter()
+            if verifier is not None and task.checksum is not None :
+                self.verifications.append((task, loop.run_in_executor(
+                    verifier, pyensemblFtp.verifyFile, task.localPath, task.checksum)))
+
+    def report(self) :
+        """Write a summary of the run to stderr"""
+        end = time.perf_counter()
+        pyensemblMetrics.observe("pipeline_stage_seconds", end - self.start,
+                                 {"stage" : "total"})
+        msg = "%i genomes, %i files retrieved" % (self.nGenomes, self.nFiles)
+        if self.skipped > 0 :
+            msg += ", %i already up to date" % self.skipped
+        if self.reused > 0 :
+            msg += ", %i taken from the store" % self.reused
+        msg += " in %.1f s" % (end - self.start)
+        if self.firstFile is not None and self.metadataDone is not None :
+            msg += (" (first file after %.1f s, genome information complete after "
+                    "%.1f s)" % (self.firstFile - self.start,
+                                 self.metadataDone - self.start))
+        self.stderr.write(PC.G + pyensembl.timestamp() + msg + PC.E + "\n")
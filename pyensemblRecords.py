@@ -0,0 +1,241 @@
+### * Description
+
+# Compact typed records for the species and genomes tables, and a streaming
+# reader and writer for these tables
+#
+# Records are named tuples, with numbers and flags converted from the table
+# text and the values repeated over many rows (division, assembly level,
+# database name, ...) shared between records. They can be used where
+# the species and genome dicts are expected (record["species"],
+# record.get("change")).
+
+### * Setup
+
+### ** Import
+
+import operator
+import collections
+import pyensembl
+
+### ** Parameters
+
+# Values written for None in the tables
+NONE_VALUES = frozenset(["None", ""])
+
+### * Functions
+
+### ** parseFlag(value)
+
+def parseFlag(value) :
+    """Parse a flag, written either as 0/1 (REST API) or False/True (tables
+    written from records), as a bool"""
+    if value in ("True", "False") :
+        return value == "True"
+    return bool(int(value))
+
+### ** formatValue(value)
+
+def formatValue(value) :
+    """Write a value of a record in a table (flags as 0/1, as in the REST
+    API)"""
+    if isinstance(value, bool) :
+        return "1" if value else "0"
+    return str(value)
+
+### ** readTable(fi, recordClass, source)
+
+def readTable(fi, recordClass, source = None) :
+    """Read the records of a tab-separated table, one at a time
+
+    The header must contain all the fields of the record class (e.g. the
+    columns written by pyensembl.dumpEnsemblInfoGenomes() for GenomeRecord),
+    in any order. Other columns are ignored, apart from the optional fields of
+    the class (such as the "change" column of "pyensembl refresh --changes").
+    Empty lines are skipped.
+
+    Args:
+        fi (file): Input stream
+        recordClass (class): SpeciesRecord or GenomeRecord
+        source (str): Name of the input, for error messages
+
+    Returns:
+        generator of records
+
+    Raises:
+        TableError: If the header lacks fields, or a line has the wrong number
+          of columns or an invalid value
+
+    """
+    source = source or getattr(fi, "name", "table")
+    header = fi.readline().rstrip("\r\n").split("\t")
+    missing = [x for x in recordClass.FIELDS if x not in header]
+    if missing :
+        raise TableError("%s: missing columns in the header: %s (is it a %s table?)" %
+                         (source, ", ".join(missing), recordClass.TABLE))
+    fields = recordClass._fields
+    nColumns = len(header)
+    # Optional fields absent from the table are read from an empty column
+    # added after the last one
+    select = operator.itemgetter(*[header.index(x) if x in header else nColumns
+                                   for x in fields])
+    # Values of the shared fields are converted once per distinct text
+    shared = [(j, recordClass.TYPES.get(x), dict()) for (j, x) in enumerate(fields)
+              if x in recordClass.SHARED_FIELDS]
+    typed = [(j, recordClass.TYPES[x]) for (j, x) in enumerate(fields)
+             if x in recordClass.TYPES and x not in recordClass.SHARED_FIELDS]
+    newRecord = tuple.__new__
+    for (i, line) in enumerate(fi, 2) :
+        line = line.rstrip("\r\n")
+        if line.strip() == "" :
+            continue
+        row = line.split("\t")
+        if len(row) != nColumns :
+            raise TableError("%s, line %i: %i columns instead of %i" %
+                             (source, i, len(row), nColumns))
+        row.append("")
+        values = [None if x in NONE_VALUES else x for x in select(row)]
+        try :
+            for (j, parse) in typed :
+                if values[j] is not None :
+                    values[j] = parse(values[j])
+            for (j, parse, cache) in shared :
+                value = values[j]
+                if value in cache :
+                    values[j] = cache[value]
+                else :
+                    if parse is not None and value is not None :
+                        values[j] = parse(value)
+                    cache[value] = values[j]
+        except ValueError :
+            raise TableError("%s, line %i: invalid value for %s: %r" %
+                             (source, i, fields[j], values[j]))
+        yield newRecord(recordClass, values)
+
+### ** loadTable(path, recordClass)
+
+def loadTable(path, recordClass) :
+    """Read all the records of a table file
+
+    Returns:
+        list of records
+
+    """
+    with open(path, "r") as fi :
+        return list(readTable(fi, recordClass, path))
+
+### ** writeTable(records, fo, recordClass, flush)
+
+def writeTable(records, fo, recordClass, flush = False) :
+    """Write records (or the equivalent dicts) as a tab-separated table, line
+    by line as they are produced
+
+    Args:
+        records (iterable): Records, or dicts with the fields of the class
+        fo (file): Output stream
+        recordClass (class): SpeciesRecord or GenomeRecord
+        flush (bool): Flush the stream after each line?
+
+    Returns:
+        int: Number of records written
+
+    """
+    def lines() :
+        yield "\t".join(recordClass.FIELDS) + "\n"
+        for record in records :
+            yield "\t".join([formatValue(record[f]) for f in recordClass.FIELDS]) + "\n"
+    return pyensembl.writeLines(lines(), fo, flush) - 1
+
+### * Classes
+
+### ** TableError
+
+class TableError(Exception) :
+    """Raised when a table cannot be read"""
+    pass
+
+### ** Record
+
+class Record(object) :
+    """Base class of the records
+
+    Records are named tuples which can also be read like the dicts of the
+    REST API (record["species"], record.get("change")). Subclasses derive
+    from Record and from a named tuple of the FIELDS (the columns of their
+    table) and OPTIONAL_FIELDS (columns read when present), and define TYPES
+    (parser of the fields which are not strings) and SHARED_FIELDS (fields
+    whose values are shared between the records of a table).
+    """
+
+    __slots__ = ()
+    FIELDS = []
+    OPTIONAL_FIELDS = []
+    TYPES = dict()
+    SHARED_FIELDS = []
+    TABLE = "record"
+
+    @classmethod
+    def fromDict(cls, d) :
+        """Build a record from a dict (e.g. from the REST API), keeping only
+        the fields of the record"""
+        return cls(*[d.get(k) for k in cls._fields])
+
+    def __getitem__(self, key) :
+        if isinstance(key, str) :
+            # Only the fields, not the other attributes of the tuple (e.g.
+            # "count" or "index")
+            if key not in self._fields :
+                raise KeyError(key)
+            return getattr(self, key)
+        return tuple.__getitem__(self, key)
+
+    def get(self, key, default = None) :
+        if key not in self._fields :
+            return default
+        return getattr(self, key)
+
+    def __contains__(self, key) :
+        return key in self._fields
+
+    def keys(self) :
+        return list(self._fields)
+
+    def asDict(self) :
+        return dict(zip(self._fields, self))
+
+### ** SpeciesRecord
+
+class SpeciesRecord(Record, collections.namedtuple("SpeciesRecord",
+                                                   pyensembl.SPECIES_FIELDS + ["change"])) :
+    """One row of a species table (as written by "pyensembl search")"""
+
+    __slots__ = ()
+    FIELDS = pyensembl.SPECIES_FIELDS
+    # Column added by "pyensembl refresh --changes"
+    OPTIONAL_FIELDS = ["change"]
+    TYPES = {"release" : int,
+             "taxon_id" : int}
+    SHARED_FIELDS = ["division", "release", "change"]
+    TABLE = "species"
+
+### ** GenomeRecord
+
+class GenomeRecord(Record, collections.namedtuple("GenomeRecord",
+                                                  pyensembl.GENOME_FIELDS)) :
+    """One row of a genomes table (as written by "pyensembl genomes")"""
+
+    __slots__ = ()
+    FIELDS = pyensembl.GENOME_FIELDS
+    TYPES = {"species_id" : int,
+             "is_reference" : parseFlag,
+             "has_pan_compara" : parseFlag,
+             "base_count" : int,
+             "taxonomy_id" : int,
+             "has_variations" : parseFlag,
+             "has_other_alignments" : parseFlag,
+             "has_peptide_compara" : parseFlag,
+             "species_taxonomy_id" : int,
+             "has_genome_alignments" : parseFlag}
+    SHARED_FIELDS = ["division", "is_reference", "has_pan_compara", "assembly_level",
+                     "serotype", "genebuild", "has_variations", "has_other_alignments",
+                     "has_peptide_compara", "has_genome_alignments", "dbname"]
+    TABLE = "genomes"
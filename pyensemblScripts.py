@@ -14,12 +14,22 @@
 ### ** Import
 
 import os
+import re
 import sys
+import gzip
 import argparse
-import random
 import pyensembl as pyensembl
-import ftplib
-import urllib
+import pyensemblBgzf
+import pyensemblFtp
+import pyensemblGenbank
+import pyensemblDb
+import pyensemblJournal
+import pyensemblMetrics
+import pyensemblPipeline
+import pyensemblRecords
+import pyensemblServe
+import pyensemblStore
+import pyensemblTaxonomy
 
 ### ** Parameters
 
@@ -28,7 +38,21 @@ DB_FOLDER = os.path.expanduser(DB_FOLDER)
 # Colors
 PC = pyensembl.PC
 # EnsemblBacteria
-FTP_GENBANK_ROOT = "pub/bacteria/current/genbank/"
+FTP_ROOT = pyensemblFtp.FTP_ROOT
+
+### * Functions
+
+### ** positiveInt(value)
+
+def positiveInt(value) :
+    """Argument type for counts which must be at least 1"""
+    try :
+        n = int(value)
+    except ValueError :
+        raise argparse.ArgumentTypeError("invalid int value: %r" % value)
+    if n < 1 :
+        raise argparse.ArgumentTypeError("must be at least 1, got %i" % n)
+    return n
 
 ### * Parser
 
@@ -41,23 +65,137 @@ def makeParser() :
     """
     parser = argparse.ArgumentParser()
     subparsers = parser.add_subparsers()
+    ### ** Options shared by the commands using the REST API
+    restOptions = argparse.ArgumentParser(add_help = False)
+    restOptions.add_argument("--cache-only", action = "store_true",
+                             help = "Answer only from the local cache of REST "
+                             "responses, without contacting the server")
+    restOptions.add_argument("--no-cache", action = "store_true",
+                             help = "Do not use the local cache of REST responses")
+    restOptions.add_argument("--rest-server", metavar = "URL", type = str,
+                             default = pyensembl.ENSEMBL_REST_SERVER,
+                             help = "Base URL of the REST server (default: %s, "
+                             "can be set with PYENSEMBL_REST_SERVER)" %
+                             pyensembl.ENSEMBL_REST_SERVER)
+    ### ** Options shared by all the commands
+    metricsOptions = argparse.ArgumentParser(add_help = False)
+    metricsOptions.add_argument("--metrics-log", metavar = "FILE", type = str,
+                                help = "Append the metrics events (requests, "
+                                "transfers, timings) to FILE as JSON lines")
+    metricsOptions.add_argument("--metrics-prom", metavar = "FILE", type = str,
+                                help = "Write the final metrics to FILE in the "
+                                "Prometheus text format")
+    metricsOptions.add_argument("--metrics-summary", action = "store_true",
+                                help = "Print a summary table of the metrics to "
+                                "stderr at the end")
+    metricsOptions.add_argument("--profile", metavar = "FILE", type = str,
+                                help = "Profile the main functions with cProfile "
+                                "and write the statistics to FILE (pstats format)")
+    ### ** Options shared by the commands downloading from the FTP server
+    ftpOptions = argparse.ArgumentParser(add_help = False)
+    ftpOptions.add_argument("-j", "--jobs", metavar = "N", type = positiveInt,
+                            default = 1,
+                            help = "Number of files to retrieve in parallel "
+                            "(default: 1)")
+    ftpOptions.add_argument("--max-connections", metavar = "N", type = positiveInt,
+                            default = pyensemblFtp.FTP_MAX_CONNECTIONS,
+                            help = "Maximum number of simultaneous connections "
+                            "to the FTP server (default: %i)" %
+                            pyensemblFtp.FTP_MAX_CONNECTIONS)
+    ftpOptions.add_argument("--segments", metavar = "N", type = positiveInt,
+                            default = pyensemblFtp.FTP_SEGMENTS,
+                            help = "Number of byte ranges of the large files, "
+                            "transferred over parallel connections (default: %i, "
+                            "1 to transfer each file over one connection)" %
+                            pyensemblFtp.FTP_SEGMENTS)
+    ftpOptions.add_argument("--segment-threshold", metavar = "MB", type = float,
+                            default = pyensemblFtp.FTP_SEGMENT_THRESHOLD / 2**20,
+                            help = "Size from which a file is split into byte "
+                            "ranges, in MB (default: %g)" %
+                            (pyensemblFtp.FTP_SEGMENT_THRESHOLD / 2**20))
+    ftpOptions.add_argument("--no-verify", action = "store_true",
+                            help = "Do not check the downloaded files against "
+                            "the CHECKSUMS files")
+    ftpOptions.add_argument("--verify-jobs", metavar = "N", type = positiveInt,
+                            default = pyensemblFtp.FTP_VERIFY_JOBS,
+                            help = "Number of processes checking the downloaded "
+                            "files (default: %i)" % pyensemblFtp.FTP_VERIFY_JOBS)
+    ftpOptions.add_argument("--ftp-server", metavar = "HOST[:PORT]", type = str,
+                            default = pyensemblFtp.FTP_SERVER,
+                            help = "FTP server (default: %s, can be set with "
+                            "PYENSEMBL_FTP_SERVER)" % pyensemblFtp.FTP_SERVER)
+    ftpOptions.add_argument("--force", action = "store_true",
+                            help = "Download all the files again, even those "
+                            "already up to date in DEST_DIR")
+    ftpOptions.add_argument("--no-listing-cache", action = "store_true",
+                            help = "Do not use the local cache of FTP listings")
+    ftpOptions.add_argument("--plasmids", action = "store_true",
+                            help = "Also download the plasmid files")
+    ftpOptions.add_argument("--store", metavar = "STORE_DIR", nargs = "?", type = str,
+                            const = pyensemblStore.STORE_FOLDER,
+                            help = "Keep the downloaded files in a store shared "
+                            "across releases and download directories, and take "
+                            "the files already stored from it instead of "
+                            "downloading them (default STORE_DIR: %s)" %
+                            pyensemblStore.STORE_FOLDER)
+    ftpOptions.add_argument("--derive", metavar = "KIND", nargs = "+",
+                            choices = pyensemblGenbank.DERIVATIVES,
+                            help = "Parse the GenBank files while they are "
+                            "downloaded and write the given derivatives next to "
+                            "them: %s" % ", ".join(pyensemblGenbank.DERIVATIVES))
+    ftpOptions.add_argument("--derive-jobs", metavar = "N", type = positiveInt,
+                            default = pyensemblGenbank.GENBANK_JOBS,
+                            help = "Number of processes parsing the GenBank files "
+                            "(default: %i)" % pyensemblGenbank.GENBANK_JOBS)
+    ftpOptions.add_argument("--bgzf", action = "store_true",
+                            help = "After the download, recompress the FASTA files "
+                            "of DEST_DIR to BGZF and index them (.fai and .gzi), "
+                            "for \"pyensembl extract\"")
+    ftpOptions.add_argument("--bgzf-jobs", metavar = "N", type = positiveInt,
+                            default = pyensemblBgzf.BGZF_JOBS,
+                            help = "Number of processes recompressing the FASTA "
+                            "files (default: %i)" % pyensemblBgzf.BGZF_JOBS)
     ### ** Refresh bacteria info database
-    sp_refresh = subparsers.add_parser("refresh",
+    sp_refresh = subparsers.add_parser("refresh", parents = [restOptions, metricsOptions],
                                        help = "Without any argument, Refresh the local "
                                        "information about "
                                        "available bacteria species in Ensembl")
     sp_refresh.add_argument("-c", "--check", action = "store_true",
                             help = "Check for existence of local information about "
                             "bacteria species in Ensembl")
+    sp_refresh.add_argument("--changes", action = "store_true",
+                            help = "Send to stdout the species added, changed or "
+                            "removed by the last refresh (table usable with "
+                            "\"pyensembl genomes -f\")")
+    sp_refresh.add_argument("-k", "--keep", metavar = "N", type = positiveInt,
+                            default = pyensemblDb.SNAPSHOT_KEEP,
+                            help = "Number of local database files to keep, older "
+                            "ones are removed (default: %i)" % pyensemblDb.SNAPSHOT_KEEP)
     sp_refresh.set_defaults(action = "refresh")
     ### ** Search among species
-    sp_search = subparsers.add_parser("search",
+    sp_search = subparsers.add_parser("search", parents = [metricsOptions],
                                       help = "Search entries "
                                       "for a given species or strain")
-    sp_search.add_argument("species", metavar = "SPECIES", type = str,
+    sp_search.add_argument("species", metavar = "SPECIES", type = str, nargs = "?",
                            help = "Query string for the species or strain")
+    sp_search.add_argument("-q", "--queries", metavar = "FILE", type = str,
+                           help = "File with one query string per line, searched "
+                           "together (a \"query\" column is added to the output)")
     sp_search.add_argument("-g", "--genomes", action = "store_true", 
                            help = "Retrieve information about genomes")
+    sp_search.add_argument("-a", "--aliases", action = "store_true",
+                           help = "Also search in aliases, accession and taxon_id "
+                           "(by default only name and display_name are searched)")
+    sp_search.add_argument("-p", "--prefix", action = "store_true",
+                           help = "Match the query string only at the start of "
+                           "the searched fields")
+    sp_search.add_argument("-r", "--release", metavar = "RELEASE", type = int,
+                           help = "Keep only species from this release")
+    sp_search.add_argument("--assembly", metavar = "ASSEMBLY", type = str,
+                           help = "Keep only species with this assembly name")
+    sp_search.add_argument("--no-daemon", action = "store_true",
+                           help = "Search the local index even if a \"pyensembl "
+                           "serve\" daemon is running")
     # sp_search.add_argument("-o", "--outDir", metavar = "DIR", type = str,
     #                        default = ".", 
     #                        help = "Destination directory for downloading ("
@@ -66,8 +204,36 @@ def makeParser() :
     #                        help = "Only send the record count to stdout, not "
     #                        "the full record information")
     sp_search.set_defaults(action = "search")
+    ### ** Serve searches from memory
+    sp_serve = subparsers.add_parser("serve", parents = [metricsOptions],
+                                     help = "Keep the species catalogue in memory and "
+                                     "answer the searches of \"pyensembl search\" (and "
+                                     "of other clients) until interrupted")
+    sp_serve.add_argument("--socket", metavar = "PATH", type = str,
+                          default = pyensemblServe.SERVE_SOCKET,
+                          help = "Unix socket of the daemon (default: %s, can be "
+                          "set with PYENSEMBL_SERVE_SOCKET)" % pyensemblServe.SERVE_SOCKET)
+    sp_serve.add_argument("--http", metavar = "PORT", type = int,
+                          help = "Also answer HTTP requests on this port of 127.0.0.1")
+    sp_serve.add_argument("--embl-index", metavar = "TABLE", type = str,
+                          help = "Table mapping species names to EMBL accession "
+                          "numbers, answering \"embl\" requests")
+    sp_serve.set_defaults(action = "serve")
+    ### ** Local taxonomy index
+    sp_taxonomy = subparsers.add_parser("taxonomy", parents = [metricsOptions],
+                                        help = "Build a local index of the NCBI "
+                                        "taxonomy, and list the species of the local "
+                                        "catalogue beneath a taxon")
+    sp_taxonomy.add_argument("taxon", metavar = "TAXON", type = str, nargs = "?",
+                             help = "NCBI taxon name or identifier (e.g. \"Serratia\", "
+                             "\"1224\"), the species beneath it are sent to stdout")
+    sp_taxonomy.add_argument("-b", "--build", metavar = "TAXDUMP", type = str,
+                             help = "Build the index from an NCBI taxonomy dump "
+                             "(taxdump.tar.gz or the folder where it was extracted, "
+                             "from %s)" % pyensemblTaxonomy.TAXDUMP_URL)
+    sp_taxonomy.set_defaults(action = "taxonomy")
     ### ** Get genome information
-    sp_genome = subparsers.add_parser("genomes",
+    sp_genome = subparsers.add_parser("genomes", parents = [restOptions, metricsOptions],
                                       help = "Retrieve genomes information, based either "
                                       "on a table containing species information or on a "
                                       "NCBI Taxon Id")
@@ -77,22 +243,97 @@ def makeParser() :
                            help = "NCBI taxon identifier (e.g. \"Serratia\", "
                            "\"Enterobacteriaceae\"). Information about all available "
                            "genomes beneath this node will be retrieved.")
+    sp_genome.add_argument("--local", action = "store_true",
+                           help = "Resolve the taxon with the local taxonomy index "
+                           "(see \"pyensembl taxonomy\") instead of the REST server, "
+                           "and read the genomes from this index (only those "
+                           "missing from it are retrieved from the REST server)")
+    sp_genome.add_argument("-j", "--jobs", metavar = "N", type = positiveInt,
+                           default = pyensembl.REST_JOBS,
+                           help = "Number of concurrent requests when using a table "
+                           "of species or --local (default: %i)" % pyensembl.REST_JOBS)
     sp_genome.set_defaults(action = "genomes")
     ### ** Download genome data
-    sp_download = subparsers.add_parser("download",
+    sp_download = subparsers.add_parser("download", parents = [ftpOptions, metricsOptions],
                                         help = "Download sequence data for a list of "
                                         "genomes")
     sp_download.add_argument("-g", "--genomeList", metavar = "GENOMES_TABLE",
                              type = str, help = "Tab-separated file containing genomes "
                              "information", nargs = 1)
     sp_download.add_argument("-f", "--format", metavar = "FORMAT", type = str,
-                             choices = ["genbank"], nargs = 1,
-                             help = "Format to retrieve (only \"genbank\" "
-                             "implemented for now)")
+                             choices = list(pyensemblFtp.FTP_FORMATS.keys()),
+                             nargs = "+", default = ["genbank"],
+                             help = "Formats to retrieve, among %s (default: "
+                             "genbank). With several formats, the files of each "
+                             "one go to a subdirectory of DEST_DIR" %
+                             ", ".join(pyensemblFtp.FTP_FORMATS.keys()))
     sp_download.add_argument("-d", "--dir", metavar = "DEST_DIR", type = str,
                              default = ".",
                              help = "Destination directory")
+    sp_download.add_argument("--resume", action = "store_true",
+                             help = "Resume the last download to DEST_DIR where it "
+                             "stopped, from its journal (%s): the genome directories "
+                             "it already listed are not listed again" %
+                             pyensemblJournal.JOURNAL_FILE)
     sp_download.set_defaults(action = "download")
+    ### ** Retrieve genome information and download genome data in one go
+    sp_fetch = subparsers.add_parser("fetch", parents = [restOptions, ftpOptions,
+                                                         metricsOptions],
+                                     help = "Retrieve genomes information and download "
+                                     "their files in one go, the downloads "
+                                     "starting as soon as the first genomes are known")
+    sp_fetch.add_argument("-f", "--file", metavar = "SPECIES_TABLE", type = str,
+                          help = "Tab-separated file containing species information")
+    sp_fetch.add_argument("-t", "--taxonName", metavar = "NCBI_TAXID", type = str,
+                          help = "NCBI taxon identifier (e.g. \"Serratia\"), all "
+                          "the genomes beneath this node are retrieved")
+    sp_fetch.add_argument("--local", action = "store_true",
+                          help = "Resolve the taxon with the local taxonomy index "
+                          "(see \"pyensembl taxonomy\") instead of the REST server, "
+                          "and read the genomes from this index (only those "
+                          "missing from it are retrieved from the REST server)")
+    sp_fetch.add_argument("-d", "--dir", metavar = "DEST_DIR", type = str,
+                          default = ".",
+                          help = "Destination directory")
+    sp_fetch.add_argument("--format", metavar = "FORMAT", type = str,
+                          choices = list(pyensemblFtp.FTP_FORMATS.keys()),
+                          nargs = "+", default = ["genbank"],
+                          help = "Formats to retrieve, as for \"pyensembl "
+                          "download\" (default: genbank)")
+    sp_fetch.add_argument("--rest-jobs", metavar = "N", type = positiveInt,
+                          default = pyensembl.REST_JOBS,
+                          help = "Number of concurrent REST requests when using a "
+                          "table of species (default: %i)" % pyensembl.REST_JOBS)
+    sp_fetch.add_argument("--list-jobs", metavar = "N", type = positiveInt,
+                          default = pyensemblPipeline.PIPELINE_LIST_JOBS,
+                          help = "Number of genome directories listed in parallel "
+                          "(default: %i)" % pyensemblPipeline.PIPELINE_LIST_JOBS)
+    sp_fetch.set_defaults(action = "fetch")
+    ### ** Extract regions of indexed FASTA files
+    sp_extract = subparsers.add_parser("extract", parents = [metricsOptions],
+                                       help = "Extract regions of the FASTA files indexed "
+                                       "by \"pyensembl download --bgzf\"")
+    sp_extract.add_argument("genome", metavar = "GENOME", type = str,
+                            help = "Indexed FASTA file, or genome (\"species\" "
+                            "column of the genomes table) whose file is looked for "
+                            "in DEST_DIR")
+    sp_extract.add_argument("regions", metavar = "REGION", type = str, nargs = "+",
+                            help = "Region to extract: RECORD, RECORD:START or "
+                            "RECORD:START-END (1-based, inclusive)")
+    sp_extract.add_argument("-d", "--dir", metavar = "DEST_DIR", type = str,
+                            default = ".",
+                            help = "Download directory of the genome files "
+                            "(default: .)")
+    sp_extract.add_argument("-f", "--format", metavar = "FORMAT", type = str,
+                            choices = [k for (k, v) in pyensemblFtp.FTP_FORMATS.items()
+                                       if v.tree == "fasta"],
+                            default = "dna",
+                            help = "Format of the genome file (default: dna)")
+    sp_extract.add_argument("-w", "--width", metavar = "N", type = positiveInt,
+                            default = pyensemblGenbank.FASTA_WIDTH,
+                            help = "Line width of the output (default: %i)" %
+                            pyensemblGenbank.FASTA_WIDTH)
+    sp_extract.set_defaults(action = "extract")
     ### ** Return
     return parser
     
@@ -117,48 +358,280 @@ def main(args = None, stdout = None, stderr = None) :
         stdout = sys.stdout
     if stderr is None :
         stderr = sys.stderr
+    if hasattr(args, "rest_server") :
+        cache = None
+        if not args.no_cache :
+            cache = pyensembl.RestCache()
+        pyensembl.setRestClient(pyensembl.RestClient(server = args.rest_server,
+                                                     cache = cache,
+                                                     cacheOnly = args.cache_only))
+    metrics = pyensemblMetrics.getMetrics()
+    if args.metrics_log is not None :
+        metrics.addSink(pyensemblMetrics.JsonLinesSink(args.metrics_log))
+    if args.metrics_prom is not None :
+        metrics.addSink(pyensemblMetrics.PrometheusSink(args.metrics_prom))
+    if args.metrics_summary :
+        metrics.addSink(pyensemblMetrics.SummarySink(stderr))
+    if args.profile is not None :
+        metrics.enableProfiling(args.profile)
     dispatch = dict()
     dispatch["refresh"] = main_refresh
     dispatch["search"] = main_search
+    dispatch["serve"] = main_serve
+    dispatch["taxonomy"] = main_taxonomy
     dispatch["genomes"] = main_genomes
     dispatch["download"] = main_download
-    dispatch[args.action](args, stdout, stderr)
+    dispatch["fetch"] = main_fetch
+    dispatch["extract"] = main_extract
+    metrics.event("command", action = args.action)
+    try :
+        dispatch[args.action](args, stdout, stderr)
+    except pyensembl.RestCacheMiss as e :
+        stderr.write(PC.F + "Not in the local cache: %s" % e + PC.E + "\n")
+        sys.exit(1)
+    finally :
+        metrics.close()
     
 ### ** Main refresh
 
 def main_refresh(args, stdout, stderr):
     if args.check:
         # Look for database files
-        files = [x for x in os.listdir(DB_FOLDER) if x.startswith(".pyensembl-bacteria-species.")]
+        files = pyensemblDb.listSnapshots(DB_FOLDER)
         print(PC.G + "Database files found in %s (%i)" % (DB_FOLDER, len(files)) + PC.E)
         for f in files:
             print(PC.Y + "    " + f + PC.E)
-    if not args.check:
-        # Download information using REST
-        speciesData = pyensembl.downloadBacteriaSpecies()
-        dbFile = os.path.join(DB_FOLDER, ".pyensembl-bacteria-species." +
-                              pyensembl.fileTimestamp())
-        pyensembl.saveJson(speciesData, dbFile)
+    elif args.changes:
+        # Report the changes from the last refresh
+        dbFile = pyensemblDb.latestSnapshot(DB_FOLDER)
+        changes = None
+        if dbFile is not None:
+            changes = os.path.join(DB_FOLDER, pyensemblDb.changesFile(dbFile))
+        if changes is None or not os.path.isfile(changes):
+            stderr.write(PC.F + "No changes file found.\nRun \"pyensembl refresh\" first." +
+                         PC.E + "\n")
+            sys.exit()
+        stderr.write(PC.G + "Changes file used: %s" % changes + PC.E + "\n")
+        with open(changes, "r") as fi:
+            for line in fi:
+                stdout.write(line)
+    else:
+        # The changes are computed against the index of the previous snapshot
+        index = pyensemblDb.SpeciesIndex(os.path.join(DB_FOLDER, pyensemblDb.INDEX_FILE))
+        previous = pyensemblDb.latestSnapshot(DB_FOLDER)
+        previousIndex = None
+        previousPath = index.path + ".previous"
+        if previous is not None:
+            if index.exists() and index.snapshot() == previous:
+                previousIndex = pyensemblDb.SpeciesIndex(index.path)
+            else:
+                print(PC.B + pyensembl.timestamp() + "Indexing previous species from %s" %
+                      previous + PC.E)
+                previousIndex = pyensemblDb.SpeciesIndex(previousPath)
+                previousIndex.build(pyensemblDb.iterSnapshot(os.path.join(DB_FOLDER, previous)),
+                                    previous)
+        # Download information using REST, saving and indexing (for "pyensembl
+        # search") the species as they arrive
+        dbName = pyensemblDb.SNAPSHOT_PREFIX + pyensembl.fileTimestamp() + ".gz"
+        dbFile = os.path.join(DB_FOLDER, dbName)
+        print(PC.B + pyensembl.timestamp() + "Saving and indexing species to %s" % dbFile + PC.E)
+        diff = pyensemblDb.SnapshotDiff(os.path.join(DB_FOLDER, pyensemblDb.changesFile(dbName)),
+                                        previousIndex)
+        try:
+            with gzip.open(dbFile + ".tmp", "wt") as fo:
+                species = pyensemblDb.writeSnapshot(pyensembl.iterBacteriaSpecies(), fo)
+                index.build(diff.track(species), dbName)
+            os.replace(dbFile + ".tmp", dbFile)
+            print(PC.G + pyensembl.timestamp() + "Saving successfull" + PC.E)
+            # Record the changes
+            diff.close(index)
+        except BaseException:
+            diff.abort()
+            if os.path.isfile(dbFile + ".tmp"):
+                os.remove(dbFile + ".tmp")
+            raise
+        finally:
+            if previousIndex is not None:
+                previousIndex.close()
+            if os.path.isfile(previousPath):
+                os.remove(previousPath)
+        print(PC.G + "Species added: %i, changed: %i, removed: %i" %
+              (diff.counts["added"], diff.counts["changed"], diff.counts["removed"]) + PC.E)
+        # Apply the retention policy
+        for f in pyensemblDb.pruneSnapshots(DB_FOLDER, args.keep):
+            print(PC.Y + "Removed old database file %s" % f + PC.E)
+        # Have a running "pyensembl serve" daemon use the new snapshot
+        if pyensemblServe.notifyReload() is not None:
+            print(PC.G + "Species daemon reloaded" + PC.E)
         
 ### ** Main search
 
 def main_search(args, stdout, stderr) :
+    if (args.species is None) == (args.queries is None):
+        stderr.write(PC.F + "Provide either a query string or a file of queries.\n" +
+                     "Type \"pyensembl search -h\" for help.\n" + PC.E)
+        sys.exit()
+    options = {"aliases" : args.aliases, "prefix" : args.prefix,
+               "release" : args.release, "assembly" : args.assembly}
+    if args.queries is not None:
+        with open(args.queries, "r") as fi:
+            queries = [x.strip() for x in fi if x.strip() != ""]
+        request = dict(options, action = "searchBatch", queries = queries)
+    else:
+        request = dict(options, action = "search", query = args.species)
+    # Forward the search to a running "pyensembl serve" daemon
+    response = None
+    if not args.no_daemon:
+        response = pyensemblServe.query(request)
+    if response is not None:
+        stderr.write(PC.G + "Database file used: %s (pyensembl serve)" % response["snapshot"] +
+                     PC.E + "\n")
+        hits = [tuple(x) for x in response.get("hits", [])]
+        species = response.get("species")
+    else:
+        index = openIndex(stderr)
+        # Perform the search
+        if args.queries is not None:
+            hits = index.searchBatch(queries, **options)
+        else:
+            species = index.search(args.species, **options)
+    if args.queries is not None:
+        stderr.write(PC.G + "Queries: %i, matches found: %i" % (len(queries), len(hits)) +
+                     PC.E + "\n")
+        lines = pyensembl.iterEnsemblInfoSpecies(sp for (q, sp) in hits)
+        stdout.write("query\t" + next(lines))
+        for ((q, sp), line) in zip(hits, lines):
+            stdout.write(q + "\t" + line)
+        return
+    stderr.write(PC.G + "Species found: %i" % len(species) + PC.E + "\n")
+    pyensembl.writeEnsemblInfoSpecies(species, stdout)
+    
+### ** openIndex(stderr)
+
+def openIndex(stderr) :
+    """Open the index of the latest species snapshot, indexing the snapshot if
+    this was not done by "pyensembl refresh"
+
+    Returns:
+        pyensemblDb.SpeciesIndex
+
+    """
     # Look for database files
-    files = [x for x in os.listdir(DB_FOLDER) if x.startswith(".pyensembl-bacteria-species.")]
-    files.sort()
-    if len(files) > 0:
-        dbFile = files[-1]
+    dbFile = pyensemblDb.latestSnapshot(DB_FOLDER)
+    if dbFile is not None:
         stderr.write(PC.G + "Database file used: %s" % dbFile + PC.E + "\n")
     else :
         stderr.write(PC.F + "No database file found.\nRun \"pyensembl refresh\" first." + PC.E + "\n")
         sys.exit()
-    # Perform the search
-    species = pyensembl.loadJson(os.path.join(DB_FOLDER, dbFile))
-    species = [x for x in species["species"] if args.species.lower() in x["name"].lower() or
-               args.species.lower() in x["display_name"].lower()]
-    stderr.write(PC.G + "Species found: %i" % len(species) + PC.E + "\n")
-    stdout.write(pyensembl.dumpEnsemblInfoSpecies(species))
+    index = pyensemblDb.SpeciesIndex(os.path.join(DB_FOLDER, pyensemblDb.INDEX_FILE))
+    if index.snapshot() != dbFile:
+        stderr.write(PC.B + "Indexing %s" % dbFile + PC.E + "\n")
+        index.build(pyensemblDb.iterSnapshot(os.path.join(DB_FOLDER, dbFile)), dbFile)
+    return index
+
+### ** Main serve
+
+def main_serve(args, stdout, stderr) :
+    catalogue = pyensemblServe.SpeciesCatalogue(DB_FOLDER, emblTable = args.embl_index)
+    try :
+        catalogue.load()
+        pyensemblServe.serve(catalogue, args.socket, httpPort = args.http, stderr = stderr)
+    except pyensemblServe.ServeError as e :
+        stderr.write(PC.F + "%s" % e + PC.E + "\n")
+        sys.exit(1)
     
+### ** Main taxonomy
+
+def main_taxonomy(args, stdout, stderr) :
+    if args.build is None and args.taxon is None :
+        stderr.write(PC.F + "Provide a taxonomy dump to index or a taxon.\n" +
+                     "Type \"pyensembl taxonomy -h\" for help.\n" + PC.E)
+        sys.exit()
+    taxonomy = pyensemblTaxonomy.TaxonomyIndex(os.path.join(DB_FOLDER,
+                                                            pyensemblTaxonomy.TAXONOMY_FILE))
+    try :
+        if args.build is not None :
+            stderr.write(PC.B + pyensembl.timestamp() + "Indexing the taxonomy from %s" %
+                         args.build + PC.E + "\n")
+            with pyensemblTaxonomy.openTaxdump(args.build) as (nodes, names) :
+                n = taxonomy.build(nodes, names)
+            stderr.write(PC.G + pyensembl.timestamp() + "Taxa indexed: %i" % n +
+                         PC.E + "\n")
+        if args.taxon is not None :
+            index = openIndex(stderr)
+            (node, names) = resolveTaxon(taxonomy, index, args.taxon, stderr)
+            species = [x for x in index.lookup(names) if x is not None]
+            stderr.write(PC.G + "Species found: %i" % len(species) + PC.E + "\n")
+            pyensembl.writeEnsemblInfoSpecies(species, stdout)
+    except pyensemblTaxonomy.TaxonomyError as e :
+        stderr.write(PC.F + "%s" % e + PC.E + "\n")
+        sys.exit(1)
+
+### ** resolveTaxon(taxonomy, index, taxon, stderr)
+
+def resolveTaxon(taxonomy, index, taxon, stderr) :
+    """Find the species of the local catalogue beneath a taxon, with the local
+    taxonomy index
+
+    Returns:
+        tuple: (taxon node, list of species names)
+
+    """
+    missing = taxonomy.syncCatalogue(index)
+    if missing :
+        stderr.write(PC.Y + "Species whose taxon is not in the taxonomy index: %i" %
+                     missing + PC.E + "\n")
+    node = taxonomy.resolve(taxon)
+    stderr.write(PC.G + "Taxon: %s (%s, taxon id %i)" % (node["name"], node["rank"],
+                                                         node["taxid"]) + PC.E + "\n")
+    stderr.write(PC.Y + "Lineage: %s" % "; ".join(x[1] for x in
+                                                  taxonomy.lineage(node["taxid"])) +
+                 PC.E + "\n")
+    return (node, taxonomy.species(node))
+
+### ** localTaxonGenomes(taxon, jobs, stderr)
+
+def localTaxonGenomes(taxon, jobs, stderr) :
+    """Genomes information for a taxon resolved with the local taxonomy index
+
+    The genomes are read from the taxonomy index. Those missing from it are
+    retrieved from the REST server (with one request for the whole taxon,
+    then species by species for those it did not return) and stored in the
+    index for the next runs.
+
+    Returns:
+        generator: JSON objects of the genomes, in catalogue order
+
+    """
+    taxonomy = pyensemblTaxonomy.TaxonomyIndex(os.path.join(DB_FOLDER,
+                                                            pyensemblTaxonomy.TAXONOMY_FILE))
+    try :
+        (node, names) = resolveTaxon(taxonomy, openIndex(stderr), taxon, stderr)
+    except pyensemblTaxonomy.TaxonomyError as e :
+        stderr.write(PC.F + "%s" % e + PC.E + "\n")
+        sys.exit(1)
+    stderr.write(PC.G + "Species found beneath %s: %i" % (node["name"], len(names)) +
+                 PC.E + "\n")
+    missing = taxonomy.missingGenomes(node)
+    stderr.write(PC.G + "Genomes found in the taxonomy index: %i" %
+                 (len(names) - len(missing)) + PC.E + "\n")
+    if len(missing) > 1 :
+        wanted = set(missing)
+        try :
+            taxonomy.recordGenomes(x for x in pyensembl.iterGenomesTaxonName(node["name"],
+                                                                             stderr = stderr)
+                                   if x.get("species") in wanted)
+        except (pyensembl.RestCacheMiss, pyensembl.requests.HTTPError) as e :
+            stderr.write(PC.Y + "Genomes of %s not retrieved at once: %s" %
+                         (node["name"], e) + PC.E + "\n")
+        missing = taxonomy.missingGenomes(node)
+    if len(missing) > 0 :
+        stderr.write(PC.Y + "Genomes retrieved species by species: %i" % len(missing) +
+                     PC.E + "\n")
+        taxonomy.recordGenomes(pyensembl.retrieveGenomesInfo(missing, jobs = jobs,
+                                                             stderr = stderr))
+    return taxonomy.genomes(node)
+
 ### ** Main genomes
 
 def main_genomes(args, stdout, stderr):
@@ -173,56 +646,200 @@ def main_genomes(args, stdout, stderr):
         sys.exit()
     if args.file is not None:
         # Load the species info
-        info = []
-        with open(args.file, "r") as fi:
-            header = fi.next().strip().split("\t")
-            for line in fi:
-                if line.strip() != "":
-                    info.append(dict(zip(header, line.strip().split("\t"))))
+        info = loadTable(args.file, pyensemblRecords.SpeciesRecord, stderr)
+        # Tables from "pyensembl refresh --changes" also list removed species
+        info = [sp for sp in info if sp.change != "removed"]
         stderr.write(PC.G + "Found %i species in %s" % (len(info), args.file) +
                      PC.E + "\n")
-        genomes = []
-        for sp in info:
-            genomes.append(pyensembl.retrieveGenomeInfo(sp["name"]))
-    elif args.taxonName is not None:
-        genomes = pyensembl.retrieveGenomesTaxonName(args.taxonName)
-        stderr.write(PC.G + "Genomes found for %s: %i" % (args.taxonName, len(genomes)) +
+        genomes = pyensembl.retrieveGenomesInfo([sp["name"] for sp in info],
+                                                jobs = args.jobs, stderr = stderr)
+    elif args.local:
+        genomes = localTaxonGenomes(args.taxonName, args.jobs, stderr)
+    else:
+        genomes = pyensembl.iterGenomesTaxonName(args.taxonName, stderr = stderr)
+    # Write the output as the genomes arrive
+    n = pyensembl.writeEnsemblInfoGenomes(genomes, stdout, flush = True)
+    if args.taxonName is not None:
+        stderr.write(PC.G + "Genomes found for %s: %i" % (args.taxonName, n) +
                      "\n" + PC.E)
-    # Write the output
-    stdout.write(pyensembl.dumpEnsemblInfoGenomes(genomes))
 
 ### ** Main download
 
 def main_download(args, stdout, stderr):
     # Load genome information
-    info = []
-    with open(args.genomeList[0], "r") as fi:
-        header = fi.next().strip().split("\t")
-        for line in fi:
-            if line.strip() != "":
-                info.append(dict(zip(header, line.strip().split("\t"))))
+    info = loadTable(args.genomeList[0], pyensemblRecords.GenomeRecord, stderr)
     stderr.write(PC.G + "%i genomes found" % len(info) + PC.E + "\n")
     # Download the genome data
-    # Probably not portable way, but should work for now
-    # http://stackoverflow.com/questions/111954/using-pythons-ftplib-to-get-a-directory-listing-portably
-    ftp = ftplib.FTP()
-    ftp.connect("ftp.ensemblgenomes.org")
-    ftp.login() # Anonymous login
-    for i, genome in enumerate(info):
-        collection = genome["dbname"].split("_collection")[0] + "_collection"
-        ftpPath = FTP_GENBANK_ROOT + "/" + collection + "/" + genome["species"]
-        ftpDir = []
-        ftp.dir(ftpPath, ftpDir.append)
-        ftpDir = [x.split(" ")[-1] for x in ftpDir]
-        # Keep only files of interest
-        ftpDir = [x for x in ftpDir if x not in ["CHECKSUMS", "README"] and "plasmid" not in x]
-        # Download
-        # http://stackoverflow.com/questions/11573817/how-to-download-a-file-via-ftp-with-python-ftplib
-        for target in ftpDir:
-            stderr.write(PC.G + "Retrieving %s (%i/%i)" % (genome["species"], i+1, len(info)) + PC.E)
-            fo = open(os.path.join(args.dir, target), "w")
-            target = (FTP_GENBANK_ROOT + "/" +
-                     collection + "/" + genome["species"] + "/" + target)
-            ftp.retrbinary("RETR %s" % target, fo.write)
-            fo.close()
-            stderr.write("    " + PC.B + "done" + PC.E + "\n")
+    listingCache = None
+    if not args.no_listing_cache :
+        listingCache = pyensemblFtp.FTPListingCache(os.path.join(DB_FOLDER,
+                                                    pyensemblFtp.LISTING_CACHE_FILE))
+    store = None
+    if args.store is not None :
+        store = pyensemblStore.GenomeStore(os.path.expanduser(args.store))
+    if not os.path.isdir(args.dir) :
+        os.makedirs(args.dir)
+    journalFile = os.path.join(args.dir, pyensemblJournal.JOURNAL_FILE)
+    if args.resume and not os.path.isfile(journalFile) :
+        stderr.write(PC.Y + "No journal found in %s, starting a new download" % args.dir +
+                     PC.E + "\n")
+    journal = pyensemblJournal.DownloadJournal(journalFile)
+    failures = pyensemblFtp.downloadGenomes(info, args.dir, jobs = args.jobs,
+                                            maxConnections = args.max_connections,
+                                            host = args.ftp_server,
+                                            root = FTP_ROOT,
+                                            formats = [pyensemblFtp.FTP_FORMATS[x]
+                                                       for x in args.format],
+                                            plasmids = args.plasmids,
+                                            verify = not args.no_verify,
+                                            verifyJobs = args.verify_jobs,
+                                            listingCache = listingCache,
+                                            skipCurrent = not args.force,
+                                            store = store,
+                                            derive = args.derive,
+                                            deriveJobs = args.derive_jobs,
+                                            segments = args.segments,
+                                            segmentThreshold = int(args.segment_threshold *
+                                                                   2**20),
+                                            journal = journal, resume = args.resume,
+                                            stderr = stderr)
+    journal.close()
+    if args.bgzf :
+        failures += indexDownloads(args.dir, args.bgzf_jobs, stderr)
+    reportFailures(failures, stderr)
+    if len(failures) > 0 :
+        sys.exit(1)
+
+### ** indexDownloads(outDir, jobs, stderr)
+
+def indexDownloads(outDir, jobs, stderr) :
+    """Recompress and index the FASTA files of a download directory which are
+    not indexed yet
+
+    Returns:
+        list of (str, Exception): The files which could not be indexed
+
+    """
+    paths = pyensemblBgzf.findUnindexed(outDir)
+    if len(paths) == 0 :
+        stderr.write(PC.G + "FASTA files already indexed" + PC.E + "\n")
+        return []
+    return pyensemblBgzf.indexFiles(paths, jobs = jobs, stderr = stderr)
+
+### ** loadTable(path, recordClass, stderr)
+
+def loadTable(path, recordClass, stderr) :
+    """Load a species or genomes table, exiting with a message if it cannot be
+    read"""
+    try :
+        return pyensemblRecords.loadTable(path, recordClass)
+    except pyensemblRecords.TableError as e :
+        stderr.write(PC.F + "%s" % e + PC.E + "\n")
+        sys.exit(1)
+
+### ** reportFailures(failures, stderr)
+
+def reportFailures(failures, stderr) :
+    """Write the failures of a download to stderr"""
+    for (item, e) in failures :
+        if isinstance(item, str) :
+            stderr.write(PC.F + "Failed to index %s (%s)" % (item, e) + PC.E + "\n")
+        elif isinstance(e, pyensemblGenbank.GenbankError) :
+            stderr.write(PC.F + "Failed to process %s (%s)" % (item.localPath, e) +
+                         PC.E + "\n")
+        elif isinstance(item, pyensemblFtp.FTPTask) :
+            stderr.write(PC.F + "Failed to retrieve %s (%s)" % (item.remotePath, e) +
+                         PC.E + "\n")
+        else :
+            stderr.write(PC.F + "Failed to list files for %s (%s)" % (item["species"], e) +
+                         PC.E + "\n")
+
+### ** Main fetch
+
+def main_fetch(args, stdout, stderr):
+    if (args.file is None) == (args.taxonName is None):
+        stderr.write(PC.F + "Provide either a table of species or a taxon name " +
+                     "(but not both).\n" +
+                     "Type \"pyensembl fetch -h\" for help.\n" + PC.E)
+        sys.exit(1)
+    if args.file is not None:
+        info = loadTable(args.file, pyensemblRecords.SpeciesRecord, stderr)
+        info = [sp for sp in info if sp.change != "removed"]
+        genomes = pyensembl.retrieveGenomesInfo([sp["name"] for sp in info],
+                                                jobs = args.rest_jobs, stderr = stderr)
+    elif args.local:
+        genomes = localTaxonGenomes(args.taxonName, args.rest_jobs, stderr)
+    else:
+        genomes = pyensembl.iterGenomesTaxonName(args.taxonName, stderr = stderr)
+    listingCache = None
+    if not args.no_listing_cache :
+        listingCache = pyensemblFtp.FTPListingCache(os.path.join(DB_FOLDER,
+                                                    pyensemblFtp.LISTING_CACHE_FILE))
+    store = None
+    if args.store is not None :
+        store = pyensemblStore.GenomeStore(os.path.expanduser(args.store))
+    # The genome table goes to stdout as the genomes arrive
+    failures = pyensemblPipeline.fetchGenomes(genomes, args.dir, jobs = args.jobs,
+                                              listJobs = args.list_jobs,
+                                              maxConnections = args.max_connections,
+                                              host = args.ftp_server,
+                                              root = FTP_ROOT,
+                                              formats = [pyensemblFtp.FTP_FORMATS[x]
+                                                         for x in args.format],
+                                              plasmids = args.plasmids,
+                                              verify = not args.no_verify,
+                                              verifyJobs = args.verify_jobs,
+                                              listingCache = listingCache,
+                                              skipCurrent = not args.force,
+                                              store = store,
+                                              derive = args.derive,
+                                              deriveJobs = args.derive_jobs,
+                                              segments = args.segments,
+                                              segmentThreshold = int(args.segment_threshold *
+                                                                     2**20),
+                                              table = stdout, stderr = stderr)
+    if args.bgzf :
+        failures += indexDownloads(args.dir, args.bgzf_jobs, stderr)
+    reportFailures(failures, stderr)
+    if len(failures) > 0 :
+        sys.exit(1)
+
+### ** findGenomeFile(outDir, genome, fmt)
+
+def findGenomeFile(outDir, genome, fmt) :
+    """Path to the file of a genome in a download directory (or in the
+    subdirectory of the format), None if not found"""
+    prefix = genome.lower() + "."
+    for folder in [os.path.join(outDir, fmt.name), outDir] :
+        if not os.path.isdir(folder) :
+            continue
+        for name in sorted(os.listdir(folder)) :
+            if name.lower().startswith(prefix) and re.search(fmt.pattern, name) :
+                return os.path.join(folder, name)
+    return None
+
+### ** Main extract
+
+def main_extract(args, stdout, stderr) :
+    path = args.genome
+    if not os.path.isfile(path) :
+        path = findGenomeFile(args.dir, args.genome,
+                              pyensemblFtp.FTP_FORMATS[args.format])
+        if path is None :
+            stderr.write(PC.F + "No %s file found for %s in %s" % (args.format, args.genome,
+                                                                   args.dir) + PC.E + "\n")
+            sys.exit(1)
+    try :
+        fasta = pyensemblBgzf.IndexedFasta(path)
+        try :
+            for region in args.regions :
+                (name, start, end) = pyensemblBgzf.parseRegion(region)
+                seq = fasta.fetch(name, start, end)
+                stdout.write(">%s\n" % region)
+                for i in range(0, len(seq), args.width) :
+                    stdout.write(seq[i:i + args.width] + "\n")
+        finally :
+            fasta.close()
+    except pyensemblBgzf.BgzfError as e :
+        stderr.write(PC.F + "%s" % e + PC.E + "\n")
+        sys.exit(1)
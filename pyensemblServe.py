@@ -0,0 +1,483 @@
+### * Description
+
+# Resident daemon keeping the species catalogue in memory and answering
+# searches and lookups over a Unix socket (and optionally local HTTP)
+#
+# Requests and responses are JSON objects, one per line on the Unix socket
+# (several requests can be sent over one connection), or the body of a POST
+# request over HTTP. A request has an "action" and its parameters:
+#   {"action" : "search", "query" : "coli", "aliases" : false, "prefix" : false,
+#    "release" : null, "assembly" : null}
+#   {"action" : "searchBatch", "queries" : ["coli", "serratia"], ...}
+#   {"action" : "lookup", "names" : ["escherichia_coli_k_12"]}
+#   {"action" : "embl", "query" : "coli"}
+#   {"action" : "status"}, {"action" : "reload"}
+# and the response has "ok" (true or false), the results and "snapshot" (the
+# catalogue snapshot used), or "error". Over HTTP, the parameters of a GET
+# request can also be given in the URL (e.g. /search?query=coli&prefix=1).
+#
+# The daemon reloads the catalogue when the index file written by "pyensembl
+# refresh" is replaced, and "pyensembl refresh" also asks it to reload as soon
+# as the new snapshot is written. "pyensembl search" forwards its queries to
+# the daemon when one is running.
+
+### * Setup
+
+### ** Import
+
+import os
+import sys
+import json
+import time
+import socket
+import threading
+import socketserver
+
+import pyensembl
+import pyensemblDb
+import pyensemblMetrics
+
+urllib_parse = pyensembl.LazyModule("urllib.parse")
+
+### ** Parameters
+
+SERVE_SOCKET = os.environ.get("PYENSEMBL_SERVE_SOCKET",
+                              os.path.join(os.path.expanduser("~"), ".pyensembl-serve.sock"))
+# Interval (in seconds) between the checks for a new index file
+RELOAD_INTERVAL = 2.0
+# Timeout (in seconds) of the queries forwarded to the daemon
+CLIENT_TIMEOUT = 10.0
+ACTIONS = ["search", "searchBatch", "lookup", "embl", "status", "reload"]
+# Parameters given as text in the URL of a GET request
+BOOLEAN_PARAMETERS = ["aliases", "prefix"]
+INTEGER_PARAMETERS = ["release"]
+LIST_PARAMETERS = ["queries", "names"]
+
+### * Functions
+
+### ** sendRequest(path, request, timeout)
+
+def sendRequest(path, request, timeout = CLIENT_TIMEOUT) :
+    """Send a request to the daemon over its Unix socket
+
+    Args:
+        path (str): Path to the socket
+        request (dict): Request, with its "action"
+        timeout (float): Timeout in seconds
+
+    Returns:
+        dict: The response
+
+    Raises:
+        OSError: If no daemon listens on the socket or the connection fails
+        ServeError: If the daemon could not answer the request
+
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s :
+        s.settimeout(timeout)
+        s.connect(path)
+        s.sendall(json.dumps(request).encode("utf-8") + b"\n")
+        with s.makefile("rb") as fi :
+            line = fi.readline()
+    if not line :
+        raise ConnectionError("Connection closed by the daemon")
+    response = json.loads(line.decode("utf-8"))
+    if not response.get("ok") :
+        raise ServeError(response.get("error"))
+    return response
+
+### ** query(request, path)
+
+def query(request, path = SERVE_SOCKET) :
+    """Send a request to the daemon if one is running
+
+    Args:
+        request (dict): Request, with its "action"
+        path (str): Path to the socket of the daemon
+
+    Returns:
+        dict: The response, or None if no daemon is running or the request
+          failed
+
+    """
+    if not os.path.exists(path) :
+        return None
+    try :
+        return sendRequest(path, request)
+    except (OSError, ValueError, ServeError) :
+        return None
+
+### ** notifyReload(path)
+
+def notifyReload(path = SERVE_SOCKET) :
+    """Ask a running daemon to reload the catalogue
+
+    Returns:
+        str: Snapshot loaded by the daemon, or None if no daemon is running
+
+    """
+    response = query({"action" : "reload"}, path)
+    if response is None :
+        return None
+    return response["snapshot"]
+
+### ** parseQueryString(queryString)
+
+def parseQueryString(queryString) :
+    """Convert the parameters of a GET request into a request dict
+
+    List parameters can be repeated or comma-separated.
+    """
+    request = dict()
+    for (key, values) in urllib_parse.parse_qs(queryString).items() :
+        if key in LIST_PARAMETERS :
+            request[key] = [x for v in values for x in v.split(",")]
+        elif key in BOOLEAN_PARAMETERS :
+            request[key] = values[-1].lower() in ("1", "true", "yes")
+        elif key in INTEGER_PARAMETERS :
+            request[key] = int(values[-1])
+        else :
+            request[key] = values[-1]
+    return request
+
+### ** serve(catalogue, path, httpPort, stderr)
+
+def serve(catalogue, path = SERVE_SOCKET, httpPort = None, stderr = None) :
+    """Run the daemon until it is interrupted (Ctrl-C or SIGTERM)
+
+    Args:
+        catalogue (SpeciesCatalogue): The catalogue (loaded if needed)
+        path (str): Path to the Unix socket
+        httpPort (int): If not None, also answer HTTP requests on this port of
+          127.0.0.1
+        stderr (file): Stream for messages (default: sys.stderr)
+
+    """
+    import signal
+    if stderr is None :
+        stderr = sys.stderr
+    if catalogue.snapshot is None :
+        catalogue.load()
+    server = SpeciesServer(catalogue, path, httpPort)
+    def stop(signum, frame) :
+        raise KeyboardInterrupt()
+    signal.signal(signal.SIGTERM, stop)
+    stderr.write(pyensembl.PC.G + pyensembl.timestamp() + "Serving %i species from %s on %s" %
+                 (catalogue.count, catalogue.snapshot, path) +
+                 ("" if httpPort is None else " and http://127.0.0.1:%i" % server.httpPort) +
+                 pyensembl.PC.E + "\n")
+    try :
+        server.run()
+    except KeyboardInterrupt :
+        pass
+    finally :
+        server.close()
+        catalogue.close()
+        stderr.write(pyensembl.PC.G + pyensembl.timestamp() + "Stopped after %i requests" %
+                     server.requests + pyensembl.PC.E + "\n")
+
+### * Classes
+
+### ** ServeError
+
+class ServeError(Exception) :
+    """Raised when the daemon cannot answer a request"""
+    pass
+
+### ** SpeciesCatalogue
+
+class SpeciesCatalogue(object) :
+    """Species catalogue held in memory by the daemon
+
+    The catalogue is the SQLite index of the latest snapshot (see
+    pyensemblDb.SpeciesIndex), copied to memory so that searches do not read
+    the disk. It is replaced when the index file changes: the new index is
+    loaded in the background and swapped in once ready, requests being
+    answered from the previous one meanwhile.
+    """
+
+    def __init__(self, folder, emblTable = None) :
+        """
+        Args:
+            folder (str): Folder of the snapshots and of the index (DB_FOLDER
+              in pyensemblScripts)
+            emblTable (str): Optional table mapping species to EMBL accession
+              numbers (see pyensembl.EMBLspeciesIndex), answering "embl"
+              requests
+
+        """
+        self.folder = folder
+        self.indexPath = os.path.join(folder, pyensemblDb.INDEX_FILE)
+        self.index = None
+        self.snapshot = None
+        self.count = 0
+        self.signature = None
+        self.embl = None
+        if emblTable is not None :
+            self.embl = pyensembl.EMBLspeciesIndex(table = emblTable)
+        self._lock = threading.Lock()
+        self._reloadLock = threading.Lock()
+
+    def fileSignature(self) :
+        """Identity of the index file, which changes when it is replaced"""
+        try :
+            st = os.stat(self.indexPath)
+        except OSError :
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def load(self) :
+        """Load the index file to memory, building it first if it does not
+        match the latest snapshot (as "pyensembl search" does)
+
+        Raises:
+            ServeError: If there is no snapshot
+
+        """
+        with self._reloadLock :
+            snapshot = pyensemblDb.latestSnapshot(self.folder)
+            if snapshot is None :
+                raise ServeError("No database file found, run \"pyensembl refresh\" first")
+            index = pyensemblDb.SpeciesIndex(self.indexPath)
+            if index.snapshot() != snapshot :
+                index.build(pyensemblDb.iterSnapshot(os.path.join(self.folder, snapshot)),
+                            snapshot)
+            index.close()
+            self._swap()
+
+    def reload(self, force = False) :
+        """Load the index file again if it changed since it was loaded
+
+        Unlike load(), the index is never rebuilt here: a new index file is
+        written by "pyensembl refresh" before its snapshot is renamed.
+
+        Returns:
+            bool: True if the index was loaded again
+
+        """
+        with self._reloadLock :
+            if not force and self.fileSignature() == self.signature :
+                return False
+            if self.fileSignature() is None :
+                return False
+            self._swap()
+            return True
+
+    def _swap(self) :
+        signature = self.fileSignature()
+        start = time.perf_counter()
+        index = pyensemblDb.SpeciesIndex(self.indexPath, memory = True)
+        snapshot = index.snapshot()
+        count = index.count()
+        pyensemblMetrics.observe("serve_load_seconds", time.perf_counter() - start)
+        with self._lock :
+            (previous, self.index) = (self.index, index)
+            (self.snapshot, self.count, self.signature) = (snapshot, count, signature)
+            if previous is not None :
+                previous.close()
+        pyensemblMetrics.event("serve_load", snapshot = snapshot, species = count)
+
+    def close(self) :
+        with self._lock :
+            if self.index is not None :
+                self.index.close()
+                self.index = None
+
+    def handle(self, request) :
+        """Answer a request
+
+        Args:
+            request (dict): Request (see the description of the module)
+
+        Returns:
+            dict: Response
+
+        """
+        action = request.get("action")
+        if action not in ACTIONS :
+            raise ServeError("Unknown action: %r" % action)
+        if action == "reload" :
+            self.reload(force = True)
+            return {"snapshot" : self.snapshot, "species" : self.count}
+        if action == "embl" :
+            if self.embl is None :
+                raise ServeError("No EMBL table loaded (serve --embl-index)")
+            return {"mapping" : self.embl.searchSpecies(request["query"]).mapping}
+        options = dict((k, request.get(k)) for k in ["release", "assembly"])
+        options["aliases"] = bool(request.get("aliases"))
+        options["prefix"] = bool(request.get("prefix"))
+        with self._lock :
+            if self.index is None :
+                raise ServeError("The catalogue is not loaded")
+            response = {"snapshot" : self.snapshot}
+            if action == "status" :
+                response["species"] = self.count
+            elif action == "search" :
+                response["species"] = self.index.search(request["query"], **options)
+            elif action == "searchBatch" :
+                response["hits"] = self.index.searchBatch(request["queries"], **options)
+            elif action == "lookup" :
+                response["species"] = self.index.lookup(request["names"])
+        return response
+
+### ** SpeciesServer
+
+class SpeciesServer(object) :
+    """Servers answering the requests to a catalogue: a Unix socket server,
+    an optional HTTP server on 127.0.0.1, and a thread watching the index
+    file
+    """
+
+    def __init__(self, catalogue, path = SERVE_SOCKET, httpPort = None) :
+        """
+        Args:
+            catalogue (SpeciesCatalogue): The (loaded) catalogue
+            path (str): Path to the Unix socket
+            httpPort (int): If not None, port of the HTTP server (0 for any
+              free port)
+
+        Raises:
+            ServeError: If another daemon already listens on the socket
+
+        """
+        self.catalogue = catalogue
+        self.path = path
+        self.requests = 0
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        if os.path.exists(path) :
+            try :
+                sendRequest(path, {"action" : "status"}, timeout = 1)
+            except (OSError, ValueError, ServeError) :
+                # Socket left by a daemon which did not stop cleanly
+                os.remove(path)
+            else :
+                raise ServeError("A daemon is already running on %s" % path)
+        self.unixServer = _UnixServer(path, _UnixHandler)
+        self.unixServer.owner = self
+        self.httpServer = None
+        self.httpPort = None
+        if httpPort is not None :
+            import http.server
+            self.httpServer = http.server.ThreadingHTTPServer(("127.0.0.1", httpPort),
+                                                              _httpHandlerClass())
+            self.httpServer.owner = self
+            self.httpPort = self.httpServer.server_address[1]
+        self._threads = []
+
+    def handle(self, request) :
+        """Answer a request, catching the errors
+
+        Returns:
+            dict: Response, with "ok" set
+
+        """
+        start = time.perf_counter()
+        action = request.get("action") if isinstance(request, dict) else None
+        try :
+            if not isinstance(request, dict) :
+                raise ServeError("The request must be a JSON object")
+            response = self.catalogue.handle(request)
+            response["ok"] = True
+            if action == "status" :
+                response["uptime"] = time.time() - self.started
+                response["requests"] = self.requests
+        except (ServeError, KeyError, TypeError, ValueError) as e :
+            if isinstance(e, KeyError) :
+                e = "Missing parameter: %s" % e
+            response = {"ok" : False, "error" : str(e)}
+        with self._lock :
+            self.requests += 1
+        pyensemblMetrics.increment("serve_requests_total",
+                                   labels = {"action" : str(action), "ok" : response["ok"]})
+        pyensemblMetrics.observe("serve_request_seconds", time.perf_counter() - start)
+        return response
+
+    def watch(self) :
+        """Reload the catalogue when the index file is replaced"""
+        while not self._stop.wait(RELOAD_INTERVAL) :
+            try :
+                self.catalogue.reload()
+            except Exception as e :
+                pyensemblMetrics.event("serve_reload_error", error = str(e))
+
+    def run(self) :
+        """Serve the requests until close() is called (or KeyboardInterrupt)"""
+        targets = [self.watch]
+        if self.httpServer is not None :
+            targets.append(self.httpServer.serve_forever)
+        for target in targets :
+            thread = threading.Thread(target = target, daemon = True)
+            thread.start()
+            self._threads.append(thread)
+        self.unixServer.serve_forever()
+
+    def close(self) :
+        self._stop.set()
+        if self.httpServer is not None :
+            self.httpServer.shutdown()
+            self.httpServer.server_close()
+        self.unixServer.server_close()
+        if os.path.exists(self.path) :
+            os.remove(self.path)
+
+### ** _UnixServer
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer) :
+    daemon_threads = True
+
+### ** _UnixHandler
+
+class _UnixHandler(socketserver.StreamRequestHandler) :
+    """Answer the requests of a connection, one JSON object per line"""
+
+    def handle(self) :
+        for line in self.rfile :
+            if line.strip() == b"" :
+                continue
+            try :
+                request = json.loads(line.decode("utf-8"))
+            except ValueError :
+                request = None
+            response = self.server.owner.handle(request)
+            self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+            self.wfile.flush()
+
+### ** _httpHandlerClass()
+
+def _httpHandlerClass() :
+    """Class answering the HTTP requests: POST with a JSON request as body, or
+    GET with the action as path and the parameters in the URL
+
+    The class is built on demand so that http.server is only imported by the
+    daemons serving HTTP.
+    """
+    import http.server
+    class HttpHandler(http.server.BaseHTTPRequestHandler) :
+        def do_GET(self) :
+            (path, _, queryString) = self.path.partition("?")
+            try :
+                request = parseQueryString(queryString)
+            except ValueError as e :
+                request = None
+            else :
+                request["action"] = path.strip("/")
+            self.reply(self.server.owner.handle(request))
+        def do_POST(self) :
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            try :
+                request = json.loads(body.decode("utf-8"))
+            except ValueError :
+                request = None
+            self.reply(self.server.owner.handle(request))
+        def reply(self, response) :
+            body = json.dumps(response).encode("utf-8")
+            self.send_response(200 if response["ok"] else 400)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        def log_message(self, format, *args) :
+            pass
+    return HttpHandler
@@ -0,0 +1,256 @@
+### * Description
+
+# Content-addressed store of downloaded genome files, shared across releases
+# and projects
+#
+# Each distinct file content is kept once, as a blob named by its SHA-256, and
+# a SQLite manifest maps each (release, collection, species, file) to its
+# blob, files being named by format and file name. Download directories are
+# views of the store: their files are hard links (or reflinks, or copies as a
+# last resort) to the blobs. A hard link shares the modification time of the
+# blob, so views whose server modification time differs from that of the
+# blob get their own copy (a reflink where the filesystem allows it). A file
+# of a new release with the same size and checksum as a file of the same
+# species and format already stored is not downloaded again (file names
+# change between releases, since they hold the release number).
+
+### * Setup
+
+### ** Import
+
+import os
+import re
+import shutil
+import sqlite3
+import threading
+
+### ** Parameters
+
+STORE_FOLDER = os.path.join(os.path.expanduser("~"), ".pyensembl-store")
+MANIFEST_FILE = "manifest.sqlite"
+BLOBS_FOLDER = "blobs"
+HASH_BLOCK_SIZE = 1 << 20
+# ioctl request cloning a file on Linux (copy-on-write filesystems such as
+# btrfs and XFS)
+FICLONE = 0x40049409
+
+### * Functions
+
+### ** hashFile(path)
+
+def hashFile(path) :
+    """SHA-256 of a file, as a hexadecimal string"""
+    import hashlib
+    h = hashlib.sha256()
+    with open(path, "rb") as fi :
+        while True :
+            block = fi.read(HASH_BLOCK_SIZE)
+            if not block :
+                break
+            h.update(block)
+    return h.hexdigest()
+
+### ** linkFile(source, dest)
+
+def linkFile(source, dest, hardLink = True) :
+    """Make `dest` a hard link to `source`, or a reflink or a copy if the two
+    paths are not on the same filesystem (or if `hardLink` is False)
+
+    `dest` is replaced atomically if it exists.
+
+    Returns:
+        str: "link", "reflink" or "copy"
+
+    """
+    tmp = dest + ".tmp"
+    if os.path.lexists(tmp) :
+        os.remove(tmp)
+    try :
+        if not hardLink :
+            raise OSError("no hard link")
+        os.link(source, tmp)
+        method = "link"
+    except OSError :
+        method = "copy"
+        with open(source, "rb") as fi, open(tmp, "wb") as fo :
+            try :
+                import fcntl
+                fcntl.ioctl(fo.fileno(), FICLONE, fi.fileno())
+                method = "reflink"
+            except (ImportError, OSError) :
+                shutil.copyfileobj(fi, fo)
+    os.replace(tmp, dest)
+    return method
+
+### ** storedName(task)
+
+def storedName(task) :
+    """Name of the file of a transfer task in the manifest: the name of its
+    format and its file name (GenBank and EMBL files have the same names)"""
+    return task.format + "/" + os.path.basename(task.remotePath)
+
+### ** releaseFreeName(name, release)
+
+def releaseFreeName(name, release) :
+    """File name without its release number (e.g. "X.ASM1v1.32.gff3.gz" gives
+    "X.ASM1v1.gff3.gz" for release "32"), identical across releases"""
+    if release is None or not str(release).isdigit() :
+        return name
+    return re.sub(r"\.%s(?=\.)" % release, "", name, count = 1)
+
+### * Classes
+
+### ** GenomeStore
+
+class GenomeStore(object) :
+    """Content-addressed store of genome files
+
+    Blobs are stored under `path`/blobs/ab/abcdef.... Those which are hard
+    links to files of download directories are left writable, like the
+    download files they are, and the others are made read-only. The
+    modification time of a file on the server is kept in the manifest: a
+    view is only a hard link to its blob when the blob has the same
+    modification time (see sameTime()). The manifest records, for each stored
+    file, its blob, its size, its (sum, blocks) checksum as given in the
+    CHECKSUMS files, its modification time on the server, its format and its
+    name without the release number (see releaseFreeName()).
+    """
+
+    def __init__(self, path = STORE_FOLDER) :
+        """
+        Args:
+            path (str): Folder of the store (created if needed)
+
+        """
+        self.path = path
+        os.makedirs(os.path.join(path, BLOBS_FOLDER), exist_ok = True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(path, MANIFEST_FILE),
+                                   check_same_thread = False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS files ("
+                         "release TEXT, collection TEXT, species TEXT, name TEXT, "
+                         "blob TEXT, size INTEGER, sum INTEGER, blocks INTEGER, "
+                         "modify REAL, format TEXT, stem TEXT, "
+                         "PRIMARY KEY (release, collection, species, name))")
+        columns = [x[1] for x in self._db.execute("PRAGMA table_info(files)")]
+        if "stem" not in columns :
+            # Manifests written before the lookup by content
+            self._db.execute("ALTER TABLE files ADD COLUMN format TEXT")
+            self._db.execute("ALTER TABLE files ADD COLUMN stem TEXT")
+            rows = self._db.execute("SELECT rowid, release, name FROM files").fetchall()
+            self._db.executemany("UPDATE files SET format = ?, stem = ? WHERE rowid = ?",
+                                 [(name.split("/")[0], releaseFreeName(name, release), i)
+                                  for (i, release, name) in rows])
+        self._db.execute("CREATE INDEX IF NOT EXISTS filesName ON files (species, name)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS filesContent ON files "
+                         "(species, format, size, sum)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS filesStem ON files (species, stem)")
+        self._db.commit()
+
+    def blobPath(self, blob) :
+        return os.path.join(self.path, BLOBS_FOLDER, blob[:2], blob)
+
+    def find(self, task) :
+        """Find a stored file with the same content as the remote file of a
+        transfer task
+
+        A stored file matches if it has the same species, format, size and
+        checksum as the remote file, whatever its name. If the checksum of
+        the task is unknown, it must have the same name (release number
+        excepted), size and modification time on the server. Files of any
+        release or collection can match.
+
+        Args:
+            task (pyensemblFtp.FTPTask): The transfer
+
+        Returns:
+            str: Blob of the file, or None if none matches
+
+        """
+        if task.size is None :
+            return None
+        if task.checksum is not None :
+            query = ("SELECT blob FROM files WHERE species = ? AND format = ? AND "
+                     "size = ? AND sum = ? AND blocks = ?")
+            params = [task.species, task.format, task.size] + list(task.checksum)
+        elif task.modify is not None :
+            query = ("SELECT blob FROM files WHERE species = ? AND stem = ? AND "
+                     "size = ? AND modify = ?")
+            params = [task.species, releaseFreeName(storedName(task), task.release),
+                      task.size, task.modify]
+        else :
+            return None
+        with self._lock :
+            rows = self._db.execute(query, params).fetchall()
+        for (blob, ) in rows :
+            if os.path.isfile(self.blobPath(blob)) :
+                return blob
+        return None
+
+    def record(self, task, blob) :
+        """Record the blob of the file of a transfer task in the manifest"""
+        checksum = task.checksum or (None, None)
+        with self._lock :
+            self._db.execute("INSERT OR REPLACE INTO files (release, collection, "
+                             "species, name, blob, size, sum, blocks, modify, format, "
+                             "stem) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                             (task.release, task.collection, task.species,
+                              storedName(task), blob,
+                              os.path.getsize(self.blobPath(blob)), checksum[0],
+                              checksum[1], task.modify, task.format,
+                              releaseFreeName(storedName(task), task.release)))
+            self._db.commit()
+
+    def add(self, task) :
+        """Add a downloaded file to the store
+
+        The file at `task.localPath` becomes a view of its blob. If the same
+        content is already stored, the existing blob is used.
+
+        Args:
+            task (pyensemblFtp.FTPTask): The completed transfer
+
+        Returns:
+            str: Blob of the file
+
+        """
+        blob = hashFile(task.localPath)
+        blobPath = self.blobPath(blob)
+        if not os.path.isfile(blobPath) :
+            os.makedirs(os.path.dirname(blobPath), exist_ok = True)
+            if linkFile(task.localPath, blobPath) != "link" :
+                os.chmod(blobPath, 0o444)
+        elif not os.path.samefile(blobPath, task.localPath) and self.sameTime(blob, task) :
+            linkFile(blobPath, task.localPath)
+        # Otherwise the downloaded file is kept as it is, with its own
+        # modification time
+        self.record(task, blob)
+        return blob
+
+    def sameTime(self, blob, task) :
+        """Can the file of a task be a hard link to a blob (the blob has the
+        modification time of the file on the server, if known)?"""
+        return (task.modify is None or
+                int(os.path.getmtime(self.blobPath(blob))) == int(task.modify))
+
+    def materialize(self, task, blob) :
+        """Write the file of a transfer task from its blob
+
+        The file has the modification time of the file on the server, so that
+        it is recognized as up to date by the next downloads: it is a hard
+        link to the blob if the blob has this time, and a reflink or a copy
+        otherwise (so that the other views of the blob keep their time).
+
+        Returns:
+            str: "link", "reflink" or "copy"
+
+        """
+        method = linkFile(self.blobPath(blob), task.localPath,
+                          hardLink = self.sameTime(blob, task))
+        if method != "link" and task.modify is not None :
+            os.utime(task.localPath, (os.path.getatime(task.localPath), task.modify))
+        return method
+
+    def close(self) :
+        with self._lock :
+            self._db.close()
@@ -0,0 +1,442 @@
+### * Description
+
+# Local index of the NCBI taxonomy, resolving the species of the catalogue
+# below a taxon without contacting the REST server
+#
+# The index is built from the nodes.dmp and names.dmp files of an NCBI
+# taxonomy dump (https://ftp.ncbi.nih.gov/pub/taxonomy/taxdump.tar.gz). Each
+# node keeps its parent and its interval in an Euler tour of the tree (the
+# preorder rank of the node and the largest preorder rank of its
+# descendants), so that the nodes below a taxon are those whose rank falls in
+# its interval. The species of the local catalogue are stored with the rank of
+# their taxon, and "all the species below taxon X" is a range query on these
+# ranks. The genome information of these species is kept in the index once
+# retrieved from the REST server, so that it is joined to the range query.
+
+### * Setup
+
+### ** Import
+
+import os
+import io
+import json
+import array
+import sqlite3
+import tarfile
+import contextlib
+
+import pyensemblMetrics
+
+### ** Parameters
+
+TAXONOMY_FILE = ".pyensembl-taxonomy.sqlite"
+NODES_FILE = "nodes.dmp"
+NAMES_FILE = "names.dmp"
+TAXDUMP_URL = "https://ftp.ncbi.nih.gov/pub/taxonomy/taxdump.tar.gz"
+ROOT_TAXID = 1
+# Name classes of names.dmp which are not kept in the index (not names one
+# would query)
+SKIPPED_NAME_CLASSES = ["authority", "type material", "in-part"]
+
+### * Functions
+
+### ** iterDmp(fi)
+
+def iterDmp(fi) :
+    """Iterate over the rows of a .dmp file of an NCBI taxonomy dump
+
+    Fields are separated by "\\t|\\t" and rows end with "\\t|".
+
+    Args:
+        fi (file): Input stream, in text mode
+
+    Returns:
+        generator: Lists of fields
+
+    """
+    for line in fi :
+        line = line.rstrip("\n")
+        if line.endswith("\t|") :
+            line = line[:-2]
+        if line != "" :
+            yield line.split("\t|\t")
+
+### ** openTaxdump(path)
+
+@contextlib.contextmanager
+def openTaxdump(path) :
+    """Open the nodes.dmp and names.dmp files of a taxonomy dump
+
+    Args:
+        path (str): Folder with the extracted dump, or the taxdump.tar.gz file
+
+    Returns:
+        context manager: Gives (nodes, names) streams, in text mode
+
+    """
+    if os.path.isdir(path) :
+        with open(os.path.join(path, NODES_FILE), "r") as nodes, \
+             open(os.path.join(path, NAMES_FILE), "r") as names :
+            yield (nodes, names)
+    else :
+        # Members of a tar file can be read in any order only if it is not
+        # read as a stream
+        with tarfile.open(path, "r:*") as tar :
+            members = dict((os.path.basename(m.name), m) for m in tar.getmembers())
+            for name in [NODES_FILE, NAMES_FILE] :
+                if name not in members :
+                    raise TaxonomyError("%s not found in %s" % (name, path))
+            nodes = io.TextIOWrapper(tar.extractfile(members[NODES_FILE]), "utf-8")
+            names = io.TextIOWrapper(tar.extractfile(members[NAMES_FILE]), "utf-8")
+            yield (nodes, names)
+
+### ** eulerIntervals(taxids, parents)
+
+def eulerIntervals(taxids, parents, root = ROOT_TAXID) :
+    """Compute the interval of each node in an Euler tour (preorder) of the tree
+
+    The tree is given as parent pointers and walked without recursion, using
+    arrays indexed by taxon id.
+
+    Args:
+        taxids (array of int): Taxon ids of the nodes
+        parents (array of int): Taxon id of the parent of each node (the root
+          is its own parent)
+        root (int): Taxon id of the root
+
+    Returns:
+        tuple: (start, end) arrays indexed by taxon id: preorder rank of each
+          node and largest preorder rank of its descendants (-1 for the ids
+          absent from the tree, and for nodes not connected to the root)
+
+    """
+    size = max(taxids) + 1
+    # Children of each node, as contiguous slices of one array
+    counts = array.array("l", bytes(8 * (size + 1)))
+    for (t, p) in zip(taxids, parents) :
+        if t != p :
+            counts[p + 1] += 1
+    for i in range(1, size + 1) :
+        counts[i] += counts[i - 1]
+    offsets = array.array("l", counts)
+    children = array.array("l", bytes(8 * len(taxids)))
+    for (t, p) in zip(taxids, parents) :
+        if t != p :
+            children[offsets[p]] = t
+            offsets[p] += 1
+    start = array.array("l", [-1]) * size
+    end = array.array("l", [-1]) * size
+    rank = 0
+    # Stack of (node, index of its next child)
+    stack = [(root, counts[root])]
+    start[root] = rank
+    while stack :
+        (node, i) = stack[-1]
+        if i < counts[node + 1] :
+            stack[-1] = (node, i + 1)
+            child = children[i]
+            rank += 1
+            start[child] = rank
+            stack.append((child, counts[child]))
+        else :
+            end[node] = rank
+            stack.pop()
+    return (start, end)
+
+### * Classes
+
+### ** TaxonomyError
+
+class TaxonomyError(Exception) :
+    """Raised when a taxon cannot be resolved or the index is missing"""
+    pass
+
+### ** TaxonomyIndex
+
+class TaxonomyIndex(object) :
+    """SQLite index of the NCBI taxonomy and of the taxa of the local species
+    catalogue
+
+    Tables:
+        nodes: taxid, parent, rank, start, end (Euler tour interval)
+        names: name, taxid, class (as in names.dmp)
+        catalogue: start of the taxon of each species of the catalogue, with
+          the species id, name, accession and release in the species index
+        genomes: genome information (JSON object from the REST server) of
+          species, with the accession and release of the species it was
+          retrieved for
+        meta: key, value (the species snapshot the catalogue table comes from)
+    """
+
+    def __init__(self, path) :
+        """
+        Args:
+            path (str): Path to the index file (created by build())
+
+        """
+        self.path = path
+        self._db = None
+
+    def db(self) :
+        if self._db is None :
+            if not self.exists() :
+                raise TaxonomyError("No taxonomy index found, run \"pyensembl "
+                                    "taxonomy --build TAXDUMP\" first")
+            self._db = sqlite3.connect(self.path)
+            self._upgrade(self._db)
+        return self._db
+
+    def _upgrade(self, db) :
+        """Add the genomes table (and the catalogue columns it is joined on)
+        to an index built by an earlier version"""
+        columns = [x[1] for x in db.execute("PRAGMA table_info(catalogue)")]
+        if "accession" in columns :
+            return
+        db.execute("ALTER TABLE catalogue ADD COLUMN accession TEXT")
+        db.execute("ALTER TABLE catalogue ADD COLUMN release INTEGER")
+        db.execute("CREATE INDEX catalogue_name ON catalogue (name)")
+        db.execute("CREATE TABLE genomes (name TEXT PRIMARY KEY, accession TEXT, "
+                   "release INTEGER, genome TEXT)")
+        # The catalogue table is filled again by the next syncCatalogue()
+        db.execute("DELETE FROM meta WHERE key = 'snapshot'")
+        db.commit()
+
+    def close(self) :
+        if self._db is not None :
+            self._db.close()
+            self._db = None
+
+    def exists(self) :
+        return os.path.isfile(self.path)
+
+    def meta(self, key) :
+        row = self.db().execute("SELECT value FROM meta WHERE key = ?", (key, )).fetchone()
+        return None if row is None else row[0]
+
+    @pyensemblMetrics.profiled
+    @pyensemblMetrics.timed("taxonomy_build_seconds")
+    def build(self, nodes, names) :
+        """Build the index from the files of a taxonomy dump, replacing any
+        previous one
+
+        Args:
+            nodes (file): Stream of nodes.dmp
+            names (file): Stream of names.dmp
+
+        Returns:
+            int: Number of nodes
+
+        """
+        taxids = array.array("l")
+        parents = array.array("l")
+        ranks = []
+        for row in iterDmp(nodes) :
+            taxids.append(int(row[0]))
+            parents.append(int(row[1]))
+            ranks.append(row[2])
+        if ROOT_TAXID not in taxids :
+            raise TaxonomyError("The root (taxon %i) is missing from %s" %
+                                (ROOT_TAXID, NODES_FILE))
+        (start, end) = eulerIntervals(taxids, parents)
+        tmpPath = self.path + ".tmp"
+        if os.path.isfile(tmpPath) :
+            os.remove(tmpPath)
+        db = sqlite3.connect(tmpPath)
+        db.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+        db.execute("CREATE TABLE nodes (taxid INTEGER PRIMARY KEY, parent INTEGER, "
+                   "rank TEXT, start INTEGER, end INTEGER)")
+        db.executemany("INSERT INTO nodes VALUES (?, ?, ?, ?, ?)",
+                       ((t, p, r, start[t], end[t]) for (t, p, r)
+                        in zip(taxids, parents, ranks) if start[t] >= 0))
+        db.execute("CREATE TABLE names (name TEXT COLLATE NOCASE, taxid INTEGER, "
+                   "class TEXT)")
+        db.executemany("INSERT INTO names VALUES (?, ?, ?)",
+                       ((row[1], int(row[0]), row[3]) for row in iterDmp(names)
+                        if row[3] not in SKIPPED_NAME_CLASSES))
+        db.execute("CREATE INDEX names_name ON names (name)")
+        db.execute("CREATE TABLE catalogue (start INTEGER, id INTEGER, name TEXT, "
+                   "accession TEXT, release INTEGER)")
+        db.execute("CREATE INDEX catalogue_start ON catalogue (start)")
+        db.execute("CREATE INDEX catalogue_name ON catalogue (name)")
+        db.execute("CREATE TABLE genomes (name TEXT PRIMARY KEY, accession TEXT, "
+                   "release INTEGER, genome TEXT)")
+        db.commit()
+        n = db.execute("SELECT COUNT(*) FROM nodes").fetchone()[0]
+        db.close()
+        self.close()
+        os.replace(tmpPath, self.path)
+        return n
+
+    def syncCatalogue(self, index) :
+        """Fill the catalogue table from a species index if it was filled from
+        another snapshot
+
+        Args:
+            index (pyensemblDb.SpeciesIndex): Index of the latest snapshot
+
+        Returns:
+            int: Number of species of the catalogue whose taxon is absent from
+              the taxonomy, or None if the table was already up to date
+
+        """
+        snapshot = index.snapshot()
+        db = self.db()
+        if self.meta("snapshot") == snapshot :
+            return None
+        db.execute("DELETE FROM catalogue")
+        missing = 0
+        rows = []
+        for (i, name, taxid, accession, release) in index.db().execute(
+                "SELECT id, name, taxon_id, accession, release FROM species") :
+            row = None
+            if taxid is not None and str(taxid).isdigit() :
+                row = db.execute("SELECT start FROM nodes WHERE taxid = ?",
+                                 (int(taxid), )).fetchone()
+            if row is None :
+                missing += 1
+            else :
+                rows.append((row[0], i, name, accession, release))
+        db.executemany("INSERT INTO catalogue VALUES (?, ?, ?, ?, ?)", rows)
+        db.execute("INSERT OR REPLACE INTO meta VALUES ('snapshot', ?)", (snapshot, ))
+        db.commit()
+        return missing
+
+    def resolve(self, taxon) :
+        """Find the node of a taxon
+
+        A taxon can be given as a taxon id or as a name (case-insensitive,
+        scientific name or another name class of names.dmp). When several
+        nodes share the name, scientific names are preferred, then the node
+        with the most species in the catalogue, then the smallest taxon id.
+
+        Args:
+            taxon (str): Taxon id or name (e.g. "Serratia", "1224")
+
+        Returns:
+            dict: taxid, name (scientific name), rank, start and end
+
+        Raises:
+            TaxonomyError: If the taxon is not found
+
+        """
+        db = self.db()
+        if taxon.strip().isdigit() :
+            candidates = [int(taxon)]
+        else :
+            rows = db.execute("SELECT taxid, class FROM names WHERE name = ?",
+                              (taxon.strip(), )).fetchall()
+            scientific = [t for (t, c) in rows if c == "scientific name"]
+            candidates = sorted(set(scientific or [t for (t, c) in rows]))
+        nodes = []
+        for taxid in candidates :
+            row = db.execute("SELECT taxid, rank, start, end FROM nodes WHERE taxid = ?",
+                             (taxid, )).fetchone()
+            if row is not None :
+                nodes.append(row)
+        if len(nodes) == 0 :
+            raise TaxonomyError("Taxon not found in the taxonomy index: %s" % taxon)
+        def count(node) :
+            return self.db().execute("SELECT COUNT(*) FROM catalogue WHERE start "
+                                     "BETWEEN ? AND ?", node[2:]).fetchone()[0]
+        nodes.sort(key = lambda x : (-count(x), x[0]))
+        (taxid, rank, start, end) = nodes[0]
+        name = db.execute("SELECT name FROM names WHERE taxid = ? AND class = "
+                          "'scientific name'", (taxid, )).fetchone()
+        return {"taxid" : taxid, "name" : name[0] if name else str(taxid),
+                "rank" : rank, "start" : start, "end" : end}
+
+    def lineage(self, taxid) :
+        """Names of the ancestors of a taxon, from the root
+
+        Returns:
+            list of (taxid, name, rank)
+
+        """
+        db = self.db()
+        o = []
+        while True :
+            row = db.execute("SELECT nodes.parent, nodes.rank, names.name FROM nodes "
+                             "LEFT JOIN names ON names.taxid = nodes.taxid AND "
+                             "names.class = 'scientific name' WHERE nodes.taxid = ?",
+                             (taxid, )).fetchone()
+            if row is None :
+                break
+            o.append((taxid, row[2], row[1]))
+            if row[0] == taxid :
+                break
+            taxid = row[0]
+        return o[::-1]
+
+    @pyensemblMetrics.timed("taxonomy_query_seconds")
+    def species(self, node) :
+        """Names of the species of the catalogue below a taxon
+
+        Args:
+            node (dict): Taxon from resolve()
+
+        Returns:
+            list of str: Species names, in catalogue order
+
+        """
+        return [x[0] for x in self.db().execute("SELECT name FROM catalogue WHERE start "
+                                                "BETWEEN ? AND ? ORDER BY id",
+                                                (node["start"], node["end"]))]
+
+    def missingGenomes(self, node) :
+        """Names of the species of the catalogue below a taxon whose genome
+        information is not in the genomes table (or was retrieved for another
+        assembly or release)
+
+        Args:
+            node (dict): Taxon from resolve()
+
+        Returns:
+            list of str: Species names, in catalogue order
+
+        """
+        return [x[0] for x in self.db().execute(
+            "SELECT catalogue.name FROM catalogue LEFT JOIN genomes ON genomes.name = "
+            "catalogue.name AND genomes.accession IS catalogue.accession AND "
+            "genomes.release IS catalogue.release WHERE catalogue.start BETWEEN ? AND ? "
+            "AND genomes.name IS NULL ORDER BY catalogue.id", (node["start"], node["end"]))]
+
+    def recordGenomes(self, genomes) :
+        """Store the genome information of species of the catalogue
+
+        Genomes of species which are not in the catalogue are ignored.
+
+        Args:
+            genomes (iterable of dict): JSON objects from the REST server
+
+        Returns:
+            int: Number of genomes stored
+
+        """
+        db = self.db()
+        n = 0
+        for genome in genomes :
+            n += db.execute("INSERT OR REPLACE INTO genomes SELECT name, accession, release, ? "
+                            "FROM catalogue WHERE name = ? LIMIT 1",
+                            (json.dumps(genome), genome.get("species"))).rowcount
+        db.commit()
+        return n
+
+    @pyensemblMetrics.timed("taxonomy_query_seconds")
+    def genomes(self, node) :
+        """Genome information of the species of the catalogue below a taxon,
+        from the genomes table (see missingGenomes() for those which are not
+        there)
+
+        Args:
+            node (dict): Taxon from resolve()
+
+        Returns:
+            generator: JSON objects of the genomes, in catalogue order
+
+        """
+        for (genome, ) in self.db().execute(
+                "SELECT genomes.genome FROM catalogue JOIN genomes ON genomes.name = "
+                "catalogue.name AND genomes.accession IS catalogue.accession AND "
+                "genomes.release IS catalogue.release WHERE catalogue.start BETWEEN ? AND ? "
+                "ORDER BY catalogue.id", (node["start"], node["end"])) :
+            yield json.loads(genome)
@@ -6,7 +6,10 @@ from setuptools import setup, find_packages
 
 setup(name = "pyensembl",
       version = "0.0.2",
-      py_modules = ["pyensembl", "pyensemblScripts"],
+      py_modules = ["pyensembl", "pyensemblBgzf", "pyensemblDb", "pyensemblFtp",
+                    "pyensemblGenbank", "pyensemblJournal", "pyensemblMetrics",
+                    "pyensemblPipeline", "pyensemblRecords", "pyensemblScripts",
+                    "pyensemblServe", "pyensemblStore", "pyensemblTaxonomy"],
       entry_points =  {
           "console_scripts" : [
               "pyensembl=pyensemblScripts:main"
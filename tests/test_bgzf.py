@@ -0,0 +1,71 @@
+### * Description
+
+# Tests of the BGZF recompression of the FASTA files (pyensemblBgzf)
+
+### * Setup
+
+### ** Import
+
+import os
+import sys
+import gzip
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import pyensemblBgzf
+import pyensemblFtp
+
+### * Tests
+
+class TestRecompressed(unittest.TestCase) :
+
+    def setUp(self) :
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, "X.dna.toplevel.fa.gz")
+        with gzip.open(self.path, "wt") as fo :
+            fo.write(">1\n" + ("ACGT" * 15 + "\n") * 2000)
+        os.utime(self.path, (1000000000, 1000000000))
+        self.size = os.path.getsize(self.path)
+        (path, n, before, after, e) = pyensemblBgzf.indexFile(self.path)
+        self.assertIsNone(e)
+        self.assertNotEqual(os.path.getsize(self.path), self.size)
+
+    def tearDown(self) :
+        shutil.rmtree(self.folder)
+
+    def entry(self, size, modify) :
+        return pyensemblFtp.FTPEntry(os.path.basename(self.path), size, modify)
+
+    def test_source(self) :
+        self.assertEqual(pyensemblBgzf.recompressedSource(self.path),
+                         (self.size, 1000000000.0))
+        fasta = pyensemblBgzf.IndexedFasta(self.path)
+        try :
+            self.assertEqual(fasta.fetch("1", 1, 8), "ACGTACGT")
+        finally :
+            fasta.close()
+
+    def test_currentWithoutModify(self) :
+        # Listings of whole collections give no modification times
+        self.assertTrue(pyensemblFtp.isCurrent(self.path, self.entry(self.size, None)))
+        self.assertFalse(pyensemblFtp.isCurrent(self.path, self.entry(self.size + 1, None)))
+
+    def test_currentWithModify(self) :
+        self.assertTrue(pyensemblFtp.isCurrent(self.path, self.entry(self.size, 1000000000)))
+        self.assertFalse(pyensemblFtp.isCurrent(self.path, self.entry(self.size, 1000000100)))
+
+    def test_replacedFile(self) :
+        # A new download replacing the recompressed file makes its source stale
+        shutil.copyfile(self.path, self.path + ".new")
+        os.utime(self.source(), (0, 0))
+        os.replace(self.path + ".new", self.path)
+        self.assertIsNone(pyensemblBgzf.recompressedSource(self.path))
+        self.assertFalse(pyensemblFtp.isCurrent(self.path, self.entry(self.size, None)))
+
+    def source(self) :
+        return self.path + pyensemblBgzf.SOURCE_SUFFIX
+
+if __name__ == "__main__" :
+    unittest.main()
@@ -0,0 +1,126 @@
+### * Description
+
+# Tests of the species snapshots and their changes (pyensemblDb)
+
+### * Setup
+
+### ** Import
+
+import io
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+import contextlib
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import pyensembl
+import pyensemblDb
+import pyensemblScripts
+
+### * Functions
+
+### ** makeSpecies(name, accession, release)
+
+def makeSpecies(name, accession, release = 32) :
+    """Species dict as returned by the REST API"""
+    return {"name" : name, "display_name" : name.capitalize().replace("_", " "),
+            "aliases" : [], "accession" : accession, "assembly" : "ASM%sv1" % accession,
+            "release" : release, "division" : "EnsemblBacteria", "taxon_id" : 1,
+            "groups" : ["core"]}
+
+### * Tests
+
+class TestSnapshotDiff(unittest.TestCase) :
+
+    def setUp(self) :
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, "index.sqlite")
+
+    def tearDown(self) :
+        shutil.rmtree(self.folder)
+
+    def readChanges(self, path) :
+        with open(path) as fi :
+            lines = [x.rstrip("\n").split("\t") for x in fi]
+        name = lines[0].index("name")
+        return [(x[0], x[name]) for x in lines[1:]]
+
+    def test_changes(self) :
+        index = pyensemblDb.SpeciesIndex(self.path)
+        index.build([makeSpecies("serratia_a", "1"), makeSpecies("serratia_b", "2"),
+                     makeSpecies("serratia_c", "3")], "snapshot.1.gz")
+        previous = pyensemblDb.SpeciesIndex(self.path)
+        changes = os.path.join(self.folder, "changes.tsv")
+        diff = pyensemblDb.SnapshotDiff(changes, previous)
+        index.build(diff.track([makeSpecies("serratia_a", "1"), makeSpecies("serratia_b", "4"),
+                                makeSpecies("serratia_d", "5")]), "snapshot.2.gz")
+        diff.close(index)
+        previous.close()
+        self.assertEqual(diff.counts, {"added" : 1, "changed" : 1, "removed" : 1})
+        self.assertEqual(self.readChanges(changes), [("changed", "serratia_b"),
+                                                     ("added", "serratia_d"),
+                                                     ("removed", "serratia_c")])
+        self.assertEqual(index.snapshot(), "snapshot.2.gz")
+        index.close()
+
+    def test_noPrevious(self) :
+        changes = os.path.join(self.folder, "changes.tsv")
+        diff = pyensemblDb.SnapshotDiff(changes)
+        index = pyensemblDb.SpeciesIndex(self.path)
+        index.build(diff.track([makeSpecies("serratia_a", "1")]), "snapshot.1.gz")
+        diff.close(index)
+        index.close()
+        self.assertEqual(self.readChanges(changes), [("added", "serratia_a")])
+
+    def test_abort(self) :
+        changes = os.path.join(self.folder, "changes.tsv")
+        diff = pyensemblDb.SnapshotDiff(changes)
+        diff.abort()
+        self.assertEqual(os.listdir(self.folder), [])
+
+class TestRefresh(unittest.TestCase) :
+
+    def setUp(self) :
+        self.folder = tempfile.mkdtemp()
+        self._dbFolder = pyensemblScripts.DB_FOLDER
+        self._iterBacteriaSpecies = pyensembl.iterBacteriaSpecies
+        pyensemblScripts.DB_FOLDER = self.folder
+
+    def tearDown(self) :
+        pyensemblScripts.DB_FOLDER = self._dbFolder
+        pyensembl.iterBacteriaSpecies = self._iterBacteriaSpecies
+        shutil.rmtree(self.folder)
+
+    def test_failedRefresh(self) :
+        def iterBacteriaSpecies() :
+            yield makeSpecies("serratia_a", "1")
+            raise ConnectionError("connection lost")
+        pyensembl.iterBacteriaSpecies = iterBacteriaSpecies
+        args = argparse.Namespace(check = False, changes = False, keep = 2)
+        with self.assertRaises(ConnectionError), contextlib.redirect_stdout(io.StringIO()) :
+            pyensemblScripts.main_refresh(args, io.StringIO(), io.StringIO())
+        self.assertEqual([x for x in os.listdir(self.folder) if x.endswith(".tmp")], [])
+        self.assertEqual(pyensemblDb.listSnapshots(self.folder), [])
+
+class TestKeep(unittest.TestCase) :
+
+    def test_positiveInt(self) :
+        self.assertEqual(pyensemblScripts.positiveInt("3"), 3)
+        for value in ["0", "-1", "x"] :
+            with self.assertRaises(argparse.ArgumentTypeError) :
+                pyensemblScripts.positiveInt(value)
+
+    def test_countOptions(self) :
+        parser = pyensemblScripts.makeParser()
+        for option in ["--jobs", "--max-connections", "--segments", "--verify-jobs",
+                       "--derive-jobs", "--bgzf-jobs"] :
+            args = parser.parse_args(["download", option, "2"])
+            self.assertEqual(getattr(args, option[2:].replace("-", "_")), 2)
+            with self.assertRaises(SystemExit), contextlib.redirect_stderr(io.StringIO()) :
+                parser.parse_args(["download", option, "0"])
+
+if __name__ == "__main__" :
+    unittest.main()
@@ -0,0 +1,237 @@
+### * Description
+
+# Tests of the downloads against the mock servers of the benchmarks: FTP
+# downloads (pyensemblFtp.downloadGenomes) and transfers of byte ranges
+# (pyensemblFtp.retrieveSegmented, pyensembl.HttpDownloader). The FTP tests
+# are skipped if pyftpdlib is not installed.
+
+### * Setup
+
+### ** Import
+
+import io
+import os
+import sys
+import json
+import random
+import shutil
+import tempfile
+import unittest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TESTS_DIR, ".."))
+sys.path.insert(0, os.path.join(TESTS_DIR, "..", "benchmarks"))
+import pyensembl
+import pyensemblFtp
+import mockServers
+
+try :
+    import pyftpdlib
+except ImportError :
+    pyftpdlib = None
+
+### * Tests
+
+@unittest.skipIf(pyftpdlib is None, "pyftpdlib is not installed")
+class TestDownload(unittest.TestCase) :
+
+    def setUp(self) :
+        self.folder = tempfile.mkdtemp()
+        self.ftpRoot = os.path.join(self.folder, "ftp")
+        self.outDir = os.path.join(self.folder, "download")
+        os.makedirs(self.outDir)
+        # Genomes of the same collection, listed with one recursive LIST
+        self.genomes = [x[1] for x in mockServers.syntheticCatalogue(2)]
+        mockServers.buildFtpTree(self.ftpRoot, self.genomes, fileSize = 4096)
+        for (dirpath, dirnames, filenames) in os.walk(self.ftpRoot) :
+            for x in filenames :
+                os.utime(os.path.join(dirpath, x), (1000000000, 1000000000))
+        self.server = mockServers.startFtpServer(self.ftpRoot)
+        self._listCollection = pyensemblFtp.listCollection
+        pyensemblFtp.listCollection = self.listCollection
+
+    def tearDown(self) :
+        pyensemblFtp.listCollection = self._listCollection
+        self.server.close_all()
+        shutil.rmtree(self.folder)
+
+    def listCollection(self, ftp, path) :
+        """Recursive listing of a collection as LIST -R gives it (pyftpdlib
+        ignores -R): sizes without modification times"""
+        base = os.path.join(self.ftpRoot, path)
+        o = dict()
+        for (dirpath, dirnames, filenames) in os.walk(base) :
+            if dirpath != base :
+                o[os.path.relpath(dirpath, base)] = [
+                    pyensemblFtp.FTPEntry(x, os.path.getsize(os.path.join(dirpath, x)), None)
+                    for x in filenames]
+        return o
+
+    def download(self, **kwargs) :
+        failures = pyensemblFtp.downloadGenomes(self.genomes, self.outDir,
+                                                host = self.server.host,
+                                                stderr = io.StringIO(), **kwargs)
+        self.assertEqual(failures, [])
+
+    def remotePath(self, name) :
+        d = pyensemblFtp.genomeFtpDir(self.genomes[0])
+        return os.path.join(self.ftpRoot, d, name)
+
+    def test_sameSizeUpdate(self) :
+        self.download(verify = False)
+        name = sorted(os.listdir(self.outDir))[0]
+        local = os.path.join(self.outDir, name)
+        remote = self.remotePath(name)
+        # The recursive listing gives no modification time, that of the server
+        # is kept anyway
+        self.assertEqual(int(os.path.getmtime(local)), int(os.path.getmtime(remote)))
+        # Same size, new content and modification time on the server
+        with open(remote, "rb") as fi :
+            content = fi.read()
+        with open(remote, "wb") as fo :
+            fo.write(content[::-1])
+        os.utime(remote, (os.path.getatime(remote), os.path.getmtime(remote) + 3600))
+        before = dict((x, os.path.getmtime(os.path.join(self.outDir, x)))
+                      for x in os.listdir(self.outDir))
+        self.download(verify = False)
+        with open(local, "rb") as fi :
+            self.assertEqual(fi.read(), content[::-1])
+        # The other files are left alone
+        for (x, mtime) in before.items() :
+            if x != name :
+                self.assertEqual(os.path.getmtime(os.path.join(self.outDir, x)), mtime)
+
+@unittest.skipIf(pyftpdlib is None, "pyftpdlib is not installed")
+class TestSegmented(unittest.TestCase) :
+
+    def setUp(self) :
+        self.folder = tempfile.mkdtemp()
+        self.ftpRoot = os.path.join(self.folder, "ftp")
+        self.outDir = os.path.join(self.folder, "download")
+        os.makedirs(self.outDir)
+        self.genome = mockServers.syntheticCatalogue(1)[0][1]
+        mockServers.buildFtpTree(self.ftpRoot, [self.genome], fileSize = 4096,
+                                 filesPerGenome = 1)
+        d = os.path.join(self.ftpRoot, pyensemblFtp.genomeFtpDir(self.genome))
+        self.name = max(os.listdir(d), key = lambda x : os.path.getsize(os.path.join(d, x)))
+        self.remote = os.path.join(d, self.name)
+        os.utime(self.remote, (1000000000, 1000000000))
+        with open(self.remote, "rb") as fi :
+            self.content = fi.read()
+        self.server = mockServers.startFtpServer(self.ftpRoot)
+        self.pool = pyensemblFtp.FTPConnectionPool(self.server.host, maxConnections = 4)
+
+    def tearDown(self) :
+        self.pool.close()
+        self.server.close_all()
+        shutil.rmtree(self.folder)
+
+    def task(self) :
+        entry = pyensemblFtp.FTPEntry(self.name, len(self.content), 1000000000.0)
+        return pyensemblFtp.genomeTasks(self.genome, [entry], self.outDir,
+                                        pyensemblFtp.FTP_ROOT)[0]
+
+    def writeState(self, size, modify, positions) :
+        """Write a partial file filled with X and its state file"""
+        task = self.task()
+        partFile = task.localPath + pyensemblFtp.PART_SUFFIX
+        with open(partFile, "wb") as fo :
+            fo.write(b"X" * len(self.content))
+        with open(partFile + pyensemblFtp.SEGMENTS_SUFFIX, "w") as fo :
+            json.dump({"size" : size, "modify" : modify,
+                       "ranges" : pyensembl.splitRanges(size, 4),
+                       "positions" : positions}, fo)
+        return task
+
+    def retrieve(self, task) :
+        pyensemblFtp.retrieveSegmented(self.pool, task, segments = 4)
+        self.assertEqual(os.listdir(self.outDir), [self.name])
+        self.assertEqual(os.path.getmtime(task.localPath), 1000000000)
+        with open(task.localPath, "rb") as fi :
+            return fi.read()
+
+    def test_retrieveRange(self) :
+        path = os.path.join(self.folder, "range")
+        pyensembl.preallocate(path, len(self.content))
+        fd = os.open(path, os.O_WRONLY)
+        received = []
+        try :
+            with self.pool.connection() as ftp :
+                # The connection is still usable after an interrupted transfer
+                for (start, end) in [(1000, 2000), (0, 10), (4000, 4096)] :
+                    pyensemblFtp.retrieveRange(ftp, self.task().remotePath, fd, start, end,
+                                               received.append)
+                with self.assertRaises(EOFError) :
+                    pyensemblFtp.retrieveRange(ftp, self.task().remotePath, fd, 4090, 5000)
+        finally :
+            os.close(fd)
+        with open(path, "rb") as fi :
+            content = fi.read()
+        self.assertEqual(sum(received), 1000 + 10 + 96)
+        for (start, end) in [(1000, 2000), (0, 10), (4000, 4096)] :
+            self.assertEqual(content[start:end], self.content[start:end])
+
+    def test_segments(self) :
+        self.assertEqual(pyensembl.splitRanges(4096, 4),
+                         [(0, 1024), (1024, 2048), (2048, 3072), (3072, 4096)])
+        self.assertEqual(pyensembl.splitRanges(3, 4), [(0, 1), (1, 2), (2, 3)])
+        self.assertEqual(self.retrieve(self.task()), self.content)
+
+    def test_resume(self) :
+        # The first range is complete and the second one started: the bytes
+        # received before are kept
+        ranges = pyensembl.splitRanges(len(self.content), 4)
+        task = self.writeState(len(self.content), 1000000000.0,
+                               [ranges[0][1], ranges[1][0] + 10, ranges[2][0], ranges[3][0]])
+        content = self.retrieve(task)
+        self.assertEqual(content[:ranges[1][0] + 10], b"X" * (ranges[1][0] + 10))
+        self.assertEqual(content[ranges[1][0] + 10:], self.content[ranges[1][0] + 10:])
+
+    def test_changedFile(self) :
+        # State files of a previous version of the file are ignored
+        for (size, modify) in [(len(self.content), 999999999.0),
+                               (len(self.content) + 1, 1000000000.0)] :
+            ranges = pyensembl.splitRanges(size, 4)
+            task = self.writeState(size, modify, [x[1] for x in ranges])
+            self.assertEqual(self.retrieve(task), self.content)
+
+class TestHttpDownloader(unittest.TestCase) :
+
+    def setUp(self) :
+        self.folder = tempfile.mkdtemp()
+        self.content = bytes(random.Random(1).getrandbits(8) for _ in range(100000))
+        with open(os.path.join(self.folder, "record.dat.gz"), "wb") as fo :
+            fo.write(self.content)
+        self.server = mockServers.startFileServer(self.folder)
+        self.outFile = os.path.join(self.folder, "out.dat.gz")
+
+    def tearDown(self) :
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.folder)
+
+    def download(self, segmentThreshold) :
+        downloader = pyensembl.HttpDownloader(maxJobs = 1, retries = 0, segments = 4,
+                                              segmentThreshold = segmentThreshold)
+        try :
+            status = downloader.download(self.server.url + "/record.dat.gz", self.outFile)
+        finally :
+            downloader.session.close()
+        self.assertEqual(status, 200)
+        self.assertFalse(os.path.exists(self.outFile + ".part"))
+        with open(self.outFile, "rb") as fi :
+            self.assertEqual(fi.read(), self.content)
+
+    def test_segments(self) :
+        self.download(1000)
+        # The plain request and the requests of the three other ranges
+        self.assertEqual(self.server.stats.requests, 4)
+        self.assertEqual(self.server.stats.bytes, len(self.content) +
+                         len(self.content) * 3 // 4)
+
+    def test_smallFile(self) :
+        self.download(len(self.content) + 1)
+        self.assertEqual(self.server.stats.requests, 1)
+
+if __name__ == "__main__" :
+    unittest.main()
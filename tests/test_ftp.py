@@ -0,0 +1,116 @@
+### * Description
+
+# Tests of the FTP downloads (pyensemblFtp)
+
+### * Setup
+
+### ** Import
+
+import os
+import sys
+import ftplib
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import pyensemblFtp
+
+### * Classes
+
+### ** DummyPool
+
+class DummyPool(pyensemblFtp.FTPConnectionPool) :
+    """Pool handing out dummy connections and counting the connections"""
+
+    def __init__(self) :
+        pyensemblFtp.FTPConnectionPool.__init__(self, retries = 2)
+        self.connections = 0
+
+    def _connect(self) :
+        self.connections += 1
+        return object()
+
+### * Tests
+
+class TestConnectionPool(unittest.TestCase) :
+
+    def setUp(self) :
+        self.sleeps = []
+        self._sleep = pyensemblFtp.time.sleep
+        pyensemblFtp.time.sleep = self.sleeps.append
+
+    def tearDown(self) :
+        pyensemblFtp.time.sleep = self._sleep
+
+    def failing(self, errors) :
+        """Function raising the given errors, then returning True"""
+        errors = list(errors)
+        def function(ftp) :
+            if len(errors) > 0 :
+                raise errors.pop(0)
+            return True
+        return function
+
+    def test_permanentError(self) :
+        pool = DummyPool()
+        with self.assertRaises(ftplib.error_perm) :
+            pool.run(self.failing([ftplib.error_perm("550 No such file")]))
+        self.assertEqual(pool.connections, 1)
+        self.assertEqual(self.sleeps, [])
+
+    def test_localError(self) :
+        pool = DummyPool()
+        with self.assertRaises(PermissionError) :
+            pool.run(self.failing([PermissionError("Permission denied")]))
+        self.assertEqual(self.sleeps, [])
+
+    def test_transientErrors(self) :
+        pool = DummyPool()
+        errors = [ftplib.error_temp("421 Too many connections"),
+                  ConnectionResetError("Connection reset")]
+        self.assertTrue(pool.run(self.failing(errors)))
+        self.assertEqual(pool.connections, 3)
+        self.assertEqual(self.sleeps, [1, 2])
+
+    def test_retriesExhausted(self) :
+        pool = DummyPool()
+        with self.assertRaises(EOFError) :
+            pool.run(self.failing([EOFError()] * 3))
+        self.assertEqual(len(self.sleeps), 2)
+
+class TestBsdSum(unittest.TestCase) :
+
+    # Output of "sum -r" on the files written in setUp()
+    EXPECTED = {"known.bin" : (35834, 11), "empty.bin" : (0, 0)}
+
+    def setUp(self) :
+        self.folder = tempfile.mkdtemp()
+        with open(os.path.join(self.folder, "known.bin"), "wb") as fo :
+            fo.write(bytes(range(256)) * 40 + b"pyensembl\n" * 3)
+        open(os.path.join(self.folder, "empty.bin"), "wb").close()
+        self._program = pyensemblFtp.SUM_PROGRAM
+
+    def tearDown(self) :
+        pyensemblFtp.SUM_PROGRAM = self._program
+        shutil.rmtree(self.folder)
+
+    def check(self, function) :
+        for (name, expected) in self.EXPECTED.items() :
+            self.assertEqual(function(os.path.join(self.folder, name)), expected)
+
+    def test_python(self) :
+        self.check(pyensemblFtp.pythonBsdSum)
+
+    def test_program(self) :
+        if shutil.which(pyensemblFtp.SUM_PROGRAM) is None :
+            self.skipTest("%s is not available" % pyensemblFtp.SUM_PROGRAM)
+        self.check(pyensemblFtp.programBsdSum)
+
+    def test_missingProgram(self) :
+        pyensemblFtp.SUM_PROGRAM = "pyensembl-no-such-sum"
+        self.assertIsNone(pyensemblFtp.programBsdSum(os.path.join(self.folder, "known.bin")))
+        self.check(pyensemblFtp.bsdSum)
+
+if __name__ == "__main__" :
+    unittest.main()
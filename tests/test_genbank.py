@@ -0,0 +1,70 @@
+### * Description
+
+# Tests of the derivatives of GenBank files (pyensemblGenbank)
+
+### * Setup
+
+### ** Import
+
+import os
+import sys
+import gzip
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import pyensemblGenbank
+
+### ** Parameters
+
+# Coding sequence starting with an alternative start codon (TTG, translated
+# as M for a complete CDS and as L for a partial one)
+CODING = "TTGAAATAA"
+
+### * Functions
+
+### ** writeGenbank(path, location, seq)
+
+def writeGenbank(path, location, seq) :
+    """Write a compressed GenBank record with one CDS without /translation"""
+    with gzip.open(path, "wt") as fo :
+        fo.write("LOCUS       TEST                       %i bp    DNA\n" % len(seq))
+        fo.write("ACCESSION   TEST\n")
+        fo.write("FEATURES             Location/Qualifiers\n")
+        fo.write("     CDS             %s\n" % location)
+        fo.write("                     /protein_id=\"P1\"\n")
+        fo.write("ORIGIN\n")
+        fo.write("        1 %s\n" % seq.lower())
+        fo.write("//\n")
+
+### * Tests
+
+class TestTranslate(unittest.TestCase) :
+
+    def setUp(self) :
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self) :
+        shutil.rmtree(self.folder)
+
+    def protein(self, location, seq) :
+        path = os.path.join(self.folder, "test.dat.gz")
+        writeGenbank(path, location, seq)
+        pyensemblGenbank.processFile(path, ["proteins"])
+        with open(pyensemblGenbank.derivativePaths(path, ["proteins"])["proteins"]) as fi :
+            return fi.read().split("\n")[1]
+
+    def test_forward(self) :
+        self.assertEqual(self.protein("1..9", CODING), "MK")
+        self.assertEqual(self.protein("<1..9", CODING), "LK")
+        self.assertEqual(self.protein("1..>9", CODING), "MK")
+
+    def test_reverse(self) :
+        seq = pyensemblGenbank.reverseComplement(CODING)
+        self.assertEqual(self.protein("complement(1..9)", seq), "MK")
+        self.assertEqual(self.protein("complement(1..>9)", seq), "LK")
+        self.assertEqual(self.protein("complement(<1..9)", seq), "MK")
+
+if __name__ == "__main__" :
+    unittest.main()
@@ -0,0 +1,50 @@
+### * Description
+
+# Tests of the parsing of the Ensembl FTP index page (pyensembl.parseHtmlToAccNum)
+
+### * Setup
+
+### ** Import
+
+import io
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import pyensembl
+
+### ** Parameters
+
+# Rows with an EMBL link, without EMBL link and without DNA link
+ROWS = ['<tr>\n<td><i>Serratia sp. A</i></td><td><a href="ftp://dna/a">FASTA</a></td>'
+        '<td>-</td><td>-</td>'
+        '<td><a href="http://www.ebi.ac.uk/ena/data/view/ACC1&amp;display=html">EMBL</a></td>'
+        '<td>-</td><td>-</td><td>-</td><td>-</td>\n</tr>',
+        '<tr>\n<td>Serratia sp. B</td><td><a href="ftp://dna/b">FASTA</a></td>'
+        + '<td>-</td>' * 7 + '\n</tr>',
+        '<tr>\n<td><i class=" x  y ">Serratia sp. C</i> &amp; co</td>'
+        '<td>-<br>none<br/></td><td>-</td><td>-</td><td>-</td>'
+        "<td title='say \"hi\"' data-x>-</td><td><!-- gff --><b>-</td><td>-</td><td>-</td>\n</tr>"]
+
+### * Tests
+
+class TestIndexPage(unittest.TestCase) :
+
+    def test_warnings(self) :
+        page = "<html><table>\n<tr><th>Species</th></tr>\n%s\n</table></html>" % "\n".join(ROWS)
+        stderr = io.StringIO()
+        mapping = pyensembl.parseHtmlToAccNum(page, stderr = stderr)
+        self.assertEqual(mapping, {"Serratia sp. A" : "ACC1"})
+        # The row is written as BeautifulSoup wrote it
+        self.assertEqual(stderr.getvalue().split("\n", 1)[1],
+                         "No EMBL entry for species Serratia sp. C & co (row <tr>\n"
+                         '<td><i class="x y">Serratia sp. C</i> &amp; co</td>'
+                         "<td>-<br/>none<br/></td><td>-</td><td>-</td><td>-</td>"
+                         '<td data-x="" title=\'say "hi"\'>-</td>'
+                         "<td><!-- gff --><b>-</b></td><td>-</td><td>-</td>\n</tr>)\n")
+        self.assertEqual(stderr.getvalue().split("\n", 1)[0],
+                         "No EMBL entry for species Serratia sp. B (DNA link: ftp://dna/b)")
+
+if __name__ == "__main__" :
+    unittest.main()
@@ -0,0 +1,194 @@
+### * Description
+
+# Tests of the journal of the downloads (pyensemblJournal) and of the resumed
+# downloads (pyensemblFtp.downloadGenomes with resume = True), the latter
+# against the mock FTP server of the benchmarks (skipped if pyftpdlib is not
+# installed)
+
+### * Setup
+
+### ** Import
+
+import io
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TESTS_DIR, ".."))
+sys.path.insert(0, os.path.join(TESTS_DIR, "..", "benchmarks"))
+import pyensemblFtp
+import pyensemblJournal
+import mockServers
+
+try :
+    import pyftpdlib
+except ImportError :
+    pyftpdlib = None
+
+### * Functions
+
+### ** makeTask(folder, name, content, checksum, modify)
+
+def makeTask(folder, name, content = b"content", checksum = (1234, 1), modify = 1000.0) :
+    """Write a downloaded file with its modification time and return its task"""
+    path = os.path.join(folder, name)
+    with open(path, "wb") as fo :
+        fo.write(content)
+    if modify is not None :
+        os.utime(path, (modify, modify))
+    return pyensemblFtp.FTPTask("serratia_sp", "genbank/serratia_sp/" + name, path,
+                                checksum, len(content), modify, "32",
+                                "bacteria_0_collection", "genbank")
+
+### * Tests
+
+class TestJournal(unittest.TestCase) :
+
+    def setUp(self) :
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, pyensemblJournal.JOURNAL_FILE)
+        self.journal = pyensemblJournal.DownloadJournal(self.path)
+
+    def tearDown(self) :
+        self.journal.close()
+        shutil.rmtree(self.folder)
+
+    def test_entries(self) :
+        self.assertIsNone(self.journal.settings())
+        self.journal.reset({"formats" : ["genbank"], "plasmids" : False})
+        tasks = [makeTask(self.folder, "a.dat.gz"),
+                 makeTask(self.folder, "b.dat.gz", checksum = None, modify = None)]
+        self.journal.plan("genbank/a", tasks)
+        self.journal.plan("genbank/b", [])
+        self.journal.setState(tasks[0], "running")
+        self.journal.setState(tasks[0], "failed", IOError("connection lost"))
+        self.journal.setState(tasks[0], "running")
+        self.journal.setState(tasks[1], "done")
+        # The journal is read back after the process stopped
+        self.journal.close()
+        self.journal = pyensemblJournal.DownloadJournal(self.path)
+        self.assertEqual(self.journal.settings(), {"formats" : ["genbank"],
+                                                   "plasmids" : False})
+        self.assertEqual(self.journal.planned(),
+                         {"genbank/a" : [(tasks[0], "running"), (tasks[1], "done")],
+                          "genbank/b" : []})
+        self.assertEqual(self.journal.counts(), {"running" : 1, "done" : 1})
+        (attempts, error) = self.journal._db.execute(
+            "SELECT attempts, error FROM tasks WHERE localPath = ?",
+            (tasks[0].localPath, )).fetchone()
+        self.assertEqual((attempts, error), (2, None))
+        # A new download starts from an empty journal
+        self.journal.reset({"formats" : ["dna"]})
+        self.assertEqual(self.journal.planned(), {})
+        self.assertEqual(self.journal.settings(), {"formats" : ["dna"]})
+
+    def test_resumeTasks(self) :
+        genome = {"species" : "serratia_sp", "dbname" : "bacteria_0_collection_core_32_1"}
+        key = pyensemblFtp.genomeDirKey(genome)
+        tasks = dict((x, makeTask(self.folder, x + ".dat.gz"))
+                     for x in ["done", "received", "running", "planned", "size", "modify"])
+        # The local files of these two differ from the listing recorded in
+        # the journal (the files changed on the server or were modified
+        # locally): they are transferred again
+        with open(tasks["size"].localPath, "ab") as fo :
+            fo.write(b"more content")
+        os.utime(tasks["size"].localPath, (1000.0, 1000.0))
+        os.utime(tasks["modify"].localPath, (2000.0, 2000.0))
+        os.remove(tasks["planned"].localPath)
+        planned = {key : [(tasks[x], "done" if x in ["size", "modify"] else x)
+                          for x in sorted(tasks)]}
+        other = {"species" : "serratia_sp2", "dbname" : "bacteria_0_collection_core_32_1"}
+        (unplanned, todo, done, unverified) = pyensemblFtp.resumeTasks(
+            [genome, other], [pyensemblFtp.GENBANK], planned)
+        self.assertEqual(unplanned, [(other, pyensemblFtp.GENBANK)])
+        self.assertEqual(sorted(todo), sorted([tasks["planned"], tasks["size"],
+                                               tasks["modify"]]))
+        self.assertEqual(sorted(done), sorted([tasks["done"], tasks["running"]]))
+        self.assertEqual(unverified, [tasks["received"]])
+        # Without skipCurrent, unfinished tasks are transferred again
+        (unplanned, todo, done, unverified) = pyensemblFtp.resumeTasks(
+            [genome], [pyensemblFtp.GENBANK], planned, skipCurrent = False)
+        self.assertEqual(done, [tasks["done"]])
+        self.assertIn(tasks["running"], todo)
+
+@unittest.skipIf(pyftpdlib is None, "pyftpdlib is not installed")
+class TestResume(unittest.TestCase) :
+
+    def setUp(self) :
+        self.folder = tempfile.mkdtemp()
+        self.ftpRoot = os.path.join(self.folder, "ftp")
+        self.outDir = os.path.join(self.folder, "download")
+        os.makedirs(self.outDir)
+        self.genomes = [x[1] for x in mockServers.syntheticCatalogue(2)]
+        mockServers.buildFtpTree(self.ftpRoot, self.genomes, fileSize = 4096)
+        for (dirpath, dirnames, filenames) in os.walk(self.ftpRoot) :
+            for x in filenames :
+                os.utime(os.path.join(dirpath, x), (1000000000, 1000000000))
+        self.server = mockServers.startFtpServer(self.ftpRoot)
+        self.listed = []
+        self._listCollection = pyensemblFtp.listCollection
+        pyensemblFtp.listCollection = self.listCollection
+        self.journal = pyensemblJournal.DownloadJournal(os.path.join(
+            self.outDir, pyensemblJournal.JOURNAL_FILE))
+
+    def tearDown(self) :
+        self.journal.close()
+        pyensemblFtp.listCollection = self._listCollection
+        self.server.close_all()
+        shutil.rmtree(self.folder)
+
+    def listCollection(self, ftp, path) :
+        """Recursive listing of a collection, as in test_download"""
+        self.listed.append(path)
+        base = os.path.join(self.ftpRoot, path)
+        o = dict()
+        for (dirpath, dirnames, filenames) in os.walk(base) :
+            if dirpath != base :
+                o[os.path.relpath(dirpath, base)] = [
+                    pyensemblFtp.FTPEntry(x, os.path.getsize(os.path.join(dirpath, x)), None)
+                    for x in filenames]
+        return o
+
+    def download(self, **kwargs) :
+        failures = pyensemblFtp.downloadGenomes(self.genomes, self.outDir,
+                                                host = self.server.host,
+                                                journal = self.journal,
+                                                stderr = io.StringIO(), **kwargs)
+        self.assertEqual(failures, [])
+
+    def localFiles(self) :
+        return dict((x, os.path.getmtime(os.path.join(self.outDir, x)))
+                    for x in os.listdir(self.outDir)
+                    if x != pyensemblJournal.JOURNAL_FILE and
+                    not x.startswith(pyensemblJournal.JOURNAL_FILE))
+
+    def test_resume(self) :
+        self.download()
+        self.assertEqual(list(self.journal.counts()), ["done"])
+        # Interrupted during the transfer of a file
+        (task, state) = list(self.journal.planned().values())[0][0]
+        self.journal.setState(task, "running")
+        os.remove(task.localPath)
+        before = self.localFiles()
+        del self.listed[:]
+        self.download(resume = True)
+        # The genome directories are not listed again
+        self.assertEqual(self.listed, [])
+        after = self.localFiles()
+        self.assertEqual(sorted(after), sorted(list(before) + [os.path.basename(task.localPath)]))
+        for (x, mtime) in before.items() :
+            self.assertEqual(after[x], mtime)
+        self.assertEqual(list(self.journal.counts()), ["done"])
+
+    def test_otherSettings(self) :
+        self.download()
+        del self.listed[:]
+        # The journal of a download with other settings is not used
+        self.download(resume = True, plasmids = True)
+        self.assertNotEqual(self.listed, [])
+
+if __name__ == "__main__" :
+    unittest.main()
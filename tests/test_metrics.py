@@ -0,0 +1,160 @@
+### * Description
+
+# Tests of the instrumentation (pyensemblMetrics)
+
+### * Setup
+
+### ** Import
+
+import io
+import os
+import sys
+import json
+import shutil
+import pstats
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import pyensemblMetrics
+
+### * Classes
+
+### ** RecordingSink
+
+class RecordingSink(object) :
+    """Sink keeping the records it receives"""
+
+    def __init__(self) :
+        self.records = []
+        self.closed = None
+
+    def event(self, record) :
+        self.records.append(dict(record))
+
+    def close(self, metrics) :
+        self.closed = metrics
+
+### * Functions
+
+@pyensemblMetrics.timed("test_call_seconds", {"kind" : "timed"})
+def timedFunction(x) :
+    """Double a number, or fail for negative ones"""
+    if x < 0 :
+        raise ValueError(x)
+    return 2 * x
+
+@pyensemblMetrics.profiled
+def profiledFunction(x) :
+    """Sum of a range, calling itself once to test nested profiling"""
+    if x < 0 :
+        raise ValueError(x)
+    if x > 10 :
+        return profiledFunction(10) + x
+    return sum(range(x))
+
+### * Tests
+
+class TestMetrics(unittest.TestCase) :
+
+    def setUp(self) :
+        self.folder = tempfile.mkdtemp()
+        self.sink = RecordingSink()
+        self.previous = pyensemblMetrics.getMetrics()
+        self.metrics = pyensemblMetrics.Metrics([self.sink])
+        pyensemblMetrics.setMetrics(self.metrics)
+
+    def tearDown(self) :
+        pyensemblMetrics.setMetrics(self.previous)
+        shutil.rmtree(self.folder)
+
+    def records(self, type) :
+        return [dict((k, v) for (k, v) in x.items() if k != "ts")
+                for x in self.sink.records if x["type"] == type]
+
+    def test_counters(self) :
+        pyensemblMetrics.increment("files_total")
+        pyensemblMetrics.increment("files_total", 2)
+        pyensemblMetrics.increment("files_total", labels = {"ok" : True})
+        self.assertEqual(self.metrics.counters, {("files_total", ()) : 3,
+                                                 ("files_total", (("ok", "True"), )) : 1})
+        self.assertEqual(self.records("counter")[-1],
+                         {"type" : "counter", "name" : "files_total", "value" : 1,
+                          "labels" : {"ok" : True}})
+        self.assertTrue(all("ts" in x for x in self.sink.records))
+
+    def test_histograms(self) :
+        for value in [0.001, 0.2, 0.3, 100] :
+            pyensemblMetrics.observe("load_seconds", value)
+        pyensemblMetrics.observe("rate", 2e5, buckets = pyensemblMetrics.RATE_BUCKETS)
+        h = self.metrics.histograms[("load_seconds", ())]
+        self.assertEqual((h.count, h.min, h.max), (4, 0.001, 100))
+        self.assertAlmostEqual(h.sum, 100.501)
+        self.assertEqual(dict(h.cumulative())[0.25], 2)
+        self.assertEqual(dict(h.cumulative())[1800], 4)
+        self.assertEqual(h.quantile(0.5), 0.25)
+        self.assertEqual(h.quantile(1), 100)
+        self.assertEqual(self.metrics.histograms[("rate", ())].buckets,
+                         pyensemblMetrics.RATE_BUCKETS)
+        self.assertEqual(len(self.records("histogram")), 5)
+
+    def test_events(self) :
+        pyensemblMetrics.event("ftp_file", path = "a.dat.gz", bytes = 10)
+        self.assertEqual(self.records("event"), [{"type" : "event", "name" : "ftp_file",
+                                                  "path" : "a.dat.gz", "bytes" : 10}])
+        self.assertEqual(self.metrics.counters, {})
+
+    def test_timed(self) :
+        self.assertEqual(timedFunction(2), 4)
+        with self.assertRaises(ValueError) :
+            timedFunction(-1)
+        self.assertEqual(timedFunction.__name__, "timedFunction")
+        # Calls which raise are timed too
+        h = self.metrics.histograms[("test_call_seconds", (("kind", "timed"), ))]
+        self.assertEqual(h.count, 2)
+        with pyensemblMetrics.timer("block_seconds") :
+            pass
+        self.assertEqual(self.metrics.histograms[("block_seconds", ())].count, 1)
+
+    def test_profiled(self) :
+        # Without profiling, the function is only called
+        self.assertEqual(profiledFunction(5), 10)
+        self.assertIsNone(self.metrics.profile)
+        path = os.path.join(self.folder, "profile.pstats")
+        self.metrics.enableProfiling(path)
+        self.assertEqual(profiledFunction(20), 65)
+        with self.assertRaises(ValueError) :
+            profiledFunction(-1)
+        self.assertEqual(profiledFunction.__name__, "profiledFunction")
+        # One profile for each outermost call
+        self.assertEqual(len(self.metrics.profile), 2)
+        self.metrics.close()
+        functions = [x[2] for x in pstats.Stats(path).stats]
+        self.assertIn("profiledFunction", functions)
+
+    def test_sinks(self) :
+        log = os.path.join(self.folder, "metrics.jsonl")
+        prom = os.path.join(self.folder, "metrics.prom")
+        summary = io.StringIO()
+        for sink in [pyensemblMetrics.JsonLinesSink(log), pyensemblMetrics.PrometheusSink(prom),
+                     pyensemblMetrics.SummarySink(summary)] :
+            self.metrics.addSink(sink)
+        pyensemblMetrics.increment("requests_total", labels = {"status" : "200"})
+        pyensemblMetrics.observe("request_seconds", 0.2)
+        pyensemblMetrics.event("done")
+        self.metrics.close()
+        self.assertIs(self.sink.closed, self.metrics)
+        with open(log) as fi :
+            records = [json.loads(x) for x in fi]
+        self.assertEqual([x["type"] for x in records], ["counter", "histogram", "event", "end"])
+        with open(prom) as fi :
+            lines = fi.read().split("\n")
+        self.assertIn('pyensembl_requests_total{status="200"} 1', lines)
+        self.assertIn('pyensembl_request_seconds_bucket{le="0.25"} 1', lines)
+        self.assertIn('pyensembl_request_seconds_bucket{le="+Inf"} 1', lines)
+        self.assertIn("pyensembl_request_seconds_count 1", lines)
+        self.assertIn('requests_total{status="200"}', summary.getvalue())
+        self.assertIn("request_seconds", summary.getvalue())
+
+if __name__ == "__main__" :
+    unittest.main()
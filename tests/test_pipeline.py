@@ -0,0 +1,61 @@
+### * Description
+
+# Tests of the genome retrieval pipeline (pyensemblPipeline)
+
+### * Setup
+
+### ** Import
+
+import io
+import os
+import sys
+import asyncio
+import itertools
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import pyensemblFtp
+import pyensemblPipeline
+
+### * Classes
+
+### ** StuckPipeline
+
+class StuckPipeline(pyensemblPipeline.Pipeline) :
+    """Pipeline whose listers never take a genome, so that the reader thread
+    waits for room in the queue"""
+
+    async def lister(self, loop, threads, genomesQueue, tasksQueue) :
+        await asyncio.sleep(3600)
+
+### * Tests
+
+class TestPipeline(unittest.TestCase) :
+
+    def test_cancelWhileReaderWaits(self) :
+        genomes = ({"species" : "serratia_%i" % i} for i in itertools.count())
+        pipeline = StuckPipeline(genomes, ".", jobs = 1, listJobs = 1, maxConnections = 1,
+                                 host = "127.0.0.1:1", root = "", formats = [],
+                                 plasmids = False, verify = False, verifyJobs = 1,
+                                 listingCache = pyensemblFtp.FTPListingCache(None),
+                                 skipCurrent = True, store = None, derive = None,
+                                 deriveJobs = 1, segments = 1, segmentThreshold = 1,
+                                 table = None, queueSize = 2, stderr = io.StringIO())
+        errors = []
+        def run() :
+            try :
+                asyncio.run(asyncio.wait_for(pipeline.run(), 0.5))
+            except BaseException as e :
+                errors.append(e)
+        thread = threading.Thread(target = run, daemon = True)
+        thread.start()
+        thread.join(10)
+        self.assertFalse(thread.is_alive(), "the pipeline is deadlocked")
+        self.assertEqual([type(e) for e in errors], [asyncio.TimeoutError])
+        self.assertTrue(pipeline.stopping.is_set())
+        # The queue was filled before the reader waited
+        self.assertEqual(pipeline.nGenomes, 2)
+
+if __name__ == "__main__" :
+    unittest.main()
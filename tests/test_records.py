@@ -0,0 +1,69 @@
+### * Description
+
+# Tests of the species and genomes tables (pyensemblRecords)
+
+### * Setup
+
+### ** Import
+
+import io
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import pyensembl
+import pyensemblRecords
+
+### * Functions
+
+### ** makeGenome(name)
+
+def makeGenome(name) :
+    """Genome dict as returned by the REST API"""
+    genome = dict((f, "x") for f in pyensembl.GENOME_FIELDS)
+    genome.update({"species" : name, "species_id" : "1", "base_count" : "5000000",
+                   "taxonomy_id" : "613", "species_taxonomy_id" : "613",
+                   "is_reference" : "1", "has_pan_compara" : "0",
+                   "has_variations" : "0", "has_other_alignments" : "0",
+                   "has_peptide_compara" : "0", "has_genome_alignments" : "0"})
+    return genome
+
+### * Tests
+
+class TestRecords(unittest.TestCase) :
+
+    def readTable(self, text) :
+        return list(pyensemblRecords.readTable(io.StringIO(text),
+                                               pyensemblRecords.GenomeRecord))
+
+    def test_parseFlag(self) :
+        for (value, expected) in [("0", False), ("1", True), ("False", False),
+                                  ("True", True)] :
+            self.assertIs(pyensemblRecords.parseFlag(value), expected)
+
+    def test_roundTrip(self) :
+        fo = io.StringIO()
+        pyensemblRecords.writeTable([makeGenome("serratia_a")], fo,
+                                    pyensemblRecords.GenomeRecord)
+        first = self.readTable(fo.getvalue())
+        self.assertIs(first[0]["is_reference"], True)
+        self.assertIs(first[0]["has_variations"], False)
+        fo = io.StringIO()
+        pyensemblRecords.writeTable(first, fo, pyensemblRecords.GenomeRecord)
+        self.assertEqual(self.readTable(fo.getvalue()), first)
+        # Flags are written as in the REST API
+        self.assertEqual(fo.getvalue().split("\n")[1].split("\t")[2], "1")
+
+    def test_tupleAttributes(self) :
+        record = pyensemblRecords.GenomeRecord.fromDict(makeGenome("serratia_a"))
+        self.assertEqual(record.get("species"), "serratia_a")
+        for key in ["count", "index", "_fields", "asDict"] :
+            self.assertIsNone(record.get(key))
+            self.assertEqual(record.get(key, "default"), "default")
+            self.assertNotIn(key, record)
+            with self.assertRaises(KeyError) :
+                record[key]
+
+if __name__ == "__main__" :
+    unittest.main()
@@ -0,0 +1,146 @@
+### * Description
+
+# Tests of the pacing and caching of the REST client (pyensembl.RestClient)
+# and of the incremental parsing of its responses (pyensembl.iterJsonArray)
+
+### * Setup
+
+### ** Import
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+import http.server
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import pyensembl
+
+### * Classes
+
+### ** NotModifiedHandler
+
+class NotModifiedHandler(http.server.BaseHTTPRequestHandler) :
+    """Answers the first request with a 304 (even without validators), then
+    with a JSON body"""
+
+    requests = []
+
+    def log_message(self, *args) :
+        pass
+
+    def do_GET(self) :
+        self.requests.append(dict(self.headers))
+        if len(self.requests) == 1 :
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = json.dumps([{"species" : "serratia_sp"}]).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+### * Tests
+
+class TestTokenBucket(unittest.TestCase) :
+
+    def test_slowRate(self) :
+        bucket = pyensembl.TokenBucket(0.5)
+        start = time.time()
+        bucket.acquire()
+        self.assertLess(time.time() - start, 0.5)
+
+    def test_slowRateFromServer(self) :
+        bucket = pyensembl.TokenBucket(15)
+        bucket.setRate(0.2)
+        self.assertEqual(bucket.capacity, 1)
+        start = time.time()
+        bucket.acquire()
+        self.assertLess(time.time() - start, 0.5)
+
+class TestMap(unittest.TestCase) :
+
+    def test_boundedWindow(self) :
+        client = pyensembl.RestClient(server = "http://127.0.0.1:1")
+        pulled = []
+        def items() :
+            for i in range(100) :
+                pulled.append(i)
+                yield i
+        results = client.map(lambda x : x * 2, items(), jobs = 2)
+        self.assertEqual(next(results), 0)
+        # Only a window of 2 * jobs items was submitted
+        self.assertEqual(len(pulled), 4)
+        self.assertEqual(list(results), [2 * x for x in range(1, 100)])
+
+    def test_exception(self) :
+        client = pyensembl.RestClient(server = "http://127.0.0.1:1")
+        def function(x) :
+            if x == 5 :
+                raise KeyError(x)
+            return x
+        results = client.map(function, range(100), jobs = 2)
+        self.assertEqual([next(results) for _ in range(5)], list(range(5)))
+        with self.assertRaises(KeyError) :
+            next(results)
+
+class TestJsonArray(unittest.TestCase) :
+
+    def split(self, text, size) :
+        data = text.encode("utf-8")
+        return [data[i:i+size] for i in range(0, len(data), size)]
+
+    def test_chunkBoundaries(self) :
+        text = ('{"n" : 3, "species" : [1, 2.5, -3e2, true, null, "s\u00e9rratia",'
+                ' {"a" : [1, 22]}, 1.25E-3 ]}')
+        expected = json.loads(text)["species"]
+        for size in range(1, len(text) + 1) :
+            self.assertEqual(list(pyensembl.iterJsonArray(self.split(text, size),
+                                                          "species")), expected)
+
+    def test_numberCutAtDot(self) :
+        self.assertEqual(list(pyensembl.iterJsonArray([b'{"species":[1,2.', b'5]}'],
+                                                      "species")), [1, 2.5])
+
+    def test_truncated(self) :
+        with self.assertRaises(ValueError) :
+            list(pyensembl.iterJsonArray(self.split('{"species":[1,2.5', 1), "species"))
+
+class TestRestCache(unittest.TestCase) :
+
+    def setUp(self) :
+        self.folder = tempfile.mkdtemp()
+        NotModifiedHandler.requests = []
+        self.server = http.server.HTTPServer(("127.0.0.1", 0), NotModifiedHandler)
+        threading.Thread(target = self.server.serve_forever, daemon = True).start()
+        url = "http://127.0.0.1:%i" % self.server.server_address[1]
+        cache = pyensembl.RestCache(os.path.join(self.folder, "cache.sqlite"))
+        self.client = pyensembl.RestClient(server = url, cache = cache, retries = 0)
+
+    def tearDown(self) :
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.folder)
+
+    def test_get304WithoutEntry(self) :
+        self.assertEqual(self.client.get("/info/genomes/serratia_sp"),
+                         [{"species" : "serratia_sp"}])
+        self.assertEqual(len(NotModifiedHandler.requests), 2)
+        # The full response was cached
+        self.assertEqual(self.client.get("/info/genomes/serratia_sp"),
+                         [{"species" : "serratia_sp"}])
+        self.assertEqual(len(NotModifiedHandler.requests), 2)
+
+    def test_iterJson304WithoutEntry(self) :
+        self.assertEqual(list(self.client.iterJson("/info/genomes/serratia_sp")),
+                         [{"species" : "serratia_sp"}])
+        self.assertEqual(len(NotModifiedHandler.requests), 2)
+
+if __name__ == "__main__" :
+    unittest.main()
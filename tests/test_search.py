@@ -0,0 +1,58 @@
+### * Description
+
+# Randomized tests of the substring search structures (pyensembl.TrigramIndex
+# and pyensembl.AhoCorasick) against a naive substring search
+
+### * Setup
+
+### ** Import
+
+import os
+import sys
+import random
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import pyensembl
+
+### ** Parameters
+
+# A small alphabet, so that the random strings share many substrings
+ALPHABET = "abc _"
+ROUNDS = 200
+
+### * Functions
+
+### ** randomString(rng, maxLength)
+
+def randomString(rng, maxLength) :
+    return "".join(rng.choice(ALPHABET) for _ in range(rng.randint(0, maxLength)))
+
+### * Tests
+
+class TestSubstringSearch(unittest.TestCase) :
+
+    def test_trigramIndex(self) :
+        rng = random.Random(1)
+        for _ in range(ROUNDS) :
+            texts = [randomString(rng, 12) for _ in range(rng.randint(0, 30))]
+            index = pyensembl.TrigramIndex(texts)
+            for query in [randomString(rng, 6) for _ in range(20)] :
+                self.assertEqual(index.search(query),
+                                 [i for (i, text) in enumerate(texts) if query in text],
+                                 (texts, query))
+
+    def test_ahoCorasick(self) :
+        rng = random.Random(2)
+        for _ in range(ROUNDS) :
+            # Queries may repeat, be empty or be prefixes and suffixes of each
+            # other
+            queries = [randomString(rng, 5) for _ in range(rng.randint(1, 15))]
+            automaton = pyensembl.AhoCorasick(queries)
+            for text in [randomString(rng, 20) for _ in range(20)] :
+                self.assertEqual(automaton.findAll(text),
+                                 set(q for (q, query) in enumerate(queries) if query in text),
+                                 (queries, text))
+
+if __name__ == "__main__" :
+    unittest.main()
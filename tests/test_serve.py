@@ -0,0 +1,139 @@
+### * Description
+
+# Tests of the species daemon (pyensemblServe)
+
+### * Setup
+
+### ** Import
+
+import os
+import sys
+import gzip
+import shutil
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import pyensemblDb
+import pyensemblServe
+
+### * Functions
+
+### ** makeSpecies(name, accession, release)
+
+def makeSpecies(name, accession, release = 32) :
+    """Species dict as returned by the REST API"""
+    return {"name" : name, "display_name" : name.capitalize().replace("_", " "),
+            "aliases" : [], "accession" : accession, "assembly" : "ASM%sv1" % accession,
+            "release" : release, "division" : "EnsemblBacteria", "taxon_id" : 1,
+            "groups" : ["core"]}
+
+### ** writeSnapshot(folder, n, species)
+
+def writeSnapshot(folder, n, species) :
+    """Write a snapshot file of species and return its name"""
+    name = pyensemblDb.SNAPSHOT_PREFIX + "%i.gz" % n
+    with gzip.open(os.path.join(folder, name), "wt") as fo :
+        for x in pyensemblDb.writeSnapshot(species, fo) :
+            pass
+    return name
+
+### * Tests
+
+class TestSpeciesCatalogue(unittest.TestCase) :
+
+    def setUp(self) :
+        self.folder = tempfile.mkdtemp()
+        self.snapshot = writeSnapshot(self.folder, 1, [makeSpecies("serratia_a", "1"),
+                                                       makeSpecies("escherichia_b", "2")])
+        self.catalogue = pyensemblServe.SpeciesCatalogue(self.folder)
+        self.catalogue.load()
+
+    def tearDown(self) :
+        self.catalogue.close()
+        shutil.rmtree(self.folder)
+
+    def names(self, species) :
+        return [x["name"] if x is not None else None for x in species]
+
+    def test_search(self) :
+        response = self.catalogue.handle({"action" : "search", "query" : "serratia"})
+        self.assertEqual(response["snapshot"], self.snapshot)
+        self.assertEqual(self.names(response["species"]), ["serratia_a"])
+        response = self.catalogue.handle({"action" : "search", "query" : "SERR",
+                                          "prefix" : True})
+        self.assertEqual(self.names(response["species"]), ["serratia_a"])
+        response = self.catalogue.handle({"action" : "search", "query" : "a",
+                                          "release" : 33})
+        self.assertEqual(response["species"], [])
+        response = self.catalogue.handle({"action" : "searchBatch",
+                                          "queries" : ["serratia", "escherichia"]})
+        self.assertEqual([(q, x["name"]) for (q, x) in response["hits"]],
+                         [("serratia", "serratia_a"), ("escherichia", "escherichia_b")])
+
+    def test_lookup(self) :
+        response = self.catalogue.handle({"action" : "lookup",
+                                          "names" : ["escherichia_b", "unknown"]})
+        self.assertEqual(self.names(response["species"]), ["escherichia_b", None])
+        self.assertEqual(response["species"][0]["accession"], "2")
+
+    def test_reload(self) :
+        self.assertFalse(self.catalogue.reload())
+        # "pyensembl refresh" replaces the index file
+        snapshot = writeSnapshot(self.folder, 2, [])
+        index = pyensemblDb.SpeciesIndex(self.catalogue.indexPath)
+        index.build([makeSpecies("serratia_a", "1"), makeSpecies("escherichia_b", "2"),
+                     makeSpecies("serratia_c", "3", 33)], snapshot)
+        index.close()
+        self.assertTrue(self.catalogue.reload())
+        self.assertFalse(self.catalogue.reload())
+        response = self.catalogue.handle({"action" : "status"})
+        self.assertEqual((response["snapshot"], response["species"]), (snapshot, 3))
+        response = self.catalogue.handle({"action" : "search", "query" : "serratia"})
+        self.assertEqual(self.names(response["species"]), ["serratia_a", "serratia_c"])
+        # A reload request loads the index even if the file did not change
+        response = self.catalogue.handle({"action" : "reload"})
+        self.assertEqual(response, {"snapshot" : snapshot, "species" : 3})
+
+    def test_unknownAction(self) :
+        for request in [{"action" : "delete"}, {}] :
+            with self.assertRaises(pyensemblServe.ServeError) :
+                self.catalogue.handle(request)
+
+class TestSpeciesServer(unittest.TestCase) :
+
+    def setUp(self) :
+        self.folder = tempfile.mkdtemp()
+        writeSnapshot(self.folder, 1, [makeSpecies("serratia_a", "1")])
+        self.catalogue = pyensemblServe.SpeciesCatalogue(self.folder)
+        self.catalogue.load()
+        self.path = os.path.join(self.folder, "serve.sock")
+        self.server = pyensemblServe.SpeciesServer(self.catalogue, self.path)
+        self.thread = threading.Thread(target = self.server.run, daemon = True)
+        self.thread.start()
+
+    def tearDown(self) :
+        self.server.unixServer.shutdown()
+        self.thread.join(10)
+        self.server.close()
+        self.catalogue.close()
+        shutil.rmtree(self.folder)
+
+    def test_roundTrip(self) :
+        response = pyensemblServe.sendRequest(self.path, {"action" : "search",
+                                                          "query" : "serratia"})
+        self.assertTrue(response["ok"])
+        self.assertEqual([x["name"] for x in response["species"]], ["serratia_a"])
+        with self.assertRaises(pyensemblServe.ServeError) :
+            pyensemblServe.sendRequest(self.path, {"action" : "delete"})
+        with self.assertRaises(pyensemblServe.ServeError) :
+            pyensemblServe.sendRequest(self.path, {"action" : "search"})
+        self.assertIsNone(pyensemblServe.query({"action" : "delete"}, self.path))
+        self.assertEqual(pyensemblServe.query({"action" : "status"}, self.path)["requests"], 4)
+        # A second daemon does not take over the socket
+        with self.assertRaises(pyensemblServe.ServeError) :
+            pyensemblServe.SpeciesServer(self.catalogue, self.path)
+
+if __name__ == "__main__" :
+    unittest.main()
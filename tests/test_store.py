@@ -0,0 +1,114 @@
+### * Description
+
+# Tests of the genome store (pyensemblStore)
+
+### * Setup
+
+### ** Import
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import pyensemblFtp
+import pyensemblStore
+
+### * Functions
+
+### ** makeTask(folder, release, content, checksum, modify)
+
+def makeTask(folder, release, content, checksum = (1234, 1), modify = None) :
+    """Write a downloaded gff3 file of a given release and return its task"""
+    name = "Serratia_sp.ASM1v1.%s.gff3.gz" % release
+    path = os.path.join(folder, release, name)
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+    with open(path, "wb") as fo :
+        fo.write(content)
+    return pyensemblFtp.FTPTask("serratia_sp", "gff3/bacteria_0_collection/serratia_sp/" +
+                                name, path, checksum, len(content), modify, release,
+                                "bacteria_0_collection", "gff3")
+
+### * Tests
+
+class TestGenomeStore(unittest.TestCase) :
+
+    def setUp(self) :
+        self.folder = tempfile.mkdtemp()
+        self.store = pyensemblStore.GenomeStore(os.path.join(self.folder, "store"))
+
+    def tearDown(self) :
+        self.store.close()
+        shutil.rmtree(self.folder)
+
+    def test_releaseFreeName(self) :
+        self.assertEqual(pyensemblStore.releaseFreeName("gff3/X.ASM1v1.32.gff3.gz", "32"),
+                         "gff3/X.ASM1v1.gff3.gz")
+        self.assertEqual(pyensemblStore.releaseFreeName("genbank/X.chr32.dat.gz", "32"),
+                         "genbank/X.chr32.dat.gz")
+        self.assertEqual(pyensemblStore.releaseFreeName("genbank/X.dat.gz", "unknown"),
+                         "genbank/X.dat.gz")
+
+    def test_unchangedFileAcrossReleases(self) :
+        old = makeTask(self.folder, "32", b"unchanged content")
+        blob = self.store.add(old)
+        new = makeTask(self.folder, "33", b"unchanged content")
+        os.remove(new.localPath)
+        self.assertEqual(self.store.find(new), blob)
+        (todo, reused) = pyensemblFtp.takeFromStore(self.store, [new])
+        self.assertEqual((todo, reused), ([], [new]))
+        with open(new.localPath, "rb") as fi :
+            self.assertEqual(fi.read(), b"unchanged content")
+
+    def test_unchangedFileWithoutChecksum(self) :
+        old = makeTask(self.folder, "32", b"unchanged content", None, 1000.0)
+        blob = self.store.add(old)
+        new = makeTask(self.folder, "33", b"unchanged content", None, 1000.0)
+        self.assertEqual(self.store.find(new), blob)
+
+    def test_changedFile(self) :
+        self.store.add(makeTask(self.folder, "32", b"old content"))
+        new = makeTask(self.folder, "33", b"new content", (4321, 1))
+        self.assertIsNone(self.store.find(new))
+        other = makeTask(self.folder, "33", b"old content")
+        self.assertIsNone(self.store.find(other._replace(format = "embl")))
+        self.assertIsNone(self.store.find(other._replace(species = "serratia_sp2")))
+
+    def test_sharedBlobWithOtherTimes(self) :
+        old = makeTask(self.folder, "32", b"unchanged content", modify = 1000.0)
+        os.utime(old.localPath, (1000.0, 1000.0))
+        blob = self.store.add(old)
+        blobPath = self.store.blobPath(blob)
+        new = makeTask(self.folder, "33", b"unchanged content", modify = 2000.0)
+        os.remove(new.localPath)
+        self.store.materialize(new, blob)
+        again = makeTask(self.folder, "34", b"unchanged content", modify = 1000.0)
+        os.remove(again.localPath)
+        self.assertEqual(self.store.materialize(again, blob), "link")
+        # Each release keeps its own server time, the blob is not touched
+        for _ in range(2) :
+            self.store.materialize(new, blob)
+            self.store.materialize(again, blob)
+        self.assertEqual(os.path.getmtime(old.localPath), 1000.0)
+        self.assertEqual(os.path.getmtime(again.localPath), 1000.0)
+        self.assertEqual(os.path.getmtime(new.localPath), 2000.0)
+        self.assertEqual(os.path.getmtime(blobPath), 1000.0)
+        self.assertFalse(os.path.samefile(new.localPath, blobPath))
+        # Download files stay writable
+        for task in [old, new, again] :
+            self.assertTrue(os.access(task.localPath, os.W_OK))
+
+    def test_addWithOtherTime(self) :
+        old = makeTask(self.folder, "32", b"unchanged content", modify = 1000.0)
+        os.utime(old.localPath, (1000.0, 1000.0))
+        self.store.add(old)
+        new = makeTask(self.folder, "33", b"unchanged content", modify = 2000.0)
+        os.utime(new.localPath, (2000.0, 2000.0))
+        self.store.add(new)
+        self.assertEqual(os.path.getmtime(old.localPath), 1000.0)
+        self.assertEqual(os.path.getmtime(new.localPath), 2000.0)
+
+if __name__ == "__main__" :
+    unittest.main()
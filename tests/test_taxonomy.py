@@ -0,0 +1,83 @@
+### * Description
+
+# Tests of the local taxonomy index (pyensemblTaxonomy)
+
+### * Setup
+
+### ** Import
+
+import io
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import pyensemblDb
+import pyensemblTaxonomy
+
+### ** Parameters
+
+# Root, one genus and two species beneath it
+NODES = ("1\t|\t1\t|\tno rank\t|\n"
+         "613\t|\t1\t|\tgenus\t|\n"
+         "1001\t|\t613\t|\tspecies\t|\n"
+         "1002\t|\t613\t|\tspecies\t|\n")
+NAMES = ("1\t|\troot\t|\t\t|\tscientific name\t|\n"
+         "613\t|\tSerratia\t|\t\t|\tscientific name\t|\n"
+         "1001\t|\tSerratia sp. A\t|\t\t|\tscientific name\t|\n"
+         "1002\t|\tSerratia sp. B\t|\t\t|\tscientific name\t|\n")
+
+### * Functions
+
+### ** makeSpecies(name, taxid, release)
+
+def makeSpecies(name, taxid, release = 32) :
+    """Species dict as returned by the REST API"""
+    return {"name" : name, "display_name" : name, "aliases" : [],
+            "accession" : "GCA_%i.1" % taxid, "assembly" : "ASM%iv1" % taxid,
+            "release" : release, "division" : "EnsemblBacteria", "taxon_id" : str(taxid)}
+
+### * Tests
+
+class TestGenomes(unittest.TestCase) :
+
+    def setUp(self) :
+        self.folder = tempfile.mkdtemp()
+        self.index = pyensemblDb.SpeciesIndex(os.path.join(self.folder, "species.sqlite"))
+        self.index.build([makeSpecies("serratia_a", 1001), makeSpecies("serratia_b", 1002)],
+                         "snapshot.1.gz")
+        self.taxonomy = pyensemblTaxonomy.TaxonomyIndex(os.path.join(self.folder,
+                                                                     "taxonomy.sqlite"))
+        self.taxonomy.build(io.StringIO(NODES), io.StringIO(NAMES))
+        self.taxonomy.syncCatalogue(self.index)
+        self.node = self.taxonomy.resolve("Serratia")
+
+    def tearDown(self) :
+        self.taxonomy.close()
+        self.index.close()
+        shutil.rmtree(self.folder)
+
+    def test_recordGenomes(self) :
+        self.assertEqual(self.taxonomy.missingGenomes(self.node), ["serratia_a", "serratia_b"])
+        n = self.taxonomy.recordGenomes([{"species" : "serratia_b", "dbname" : "b_32"},
+                                         {"species" : "escherichia_c", "dbname" : "c_32"}])
+        self.assertEqual(n, 1)
+        self.assertEqual(self.taxonomy.missingGenomes(self.node), ["serratia_a"])
+        self.taxonomy.recordGenomes([{"species" : "serratia_a", "dbname" : "a_32"}])
+        self.assertEqual(self.taxonomy.missingGenomes(self.node), [])
+        self.assertEqual([x["dbname"] for x in self.taxonomy.genomes(self.node)],
+                         ["a_32", "b_32"])
+
+    def test_newRelease(self) :
+        self.taxonomy.recordGenomes([{"species" : "serratia_a", "dbname" : "a_32"},
+                                     {"species" : "serratia_b", "dbname" : "b_32"}])
+        self.index.build([makeSpecies("serratia_a", 1001), makeSpecies("serratia_b", 1002, 33)],
+                         "snapshot.2.gz")
+        self.taxonomy.syncCatalogue(self.index)
+        self.assertEqual(self.taxonomy.missingGenomes(self.node), ["serratia_b"])
+        self.assertEqual([x["dbname"] for x in self.taxonomy.genomes(self.node)], ["a_32"])
+
+if __name__ == "__main__" :
+    unittest.main()